@@ -0,0 +1,8 @@
+"""
+Benchmark scripts for pyjsgf.
+
+Run each benchmark as a module from the repository's root directory so that the
+``jsgf`` package can be imported, e.g.::
+
+    python -m benchmarks.chart_benchmark
+"""
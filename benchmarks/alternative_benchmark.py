@@ -0,0 +1,90 @@
+"""
+Benchmark for matching large alternative sets of literals and of alternatives
+that cannot match at the same position, such as sets of command words.
+
+Sets of literals are matched using tries. The pyparsing Or element previously
+used for all alternative sets is also timed for comparison, along with the time
+taken to create each element.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.alternative_benchmark
+"""
+
+import string
+
+import pyparsing
+
+from jsgf import AlternativeSet, Sequence
+
+from benchmarks.timing import best_time
+
+
+def make_alternative_set(alternatives, literals):
+    """
+    Make an alternative set with the given number of words starting with
+    different letters.
+
+    :param alternatives: int
+    :param literals: whether to use literals or sequences for the words
+    :returns: AlternativeSet
+    """
+    words = [make_word(i) for i in range(alternatives)]
+    if not literals:
+        words = [Sequence(word) for word in words]
+    return AlternativeSet(*words)
+
+
+def make_word(i):
+    """
+    Make the word for an alternative.
+
+    :param i: int
+    :returns: str
+    """
+    return "%s%04d" % (string.ascii_lowercase[i % 26], i)
+
+
+def make_reference_element(alt_set):
+    """
+    Make the Or element previously used for an alternative set.
+
+    :param alt_set: AlternativeSet
+    :returns: pyparsing.ParserElement
+    """
+    return pyparsing.Or([e.matcher_element for e in alt_set.children])
+
+
+def match_words(element, words):
+    """
+    Match each word with a parser element.
+
+    :param element: pyparsing.ParserElement
+    :param words: list
+    """
+    for word in words:
+        element.parseString(word, parseAll=True)
+
+
+def main():
+    print("%-10s %-14s %-12s %-12s %-14s %s" % (
+        "kind", "alternatives", "create (s)", "element (s)",
+        "create Or (s)", "Or (s)"))
+    for kind in ("literals", "sequences"):
+        for alternatives in (10, 100, 1000):
+            words = [make_word(alternatives * i // 20) for i in range(20)]
+            alt_set = make_alternative_set(alternatives, kind == "literals")
+            create_time = best_time(lambda: alt_set.copy().matcher_element)
+            element = alt_set.matcher_element
+            element_time = best_time(lambda: match_words(element, words))
+            reference_create_time = best_time(
+                lambda: make_reference_element(alt_set.copy()))
+            reference = make_reference_element(alt_set)
+            reference_time = best_time(lambda: match_words(reference, words))
+            print("%-10s %-14d %-12.5f %-12.5f %-14.5f %.5f" % (
+                kind, alternatives, create_time, element_time,
+                reference_create_time, reference_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark for matching rules using the chart parser backend.
+
+Matching with the default pyparsing backend is also timed for comparison where
+it can match the speech.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.chart_benchmark
+"""
+
+from jsgf import (AlternativeSet, KleeneStar, MatchBackend, OptionalGrouping,
+                  PublicRule, Sequence)
+
+from benchmarks.timing import best_time
+
+
+def make_rule():
+    """
+    Make a command rule with repeated directions and optional words.
+
+    :returns: Rule
+    """
+    return PublicRule("move", Sequence(
+        OptionalGrouping("please"), "move",
+        KleeneStar(Sequence(AlternativeSet("up", "down", "left", "right"),
+                            OptionalGrouping("then"))),
+        OptionalGrouping("now")
+    ))
+
+
+def make_ambiguous_rule():
+    """
+    Make a rule the default backend cannot match because repeats match as many
+    words as they can.
+
+    :returns: Rule
+    """
+    return PublicRule("ambiguous", Sequence(
+        KleeneStar("go"), OptionalGrouping("go"), "go"
+    ))
+
+
+def main():
+    print("%-10s %-7s %-12s %s" % ("rule", "words", "chart (s)", "pyparsing (s)"))
+    directions = ["up", "down", "left", "right then"]
+    for name, rule, word in (("command", make_rule(), None),
+                             ("ambiguous", make_ambiguous_rule(), "go")):
+        for words in (10, 100, 500):
+            if word is None:
+                speech = "please move %s now" % " ".join(
+                    [directions[i % 4] for i in range(words)])
+            else:
+                speech = " ".join([word] * words)
+
+            rule.matching_backend = MatchBackend.Chart
+            assert rule.matches(speech)
+            chart_time = best_time(lambda: rule.matches(speech))
+
+            rule.matching_backend = MatchBackend.Pyparsing
+            if rule.matches(speech):
+                pyparsing_time = "%.5f" % best_time(
+                    lambda: rule.matches(speech))
+            else:
+                pyparsing_time = "no match"
+            print("%-10s %-7d %-12.5f %s" % (name, words, chart_time,
+                                            pyparsing_time))
+
+
+if __name__ == '__main__':
+    main()
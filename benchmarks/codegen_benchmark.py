@@ -0,0 +1,64 @@
+"""
+Benchmark for matching rules using compiled matchers.
+
+Matching with the default pyparsing backend is also timed for comparison, along
+with the time taken to generate and compile each matcher.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.codegen_benchmark
+"""
+
+from jsgf import (AlternativeSet, CompiledMatcher, KleeneStar, MatchBackend,
+                  OptionalGrouping, PublicRule, Sequence)
+
+from benchmarks.timing import best_time
+
+
+def make_rule():
+    """
+    Make a command rule with repeated directions and optional words.
+
+    :returns: Rule
+    """
+    return PublicRule("move", Sequence(
+        OptionalGrouping("please"), "move",
+        KleeneStar(Sequence(AlternativeSet("up", "down", "left", "right"),
+                            OptionalGrouping("then"))),
+        OptionalGrouping("now")
+    ))
+
+
+def make_speech(words):
+    """
+    Make speech matching the command rule.
+
+    :param words: number of directions
+    :returns: str
+    """
+    directions = ["up", "down", "left", "right then"]
+    return "please move %s now" % " ".join(
+        [directions[i % 4] for i in range(words)])
+
+
+def main():
+    print("%-7s %-12s %-14s %s" % ("words", "compile (s)", "compiled (s)",
+                                   "pyparsing (s)"))
+    rule = make_rule()
+    for words in (1, 10, 100):
+        speech = make_speech(words)
+        compile_time = best_time(lambda: CompiledMatcher(rule.expansion))
+
+        rule.matching_backend = MatchBackend.Compiled
+        assert rule.matches(speech)
+        compiled_time = best_time(lambda: rule.matches(speech), 100)
+
+        rule.matching_backend = MatchBackend.Pyparsing
+        assert rule.matches(speech)
+        pyparsing_time = best_time(lambda: rule.matches(speech), 100)
+        print("%-7d %-12.5f %-14.6f %.6f" % (words, compile_time, compiled_time,
+                                             pyparsing_time))
+
+
+if __name__ == '__main__':
+    main()
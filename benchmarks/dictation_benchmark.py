@@ -0,0 +1,78 @@
+"""
+Benchmark for matching long runs of dictated words with rules using jsgf.ext
+Dictation expansions.
+
+The pyparsing element previously used for matching Dictation expansions is also
+timed for comparison.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.dictation_benchmark
+"""
+
+import re
+
+import pyparsing
+
+from jsgf import OptionalGrouping, PublicRule, Sequence
+from jsgf.ext import Dictation
+from jsgf.ext.expansions import _word_regex_str
+
+from benchmarks.timing import best_time
+
+
+def make_speech(words, ending):
+    """
+    Make a speech string starting with 'note', followed by the given number of
+    dictated words and an ending string.
+
+    :param words: int
+    :param ending: str
+    :returns: str
+    """
+    dictated = ["word%d" % (i % 50) for i in range(words)]
+    return " ".join(["note"] + dictated + ([ending] if ending else []))
+
+
+def make_reference_element(stop_literals):
+    """
+    Make the pyparsing element previously used for Dictation expansions.
+
+    :param stop_literals: list
+    :returns: pyparsing.ParserElement
+    """
+    word = pyparsing.Regex(_word_regex_str, re.UNICODE)
+    if not stop_literals:
+        return pyparsing.OneOrMore(word)
+    stop_on = pyparsing.Or(list(map(pyparsing.Literal, stop_literals)))
+    return pyparsing.OneOrMore(word, stopOn=stop_on)
+
+
+def main():
+    # Rules with no literals after the Dictation expansion and with several
+    # possible next literals.
+    rules = [
+        ("none", PublicRule("note", Sequence("note", Dictation())), None, []),
+        ("literals", PublicRule("note", Sequence(
+            "note", Dictation(), OptionalGrouping("please"),
+            OptionalGrouping("now"), OptionalGrouping("then"),
+            OptionalGrouping("finish"), "done"
+        )), "done", ["please", "now", "then", "finish", "done"]),
+    ]
+
+    print("%-10s %-7s %-12s %s" % ("stops", "words", "match (s)",
+                                   "reference (s)"))
+    for name, rule, ending, stop_literals in rules:
+        reference = make_reference_element(stop_literals)
+        for words in (10, 100, 1000):
+            speech = make_speech(words, ending)
+            dictated = speech[len("note "):]
+            assert rule.matches(speech)
+            match_time = best_time(lambda: rule.matches(speech))
+            reference_time = best_time(lambda: reference.parseString(dictated))
+            print("%-10s %-7d %-12.5f %.5f" % (name, words, match_time,
+                                               reference_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark for the jsgf.ext expand_dictation_expansion function and for adding rules
+with several optional or alternative Dictation expansions to a DictationGrammar.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.expand_dictation_benchmark
+"""
+
+from jsgf import AlternativeSet, OptionalGrouping, PublicRule, Sequence
+from jsgf.ext import Dictation, DictationGrammar
+from jsgf.ext.expansions import expand_dictation_expansion
+
+from benchmarks.timing import best_time
+
+
+def make_expansion(positions, use_alternatives):
+    """
+    Make a sequence with the given number of Dictation positions. Each position
+    is either optional or an alternative to a literal.
+
+    :param positions: int
+    :param use_alternatives: bool
+    :returns: Sequence
+    """
+    children = []
+    for i in range(positions):
+        children.append("word%d" % i)
+        if use_alternatives and i % 2 == 0:
+            children.append(AlternativeSet("other%d" % i, Dictation()))
+        else:
+            children.append(OptionalGrouping(Dictation()))
+    return Sequence(*children)
+
+
+def add_rule(expansion):
+    grammar = DictationGrammar()
+    grammar.add_rule(PublicRule("test", expansion))
+
+
+def main():
+    print("%-10s %-9s %-9s %-12s %s" % ("positions", "kind", "variants",
+                                           "expand (s)", "add rule (s)"))
+    for use_alternatives in (False, True):
+        kind = "mixed" if use_alternatives else "optional"
+        for positions in range(1, 9):
+            e = make_expansion(positions, use_alternatives)
+            variants = len(expand_dictation_expansion(e))
+            expand_time = best_time(lambda: expand_dictation_expansion(e))
+            add_time = best_time(lambda: add_rule(e), repeat=3)
+            print("%-10d %-9s %-9d %-12.4f %.4f" % (
+                positions, kind, variants, expand_time, add_time))
+
+
+if __name__ == '__main__':
+    main()
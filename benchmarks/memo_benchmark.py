@@ -0,0 +1,106 @@
+"""
+Benchmark for matching grammars using the Grammar 'memoize_references' option
+and pyparsing packrat caching.
+
+Rules in the "shared" grammars reference the same rules, so the memo's results
+are reused. Rules in the "unshared" grammars each reference their own rule, so
+the times show the memo's overhead when its results aren't reused.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.memo_benchmark
+"""
+
+from jsgf import (AlternativeSet, Grammar, HiddenRule, NamedRuleRef,
+                  OptionalGrouping, PublicRule, Repeat, Sequence, disable_packrat,
+                  enable_packrat)
+
+from benchmarks.timing import best_time
+
+
+def make_grammar(rules):
+    """
+    Make a grammar with the given number of command rules referencing shared
+    number, application name and direction rules.
+
+    :param rules: int
+    :returns: Grammar
+    """
+    grammar = Grammar()
+    digits = ["zero", "one", "two", "three", "four", "five", "six", "seven",
+              "eight", "nine"]
+    grammar.add_rules(
+        HiddenRule("digit", AlternativeSet(*digits)),
+        HiddenRule("number", Sequence(
+            Repeat(NamedRuleRef("digit")),
+            OptionalGrouping(Sequence("point", Repeat(NamedRuleRef("digit"))))
+        )),
+        HiddenRule("app_name", AlternativeSet(
+            "firefox", "files", "terminal", "text editor", "calculator"
+        )),
+        HiddenRule("direction", AlternativeSet("up", "down", "left", "right")),
+        HiddenRule("motion", Sequence(
+            NamedRuleRef("direction"), OptionalGrouping(NamedRuleRef("number"))
+        )),
+    )
+    for i in range(rules):
+        grammar.add_rule(PublicRule("command%d" % i, Sequence(
+            OptionalGrouping(NamedRuleRef("app_name")),
+            Repeat(NamedRuleRef("motion")),
+            "command%d" % i
+        )))
+    return grammar
+
+
+def make_unshared_grammar(rules):
+    """
+    Make a grammar with the given number of command rules that each reference
+    their own number rule.
+
+    :param rules: int
+    :returns: Grammar
+    """
+    grammar = Grammar()
+    for i in range(rules):
+        grammar.add_rules(
+            HiddenRule("number%d" % i, Sequence(
+                Repeat(AlternativeSet("one", "two", "three")),
+                OptionalGrouping(AlternativeSet("up", "down"))
+            )),
+            PublicRule("command%d" % i, Sequence(
+                "go", NamedRuleRef("number%d" % i), "command%d" % i
+            ))
+        )
+    return grammar
+
+
+def main():
+    speech = {
+        "shared": ("terminal up one two three point five left four right "
+                   "nine nine down seven command1"),
+        "unshared": "go one two three one up command1",
+    }
+    grammars = [(name, rules, make(rules))
+                for name, make in (("shared", make_grammar),
+                                   ("unshared", make_unshared_grammar))
+                for rules in (10, 50, 200)]
+
+    print("%-9s %-7s %-9s %s" % ("grammar", "rules", "options", "time (s)"))
+    for name, rules, grammar in grammars:
+        for use_packrat, memoize_references in ((False, False), (False, True),
+                                                (True, False), (True, True)):
+            options = {(False, False): "none", (True, False): "packrat",
+                       (False, True): "memo", (True, True): "both"}[
+                (use_packrat, memoize_references)]
+            if use_packrat:
+                enable_packrat()
+            grammar.memoize_references = memoize_references
+            assert len(grammar.find_matching_rules(speech[name])) == 1
+            t = best_time(lambda: grammar.find_matching_rules(speech[name]),
+                          repeat=15)
+            disable_packrat()
+            print("%-9s %-7d %-9s %.5f" % (name, rules, options, t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for matching N-best recognition hypotheses sharing prefixes using
+Grammar.match_nbest.
+
+Matching each hypothesis separately with Grammar.find_matching_rules is also
+timed for comparison.
+
+Run from the repository's root directory::
+
+    python -m benchmarks.nbest_benchmark
+"""
+
+from jsgf import AlternativeSet, Grammar, PublicRule, Repeat, Sequence
+
+from benchmarks.timing import best_time
+
+
+def make_grammar(rules):
+    """
+    Make a grammar with the given number of command rules.
+
+    :param rules: int
+    :returns: Grammar
+    """
+    grammar = Grammar()
+    for i in range(rules):
+        grammar.add_rule(PublicRule("command%d" % i, Sequence(
+            "command", "number%d" % i,
+            Repeat(AlternativeSet("up", "down", "left", "right"))
+        )))
+    return grammar
+
+
+def make_hypotheses(count, words):
+    """
+    Make N-best hypotheses where the first matches and the others share all of
+    its words and add a word that doesn't match.
+
+    :param count: int
+    :param words: int
+    :returns: list
+    """
+    directions = ["up", "down", "left", "right"]
+    prefix = " ".join(["command", "number1"] +
+                      [directions[i % 4] for i in range(words)])
+    return [prefix] + ["%s x%d" % (prefix, i) for i in range(1, count)]
+
+
+def main():
+    print("%-7s %-7s %-7s %-12s %s" % ("rules", "count", "words", "nbest (s)",
+                                       "separately (s)"))
+    for rules in (10, 100):
+        grammar = make_grammar(rules)
+        for count, words in ((5, 10), (20, 10), (20, 50)):
+            hypotheses = make_hypotheses(count, words)
+            assert grammar.match_nbest(hypotheses)
+            nbest_time = best_time(lambda: grammar.match_nbest(hypotheses))
+            separate_time = best_time(
+                lambda: [grammar.find_matching_rules(h) for h in hypotheses])
+            print("%-7d %-7d %-7d %-12.5f %.5f" % (rules, count, words,
+                                                   nbest_time, separate_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+Timing helper shared by the benchmark scripts.
+"""
+
+import timeit
+
+
+def best_time(func, number=1, repeat=5):
+    """
+    Call a function ``number`` times in each of ``repeat`` runs and return the
+    average time per call of the fastest run in seconds.
+
+    :param func: callable
+    :param number: int
+    :param repeat: int
+    :returns: float
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
@@ -3,12 +3,22 @@ This package contains classes and functions for compiling, matching and parsing
 grammars using rules, imports and rule expansions, such as sequences, repeats,
 optional and required groupings.
 """
+from .automaton import IncrementalMatcher, Lattice, WordAutomaton
+
+from .batch import BatchMatcher
+
+from .chart import Chart, ChartParser, MatchBackend
+
+from .codegen import CompiledMatcher, get_compiled_matcher
+
 from .errors import CompilationError
 from .errors import ExpansionError
 from .errors import GrammarError
 from .errors import MatchError
 
 from .expansions import AlternativeSet
+from .expansions import bulk_build
+from .expansions import BulkBuildContext
 from .expansions import Expansion
 from .expansions import filter_expansion
 from .expansions import find_expansion
@@ -19,6 +29,7 @@ from .expansions import Literal
 from .expansions import map_expansion
 from .expansions import OptionalGrouping
 from .expansions import restore_current_matches
+from .expansions import RuleMatchMemo
 from .expansions import Repeat
 from .expansions import RequiredGrouping
 from .expansions import RuleRef
@@ -29,6 +40,9 @@ from .expansions import TraversalOrder
 from .expansions import VariableChildExpansion
 from .expansions import NamedRuleRef, NullRef, VoidRef
 
+from .frozen import FrozenGrammar, FrozenRule, NodeKind
+
+from .grammars import disable_packrat, enable_packrat
 from .grammars import Grammar
 from .grammars import Import
 from .grammars import RootGrammar
@@ -41,3 +55,8 @@ from .references import BaseRef
 from .rules import HiddenRule
 from .rules import PublicRule
 from .rules import Rule
+
+from .utterances import Utterance
+
+from .wordlists import (DynamicSlot, MappedLexicon, MemoryLexicon, WordList,
+                        write_lexicon)
@@ -0,0 +1,849 @@
+"""
+This module contains classes for matching speech word by word using finite
+automata compiled from rule expansions.
+
+A ``WordAutomaton`` is a nondeterministic finite automaton over words built from
+the expansion trees of one or more rules. It is used by ``IncrementalMatcher`` to
+match partial recognition hypotheses as they grow without matching each prefix
+from scratch.
+
+Incremental matchers can be created using the ``Grammar.incremental`` method::
+
+    matcher = grammar.incremental()
+    matcher.feed("hello")
+    matcher.viable_rules     # rules that can still match
+    matcher.partial_matches  # where "hello" matched in each viable rule
+    matcher.feed("world")
+    matcher.completed_rules  # rules the automaton accepts for "hello world"
+    matcher.find_matching_rules()  # completed rules that Rule.matches accepts
+
+Word lattices and confusion networks from recognisers can be matched using the
+``Grammar.match_lattice`` and ``Rule.match_lattice`` methods. The best scoring
+path accepted by each rule is found without enumerating every path.
+"""
+
+import re
+
+from .errors import GrammarError
+from .expansions import (AlternativeSet, KleeneStar, Literal, NamedRuleRef, NullRef,
+                         OptionalGrouping, Repeat, Sequence, VoidRef)
+
+
+class WordAutomaton(object):
+    """
+    Nondeterministic finite automaton over words compiled from the expansions of
+    one or more rules.
+
+    Each rule has its own start and accepting states, so sets of states can be
+    used to find which rules can still match and which have matched. Referenced
+    rules are inlined. Alternatives with a weight of 0 are excluded, as they are
+    when matching with ``Rule.matches``.
+
+    Rules using expansions that the automaton can't match word by word, such as
+    ``WordList`` expansions, have no states. They are the ``fallback_rules`` and
+    are matched using ``Rule.matches`` by the methods that match speech.
+
+    The automaton is a snapshot: changes made to rules after it was built are not
+    reflected.
+    """
+
+    # The number of state set transitions to cache before clearing the cache.
+    transition_cache_size = 10000
+
+    def __init__(self, rules):
+        """
+        :param rules: list
+        :raises: GrammarError
+        """
+        self._rules = list(rules)
+
+        # Edges are stored in lists indexed by state.
+        self._word_edges = []
+        self._dictation_edges = []
+        self._epsilon_edges = []
+        self._state_rules = []
+        self._state_positions = []
+        self._accepting = {}
+        self._transitions = {}
+        self._fallback = []
+
+        # Import the Dictation word pattern here to avoid a circular import with
+        # jsgf.ext.
+        from .ext.expansions import _word_regex_str
+        self._dictation_word = re.compile(r"(?:%s)\Z" % _word_regex_str,
+                                          re.UNICODE)
+
+        starts = []
+        for i, rule in enumerate(self._rules):
+            state_count = self.state_count
+            start = self._new_state(i)
+            try:
+                end = self._build(rule.expansion, start, i, [rule])
+            except TypeError:
+                # Remove the rule's states and match it using Rule.matches.
+                self._remove_states(state_count)
+                self._fallback.append(i)
+                continue
+            self._accepting[end] = i
+            starts.append(start)
+
+        self._live = self._find_live_states()
+        self._start = self._closure(starts)
+
+    @property
+    def rules(self):
+        """
+        The rules this automaton was built from.
+
+        :returns: list
+        """
+        return list(self._rules)
+
+    @property
+    def fallback_rules(self):
+        """
+        The rules with expansions this automaton can't match, which are matched
+        using ``Rule.matches`` instead.
+
+        :returns: list
+        """
+        return [self._rules[i] for i in self._fallback]
+
+    @property
+    def state_count(self):
+        """
+        The number of states in this automaton.
+
+        :returns: int
+        """
+        return len(self._state_rules)
+
+    @property
+    def start_states(self):
+        """
+        The set of states before any words have been matched.
+
+        :returns: frozenset
+        """
+        return self._start
+
+    def _new_state(self, rule_index):
+        self._word_edges.append({})
+        self._dictation_edges.append([])
+        self._epsilon_edges.append([])
+        self._state_rules.append(rule_index)
+        self._state_positions.append(None)
+        return len(self._state_rules) - 1
+
+    def _remove_states(self, state_count):
+        """
+        Internal method to remove the states added after the given number of
+        states. Only states of the rule being built can be removed.
+
+        :param state_count: int
+        """
+        for states in (self._word_edges, self._dictation_edges,
+                       self._epsilon_edges, self._state_rules,
+                       self._state_positions):
+            del states[state_count:]
+
+    def _build(self, e, start, rule_index, rule_stack):
+        """
+        Internal method to add states and edges for an expansion starting from the
+        given state.
+
+        :param e: Expansion
+        :param start: int
+        :param rule_index: int
+        :param rule_stack: list of rules being built, used to detect recursion
+        :returns: int state reached after matching the expansion
+        :raises: GrammarError, TypeError
+        """
+        # Import Dictation here to avoid a circular import with jsgf.ext.
+        from .ext.expansions import Dictation
+
+        if isinstance(e, Dictation):
+            # Dictation matches one or more words.
+            end = self._new_state(rule_index)
+            self._dictation_edges[start].append(end)
+            self._dictation_edges[end].append(end)
+            self._state_positions[end] = (e, None)
+            return end
+
+        elif isinstance(e, Literal):
+            state = start
+            for i, word in enumerate(e.text.split()):
+                end = self._new_state(rule_index)
+                self._word_edges[state].setdefault(word, []).append(end)
+                self._state_positions[end] = (e, i)
+                state = end
+            return state
+
+        elif isinstance(e, NullRef):
+            return start
+
+        elif isinstance(e, VoidRef):
+            # Return a state with no incoming edges so nothing after this
+            # expansion can be matched.
+            return self._new_state(rule_index)
+
+        elif isinstance(e, NamedRuleRef):
+            rule = e.referenced_rule
+            if any([r is rule for r in rule_stack]):
+                raise GrammarError("cannot build automaton for recursive rule "
+                                   "reference %s" % e)
+            return self._build(rule.expansion, start, rule_index,
+                               rule_stack + [rule])
+
+        elif isinstance(e, Sequence):
+            state = start
+            for child in e.children:
+                state = self._build(child, state, rule_index, rule_stack)
+            return state
+
+        elif isinstance(e, AlternativeSet):
+            children = e.children
+            if e.weights:
+                children = [c for c in children if e.weights.get(c, 1) > 0]
+            end = self._new_state(rule_index)
+            for child in children:
+                child_end = self._build(child, start, rule_index, rule_stack)
+                self._epsilon_edges[child_end].append(end)
+            return end
+
+        elif isinstance(e, OptionalGrouping):
+            end = self._build(e.child, start, rule_index, rule_stack)
+            if end != start:
+                self._epsilon_edges[start].append(end)
+            return end
+
+        elif isinstance(e, Repeat):
+            # Use new states for the loop so that the loop's edge back doesn't
+            # lead to anything else that starts from 'start'.
+            inner = self._new_state(rule_index)
+            end = self._new_state(rule_index)
+            self._epsilon_edges[start].append(inner)
+            child_end = self._build(e.child, inner, rule_index, rule_stack)
+            self._epsilon_edges[child_end].extend([inner, end])
+
+            # KleeneStar expansions can also match zero times.
+            if isinstance(e, KleeneStar):
+                self._epsilon_edges[inner].append(end)
+            return end
+
+        raise TypeError("cannot build automaton for expansion %s of unsupported "
+                        "type %s" % (e, type(e).__name__))
+
+    def _find_live_states(self):
+        """
+        Internal method to find the states that can reach an accepting state.
+
+        :returns: set
+        """
+        reverse = [[] for _ in self._state_rules]
+        for state in range(len(self._state_rules)):
+            targets = list(self._epsilon_edges[state])
+            targets.extend(self._dictation_edges[state])
+            for ends in self._word_edges[state].values():
+                targets.extend(ends)
+            for target in targets:
+                reverse[target].append(state)
+
+        live = set(self._accepting)
+        stack = list(live)
+        while stack:
+            for state in reverse[stack.pop()]:
+                if state not in live:
+                    live.add(state)
+                    stack.append(state)
+        return live
+
+    def _closure(self, states):
+        """
+        Internal method to get the set of live states reachable from the given
+        states without matching any words.
+
+        :param states: iterable
+        :returns: frozenset
+        """
+        result = set()
+        stack = [s for s in states if s in self._live]
+        epsilon_edges, live = self._epsilon_edges, self._live
+        while stack:
+            state = stack.pop()
+            if state in result:
+                continue
+            result.add(state)
+            stack.extend([s for s in epsilon_edges[state] if s in live])
+        return frozenset(result)
+
+    def step(self, states, word):
+        """
+        Get the set of states reached by matching a word from a set of states.
+
+        The word should already be lowercase.
+
+        :param states: frozenset
+        :param word: str
+        :returns: frozenset
+        """
+        key = (states, word)
+        result = self._transitions.get(key)
+        if result is not None:
+            return result
+
+        targets = []
+        is_dictation_word = None
+        for state in states:
+            targets.extend(self._word_edges[state].get(word, ()))
+            if self._dictation_edges[state]:
+                if is_dictation_word is None:
+                    is_dictation_word = bool(self._dictation_word.match(word))
+                if is_dictation_word:
+                    targets.extend(self._dictation_edges[state])
+
+        result = self._closure(targets)
+        if len(self._transitions) >= self.transition_cache_size:
+            self._transitions.clear()
+        self._transitions[key] = result
+        return result
+
+    def matched_positions(self, states, word):
+        """
+        Get the positions in rule expansions matched by a word from a set of
+        states, only including positions from which rules can still match.
+
+        Each position is a ``(rule, expansion, index)`` tuple, where
+        ``expansion`` is the ``Literal`` or ``Dictation`` expansion that matched
+        the word and ``index`` is the index of the word in the literal's text, or
+        None for ``Dictation`` expansions. Expansions of referenced rules are
+        included as they are inlined. Ambiguous rules can have more than one
+        position.
+
+        The word should already be lowercase.
+
+        :param states: frozenset
+        :param word: str
+        :returns: list
+        """
+        reached = self.step(states, word)
+        is_dictation_word = bool(self._dictation_word.match(word))
+        targets = set()
+        for state in states:
+            targets.update(self._word_edges[state].get(word, ()))
+            if is_dictation_word:
+                targets.update(self._dictation_edges[state])
+
+        result = []
+        for target in sorted(targets):
+            if target in reached:
+                expansion, index = self._state_positions[target]
+                result.append((self._rules[self._state_rules[target]],
+                               expansion, index))
+        return result
+
+    def next_words(self, states):
+        """
+        Get the words that have edges from a set of states, not including words
+        only matched by ``Dictation`` expansions.
+
+        :param states: frozenset
+        :returns: set
+        """
+        result = set()
+        for state in states:
+            result.update(self._word_edges[state])
+        return result
+
+    def viable_rules(self, states):
+        """
+        Get the rules that can still match from a set of states. Fallback rules
+        are always included.
+
+        :param states: frozenset
+        :returns: list
+        """
+        indices = set([self._state_rules[s] for s in states])
+        indices.update(self._fallback)
+        return [self._rules[i] for i in sorted(indices)]
+
+    def accepted_rules(self, states):
+        """
+        Get the rules that have matched in a set of states. Fallback rules are
+        not included.
+
+        :param states: frozenset
+        :returns: list
+        """
+        accepting = self._accepting
+        indices = set([accepting[s] for s in states if s in accepting])
+        return [self._rules[i] for i in sorted(indices)]
+
+    def accepts(self, words):
+        """
+        Get the rules that match a list of words. Fallback rules are not
+        included.
+
+        :param words: list
+        :returns: list
+        """
+        states = self._start
+        for word in words:
+            if not states:
+                break
+            states = self.step(states, word.lower())
+        return self.accepted_rules(states)
+
+    def match_nbest(self, hypotheses, scores=None):
+        """
+        Find the best hypothesis for each rule from a list of N-best recognition
+        hypotheses.
+
+        Hypotheses are put into a prefix tree of words so that words shared by
+        hypotheses are only matched once. The hypotheses accepted for each rule
+        are then matched using ``Rule.matches`` from best to worst until one
+        matches, so that the rule's match data is set. This way hypotheses that
+        the automaton accepts, but ``Rule.matches`` doesn't, are skipped.
+
+        Fallback rules are matched against every hypothesis from best to worst
+        until one matches.
+
+        If no scores are given, hypotheses earlier in the list are better.
+        Otherwise, higher scores are better.
+
+        :param hypotheses: list of str
+        :param scores: list of numbers | None
+        :returns: list of (hypothesis, rule) tuples ordered from best to worst
+        :raises: ValueError
+        """
+        hypotheses = list(hypotheses)
+        if scores is None:
+            scores = [-i for i in range(len(hypotheses))]
+        else:
+            scores = list(scores)
+            if len(scores) != len(hypotheses):
+                raise ValueError("expected %d scores, got %d"
+                                 % (len(hypotheses), len(scores)))
+
+        # Build the prefix tree. Each node is a list of the node's children and
+        # the indices of hypotheses ending at the node.
+        root = [{}, []]
+        for i, hypothesis in enumerate(hypotheses):
+            node = root
+            for word in hypothesis.lower().split():
+                children = node[0]
+                child = children.get(word)
+                if child is None:
+                    child = children[word] = [{}, []]
+                node = child
+            node[1].append(i)
+
+        # Walk the tree, collecting the accepted hypothesis indices for each rule
+        # index.
+        accepted = {}
+        accepting = self._accepting
+        stack = [(root, self._start)]
+        while stack:
+            (children, ending), states = stack.pop()
+            if ending:
+                for rule_index in set([accepting[s] for s in states
+                                       if s in accepting]):
+                    accepted.setdefault(rule_index, []).extend(ending)
+
+            for word, child in children.items():
+                next_states = self.step(states, word)
+                if next_states:
+                    stack.append((child, next_states))
+
+        # Fallback rules can match any hypothesis.
+        for rule_index in self._fallback:
+            accepted[rule_index] = list(range(len(hypotheses)))
+
+        # Match each rule's hypotheses from best to worst until one matches,
+        # setting the rule's match data. Then order the rules by the scores of
+        # their matching hypotheses.
+        matched = []
+        for rule_index, indices in accepted.items():
+            rule = self._rules[rule_index]
+            if not rule.active:
+                continue
+            for i in sorted(indices, key=lambda i: (-scores[i], i)):
+                if rule.matches(hypotheses[i]):
+                    matched.append((rule_index, i))
+                    break
+
+        matched.sort(key=lambda x: (-scores[x[1]], x[1], x[0]))
+        return [(hypotheses[i], self._rules[rule_index])
+                for rule_index, i in matched]
+
+    def match_lattice(self, lattice, max_paths=10):
+        """
+        Find the best scoring path through a word lattice for each rule.
+
+        The lattice is intersected with this automaton using dynamic programming
+        over the lattice's nodes in topological order, so paths are not
+        enumerated. Up to ``max_paths`` of the best paths with different words
+        are kept for each automaton state at each lattice node. The paths
+        accepted for each rule are then matched using ``Rule.matches`` from best
+        to worst until one matches, so that the rule's match data is set. This
+        way paths that the automaton accepts, but ``Rule.matches`` doesn't, are
+        skipped.
+
+        Fallback rules are matched against the ``max_paths`` best paths through
+        the lattice with different words from best to worst until one matches.
+
+        :param lattice: Lattice
+        :param max_paths: int
+        :returns: list of (hypothesis, score, rule) tuples ordered from best to
+            worst
+        :raises: ValueError
+        """
+        if max_paths < 1:
+            raise ValueError("max_paths must be at least 1, got %r" % max_paths)
+
+        # The best (score, words) paths for each automaton state at each lattice
+        # node. Paths are pruned when their node is reached. Paths for fallback
+        # rules use None as their state and match any words.
+        best = dict((node, {}) for node in lattice.nodes)
+        best[lattice.start] = dict((s, [(0.0, ())]) for s in self._start)
+        if self._fallback:
+            best[lattice.start][None] = [(0.0, ())]
+
+        for node in lattice.nodes:
+            entries = best[node]
+            if not entries:
+                continue
+            for state in entries:
+                entries[state] = _best_paths(entries[state], max_paths)
+            if node == lattice.end:
+                continue
+
+            for end, words, score in lattice.arcs_from(node):
+                end_entries = best[end]
+                for state, paths in entries.items():
+                    targets = frozenset([state])
+                    for word in words:
+                        if not targets or state is None:
+                            break
+                        targets = self.step(targets, word)
+
+                    new_paths = [(path_score + score, path_words + words)
+                                 for path_score, path_words in paths]
+                    for target in targets:
+                        end_entries.setdefault(target, []).extend(new_paths)
+
+        # Collect the paths accepted for each rule at the end node.
+        accepted = {}
+        for state, paths in best[lattice.end].items():
+            rule_index = self._accepting.get(state)
+            if rule_index is not None:
+                accepted.setdefault(rule_index, []).extend(paths)
+        for rule_index in self._fallback:
+            accepted[rule_index] = best[lattice.end].get(None, [])
+
+        # Match each rule's paths from best to worst until one matches, setting
+        # the rule's match data. Then order the rules by their paths' scores.
+        result = []
+        for rule_index, paths in accepted.items():
+            rule = self._rules[rule_index]
+            if not rule.active:
+                continue
+            for score, words in _best_paths(paths, len(paths)):
+                hypothesis = " ".join(words)
+                if rule.matches(hypothesis):
+                    result.append((rule_index, hypothesis, score))
+                    break
+
+        result.sort(key=lambda x: (-x[2], x[0]))
+        return [(hypothesis, score, self._rules[rule_index])
+                for rule_index, hypothesis, score in result]
+
+
+def _best_paths(paths, limit):
+    """
+    Internal function to get the best scoring paths with different words from a
+    list of (score, words) paths, ordered from best to worst.
+
+    :param paths: list
+    :param limit: int
+    :returns: list
+    """
+    result = []
+    seen = set()
+    for score, words in sorted(paths, key=lambda x: (-x[0], x[1])):
+        if words in seen:
+            continue
+        seen.add(words)
+        result.append((score, words))
+        if len(result) == limit:
+            break
+    return result
+
+
+class Lattice(object):
+    """
+    Directed acyclic graph of scored word arcs, such as a word lattice or
+    confusion network from a speech recogniser.
+
+    Nodes are hashable values, usually integers. Each arc is a
+    ``(start, end, words, score)`` tuple, where ``words`` is a string of zero or
+    more words and ``score`` is a number added to the score of each path using
+    the arc, such as a log probability. Arcs with no words can be used to skip
+    parts of the lattice. Higher path scores are better.
+    """
+    def __init__(self, arcs, start=None, end=None):
+        """
+        :param arcs: list of (start, end, words, score) tuples
+        :param start: start node (default: the node with no incoming arcs)
+        :param end: end node (default: the node with no outgoing arcs)
+        :raises: ValueError
+        """
+        self._arcs = {}
+        incoming = {}
+        for arc_start, arc_end, words, score in arcs:
+            words = tuple(words.lower().split()) if words else ()
+            self._arcs.setdefault(arc_start, []).append(
+                (arc_end, words, float(score))
+            )
+            self._arcs.setdefault(arc_end, [])
+            incoming[arc_end] = incoming.get(arc_end, 0) + 1
+            incoming.setdefault(arc_start, 0)
+
+        # Sort the nodes topologically.
+        ready = [n for n in incoming if incoming[n] == 0]
+        first_nodes = list(ready)
+        nodes = []
+        while ready:
+            node = ready.pop()
+            nodes.append(node)
+            for arc_end, _, _ in self._arcs[node]:
+                incoming[arc_end] -= 1
+                if incoming[arc_end] == 0:
+                    ready.append(arc_end)
+        if len(nodes) != len(incoming):
+            raise ValueError("lattice arcs cannot form cycles")
+        self._nodes = nodes
+
+        if start is None:
+            start = self._only_node(first_nodes, "start")
+        if end is None:
+            end = self._only_node([n for n in nodes if not self._arcs[n]], "end")
+        for node in (start, end):
+            if node not in self._arcs:
+                raise ValueError("node %r is not in the lattice" % (node,))
+        self._start, self._end = start, end
+
+    @staticmethod
+    def _only_node(nodes, kind):
+        if len(nodes) != 1:
+            raise ValueError("cannot find the %s node of the lattice: there are "
+                             "%d candidates" % (kind, len(nodes)))
+        return nodes[0]
+
+    @classmethod
+    def from_confusion_network(cls, slots):
+        """
+        Create a lattice from a confusion network.
+
+        Each slot in the network is a list of ``(words, score)`` alternatives. Use
+        an empty string or ``None`` as the words of an alternative to allow the
+        slot to be skipped.
+
+        :param slots: list of lists
+        :returns: Lattice
+        """
+        arcs = []
+        for i, slot in enumerate(slots):
+            for words, score in slot:
+                arcs.append((i, i + 1, words, score))
+        return cls(arcs, 0, len(slots))
+
+    @property
+    def start(self):
+        """
+        The start node of this lattice.
+        """
+        return self._start
+
+    @property
+    def end(self):
+        """
+        The end node of this lattice.
+        """
+        return self._end
+
+    @property
+    def nodes(self):
+        """
+        The nodes of this lattice in topological order.
+
+        :returns: list
+        """
+        return list(self._nodes)
+
+    def arcs_from(self, node):
+        """
+        Get the arcs starting from a node as ``(end, words, score)`` tuples, where
+        ``words`` is a tuple of lowercase words.
+
+        :param node: lattice node
+        :returns: list
+        """
+        return list(self._arcs[node])
+
+
+class IncrementalMatcher(object):
+    """
+    Class for matching speech against rules one word at a time.
+
+    Each word fed to the matcher advances the matching state of all rules, so
+    growing partial recognition hypotheses don't need to be matched from the
+    start each time. Disabled rules are never viable.
+    """
+    def __init__(self, automaton):
+        """
+        :param automaton: WordAutomaton
+        """
+        self._automaton = automaton
+        self._states = automaton.start_states
+        self._words = []
+
+        # The states before the last word was fed, used to get the positions
+        # the word matched when they are needed.
+        self._last_states = None
+
+    @property
+    def automaton(self):
+        """
+        The automaton used by this matcher.
+
+        :returns: WordAutomaton
+        """
+        return self._automaton
+
+    def reset(self):
+        """
+        Clear the words fed to this matcher so that a new utterance can be matched.
+        """
+        self._states = self._automaton.start_states
+        self._words = []
+        self._last_states = None
+
+    def feed(self, words):
+        """
+        Advance the matching state of each rule by one or more words.
+
+        :param words: str
+        :returns: bool whether any rule can still match
+        """
+        automaton = self._automaton
+        for word in words.lower().split():
+            self._last_states = self._states
+            if self._states:
+                self._states = automaton.step(self._states, word)
+            self._words.append(word)
+        return self.is_viable
+
+    @property
+    def words(self):
+        """
+        The words fed to this matcher since it was created or reset.
+
+        :returns: list
+        """
+        return list(self._words)
+
+    @property
+    def current_match(self):
+        """
+        The speech fed to this matcher since it was created or reset. This is the
+        partial match of each viable rule; see ``partial_matches``.
+
+        :returns: str
+        """
+        return " ".join(self._words)
+
+    @property
+    def partial_matches(self):
+        """
+        The partial match of each viable rule as a ``(rule, positions)`` tuple.
+
+        Each viable rule's partial match is all of the words fed so far. The
+        positions are where the last word was matched in the rule's expansion,
+        as ``(expansion, index)`` tuples: ``expansion`` is the ``Literal`` or
+        ``Dictation`` expansion that matched the word and ``index`` is the index
+        of the word in the literal's text, or None for ``Dictation``
+        expansions. Rules have no positions before any words are fed and can
+        have more than one if their expansions are ambiguous. The automaton's
+        fallback rules have no positions.
+
+        :returns: list
+        """
+        rules = self.viable_rules
+        positions = dict((id(r), []) for r in rules)
+        if self._last_states:
+            for rule, expansion, index in self._automaton.matched_positions(
+                    self._last_states, self._words[-1]):
+                if id(rule) in positions:
+                    positions[id(rule)].append((expansion, index))
+        return [(r, positions[id(r)]) for r in rules]
+
+    @property
+    def is_viable(self):
+        """
+        Whether any rule can still match after the words fed so far.
+
+        :returns: bool
+        """
+        return len(self.viable_rules) > 0
+
+    @property
+    def viable_rules(self):
+        """
+        The rules that match the words fed so far or could match if more words are
+        fed. The automaton's fallback rules are always viable while they are
+        active.
+
+        :returns: list
+        """
+        return [r for r in self._automaton.viable_rules(self._states)
+                if r.active]
+
+    @property
+    def completed_rules(self):
+        """
+        The rules that the automaton accepts for the words fed so far.
+
+        Each rule that ``Rule.matches`` accepts for the words is included, except
+        for rules with expansions that can match empty speech and the
+        automaton's fallback rules. Other rules can
+        also be included, because the automaton follows every path through
+        optional and repeated expansions, whereas ``Rule.matches`` doesn't
+        support ambiguous rule expansions. For example, ``<rule> = [a] a b;`` is
+        completed by "a b", but doesn't match it. Use ``find_matching_rules`` to
+        get exactly the rules that ``Rule.matches`` accepts.
+
+        :returns: list
+        """
+        return [r for r in self._automaton.accepted_rules(self._states)
+                if r.active]
+
+    def find_matching_rules(self):
+        """
+        Match the words fed so far against each completed rule using
+        ``Rule.matches`` so that their match data is set. Completed rules that
+        ``Rule.matches`` doesn't accept are not returned.
+
+        Rules with expansions that can match empty speech and the automaton's
+        fallback rules are matched too, so the result is the same as matching
+        each rule with ``Rule.matches``.
+
+        :returns: list
+        """
+        speech = self.current_match
+        completed = set([id(r) for r in self.completed_rules])
+        completed.update([id(r) for r in self._automaton.fallback_rules])
+        return [r for r in self._automaton.rules
+                if r.active and (id(r) in completed or
+                                 r.expansion.can_match_empty)
+                and r.matches(speech)]
@@ -0,0 +1,275 @@
+"""
+This module contains the ``BatchMatcher`` class for matching batches of
+utterances against rules using NumPy.
+
+Regular rules, which are rules a ``WordAutomaton`` can be built for that don't
+use ``Dictation`` expansions, are compiled into a deterministic finite automaton
+with a dense table of transitions for each word in the rules' vocabulary.
+Utterances are encoded as a padded 2-D array of word IDs and matched one word
+position at a time for the whole batch. Other rules are matched using
+``Rule.matches`` for each utterance.
+
+NumPy is an optional dependency. It can be installed with pyjsgf by running::
+
+    $ pip install pyjsgf[batch]
+
+Batch matchers can be created using the ``Grammar.batch_matcher`` method::
+
+    matcher = grammar.batch_matcher()
+    utterances = ["hello world", "goodbye"]
+    batch = matcher.encode(utterances)
+    rules, accepted = matcher.match(batch, utterances)
+"""
+
+from .automaton import WordAutomaton
+from .errors import GrammarError
+from .utterances import make_utterance
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Word IDs used for padding and for words that are not in the vocabulary.
+PADDING_ID = 0
+UNKNOWN_ID = 1
+
+
+class BatchMatcher(object):
+    """
+    Matcher for batches of utterances encoded as arrays of word IDs.
+
+    Regular rules are matched like they are by ``WordAutomaton``, so ambiguous
+    expansions are supported and match data is not set. Rules that are not
+    regular are matched using ``Rule.matches``, which sets match data.
+
+    The matcher is a snapshot: changes made to rules after it was created are
+    not reflected, except for whether rules are active.
+    """
+    def __init__(self, rules):
+        """
+        :param rules: list
+        :raises: ImportError
+        """
+        if numpy is None:
+            raise ImportError("BatchMatcher requires NumPy, which can be "
+                              "installed using 'pip install pyjsgf[batch]'")
+
+        self._rules = list(rules)
+        self._regular = []
+        self._fallback = []
+        for i, rule in enumerate(self._rules):
+            if self._is_regular(rule):
+                self._regular.append(i)
+            else:
+                self._fallback.append(i)
+
+        self._build(WordAutomaton([self._rules[i] for i in self._regular]))
+
+    @staticmethod
+    def _is_regular(rule):
+        """
+        Internal method to check whether a rule can be matched using the
+        automaton.
+
+        :param rule: Rule
+        :returns: bool
+        """
+        try:
+            if rule.expansion.contains_dictation:
+                return False
+            return not WordAutomaton([rule]).fallback_rules
+        except GrammarError:
+            return False
+
+    def _build(self, automaton):
+        """
+        Internal method to build the transition and accepting state tables from
+        an automaton using the subset construction. State 0 is the dead state.
+
+        :param automaton: WordAutomaton
+        """
+        dead = frozenset()
+        state_ids = {dead: 0}
+        states = [dead]
+        self._start = state_ids.setdefault(automaton.start_states, len(states))
+        if self._start == len(states):
+            states.append(automaton.start_states)
+
+        rows = []
+        while len(rows) < len(states):
+            current = states[len(rows)]
+            row = {}
+            for word in automaton.next_words(current):
+                target = automaton.step(current, word)
+                index = state_ids.get(target)
+                if index is None:
+                    index = state_ids[target] = len(states)
+                    states.append(target)
+                row[word] = index
+            rows.append(row)
+
+        # Assign word IDs after the reserved ones in sorted order.
+        vocabulary = sorted(set([word for row in rows for word in row]))
+        self._word_ids = dict((word, i + 2) for i, word in enumerate(vocabulary))
+
+        # Padding leaves states unchanged. Unknown words lead to the dead state.
+        transitions = numpy.zeros((len(states), len(vocabulary) + 2),
+                                  dtype=numpy.int32)
+        transitions[:, PADDING_ID] = numpy.arange(len(states))
+        for i, row in enumerate(rows):
+            for word, index in row.items():
+                transitions[i, self._word_ids[word]] = index
+        self._transitions = transitions
+
+        # Make a table of the regular rules accepted in each state.
+        columns = dict((id(self._rules[i]), j)
+                       for j, i in enumerate(self._regular))
+        accepting = numpy.zeros((len(states), len(self._regular)), dtype=bool)
+        for i, state in enumerate(states):
+            for rule in automaton.accepted_rules(state):
+                accepting[i, columns[id(rule)]] = True
+        self._accepting = accepting
+
+    @property
+    def rules(self):
+        """
+        The rules this matcher was created for.
+
+        :returns: list
+        """
+        return list(self._rules)
+
+    @property
+    def regular_rules(self):
+        """
+        The rules matched using the transition table.
+
+        :returns: list
+        """
+        return [self._rules[i] for i in self._regular]
+
+    @property
+    def fallback_rules(self):
+        """
+        The rules matched using ``Rule.matches`` for each utterance.
+
+        :returns: list
+        """
+        return [self._rules[i] for i in self._fallback]
+
+    @property
+    def word_ids(self):
+        """
+        Dictionary of the IDs of each word in the regular rules' vocabulary.
+
+        :returns: dict
+        """
+        return dict(self._word_ids)
+
+    @property
+    def transitions(self):
+        """
+        The transition table with a row for each state and a column for each
+        word ID.
+
+        :returns: numpy.ndarray
+        """
+        return self._transitions
+
+    @property
+    def state_count(self):
+        """
+        The number of states in the transition table, including the dead state.
+
+        :returns: int
+        """
+        return len(self._transitions)
+
+    def encode(self, utterances, length=None):
+        """
+        Encode utterances as a 2-D array of word IDs with a row for each one.
+
+        Rows are padded with ``PADDING_ID`` to the length of the longest
+        utterance or to ``length`` if it is given. Words that are not in the
+        vocabulary are encoded as ``UNKNOWN_ID``.
+
+        :param utterances: list of str, lists of words or Utterances
+        :param length: int | None
+        :returns: numpy.ndarray
+        :raises: ValueError
+        """
+        word_lists = [make_utterance(u).words for u in utterances]
+        longest = max([len(words) for words in word_lists] or [0])
+        if length is None:
+            length = longest
+        elif longest > length:
+            raise ValueError("utterance with %d words is longer than the batch "
+                             "length %d" % (longest, length))
+
+        batch = numpy.zeros((len(word_lists), length), dtype=numpy.int32)
+        get = self._word_ids.get
+        for i, words in enumerate(word_lists):
+            batch[i, :len(words)] = [get(word, UNKNOWN_ID) for word in words]
+        return batch
+
+    def accept_flags(self, batch, utterances=None):
+        """
+        Get whether each rule accepts each utterance in a batch.
+
+        Utterances are required to match rules that are not regular.
+
+        :param batch: 2-D array of word IDs
+        :param utterances: list of str, lists of words or Utterances | None
+        :returns: numpy.ndarray of bools with a row for each utterance and a
+            column for each rule
+        :raises: ValueError
+        """
+        batch = numpy.asarray(batch)
+        if batch.ndim != 2:
+            raise ValueError("expected a 2-D array of word IDs, got an array "
+                             "with %d dimensions" % batch.ndim)
+
+        fallback = [i for i in self._fallback if self._rules[i].active]
+        if fallback:
+            if utterances is None:
+                raise ValueError("utterances are required to match rules that "
+                                 "are not regular")
+            utterances = [make_utterance(u) for u in utterances]
+            if len(utterances) != len(batch):
+                raise ValueError("expected %d utterances, got %d"
+                                 % (len(batch), len(utterances)))
+
+        # Step every utterance through the table one word position at a time.
+        states = numpy.full(len(batch), self._start, dtype=numpy.int32)
+        transitions = self._transitions
+        for position in range(batch.shape[1]):
+            states = transitions[states, batch[:, position]]
+
+        flags = numpy.zeros((len(batch), len(self._rules)), dtype=bool)
+        flags[:, self._regular] = self._accepting[states]
+        for i in fallback:
+            rule = self._rules[i]
+            flags[:, i] = [rule.matches(u) for u in utterances]
+
+        # Inactive rules don't match anything.
+        flags[:, [i for i, r in enumerate(self._rules) if not r.active]] = False
+        return flags
+
+    def match(self, batch, utterances=None):
+        """
+        Find the rules accepting each utterance in a batch.
+
+        See ``accept_flags`` for details.
+
+        :param batch: 2-D array of word IDs
+        :param utterances: list of str, lists of words or Utterances | None
+        :returns: (rule lists, accept flags) tuple with a list of the accepting
+            rules for each utterance and a numpy.ndarray of whether any rule
+            accepts each utterance
+        :raises: ValueError
+        """
+        flags = self.accept_flags(batch, utterances)
+        rules = [[self._rules[i] for i in numpy.flatnonzero(row)]
+                 for row in flags]
+        return rules, flags.any(axis=1)
@@ -0,0 +1,661 @@
+"""
+This module contains an Earley chart parser for matching speech against rule
+expansions.
+
+The chart parser is an alternative to the ``pyparsing`` elements normally used
+for matching. It considers every way an expansion tree can match, so it supports
+ambiguous expansions such as ``[test] test``, expansions that can match nothing
+and recursive rule references. Parsing takes O(n^3) time in the worst
+case, where n is the number of words, and close to linear time for most
+grammars.
+
+The chart parser can be used by setting the ``matching_backend`` attribute of
+rules or grammars::
+
+    rule.matching_backend = MatchBackend.Chart
+    rule.matches("test")  # matches <rule> = [test] test;
+
+Match data is set in the same way as for the default backend.
+
+The ``Weighted`` backend uses the parse with the highest product of alternative
+set weights instead of the first parse, and sets the ``match_score`` attribute of
+matching rules to the parse's score (the natural logarithm of the product)::
+
+    rule.matching_backend = MatchBackend.Weighted
+    rule.matches("test")
+    rule.match_score
+"""
+
+import math
+import re
+
+from six import get_unbound_function
+
+from .utterances import make_utterance
+from .expansions import (AlternativeSet, Expansion, KleeneStar, Literal,
+                         NamedRuleRef, NullRef, OptionalGrouping, Repeat, Sequence,
+                         VoidRef)
+
+
+class MatchBackend(object):
+    """
+    Constants for the backends used to match speech against rules.
+
+    ``Pyparsing`` uses ``Expansion.matcher_element``. ``Chart`` uses
+    ``ChartParser`` and the first complete parse. ``Weighted`` uses
+    ``ChartParser`` and the complete parse with the highest product of
+    alternative weights. ``Compiled`` uses a ``CompiledMatcher`` generated for
+    the expansion tree.
+
+    Only ``Pyparsing`` matches any speech against rules with optional root
+    expansions, such as ``<rule> = [a];``. The other backends only match speech
+    that the whole expansion matches; see ``Rule.matches``.
+    """
+    Pyparsing, Chart, Weighted, Compiled = list(range(4))
+
+
+# Terminal symbol matching any word Dictation expansions can match.
+_DICTATION_WORD = object()
+
+# reset_match_data methods that charts can reset match data without calling.
+_PLAIN_RESET_METHODS = (get_unbound_function(Expansion.reset_match_data),
+                        get_unbound_function(Repeat.reset_match_data))
+
+class ChartParser(object):
+    """
+    Earley chart parser over words for one or more expansion trees.
+
+    Expansion trees are converted into context-free grammar productions with one
+    nonterminal symbol per expansion. Referenced rules are converted once and
+    shared by referencing expansions. The parser is a snapshot: changes made to
+    the expansion trees after it was created are not reflected.
+    """
+    def __init__(self, expansions):
+        """
+        :param expansions: list of root expansions to match against
+        :raises: GrammarError
+        """
+        # Import the Dictation class here to avoid a circular import with jsgf.ext.
+        from .ext.expansions import Dictation, _word_regex_str
+        self._dictation_class = Dictation
+        self._dictation_word = re.compile(r"(?:%s)\Z" % _word_regex_str,
+                                          re.UNICODE)
+
+        # Nonterminal symbols are indices into _nodes.
+        self._nodes = []
+        self._symbols = {}
+
+        # Productions are stored in parallel lists.
+        self._lhs = []
+        self._rhs = []
+        self._scores = []
+        self._productions = []
+
+        self._roots = [self._add_expansion(e) for e in expansions]
+        self._nullable = self._find_nullable_symbols()
+
+        # The current_match value of each expansion after its match data is
+        # reset, or None if the expansion's reset_match_data method must be
+        # called.
+        self._reset_values = [
+            (e._current_match_value(None),)
+            if get_unbound_function(type(e).reset_match_data) in
+            _PLAIN_RESET_METHODS else None
+            for e in self._nodes
+        ]
+
+    def _add_production(self, lhs, rhs, score=0.0):
+        self._lhs.append(lhs)
+        self._rhs.append(tuple(rhs))
+        self._scores.append(score)
+        self._productions[lhs].append(len(self._lhs) - 1)
+
+    def _add_expansion(self, e):
+        """
+        Internal method to add nonterminal symbols and productions for an
+        expansion tree.
+
+        :param e: Expansion
+        :returns: int symbol for the expansion
+        :raises: GrammarError
+        """
+        symbol = self._symbols.get(id(e))
+        if symbol is not None:
+            return symbol
+
+        symbol = len(self._nodes)
+        self._symbols[id(e)] = symbol
+        self._nodes.append(e)
+        self._productions.append([])
+        add = self._add_production
+
+        if isinstance(e, self._dictation_class):
+            # Dictation matches one or more words.
+            add(symbol, [_DICTATION_WORD])
+            add(symbol, [symbol, _DICTATION_WORD])
+
+        elif isinstance(e, Literal):
+            add(symbol, e.text.split())
+
+        elif isinstance(e, NullRef):
+            add(symbol, [])
+
+        elif isinstance(e, VoidRef):
+            # VoidRef expansions have no productions and never match.
+            pass
+
+        elif isinstance(e, NamedRuleRef):
+            add(symbol, [self._add_expansion(e.referenced_rule.expansion)])
+
+        elif isinstance(e, Sequence):
+            add(symbol, [self._add_expansion(c) for c in e.children])
+
+        elif isinstance(e, AlternativeSet):
+            # Use the same alternatives in the same order as the default backend.
+            # Productions for weighted alternatives are scored using the
+            # logarithms of their weights.
+            weighted = [(c, 1) for c in e.children]
+            if e.weights:
+                weighted = [(c, e.weights.get(c, 1)) for c in e.children]
+                weighted = sorted([x for x in weighted if x[1] > 0],
+                                  key=lambda x: -x[1])
+            for child, weight in weighted:
+                add(symbol, [self._add_expansion(child)], math.log(weight))
+
+        elif isinstance(e, OptionalGrouping):
+            add(symbol, [self._add_expansion(e.child)])
+            add(symbol, [])
+
+        elif isinstance(e, Repeat):
+            # Repetitions are matched using left recursion.
+            child = self._add_expansion(e.child)
+            if isinstance(e, KleeneStar):
+                add(symbol, [])
+            else:
+                add(symbol, [child])
+            add(symbol, [symbol, child])
+
+        else:
+            raise TypeError("cannot parse expansion %s of unsupported type %s"
+                            % (e, type(e).__name__))
+
+        return symbol
+
+    def _find_nullable_symbols(self):
+        """
+        Internal method to find the nonterminal symbols that can match nothing.
+
+        :returns: set
+        """
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in zip(self._lhs, self._rhs):
+                if lhs not in nullable and all([
+                        s.__class__ is int and s in nullable for s in rhs]):
+                    nullable.add(lhs)
+                    changed = True
+        return nullable
+
+    def _terminal_matches(self, terminal, word):
+        if terminal is _DICTATION_WORD:
+            return bool(self._dictation_word.match(word))
+        return terminal == word
+
+    def parse(self, speech, beam_width=None, expansions=None):
+        """
+        Parse speech and return a ``Chart`` that can be used to check which
+        expansions matched and to set match data.
+
+        If a list of expansions is given, only those root expansions are matched.
+        Each one must have been given to the parser when it was created.
+
+        If a beam width is given, partial parses are pruned after each word if
+        their score is lower than the best partial parse's score minus the beam
+        width. Scores are the sums of the natural logarithms of the weights of
+        the alternatives used. Pruning can make matches fail.
+
+        :param speech: str, list of words or Utterance
+        :param beam_width: float | None
+        :param expansions: list | None
+        :returns: Chart
+        """
+        roots = self._roots
+        if expansions is not None:
+            roots = [self._symbols[id(e)] for e in expansions]
+
+        utterance = make_utterance(speech)
+        speech, words, spans = utterance.text, utterance.words, utterance.spans
+        n = len(words)
+
+        lhs_of, rhs_of = self._lhs, self._rhs
+        productions, nullable = self._productions, self._nullable
+        production_scores = self._scores
+        terminal_matches = self._terminal_matches
+
+        # Items are (production, dot, origin) tuples. Each item has the best
+        # score of the words before it and the best score of its own matched
+        # symbols, used for pruning.
+        item_lists = [[] for _ in range(n + 1)]
+        item_scores = [{} for _ in range(n + 1)]
+
+        # Items waiting for each symbol at each position and the ends of the
+        # completed symbols starting at each position.
+        waiting = [{} for _ in range(n + 1)]
+        completed = {}
+
+        def add(j, item, prefix_score, inside_score):
+            scores = item_scores[j].get(item)
+            if scores is None:
+                item_scores[j][item] = [prefix_score, inside_score]
+                item_lists[j].append(item)
+            else:
+                scores[0] = max(scores[0], prefix_score)
+                scores[1] = max(scores[1], inside_score)
+
+        if beam_width is None:
+            # Scores are only used for pruning, so don't keep them.
+            no_scores = (0.0, 0.0)
+
+            def add(j, item, prefix_score, inside_score):
+                scores = item_scores[j]
+                if item not in scores:
+                    scores[item] = no_scores
+                    item_lists[j].append(item)
+
+        for root in roots:
+            for p in productions[root]:
+                add(0, (p, 0, 0), production_scores[p], production_scores[p])
+
+        for j in range(n + 1):
+            items = item_lists[j]
+            scores_j = item_scores[j]
+            if beam_width is not None and items:
+                # Prune the items added by matching the previous word.
+                threshold = max([scores_j[x][0] for x in items]) - beam_width
+                items[:] = [x for x in items if scores_j[x][0] >= threshold]
+
+            predicted = set()
+            i = 0
+            while i < len(items):
+                item = items[i]
+                i += 1
+                p, dot, origin = item
+                rhs = rhs_of[p]
+                prefix_score, inside_score = scores_j[item]
+
+                if dot == len(rhs):
+                    # Complete the production and advance items waiting for it.
+                    lhs = lhs_of[p]
+                    ends = completed.setdefault((lhs, origin), set())
+                    if j in ends:
+                        continue
+                    ends.add(j)
+                    origin_scores = item_scores[origin]
+                    for waiting_item in waiting[origin].get(lhs, ()):
+                        p2, dot2, origin2 = waiting_item
+                        waiting_prefix, waiting_inside = origin_scores[waiting_item]
+                        add(j, (p2, dot2 + 1, origin2),
+                            waiting_prefix + inside_score,
+                            waiting_inside + inside_score)
+                    continue
+
+                symbol = rhs[dot]
+                if symbol.__class__ is int:
+                    waiting[j].setdefault(symbol, []).append(item)
+                    if symbol not in predicted:
+                        predicted.add(symbol)
+                        for p2 in productions[symbol]:
+                            add(j, (p2, 0, j), prefix_score + production_scores[p2],
+                                production_scores[p2])
+
+                    # Advance past nullable symbols straight away, as they may
+                    # have already been completed at this position.
+                    if symbol in nullable:
+                        add(j, (p, dot + 1, origin), prefix_score, inside_score)
+
+                elif j < n and (symbol == words[j] or symbol is _DICTATION_WORD
+                                and terminal_matches(symbol, words[j])):
+                    add(j + 1, (p, dot + 1, origin), prefix_score, inside_score)
+
+        return Chart(self, speech, words, spans, completed)
+
+
+class Chart(object):
+    """
+    Result of parsing speech with a ``ChartParser``.
+    """
+    def __init__(self, parser, speech, words, spans, completed):
+        self._parser = parser
+        self._speech = speech
+        self._words = words
+        self._spans = spans
+        self._completed = completed
+
+        # Derivations found for each span, keyed by whether the best or the first
+        # derivations were found.
+        self._derivations = {False: {}, True: {}}
+        self._sequence_derivations = {False: {}, True: {}}
+
+    @property
+    def words(self):
+        """
+        The lowercase words parsed.
+
+        :returns: list
+        """
+        return list(self._words)
+
+    def matched(self, expansion):
+        """
+        Whether an expansion matched all of the words parsed.
+
+        :param expansion: Expansion
+        :returns: bool
+        """
+        symbol = self._parser._symbols.get(id(expansion))
+        if symbol is None:
+            return False
+        return len(self._words) in self._completed.get((symbol, 0), ())
+
+    def set_match_data(self, expansion):
+        """
+        Reset the match data of an expansion tree and set it using the first
+        complete parse of the words, if there is one.
+
+        Earlier expansions in sequences match as many words as possible.
+
+        :param expansion: Expansion
+        :returns: bool whether the expansion matched
+        """
+        return self._set_match_data(expansion, False) is not None
+
+    def set_best_match_data(self, expansion):
+        """
+        Reset the match data of an expansion tree and set it using the complete
+        parse of the words with the highest score, if there is one.
+
+        Parse scores are the sums of the natural logarithms of the weights of the
+        alternatives used, so the best parse has the highest product of weights.
+        Alternatives without weights do not change scores. If parses have the
+        same score, the first parse is used.
+
+        :param expansion: Expansion
+        :returns: float score | None
+        """
+        return self._set_match_data(expansion, True)
+
+    def _set_match_data(self, expansion, best):
+        parser = self._parser
+        symbol = parser._symbols[id(expansion)]
+        self._reset_match_data(self._reachable_symbols(symbol))
+
+        if not self.matched(expansion):
+            return None
+
+        score, derivation = self._derive(symbol, 0, len(self._words), best,
+                                         set())[0]
+        self._apply(derivation)
+        return score
+
+    def _reachable_symbols(self, symbol):
+        """
+        Internal method to get the symbols of the expansions reachable from a
+        symbol, including those in referenced rules.
+
+        :param symbol: int
+        :returns: list
+        """
+        parser = self._parser
+        seen = set([symbol])
+        stack = [symbol]
+        result = []
+        while stack:
+            s = stack.pop()
+            result.append(s)
+            for p in parser._productions[s]:
+                for x in parser._rhs[p]:
+                    if x.__class__ is int and x not in seen:
+                        seen.add(x)
+                        stack.append(x)
+        return result
+
+    def _reset_match_data(self, symbols):
+        """
+        Internal method to reset the match data of the expansions of a list of
+        symbols.
+
+        :param symbols: list
+        """
+        parser = self._parser
+        nodes, reset_values = parser._nodes, parser._reset_values
+        for s in symbols:
+            x, value = nodes[s], reset_values[s]
+            if value is None:
+                x.reset_match_data()
+                continue
+            x._match_span = None
+            x._current_match = value[0]
+            x._matching_slice = None
+            if isinstance(x, Repeat):
+                x._repetitions_matched = []
+
+    def _derive(self, symbol, start, end, best, in_progress):
+        """
+        Internal method to find the first or the best scoring derivation of a
+        symbol for a span of words.
+
+        Derivations are ``(symbol, start, end, children)`` tuples, where children
+        are derivations or the positions of words matched by terminal symbols.
+
+        :param symbol: int
+        :param start: int
+        :param end: int
+        :param best: whether to find the best scoring derivation
+        :param in_progress: set of derivations being found, used to avoid cycles
+        :returns: ((score, derivation) | None, whether the result can be cached)
+        """
+        key = (symbol, start, end)
+        memo = self._derivations[best]
+        if key in memo:
+            return memo[key], True
+        if end not in self._completed.get((symbol, start), ()):
+            return None, True
+        if key in in_progress:
+            return None, False
+
+        in_progress.add(key)
+        result, cacheable = None, True
+        parser = self._parser
+        e = parser._nodes[symbol]
+        if isinstance(e, parser._dictation_class):
+            # The span is known to be made of Dictation words.
+            result = (0.0, (symbol, start, end, []))
+        elif isinstance(e, Repeat):
+            children, cacheable = self._derive_repetitions(
+                parser._symbols[id(e.child)], start, end, best, in_progress
+            )
+            if children is not None:
+                result = (children[0], (symbol, start, end, children[1]))
+        else:
+            for p in parser._productions[symbol]:
+                children, can_cache = self._derive_sequence(p, 0, start, end,
+                                                            best, in_progress)
+                cacheable = cacheable and can_cache
+                if children is None:
+                    continue
+                score = parser._scores[p] + children[0]
+                if result is None or score > result[0]:
+                    result = (score, (symbol, start, end, children[1]))
+                if not best:
+                    break
+        in_progress.discard(key)
+
+        if result is not None or cacheable:
+            memo[key] = result
+        return result, cacheable
+
+    def _derive_repetitions(self, child, start, end, best, in_progress):
+        """
+        Internal method to find the first or the best scoring derivation of a list
+        of repetitions of a symbol for a span of words.
+
+        The first derivation has repetitions matching as many words as possible.
+        Derivations are found iteratively to allow any number of repetitions.
+
+        :param child: int
+        :param start: int
+        :param end: int
+        :param best: bool
+        :param in_progress: set
+        :returns: ((score, list of derivations) | None, whether the result can
+            be cached)
+        """
+        if start == end:
+            # Repeat expansions that can match nothing match one empty
+            # repetition. KleeneStar expansions match zero repetitions.
+            result, cacheable = self._derive(child, start, end, best, in_progress)
+            if result is None:
+                return (0.0, []), cacheable
+            return (result[0], [result[1]]), cacheable
+
+        # Find the positions from which the rest of the span can be matched by
+        # non-empty repetitions, along with the score of the rest of the span and
+        # the derivation for the next repetition.
+        cacheable = True
+        next_repetition = {end: (0.0, None)}
+        for m in range(end - 1, start - 1, -1):
+            ends = sorted(self._completed.get((child, m), ()), reverse=True)
+            for e in ends:
+                if e > end or e == m or e not in next_repetition:
+                    continue
+                result, can_cache = self._derive(child, m, e, best, in_progress)
+                cacheable = cacheable and can_cache
+                if result is None:
+                    continue
+                score = result[0] + next_repetition[e][0]
+                current = next_repetition.get(m)
+                if current is None or score > current[0]:
+                    next_repetition[m] = (score, result[1])
+                if not best:
+                    break
+
+        if start not in next_repetition:
+            return None, cacheable
+
+        derivations = []
+        m = start
+        while m != end:
+            derivation = next_repetition[m][1]
+            derivations.append(derivation)
+            m = derivation[2]
+        return (next_repetition[start][0], derivations), cacheable
+
+    def _derive_sequence(self, p, dot, start, end, best, in_progress):
+        """
+        Internal method to find the first or the best scoring derivation of the
+        rest of a production's symbols for a span of words.
+
+        :returns: ((score, list of derivations) | None, whether the result can
+            be cached)
+        """
+        key = (p, dot, start, end)
+        memo = self._sequence_derivations[best]
+        if key in memo:
+            return memo[key], True
+
+        parser = self._parser
+        rhs = parser._rhs[p]
+        result, cacheable = None, True
+        if dot == len(rhs):
+            if start == end:
+                result = (0.0, [])
+        else:
+            symbol = rhs[dot]
+            last = dot == len(rhs) - 1
+            if symbol.__class__ is int:
+                # Try the longest spans first, except for Dictation expansions,
+                # which stop before words the rest of the sequence can match.
+                ends = self._completed.get((symbol, start), ())
+                if last:
+                    ends = [end]
+                else:
+                    ends = sorted(ends, reverse=not isinstance(
+                        parser._nodes[symbol], parser._dictation_class))
+                for m in ends:
+                    if m > end:
+                        continue
+                    derivation, can_cache = self._derive(symbol, start, m, best,
+                                                         in_progress)
+                    cacheable = cacheable and can_cache
+                    if derivation is None:
+                        continue
+                    rest, can_cache = self._derive_sequence(p, dot + 1, m, end,
+                                                            best, in_progress)
+                    cacheable = cacheable and can_cache
+                    if rest is None:
+                        continue
+                    score = derivation[0] + rest[0]
+                    if result is None or score > result[0]:
+                        result = (score, [derivation[1]] + rest[1])
+                    if not best:
+                        break
+            elif start < end and parser._terminal_matches(
+                    symbol, self._words[start]):
+                rest, cacheable = self._derive_sequence(p, dot + 1, start + 1,
+                                                        end, best, in_progress)
+                if rest is not None:
+                    result = (rest[0], [start] + rest[1])
+
+        if result is not None or cacheable:
+            memo[key] = result
+        return result, cacheable
+
+    def _slice(self, start, end):
+        spans = self._spans
+        if start < end:
+            return slice(spans[start][0], spans[end - 1][1])
+        position = spans[start][0] if start < len(spans) else len(self._speech)
+        return slice(position, position)
+
+    def _apply(self, derivation):
+        """
+        Internal method to set match data using a derivation.
+
+        :param derivation: tuple
+        """
+        parser = self._parser
+        symbol, start, end, children = derivation
+        e = parser._nodes[symbol]
+
+        if start == end:
+            # Only set match data for the outermost expansion matching nothing,
+            # as the default backend does.
+            pass
+        elif isinstance(e, Repeat):
+            # Save the match data of each expansion that matched in each
+            # repetition.
+            e._repetitions_matched = []
+            child_symbols = self._reachable_symbols(parser._symbols[id(e.child)])
+            child_nodes = [parser._nodes[s] for s in child_symbols]
+            for i, repetition in enumerate(children):
+                self._apply(repetition)
+                e._repetitions_matched.append(tuple(
+                    (x, (x.current_match, x.matching_slice))
+                    for x in child_nodes if x.matching_slice is not None
+                ))
+                if i < len(children) - 1:
+                    self._reset_match_data(child_symbols)
+        else:
+            for child in children:
+                if child.__class__ is not int:
+                    self._apply(child)
+
+        if start == end:
+            e.current_match = ""
+        else:
+            # Words have no whitespace, so current_match can be set directly.
+            e._match_span = None
+            e._current_match = " ".join(self._words[start:end])
+        e.matching_slice = self._slice(start, end)
@@ -0,0 +1,713 @@
+"""
+This module contains the ``CompiledMatcher`` class for matching speech using
+Python code generated specifically for one expansion tree.
+
+The generated source has one function for each expansion that matches speech
+word by word, comparing words with the literals in the tree directly. The
+alternatives of alternative sets are chosen using dictionaries keyed by the next
+word where possible and repeats are matched using loops. Spans of matched words
+are recorded in a preallocated list and only used to set match data once the
+whole tree has matched.
+
+The source is compiled once and can be inspected using the ``source``
+attribute. If a cache directory is given, compiled code objects are also saved
+there and loaded again for trees generating the same source::
+
+    matcher = CompiledMatcher(rule.expansion, cache_dir="/tmp/jsgf-cache")
+    print(matcher.source)
+    matcher.matches("hello world")
+
+Rules use compiled matchers if their ``matching_backend`` is
+``MatchBackend.Compiled``. Matchers are cached on the root expansion and are
+generated again after the expansion tree changes.
+
+Compiled matchers match speech like the ``pyparsing`` backend, except that only
+whole words are matched and rules that can match empty speech only match
+speech their whole expansion matches. For example, ``<rule> = [a];`` matches
+"b" with the ``pyparsing`` backend, but not with compiled matchers. Sequences,
+optional groupings and repeats match as much as possible without backtracking
+and alternative sets match their longest alternative. Expansion types without generated code, such as ``Dictation`` and
+``WordList``, are matched using their ``matcher_element`` instead.
+"""
+
+import hashlib
+import marshal
+import os
+import platform
+import sys
+import tempfile
+
+import pyparsing
+
+from .expansions import AlternativeSet, Literal, NamedRuleRef, NullRef, \
+    OptionalGrouping, Repeat, Sequence, VoidRef
+from .utterances import make_utterance
+
+# Suffix of code object files saved in cache directories. Marshal formats differ
+# between Python implementations and versions.
+_CACHE_SUFFIX = "-%s%d%d.marshal" % ((platform.python_implementation().lower(),)
+                                     + tuple(sys.version_info[:2]))
+
+# Arguments of generated functions that record spans and of functions that
+# only test whether speech matches.
+_RECORD_ARGS = "u, w, n, p, s, r"
+_TEST_ARGS = "u, w, n, p"
+
+
+def _node_kind(e):
+    """
+    Internal function to get the expansion class generated code is based on for an
+    expansion, or None if its matcher element has to be used. Subclasses are only
+    matched like their base class if they use its matcher element.
+
+    :param e: Expansion
+    :returns: type | None
+    """
+    for cls in type(e).__mro__:
+        if "_make_matcher_element" in cls.__dict__:
+            if cls in (Literal, Sequence, AlternativeSet, OptionalGrouping,
+                       Repeat, NamedRuleRef, NullRef, VoidRef):
+                return cls
+            return None
+    return None
+
+
+def _fallback_match(e, utterance, n, p):
+    """
+    Internal function to match words using an expansion's matcher element.
+
+    :param e: Expansion
+    :param utterance: Utterance
+    :param n: number of words
+    :param p: index of the first word to match
+    :returns: index after the last matched word or -1
+    """
+    text, spans = utterance.text, utterance.spans
+    start = spans[p][0] if p < n else len(text)
+    try:
+        end = e.matcher_element.tryParse(text, start)
+    except (pyparsing.ParseException, IndexError):
+        return -1
+
+    # Only accept matches ending at the end of a word.
+    if end <= start:
+        return p
+    index = utterance.word_index(end)
+    if spans[index - 1][1] != end:
+        return -1
+    return index
+
+
+def _load_code(source, cache_dir):
+    """
+    Internal function to compile generated source, using the code object saved
+    in the cache directory if there is one.
+
+    :param source: str
+    :param cache_dir: str | None
+    :returns: code object
+    """
+    if cache_dir is None:
+        return compile(source, "<jsgf matcher>", "exec")
+
+    key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, key + _CACHE_SUFFIX)
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+
+    # Write the code object to a temporary file first so that other processes
+    # never load partially written files.
+    code = compile(source, "<jsgf matcher>", "exec")
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(code, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+    return code
+
+
+class _SourceGenerator(object):
+    """
+    Internal class for generating the source of a compiled matcher.
+
+    Expansions are numbered in pre-order, so each subtree has a contiguous range
+    of indices. Referenced rule expansion trees are numbered after the tree and
+    are only included once.
+    """
+    def __init__(self, expansion):
+        self.nodes = []
+        self.parents = []
+        self.kinds = []
+        self.references = {}
+        self._roots = {}
+        self._ends = []
+        self._first_words = {}
+        self._functions = {}
+        self._tables = []
+        self._generated = set()
+        self._pending = []
+
+        # Number each expansion tree, including referenced trees found while
+        # numbering.
+        trees = [expansion]
+        while trees:
+            e = trees.pop(0)
+            self._roots[id(e)] = len(self.nodes)
+            self._number(e, -1, trees)
+
+        # Generate the functions required to match the tree.
+        self._function(0)
+        while self._pending:
+            self._generate(self._pending.pop())
+
+    @property
+    def source(self):
+        """
+        The generated source.
+
+        :returns: str
+        """
+        lines = []
+        for index in sorted(self._functions):
+            lines.extend(self._functions[index])
+        return "\n".join(lines + [""] + self._tables) + "\n"
+
+    def _number(self, e, parent, trees):
+        # Number e and its descendants in pre-order.
+        stack = [(e, parent)]
+        while stack:
+            x, parent = stack.pop()
+            index = len(self.nodes)
+            kind = _node_kind(x)
+            self.nodes.append(x)
+            self.parents.append(parent)
+            self.kinds.append(kind)
+            self._ends.append(None)
+            if kind is NamedRuleRef:
+                root = x.referenced_rule.expansion
+                if id(root) not in self._roots and \
+                        not any(t is root for t in trees):
+                    trees.append(root)
+                self.references[index] = root
+                self._ends[index] = index + 1
+            elif kind is not None:
+                stack.append((None, index))
+                stack.extend((c, index) for c in reversed(x.children))
+            else:
+                self._ends[index] = index + 1
+
+            # Record the end of each subtree using the markers pushed above.
+            while stack and stack[-1][0] is None:
+                _, finished = stack.pop()
+                self._ends[finished] = len(self.nodes)
+
+    def root_index(self, index):
+        """
+        Get the index of the root expansion referenced by a NamedRuleRef.
+
+        :param index: int
+        :returns: int
+        """
+        return self._roots[id(self.references[index])]
+
+    def subtree_ranges(self, index):
+        """
+        Get the ranges of indices of an expansion's subtree and of any referenced
+        trees that can be matched by it.
+
+        :param index: int
+        :returns: list
+        """
+        ranges = []
+        pending = [index]
+        seen = set()
+        while pending:
+            start = pending.pop(0)
+            if start in seen:
+                continue
+            seen.add(start)
+            end = self._ends[start]
+            ranges.append((start, end))
+            for i in range(start, end):
+                if i in self.references:
+                    pending.append(self.root_index(i))
+        return ranges
+
+    def _function(self, index):
+        # Get the name of the functions for an expansion, generating them later
+        # if necessary.
+        if index not in self._generated:
+            self._generated.add(index)
+            self._pending.append(index)
+        return "m%d" % index, "t%d" % index
+
+    def _call(self, index, q, record):
+        m, t = self._function(index)
+        if record:
+            return "%s(u, w, n, %s, s, r)" % (m, q)
+        return "%s(u, w, n, %s)" % (t, q)
+
+    def _words(self, index):
+        return tuple(self.nodes[index].text.split())
+
+    def _literal_expression(self, index, q):
+        # Get an expression matching a literal's words at position q.
+        words = self._words(index)
+        k = len(words)
+        if k == 0:
+            return q
+        if k == 1:
+            return "%s + 1 if %s < n and w[%s] == %r else -1" % (q, q, q, words[0])
+        return "%s + %d if w[%s:%s + %d] == %r else -1" % (q, k, q, q, k, words)
+
+    def _children(self, index):
+        # Get the indices of an expansion's children.
+        result = []
+        i = index + 1
+        end = self._ends[index]
+        while i < end:
+            result.append(i)
+            i = self._ends[i]
+        return result
+
+    def first_words(self, index, visiting=None):
+        """
+        Get the set of words an expansion's matches can start with, or None if it
+        is not known or if the expansion can match no words.
+
+        :param index: int
+        :param visiting: set of indices of NamedRuleRefs being visited
+        :returns: frozenset | None
+        """
+        if index in self._first_words:
+            return self._first_words[index]
+
+        kind = self.kinds[index]
+        result = None
+        if kind is Literal:
+            words = self._words(index)
+            if words:
+                result = frozenset(words[:1])
+        elif kind is Sequence:
+            children = self._children(index)
+            if children:
+                result = self.first_words(children[0], visiting)
+        elif kind is AlternativeSet:
+            children = self._alternatives(index)
+            if children:
+                result = frozenset()
+                for c in children:
+                    words = self.first_words(c, visiting)
+                    if words is None:
+                        result = None
+                        break
+                    result = result | words
+        elif kind is Repeat:
+            if not self.nodes[index].is_optional:
+                result = self.first_words(index + 1, visiting)
+        elif kind is NamedRuleRef:
+            # Don't follow recursive references.
+            visiting = visiting or set()
+            if index not in visiting:
+                visiting.add(index)
+                result = self.first_words(self.root_index(index), visiting)
+                visiting.discard(index)
+                self._first_words[index] = result
+            return result
+
+        self._first_words[index] = result
+        return result
+
+    def _alternatives(self, index):
+        # Get the indices of the alternatives that can be matched, in order.
+        positions = dict((id(self.nodes[c]), c) for c in self._children(index))
+        return [positions[id(e)] for e in self.nodes[index]._matched_children()]
+
+    def _generate(self, index):
+        kind = self.kinds[index]
+        name = kind.__name__ if kind else type(self.nodes[index]).__name__
+        lines = self._functions[index] = ["# %d: %s" % (index, name)]
+        for record in (True, False):
+            prefix, args = ("m", _RECORD_ARGS) if record else ("t", _TEST_ARGS)
+            lines.append("def %s%d(%s):" % (prefix, index, args))
+            if kind is Literal:
+                body = self._literal_body(index, record)
+            elif kind is Sequence:
+                body = self._sequence_body(index, record)
+            elif kind is AlternativeSet:
+                body = self._alternative_set_body(index, record)
+            elif kind is OptionalGrouping:
+                body = self._optional_body(index, record)
+            elif kind is Repeat:
+                body = self._repeat_body(index, record)
+            elif kind is NamedRuleRef:
+                body = self._reference_body(index, record)
+            elif kind is NullRef:
+                body = ["s[%d] = (p, p)" % index] if record else []
+                body.append("return p")
+            elif kind is VoidRef:
+                body = ["return -1"]
+            else:
+                body = self._fallback_body(index, record)
+            lines.extend("    " + line for line in body)
+            lines.append("")
+
+    def _record_result(self, index, expression, record):
+        # Get lines returning the result of an expression and recording it.
+        if not record:
+            return ["return %s" % expression]
+        return [
+            "e = %s" % expression,
+            "if e >= 0:",
+            "    s[%d] = (p, e)" % index,
+            "return e",
+        ]
+
+    def _literal_body(self, index, record):
+        return self._record_result(index, self._literal_expression(index, "p"),
+                                   record)
+
+    def _fallback_body(self, index, record):
+        if record:
+            self._tables.append("E%d = nodes[%d]" % (index, index))
+        return self._record_result(index, "F(E%d, u, n, p)" % index, record)
+
+    def _reference_body(self, index, record):
+        return self._record_result(
+            index, self._call(self.root_index(index), "p", record), record)
+
+    def _sequence_body(self, index, record):
+        lines = ["q = p"]
+        for c in self._children(index):
+            literal = self.kinds[c] is Literal
+            if literal:
+                lines.append("e = %s" % self._literal_expression(c, "q"))
+            else:
+                lines.append("e = %s" % self._call(c, "q", record))
+            lines.extend(["if e < 0:", "    return -1"])
+            if literal and record:
+                lines.append("s[%d] = (q, e)" % c)
+            lines.append("q = e")
+        if record:
+            lines.append("s[%d] = (p, q)" % index)
+        lines.append("return q")
+        return lines
+
+    def _optional_body(self, index, record):
+        lines = [
+            "e = %s" % self._call(index + 1, "p", record),
+            "if e < 0:",
+            "    e = p",
+        ]
+        if record:
+            lines.append("s[%d] = (p, e)" % index)
+        lines.append("return e")
+        return lines
+
+    def _alternative_set_body(self, index, record):
+        children = self._alternatives(index)
+        if not self._children(index):
+            # Empty alternative sets are matched like <NULL>.
+            return (["s[%d] = (p, p)" % index] if record else []) + ["return p"]
+        if not children:
+            return ["return -1"]
+
+        # Match literals by looking up the literals starting with the next word.
+        # Longer literals are tried first.
+        first_words = [self.first_words(c) for c in children]
+        if (all(self.kinds[c] is Literal for c in children) and
+                None not in first_words):
+            ordered = sorted(enumerate(children),
+                             key=lambda x: (-len(self._words(x[1])), x[0]))
+            table = {}
+            for _, c in ordered:
+                words = self._words(c)
+                table.setdefault(words[0], []).append((words, c))
+            if record:
+                self._tables.append("L%d = %s" % (index, self._dict_source(
+                    (word, "(%s,)" % ", ".join("(%r, %d)" % x for x in items))
+                    for word, items in table.items()
+                )))
+            lines = [
+                "if p < n:",
+                "    for k, c in L%d.get(w[p], ()):" % index,
+                "        e = p + len(k)",
+                "        if w[p:e] == k:",
+            ]
+            if record:
+                lines.extend(["            s[c] = (p, e)",
+                              "            s[%d] = (p, e)" % index])
+            lines.extend(["            return e", "return -1"])
+            return lines
+
+        # Dispatch on the next word if the words each alternative starts with are
+        # known. Otherwise try every alternative.
+        if None not in first_words:
+            table = {}
+            for c, words in zip(children, first_words):
+                for word in words:
+                    table.setdefault(word, []).append(c)
+            if record:
+                self._tables.append("D%d = %s" % (index, self._dict_source(
+                    (word, self._candidates_source(items))
+                    for word, items in table.items()
+                )))
+            lines = [
+                "if p >= n:",
+                "    return -1",
+                "k = D%d.get(w[p])" % index,
+                "if k is None:",
+                "    return -1",
+            ]
+        else:
+            if record:
+                self._tables.append("A%d = %s" % (
+                    index, self._candidates_source(children)))
+            lines = ["k = A%d" % index]
+
+        # Use the longest match. The first alternative is used for ties.
+        if not record:
+            return lines + [
+                "x = -1",
+                "for t, m in k:",
+                "    e = t(u, w, n, p)",
+                "    if e > x:",
+                "        x = e",
+                "return x",
+            ]
+        return lines + [
+            "if len(k) == 1:",
+            "    e = k[0][1](u, w, n, p, s, r)",
+            "else:",
+            "    b = None",
+            "    x = -1",
+            "    for t, m in k:",
+            "        e = t(u, w, n, p)",
+            "        if e > x:",
+            "            x = e",
+            "            b = m",
+            "    if b is None:",
+            "        return -1",
+            "    e = b(u, w, n, p, s, r)",
+            "if e >= 0:",
+            "    s[%d] = (p, e)" % index,
+            "return e",
+        ]
+
+    def _candidates_source(self, children):
+        return "(%s,)" % ", ".join(
+            "(%s, %s)" % tuple(reversed(self._function(c))) for c in children
+        )
+
+    @staticmethod
+    def _dict_source(items):
+        return "{%s}" % ", ".join("%r: %s" % item for item in sorted(items))
+
+    def _repeat_body(self, index, record):
+        e = self.nodes[index]
+        child = index + 1
+
+        # Match the child once if the repeat is the only branch of a repetition
+        # ancestor's child, as the matcher element would.
+        once = False
+        ancestor = e.repetition_ancestor
+        if ancestor:
+            c = ancestor.child
+            once = True
+            while c is not e:
+                if len(c.children) > 1:
+                    once = False
+                    break
+                c = c.children[0]
+
+        # Repeats with optional ancestors can match nothing, except when matched
+        # once.
+        required = once or not e.is_optional
+
+        if not record:
+            # Only keep track of whether the child matched if it has to.
+            lines = ["q = p"] + (["k = False"] if required else []) + [
+                "while True:",
+                "    e = %s" % self._call(child, "q", False),
+                "    if e < 0:",
+                "        break",
+            ] + (["    k = True"] if required else []) + [
+                "    if e == q:",
+                "        break",
+                "    q = e",
+            ]
+            if once:
+                lines.append("    break")
+            if required:
+                lines.extend(["if not k:", "    return -1"])
+            return lines + ["return q"]
+
+        # Save the spans recorded in each repetition and reset them before the
+        # next one. The last repetition's spans are restored at the end.
+        # Repetitions of repeats in the subtree are saved too.
+        ranges = self.subtree_ranges(child)
+        saved = ["s[%d:%d]" % r for r in ranges]
+        nested = [r for r in ranges
+                  if any(self.kinds[i] is Repeat for i in range(*r))]
+        saved.extend("r[%d:%d]" % r for r in nested)
+        for i, (start, end) in enumerate(ranges):
+            self._tables.append("N%d_%d = (None,) * %d" % (index, i, end - start))
+
+        lines = [
+            "x = []",
+            "q = p",
+            "while True:",
+            "    e = %s" % self._call(child, "q", True),
+            "    if e < 0:",
+            "        break",
+            "    x.append((%s,))" % ", ".join(saved),
+        ]
+        lines.extend("    s[%d:%d] = N%d_%d" % (start, end, index, i)
+                     for i, (start, end) in enumerate(ranges))
+        lines.extend([
+            "    if e == q:",
+            "        break",
+            "    q = e",
+        ])
+        if once:
+            lines.append("    break")
+        lines.append("if x:")
+        lines.append("    y = x[-1]")
+        lines.extend("    %s = y[%d]" % (target, i)
+                     for i, target in enumerate(saved))
+        if required:
+            lines.extend(["else:", "    return -1"])
+        lines.extend([
+            "r[%d] = x" % index,
+            "s[%d] = (p, q)" % index,
+            "return q",
+        ])
+        return lines
+
+
+class CompiledMatcher(object):
+    """
+    Matcher for an expansion tree using generated and compiled Python code.
+
+    Matchers are snapshots: changes made to the expansion tree after a matcher
+    was created are not reflected. Use ``get_compiled_matcher`` to get a matcher
+    that is created again when the tree changes.
+    """
+    def __init__(self, expansion, cache_dir=None):
+        """
+        :param expansion: Expansion
+        :param cache_dir: directory to save and load compiled code in, if any
+        :raises: GrammarError
+        """
+        generator = _SourceGenerator(expansion)
+        self.expansion = expansion
+        self.source = generator.source
+        self._nodes = generator.nodes
+        self._parents = generator.parents
+        self._references = generator.references
+        self._repeat_ranges = dict(
+            (i, generator.subtree_ranges(i + 1))
+            for i, kind in enumerate(generator.kinds) if kind is Repeat
+        )
+
+        namespace = {"F": _fallback_match, "nodes": self._nodes}
+        exec(_load_code(self.source, cache_dir), namespace)
+        self._match = namespace["m0"]
+
+    def matches(self, speech):
+        """
+        Whether speech matches the expansion tree completely. If it does, match
+        data is set for each expansion in the tree and in referenced rules.
+        Otherwise match data is reset.
+
+        :param speech: str | list | Utterance
+        :returns: bool
+        """
+        utterance = make_utterance(speech)
+        words = utterance.words
+        n = len(words)
+        size = len(self._nodes)
+        spans = [None] * size
+        repetitions = [None] * size
+        if self._match(utterance, words, n, 0, spans, repetitions) != n:
+            for x in self._nodes:
+                x.reset_match_data()
+            return False
+
+        self._set_match_data(utterance, spans, repetitions)
+        return True
+
+    def _speech_span(self, utterance, span):
+        # Convert a span of words into a span of the speech string.
+        text, spans = utterance.text, utterance.spans
+        start, end = span
+        if start < end:
+            return text, spans[start][0], spans[end - 1][1]
+        offset = spans[start][0] if start < len(spans) else len(text)
+        return text, offset, offset
+
+    def _set_match_data(self, utterance, spans, repetitions):
+        # Set match data for expansions that matched as part of their parent's
+        # match and reset it for the others. Like the pyparsing backend, the
+        # descendants of expansions that matched no words are reset, except for
+        # rule references. Parents come before their children.
+        nodes, parents = self._nodes, self._parents
+        matched = [False] * len(nodes)
+        for i, x in enumerate(nodes):
+            span = spans[i]
+            parent = parents[i]
+            if span is None or not (parent < 0 or matched[parent] or
+                                    i in self._references):
+                x.reset_match_data()
+                continue
+
+            matched[i] = span[0] < span[1]
+            x._match_span = self._speech_span(utterance, span)
+            if i in self._repeat_ranges:
+                x._repetitions_matched = [
+                    self._repetition_entries(i, saved, utterance)
+                    for saved in repetitions[i]
+                ]
+
+    def _repetition_entries(self, index, saved, utterance):
+        # Get the (expansion, span) entries of one repetition of a repeat.
+        nodes, parents = self._nodes, self._parents
+        entries = []
+        matched = set([index])
+        for (start, end), spans in zip(self._repeat_ranges[index], saved):
+            for i in range(start, end):
+                span = spans[i - start]
+                parent = parents[i]
+                if span is not None and (parent < 0 or parent in matched):
+                    if span[0] < span[1]:
+                        matched.add(i)
+                    entries.append(
+                        (nodes[i], self._speech_span(utterance, span))
+                    )
+        return tuple(entries)
+
+
+def get_compiled_matcher(expansion, cache_dir=None):
+    """
+    Get the compiled matcher for an expansion tree, creating it if the tree has
+    changed since it was last created.
+
+    Each expansion in the tree and in referenced rules is marked so that changes
+    to them invalidate the matcher like they invalidate ``matcher_element``.
+
+    :param expansion: Expansion
+    :param cache_dir: directory to save and load compiled code in, if any
+    :returns: CompiledMatcher
+    :raises: GrammarError
+    """
+    matcher = expansion._compiled_matcher
+    if matcher is None or matcher.expansion is not expansion:
+        matcher = CompiledMatcher(expansion, cache_dir)
+        for x in matcher._nodes:
+            x._compiled_matcher = matcher
+    return matcher
@@ -3,13 +3,21 @@ This module contains classes for compiling and matching JSpeech Grammar Format r
 expansions.
 """
 import re
-from copy import deepcopy
+import threading
+import weakref
+from collections import namedtuple
 
 import pyparsing
 from six import string_types, PY2, integer_types
 
 from .errors import CompilationError, GrammarError
-from .references import BaseRef, optionally_qualified_name
+from .references import (BaseRef, optionally_qualified_name,
+                         optionally_qualified_name_regex, _bulk_build_state)
+
+
+# Expansions that have unfinished lazy copies, keyed by ID. IDs are used instead of
+# a WeakSet because expansion hashes and comparisons are structural.
+_lazy_copy_sources = weakref.WeakValueDictionary()
 
 
 class TraversalOrder(object):
@@ -185,6 +193,110 @@ def matches_overlap(m1, m2):
     return x1 < x2 <= y1 or x2 < x1 <= y2 or x1 == x2
 
 
+# Regular expression used to check whether recorded spans of speech are empty.
+_non_whitespace_regex = re.compile(r"\S", re.UNICODE)
+
+
+# Summary of an expansion tree. Counts include the leaves of referenced rules.
+_ExpansionSummary = namedtuple("_ExpansionSummary", [
+    "leaf_count", "literal_count", "dictation_count", "can_match_empty"
+])
+
+# Summary used for references back to a rule being summarised.
+_RECURSIVE_SUMMARY = _ExpansionSummary(0, 0, 0, False)
+
+# Vocabulary of an expansion tree, not including referenced rules: the words its
+# literals can match, its rule references and whether it can match words that
+# aren't known in advance, e.g. using Dictation expansions.
+_Vocabulary = namedtuple("_Vocabulary", ["words", "references", "is_open"])
+
+_EMPTY_VOCABULARY = _Vocabulary(frozenset(), (), False)
+_OPEN_VOCABULARY = _Vocabulary(frozenset(), (), True)
+
+
+def _calculate_summary(e):
+    """
+    Internal function to calculate the summary of an expansion tree iteratively.
+
+    Summaries are cached on expansions unless their trees contain rule references.
+    Referenced rules can change without the referencing trees being notified, so
+    summaries of those trees are calculated from their children each time.
+
+    :param e: Expansion
+    :returns: _ExpansionSummary
+    """
+    # Map expansion IDs to (summary, cacheable) tuples.
+    done = {}
+    in_progress = set()
+    stack = [(e, False)]
+    while stack:
+        x, children_done = stack.pop()
+        key = id(x)
+        if key in done:
+            continue
+
+        if not children_done:
+            if x._summary is not None:
+                done[key] = (x._summary, True)
+                continue
+
+            in_progress.add(key)
+            stack.append((x, True))
+            for child in x._summary_children:
+                if id(child) not in done and id(child) not in in_progress:
+                    stack.append((child, False))
+            continue
+
+        # Calculate x's summary from its children's summaries.
+        cacheable = not isinstance(x, NamedRuleRef)
+        summaries = []
+        for child in x._summary_children:
+            entry = done.get(id(child))
+            if entry is None:
+                # Recursive reference.
+                summaries.append(_RECURSIVE_SUMMARY)
+                cacheable = False
+            else:
+                summaries.append(entry[0])
+                cacheable = cacheable and entry[1]
+
+        summary = x._summarize(summaries)
+        in_progress.discard(key)
+        if cacheable:
+            x._summary = summary
+        done[key] = (summary, cacheable)
+
+    return done[id(e)][0]
+
+
+def _calculate_vocabulary(e):
+    """
+    Internal function to calculate the vocabulary of an expansion tree
+    iteratively. The vocabulary of each expansion in the tree is cached.
+
+    :param e: Expansion
+    :returns: _Vocabulary
+    """
+    stack = [(e, False)]
+    while stack:
+        x, children_done = stack.pop()
+        if x._vocabulary is not None:
+            continue
+
+        children = x.children
+        if children and not children_done:
+            stack.append((x, True))
+            stack.extend([(child, False) for child in children
+                          if child._vocabulary is None])
+            continue
+
+        x._vocabulary = x._combine_vocabularies(
+            [child._vocabulary for child in children]
+        )
+
+    return e._vocabulary
+
+
 class JointTreeContext(object):
     """
     Class that temporarily joins an expansion tree with the expansion trees of all
@@ -237,6 +349,456 @@ class JointTreeContext(object):
         map_expansion(self._root, self.detach_tree, TraversalOrder.PostOrder)
 
 
+class BulkBuildContext(object):
+    """
+    Class that speeds up building large expansion trees and grammars
+    programmatically.
+
+    While a bulk build is in progress, ``Expansion.invalidate_matcher`` calls
+    caused by setting parents or changing child lists are deferred and the
+    validation of reference names (e.g. rule names) is skipped. On ``__exit__``,
+    each affected expansion's matcher element is invalidated once and each name
+    set during the build is validated with compiled regular expressions, which is
+    much faster than using ``pyparsing`` elements.
+
+    If an invalid name was used, a ``GrammarError`` is raised on ``__exit__``.
+
+    Bulk builds can be nested; the work is only done when the outermost one exits.
+
+    Bulk builds are per thread: only changes made in the thread that entered the
+    context are deferred. Changes made in other threads at the same time are
+    handled normally. Trees being bulk built should not be changed by other
+    threads until the build has finished.
+
+    This class can be used with Python's ``with`` statement. The ``bulk_build``
+    function can be used instead of the class constructor::
+
+        with bulk_build():
+            rules = [PublicRule("r%d" % i, AlternativeSet(*words))
+                     for i, words in enumerate(word_lists)]
+            grammar.add_rules(*rules)
+    """
+
+    def __enter__(self):
+        _bulk_build_state.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        state = _bulk_build_state
+        state.depth -= 1
+        if state.depth:
+            return
+
+        pending_expansions = state.pending_expansions
+        pending_refs = state.pending_refs
+        state.pending_expansions = []
+        state.pending_refs = []
+
+        # Invalidate the matcher element of each affected expansion once.
+        seen = set()
+        for e in pending_expansions:
+            if id(e) not in seen:
+                seen.add(id(e))
+                e.invalidate_matcher()
+
+        # Don't validate names if an exception was raised during the build.
+        if exc_type is not None:
+            return
+
+        # Validate the names of each reference that had its name set.
+        seen = set()
+        for ref in pending_refs:
+            if id(ref) in seen:
+                continue
+            seen.add(id(ref))
+            if not ref.fast_valid(ref.name):
+                raise GrammarError("'%s' is not a valid %s name"
+                                   % (ref.name, ref.__class__.__name__))
+
+
+def bulk_build():
+    """
+    Get a new ``BulkBuildContext`` for use with Python's ``with`` statement.
+
+    :returns: BulkBuildContext
+    """
+    return BulkBuildContext()
+
+
+class _MatchMemoState(threading.local):
+    """
+    Internal class for storing the memo used while matching in each thread, if
+    there is one.
+    """
+    def __init__(self):
+        self.memo = None
+
+
+_match_memo_state = _MatchMemoState()
+
+
+class RuleMatchMemo(object):
+    """
+    Table of the results of matching referenced rules at positions in a speech
+    string.
+
+    While a memo is in use, ``NamedRuleRef`` expansions look up the result of
+    matching their referenced rule at the current position before matching it.
+    Results include the match data of the referenced rule's expansions, which is
+    restored instead of matching the rule again. This speeds up matching many
+    rules that reference the same rules against one utterance.
+
+    Results are only kept for one speech string at a time and are cleared
+    automatically when a different string is matched. Referenced rules must not be
+    changed while a memo is in use. A memo is only used by the thread that
+    entered it.
+
+    This class can be used with Python's ``with`` statement::
+
+        with RuleMatchMemo():
+            result = [r for r in rules if r.matches(speech)]
+    """
+    def __init__(self):
+        self._speech = None
+        self._results = {}
+        self._nodes = {}
+        self._previous = None
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        self._previous = _match_memo_state.memo
+        _match_memo_state.memo = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _match_memo_state.memo = self._previous
+        self._previous = None
+
+    def clear(self):
+        """
+        Clear the results stored in this memo.
+        """
+        self._speech = None
+        self._results = {}
+        self._nodes = {}
+
+    def _rule_nodes(self, rule):
+        """
+        Internal method to get the expansions in a rule's tree and the trees of
+        rules it references.
+
+        :param rule: Rule
+        :returns: list
+        """
+        nodes = self._nodes.get(id(rule))
+        if nodes is None:
+            nodes = rule._get_tree_expansions()
+            self._nodes[id(rule)] = nodes
+        return nodes
+
+    def _match(self, rule, element, instring, loc, do_actions):
+        """
+        Internal method to match a referenced rule's parser element at a position
+        using the stored result if there is one.
+
+        :returns: (int, pyparsing.ParseResults)
+        :raises: pyparsing.ParseBaseException
+        """
+        if instring != self._speech:
+            self.clear()
+            self._speech = instring
+
+        key = (id(rule), loc, do_actions)
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            try:
+                end, tokens = element._parse(instring, loc, do_actions,
+                                             callPreParse=False)
+            except pyparsing.ParseBaseException as e:
+                self._results[key] = (None, e, None)
+                raise
+
+            # Save the match data set by the referenced rule's parse actions.
+            data = None
+            if do_actions:
+                data = [(x, x._current_match, x._matching_slice, x._match_span,
+                         list(x._repetitions_matched)
+                         if isinstance(x, Repeat) else None)
+                        for x in self._rule_nodes(rule)]
+            self._results[key] = (end, tokens.copy(), data)
+            return end, tokens
+
+        self.hits += 1
+        end, tokens, data = result
+        if end is None:
+            raise tokens
+
+        # Restore the saved match data.
+        if data:
+            log = _repetition_state.log if _repetition_state.depth else None
+            for x, current_match, matching_slice, span, repetitions in data:
+                x._current_match = current_match
+                x._matching_slice = matching_slice
+                x._match_span = span
+                if repetitions is not None:
+                    x._repetitions_matched = list(repetitions)
+
+                # Record restored matches for repetitions being matched.
+                if log is None:
+                    continue
+                if span is not None:
+                    log.append((x, span))
+                elif matching_slice is not None:
+                    log.append((x, (current_match, matching_slice)))
+        return end, tokens.copy()
+
+
+class _MemoizedRuleElement(pyparsing.ParseElementEnhance):
+    """
+    Internal parser element for referenced rules that uses the current
+    ``RuleMatchMemo``, if there is one.
+    """
+    def __init__(self, rule, element):
+        super(_MemoizedRuleElement, self).__init__(element)
+        self._rule = rule
+
+    def parseImpl(self, instring, loc, doActions=True):
+        memo = _match_memo_state.memo
+        if memo is None:
+            return self.expr._parse(instring, loc, doActions, callPreParse=False)
+        return memo._match(self._rule, self.expr, instring, loc, doActions)
+
+
+def _span_match_data(span):
+    """
+    Internal function to get the matched string and slice of a recorded span of
+    speech. Whitespace skipped by parser elements is not included.
+
+    :param span: (speech, start, end) tuple
+    :returns: (str, slice)
+    """
+    speech, start, end = span
+    while start < end and speech[start].isspace():
+        start += 1
+    while end > start and speech[end - 1].isspace():
+        end -= 1
+    return speech[start:end], slice(start, end)
+
+
+class _RepetitionState(threading.local):
+    """
+    Internal class for storing matches recorded while repeated expansions are
+    being matched in each thread.
+
+    Each entry in the log is an (expansion, data) tuple where data is either a
+    (speech, start, end) span or a (current_match, matching_slice) tuple.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.log = []
+
+
+_repetition_state = _RepetitionState()
+
+
+def _repetition_match_data(e, data):
+    """
+    Internal function to get the match data of an expansion from a repetition log
+    entry's data, or the match data of an unmatched expansion if data is None.
+
+    :param e: Expansion
+    :param data: tuple | None
+    :returns: (current_match, matching_slice)
+    """
+    if data is None:
+        return e._current_match_value(None), None
+    if len(data) == 3:
+        text, matching_slice = _span_match_data(data)
+        return e._current_match_value(text), matching_slice
+    return data
+
+
+class _RepetitionElement(pyparsing.ParseElementEnhance):
+    """
+    Internal parser element for ``Repeat`` expansions that records the matches of
+    the expansion's descendants in each repetition.
+    """
+    def __init__(self, repeat, element):
+        super(_RepetitionElement, self).__init__(element)
+        self._repeat = repeat
+
+    def parseImpl(self, instring, loc, doActions=True):
+        if not doActions:
+            return self.expr._parse(instring, loc, doActions, callPreParse=False)
+
+        state = _repetition_state
+        repeat = self._repeat
+        repeat._pending_repetitions = []
+        repeat._log_start = repeat._log_position = len(state.log)
+        state.depth += 1
+        try:
+            return self.expr._parse(instring, loc, doActions, callPreParse=False)
+        finally:
+            state.depth -= 1
+            if not state.depth:
+                del state.log[:]
+
+    def __str__(self):
+        return str(self.expr)
+
+
+# First set of an expansion: the characters that speech matched by the expansion
+# can start with, whether the expansion can match nothing and the text of plain
+# literals. Characters are None if they are not known.
+_FirstSet = namedtuple("_FirstSet", ["chars", "can_match_empty", "text"])
+
+# First set used for expansions that can match any characters.
+_UNKNOWN_FIRST_SET = _FirstSet(None, True, None)
+
+# Value used for first sets being calculated, e.g. for recursive rules.
+_FIRST_SET_IN_PROGRESS = object()
+
+
+def _dispatch_table(first_sets):
+    """
+    Internal function to make a table mapping first characters to the indices of
+    alternatives that can match speech starting with them.
+
+    At most one alternative can match at any position in a speech string if the
+    alternatives cannot match nothing and alternatives sharing first characters
+    are plain literals that are not prefixes of each other. In this case the
+    longest match is the only match and the table is returned. Otherwise None is
+    returned.
+
+    :param first_sets: list of _FirstSet
+    :returns: dict | None
+    """
+    table = {}
+    for i, first_set in enumerate(first_sets):
+        if first_set.chars is None or first_set.can_match_empty:
+            return None
+        for c in first_set.chars:
+            table.setdefault(c, []).append(i)
+
+    for indices in table.values():
+        if len(indices) == 1:
+            continue
+
+        # A sorted list of strings has a string that is a prefix of another only
+        # if it is a prefix of the next string.
+        texts = [first_sets[i].text for i in indices]
+        if None in texts:
+            return None
+        texts.sort()
+        for t1, t2 in zip(texts, texts[1:]):
+            if t2.startswith(t1):
+                return None
+
+    return table
+
+
+class _FirstCharDispatch(pyparsing.ParseExpression):
+    """
+    Internal parser element for alternatives that cannot match at the same
+    position. Only the alternatives that can start with the next character are
+    tried.
+    """
+    def __init__(self, exprs, table):
+        super(_FirstCharDispatch, self).__init__(exprs)
+        self._table = dict((c, tuple(self.exprs[i] for i in indices))
+                           for c, indices in table.items())
+        self.mayReturnEmpty = False
+        self.errmsg = "Expected " + str(self)
+
+    def streamline(self):
+        # Don't merge nested elements because the table refers to them.
+        if not self.streamlined:
+            pyparsing.ParserElement.streamline(self)
+            for e in self.exprs:
+                e.streamline()
+        return self
+
+    def parseImpl(self, instring, loc, doActions=True):
+        # Alternatives skip whitespace themselves, so only skip it to find the
+        # next character.
+        exception = None
+        start = self.preParse(instring, loc)
+        if start < len(instring):
+            for e in self._table.get(instring[start], ()):
+                # Like Or elements, only run parse actions for the alternative
+                # that matches so that match data isn't set by failed attempts.
+                try:
+                    e.tryParse(instring, loc)
+                except (pyparsing.ParseException, IndexError) as err:
+                    exception = err
+                    continue
+                return e._parse(instring, loc, doActions)
+        if isinstance(exception, pyparsing.ParseException):
+            raise exception
+        raise pyparsing.ParseException(instring, loc, self.errmsg, self)
+
+    def __str__(self):
+        if hasattr(self, "name"):
+            return self.name
+        if self.strRepr is None:
+            self.strRepr = "{" + " | ".join(str(e) for e in self.exprs) + "}"
+        return self.strRepr
+
+
+class _LiteralTrie(pyparsing.Token):
+    """
+    Internal parser element for alternative sets of literals. The longest
+    matching literal is found using a character trie and its match data is set.
+    """
+    def __init__(self, literals):
+        super(_LiteralTrie, self).__init__()
+        self._literals = literals
+
+        # Nodes are dictionaries of characters to child nodes. The None key maps
+        # to the first literal with the text ending at the node.
+        self._trie = {}
+        for e in literals:
+            node = self._trie
+            for c in e.text:
+                node = node.setdefault(c, {})
+            node.setdefault(None, e)
+
+        self.mayReturnEmpty = None in self._trie
+        self.mayIndexError = False
+        self.errmsg = "Expected " + str(self)
+
+    def parseImpl(self, instring, loc, doActions=True):
+        node = self._trie
+        result, end = node.get(None), loc
+        for i in range(loc, len(instring)):
+            node = node.get(instring[i])
+            if node is None:
+                break
+            if None in node:
+                result, end = node[None], i + 1
+
+        if result is None:
+            raise pyparsing.ParseException(instring, loc, self.errmsg, self)
+
+        # Record the matched literal's match like its own matcher element would.
+        if doActions:
+            span = (instring, loc, end)
+            result._match_span = span
+            if _repetition_state.depth:
+                _repetition_state.log.append((result, span))
+        return end, result.text
+
+    def __str__(self):
+        if hasattr(self, "name"):
+            return self.name
+        if self.strRepr is None:
+            self.strRepr = "{" + " ^ ".join('"%s"' % e.text
+                                           for e in self._literals) + "}"
+        return self.strRepr
+
+
 class ChildList(list):
     """
     List subclass for expansion child lists.
@@ -260,8 +822,16 @@ class ChildList(list):
             seq = map(f, seq)
         super(ChildList, self).__init__(seq)
 
+    @classmethod
+    def _new_raw(cls, expansion):
+        # Create an empty ChildList for an expansion without validation.
+        result = list.__new__(cls)
+        result._expansion = expansion
+        return result
+
     def append(self, e):
         e = Expansion.make_expansion(e)
+        self._expansion._detach_lazy_copies()
         super(ChildList, self).append(e)
         e.parent = self._expansion
 
@@ -285,6 +855,7 @@ class ChildList(list):
         iterable = [Expansion.make_expansion(e) for e in iterable]
 
         # Set the parent of each to self._expansion.
+        self._expansion._detach_lazy_copies()
         for e in iterable:
             e.parent = self._expansion
 
@@ -294,12 +865,14 @@ class ChildList(list):
     def insert(self, index, e):
         # Make e an Expansion, call the super method and set e's parent.
         e = Expansion.make_expansion(e)
+        self._expansion._detach_lazy_copies()
         super(ChildList, self).insert(index, e)
         e.parent = self._expansion
 
     def pop(self, index=-1):
         # Pop item at the specified index (default -1), set its parent to None
         # and return it.
+        self._expansion._detach_lazy_copies()
         e = super(ChildList, self).pop(index)
         e.parent = None
         return e
@@ -307,6 +880,7 @@ class ChildList(list):
     def remove(self, value):
         # Set the parent before removing the expansion.
         # 'value' is not necessarily in the list, so we can't use that.
+        self._expansion._detach_lazy_copies()
         self[self.index(value)].parent = None
         super(ChildList, self).remove(value)
 
@@ -320,6 +894,7 @@ class ChildList(list):
         """
         # Convert the sequence to a sequence of Expansions if it isn't one.
         sequence = [Expansion.make_expansion(e) for e in sequence]
+        self._expansion._detach_lazy_copies()
 
         # Orphan the old children :-(
         def orphan(x):
@@ -347,6 +922,7 @@ class ChildList(list):
 
         # Convert value to Expansion appropriately.
         value = Expansion.make_expansion(value)
+        self._expansion._detach_lazy_copies()
 
         # Orphan the old child :-(
         self[i].parent = None
@@ -365,6 +941,37 @@ class Expansion(object):
 
     _NO_CALCULATION = object()
 
+    # Values to reset in copies made by _copy_node.
+    _copy_reset_values = {
+        "_parent": None, "_children": None, "_lazy_source": None,
+        "_matcher_element": None, "_current_match": None,
+        "_matching_slice": None, "_lookup_dict": None, "rule": None,
+        "_summary": None, "_first_set": None, "_match_span": None,
+        "_match_end": None, "_compiled_matcher": None, "_vocabulary": None
+    }
+
+    # Cached summary of this expansion tree. This is reset whenever the tree
+    # changes.
+    _summary = None
+
+    # Cached vocabulary of this expansion tree. This is reset whenever the tree
+    # or the text of a literal in it changes.
+    _vocabulary = None
+
+    # Cached first set of this expansion tree. This is reset with the matcher
+    # element.
+    _first_set = None
+
+    # Compiled matcher of the expansion tree this expansion was last compiled as
+    # part of. This is reset with the matcher element.
+    _compiled_matcher = None
+
+    # (speech, start, end) tuple recorded by the matcher element's parse action
+    # and used to set current_match and matching_slice when they are next used.
+    # The end is recorded separately by the element's postParse function.
+    _match_span = None
+    _match_end = None
+
     def __init__(self, children):
         self._tag = ""
         self._parent = None
@@ -372,6 +979,10 @@ class Expansion(object):
         # Internal member for the parser element used during matching.
         self._matcher_element = None
 
+        # Internal member for the expansion a lazy copy was made from. This is only
+        # set until the copy's children have been copied.
+        self._lazy_source = None
+
         # Set children, letting the setter handle validation.
         self._children = None
         self.children = children
@@ -405,26 +1016,127 @@ class Expansion(object):
         return e
 
     def __deepcopy__(self, memo):
-        if not self.children:
-            e = type(self)([])
-        else:
-            children = [deepcopy(child, memo) for child in self.children]
-            e = type(self)(children)
-        e.tag = self.tag
-        return e
+        return self._deep_copy()
 
-    def copy(self, shallow=False):
+    def copy(self, shallow=False, lazy=False):
         """
         Make a copy of this expansion. This returns a deep copy by default.
         Neither referenced rules or their expansions will be deep copied.
 
+        Deep copies are made iteratively, so there is no recursion limit, and
+        without calling constructors, validating values or invalidating matcher
+        elements. Match data is not copied.
+
+        If ``lazy`` is True, a copy-on-write copy is returned instead. The
+        children of a lazy copy (and their children, etc.) are only copied when
+        they are first accessed, so subtrees that are never used are never copied.
+        Modifying the original expansion tree will finish any lazy copies of it
+        first, so lazy copies are never affected by later changes.
+
         :param shallow: whether to create a shallow copy (default: False)
+        :param lazy: whether to create a lazy copy (default: False)
         :returns: Expansion
         """
         if shallow:
             return self.__copy__()
+        elif lazy:
+            return self._lazy_copy()
         else:
-            return self.__deepcopy__({})
+            return self._deep_copy()
+
+    def _copy_node(self):
+        """
+        Create a copy of this expansion without children, a parent or match data.
+        The returned copy has ``None`` for its child list.
+
+        Subclasses with extra per-instance state should extend this method.
+
+        :returns: Expansion
+        """
+        e = object.__new__(type(self))
+        values = self.__dict__.copy()
+        values.pop("_lazy_copies", None)
+        values.update(self._copy_reset_values)
+        e.__dict__ = values
+        return e
+
+    def _after_copy(self, original):
+        """
+        Method called on a copy after its children have been copied from the
+        original expansion's children.
+
+        :param original: Expansion
+        """
+        pass
+
+    def _deep_copy(self):
+        # Copy this expansion tree iteratively using a stack of
+        # (original, copy) pairs.
+        result = self._copy_node()
+        stack = [(self, result)]
+        while stack:
+            original, e = stack.pop()
+            children = ChildList._new_raw(e)
+            for child in original.children:
+                c = child._copy_node()
+                c._parent = e
+                list.append(children, c)
+                stack.append((child, c))
+            e._children = children
+            e._after_copy(original)
+        return result
+
+    def _lazy_copy(self):
+        # Create a copy of this expansion which copies its children lazily.
+        e = self._copy_node()
+        e._lazy_source = self
+        copies = self.__dict__.get("_lazy_copies")
+        if copies is None:
+            copies = self._lazy_copies = weakref.WeakValueDictionary()
+        copies[id(e)] = e
+        _lazy_copy_sources[id(self)] = self
+        return e
+
+    def _unregister_lazy_copy(self):
+        # Unregister this lazy copy from its source expansion and return the source.
+        source = self._lazy_source
+        self._lazy_source = None
+        copies = source.__dict__.get("_lazy_copies")
+        if copies is not None:
+            copies.pop(id(self), None)
+            if not copies:
+                _lazy_copy_sources.pop(id(source), None)
+        return source
+
+    def _copy_lazy_children(self):
+        # Copy the children of this lazy copy's source expansion lazily.
+        source = self._unregister_lazy_copy()
+        children = ChildList._new_raw(self)
+        for child in source.children:
+            c = child._lazy_copy()
+            c._parent = self
+            list.append(children, c)
+        self._children = children
+        self._after_copy(source)
+        return children
+
+    def _detach_lazy_copies(self):
+        # Finish any lazy copies of this expansion or of its ancestors so that they
+        # are not affected by changes to this expansion. This is a quick operation
+        # if there are no unfinished lazy copies.
+        if not _lazy_copy_sources:
+            return
+
+        e = self
+        while e is not None:
+            copies = e.__dict__.get("_lazy_copies")
+            if copies:
+                for copy in list(copies.values()):
+                    # Access the children of each lazy descendant.
+                    stack = [copy]
+                    while stack:
+                        stack.extend(stack.pop().children)
+            e = e.__dict__.get("_parent")
 
     @property
     def children(self):
@@ -433,13 +1145,21 @@ class Expansion(object):
 
         :returns: ChildList
         """
-        return self._children
+        children = self._children
+        if children is None and self._lazy_source is not None:
+            children = self._copy_lazy_children()
+        return children
 
     @children.setter
     def children(self, value):
         if not isinstance(value, (tuple, list)):
             raise TypeError("'children' must be a list or tuple")
 
+        # The new children replace any lazily copied ones.
+        self._detach_lazy_copies()
+        if self._lazy_source is not None:
+            self._unregister_lazy_copy()
+
         # Orphan current children if applicable.
         if self._children:
             self._children.orphan_children()
@@ -469,6 +1189,26 @@ class Expansion(object):
     @parent.setter
     def parent(self, value):
         if isinstance(value, Expansion) or value is None:
+            # Reset the summaries and vocabularies of the old and new parent
+            # trees.
+            if self._parent:
+                self._parent._invalidate_summary()
+                self._parent._invalidate_vocabulary()
+            if value:
+                value._invalidate_summary()
+                value._invalidate_vocabulary()
+
+        if _bulk_build_state.depth and (isinstance(value, Expansion) or
+                                        value is None):
+            # Defer matcher invalidation until the end of the bulk build.
+            pending = _bulk_build_state.pending_expansions
+            if self._parent:
+                pending.append(self._parent)
+            pending.append(self)
+            if value:
+                pending.append(value)
+            self._parent = value
+        elif isinstance(value, Expansion) or value is None:
             # Invalidate the old parent if necessary.
             if self._parent:
                 self._parent.invalidate_matcher()
@@ -500,6 +1240,9 @@ class Expansion(object):
 
         :param value: str
         """
+        if getattr(self, "_parent", None):
+            self._detach_lazy_copies()
+
         if not value:
             self._tag = ""
         elif isinstance(value, string_types):
@@ -561,13 +1304,51 @@ class Expansion(object):
 
         :returns: str | None
         """
+        if self._match_span is not None:
+            self._set_match_data_from_span()
         return self._current_match
 
     @current_match.setter
     def current_match(self, value):
+        if self._match_span is not None:
+            self._set_match_data_from_span()
         self._set_current_match(value)
 
+    def _has_current_match(self):
+        """
+        Internal method to check whether ``current_match`` is not '' or None
+        without setting it from a recorded span.
+
+        :returns: bool
+        """
+        span = self._match_span
+        if span is None:
+            return bool(self._current_match)
+        speech, start, end = span
+        return _non_whitespace_regex.search(speech, start, end) is not None
+
+    def _set_match_data_from_span(self):
+        """
+        Internal method to set ``current_match`` and ``matching_slice`` from the
+        span of speech recorded by the last successful match.
+        """
+        text, matching_slice = _span_match_data(self._match_span)
+        self._match_span = None
+        self._set_current_match(text)
+        self._matching_slice = matching_slice
+
     def _set_current_match(self, value):
+        self._current_match = self._current_match_value(value)
+
+    def _current_match_value(self, value):
+        """
+        Internal method to get the ``current_match`` value to use for a matched
+        string or None.
+
+        :param value: str | None
+        :returns: str | None
+        :raises: TypeError
+        """
         if isinstance(value, string_types):
             # Ensure that string values have only one space between words
             value = " ".join([x.strip() for x in value.split()])
@@ -580,7 +1361,7 @@ class Expansion(object):
             else:
                 value = None
 
-        self._current_match = value
+        return value
 
     @property
     def matching_slice(self):
@@ -589,12 +1370,16 @@ class Expansion(object):
 
         :rtype: slice
         """
+        if self._match_span is not None:
+            self._set_match_data_from_span()
         return self._matching_slice
 
     @matching_slice.setter
     def matching_slice(self, value):
         if not isinstance(value, slice) and value is not None:
             raise TypeError("matching_slice must be a slice or None")
+        if self._match_span is not None:
+            self._set_match_data_from_span()
 
         self._matching_slice = value
 
@@ -611,6 +1396,7 @@ class Expansion(object):
 
         This does **not** invalidate ``matcher_element``.
         """
+        self._match_span = None
         self.current_match = None
         self.matching_slice = None
 
@@ -646,9 +1432,8 @@ class Expansion(object):
         def process(x):
             # Remove partial matches.
             if (x.parent and not isinstance(x, NamedRuleRef) and not
-                    x.parent.current_match):
-                x.current_match = None
-                x.matching_slice = None
+                    x.parent._has_current_match()):
+                x.reset_match_data()
 
         map_expansion(self, process)
         return remaining
@@ -662,13 +1447,29 @@ class Expansion(object):
         This only needs to be called manually if modifying an expansion tree *after*
         matching with a Dictation expansion.
         """
-        # Return early if _matcher_element hasn't been set.
-        if not self._matcher_element:
+        # Reset cached vocabularies so that chart parsers and automata using
+        # this expansion are created again.
+        self._invalidate_vocabulary()
+
+        # Return early if _matcher_element hasn't been set and no compiled matcher
+        # includes this expansion. Literals in alternative sets may be matched by
+        # their parent's element without their own.
+        parent = self._parent
+        if not self._matcher_element and self._compiled_matcher is None and \
+                not (parent and (parent._matcher_element or
+                                 parent._compiled_matcher is not None)):
+            return
+
+        # Defer invalidation until the end of the bulk build if there is one.
+        if _bulk_build_state.depth:
+            _bulk_build_state.pending_expansions.append(self)
             return
 
         # Set _matcher_element to None for this expansion and each ancestor, but not
         # any other subtrees (they are unaffected).
         self._matcher_element = None
+        self._first_set = None
+        self._compiled_matcher = None
         if self.parent:
             self.parent.invalidate_matcher()
 
@@ -700,8 +1501,13 @@ class Expansion(object):
             element = self._matcher_element
         return element
 
-    def _parse_action(self, tokens):
-        self.current_match = " ".join(tokens.asList())
+    def _parse_action(self, instring, loc, tokens):
+        # Only record the span of the match. Match data is set from it when it is
+        # used.
+        span = (instring, loc, self._match_end)
+        self._match_span = span
+        if _repetition_state.depth:
+            _repetition_state.log.append((self, span))
         return tokens
 
     def _make_matcher_element(self):
@@ -712,6 +1518,39 @@ class Expansion(object):
         """
         raise NotImplementedError()
 
+    def _get_first_set(self):
+        """
+        Internal method to get the first set of this expansion, used to choose
+        parser elements for alternative sets.
+
+        First sets are only calculated for expansions with matcher elements and
+        are cached until the matcher element is invalidated.
+
+        :returns: _FirstSet
+        """
+        first_set = self._first_set
+        if first_set is _FIRST_SET_IN_PROGRESS:
+            # Recursive rule reference.
+            return _UNKNOWN_FIRST_SET
+        if first_set is None:
+            self._first_set = _FIRST_SET_IN_PROGRESS
+            try:
+                first_set = self._calculate_first_set()
+            finally:
+                self._first_set = None
+            self._first_set = first_set
+        return first_set
+
+    def _calculate_first_set(self):
+        """
+        Internal method to calculate the first set of this expansion.
+
+        Subclasses should override this if their first sets can be known.
+
+        :returns: _FirstSet
+        """
+        return _UNKNOWN_FIRST_SET
+
     def _set_matcher_element_attributes(self, element):
         # Set the ParserElement's action.
         element.setParseAction(self._parse_action)
@@ -719,18 +1558,11 @@ class Expansion(object):
         # Save the element's original postParse function.
         closure = element.postParse
 
-        # Set a new function and use the original function for returning values.
+        # Set a new function that records where the element's match ended and use
+        # the original function for returning values. Parse actions are called
+        # straight after postParse with the start of the match.
         def postParse(instring, loc, tokenlist):
-            if isinstance(tokenlist, pyparsing.ParseResults):
-                s = " ".join(tokenlist.asList())
-            elif isinstance(tokenlist, list):
-                s = "".join(tokenlist)
-            elif isinstance(tokenlist, string_types):
-                s = tokenlist
-            else:
-                raise TypeError("postParse received invalid tokenlist %s"
-                                % tokenlist)
-            self.matching_slice = slice(loc - len(s), loc)
+            self._match_end = loc
             return closure(instring, loc, tokenlist)
 
         element.postParse = postParse
@@ -914,6 +1746,176 @@ class Expansion(object):
 
         return result
 
+    def _invalidate_summary(self):
+        # Reset the cached summaries of this expansion and its ancestors. Expansions
+        # are only summarised after their children are, so stop at the first
+        # expansion without a cached summary.
+        e = self
+        while e is not None and e._summary is not None:
+            e._summary = None
+            e = e._parent
+
+    def _invalidate_vocabulary(self):
+        # Reset the cached vocabularies of this expansion and its ancestors. Like
+        # summaries, stop at the first expansion without a cached vocabulary.
+        e = self
+        while e is not None and e._vocabulary is not None:
+            e._vocabulary = None
+            e = e._parent
+
+    @property
+    def _summary_children(self):
+        # Expansions used to calculate this expansion's summary.
+        return self.children
+
+    def _leaf_summary(self):
+        """
+        Internal method to get the summary of this expansion if it has no
+        children.
+
+        :returns: _ExpansionSummary
+        """
+        return _ExpansionSummary(1, 0, 0, self._can_match_empty([]))
+
+    def _can_match_empty(self, child_values):
+        """
+        Internal method to calculate whether this expansion can match the empty
+        string using the values for its children.
+
+        :param child_values: list
+        :returns: bool
+        """
+        return all(child_values)
+
+    def _summarize(self, child_summaries):
+        """
+        Internal method to calculate the summary of this expansion from the
+        summaries of its children.
+
+        :param child_summaries: list
+        :returns: _ExpansionSummary
+        """
+        if not child_summaries:
+            return self._leaf_summary()
+
+        leaf_count, literal_count, dictation_count = 0, 0, 0
+        for summary in child_summaries:
+            leaf_count += summary.leaf_count
+            literal_count += summary.literal_count
+            dictation_count += summary.dictation_count
+        return _ExpansionSummary(leaf_count, literal_count, dictation_count,
+                                 self._can_match_empty([
+                                     summary.can_match_empty
+                                     for summary in child_summaries
+                                 ]))
+
+    def _leaf_vocabulary(self):
+        """
+        Internal method to get the vocabulary of this expansion if it has no
+        children.
+
+        Expansions that don't override this method are assumed to be able to
+        match any word.
+
+        :returns: _Vocabulary
+        """
+        return _OPEN_VOCABULARY
+
+    def _combine_vocabularies(self, child_vocabularies):
+        """
+        Internal method to calculate the vocabulary of this expansion from the
+        vocabularies of its children.
+
+        :param child_vocabularies: list
+        :returns: _Vocabulary
+        """
+        if not child_vocabularies:
+            return self._leaf_vocabulary()
+
+        words, references, is_open = set(), [], False
+        for vocabulary in child_vocabularies:
+            words.update(vocabulary.words)
+            references.extend(vocabulary.references)
+            is_open = is_open or vocabulary.is_open
+        return _Vocabulary(frozenset(words), tuple(references), is_open)
+
+    def _get_vocabulary(self):
+        """
+        Internal method to get the vocabulary of this expansion tree, not
+        including referenced rules.
+
+        Vocabularies are calculated lazily and cached until the tree changes.
+
+        :returns: _Vocabulary
+        """
+        vocabulary = self._vocabulary
+        if vocabulary is None:
+            vocabulary = _calculate_vocabulary(self)
+        return vocabulary
+
+    def _get_summary(self):
+        """
+        Internal method to get the summary of this expansion tree, including the
+        trees of referenced rules.
+
+        Summaries are calculated lazily and cached until the tree changes.
+
+        :returns: _ExpansionSummary
+        """
+        summary = self._summary
+        if summary is None:
+            summary = _calculate_summary(self)
+        return summary
+
+    @property
+    def leaf_count(self):
+        """
+        The number of leaves in this expansion tree. This is the same as
+        ``len(self.leaves)``, but is cached.
+
+        :returns: int
+        """
+        return self._get_summary().leaf_count
+
+    @property
+    def contains_literal(self):
+        """
+        Whether this expansion tree has ``Literal`` leaves that are not
+        ``Dictation`` expansions.
+
+        :returns: bool
+        """
+        return self._get_summary().literal_count > 0
+
+    @property
+    def contains_dictation(self):
+        """
+        Whether this expansion tree has ``Dictation`` leaves.
+
+        :returns: bool
+        """
+        return self._get_summary().dictation_count > 0
+
+    @property
+    def is_dictation_only(self):
+        """
+        Whether every leaf in this expansion tree is a ``Dictation`` expansion.
+
+        :returns: bool
+        """
+        summary = self._get_summary()
+        return 0 < summary.dictation_count == summary.leaf_count
+
+    @property
+    def can_match_empty(self):
+        """
+        Whether this expansion can match the empty string, e.g. if it is optional
+        or references the *NULL* rule.
+
+        :returns: bool
+        """
+        return self._get_summary().can_match_empty
+
     def collect_leaves(self, order=TraversalOrder.PreOrder, shallow=False):
         """
         Collect all descendants of an expansion that have no children.
@@ -1063,10 +2065,27 @@ class BaseExpansionRef(BaseRef, Expansion):
         BaseRef.__init__(self, name)
         Expansion.__init__(self, [])
 
+    @BaseRef.name.setter
+    def name(self, value):
+        # Finish any lazy copies first so that they keep the current name.
+        if getattr(self, "_parent", None):
+            self._detach_lazy_copies()
+        BaseRef.name.fset(self, value)
+
+        # Reset the vocabularies and parser elements using the old name. This
+        # isn't needed while the expansion is being initialised.
+        if hasattr(self, "_parent"):
+            self._invalidate_vocabulary()
+            self.invalidate_matcher()
+
     @staticmethod
     def valid(name):
         return optionally_qualified_name.matches(name)
 
+    @staticmethod
+    def fast_valid(name):
+        return bool(optionally_qualified_name_regex.match(name))
+
     def compile(self, ignore_tags=False):
         self.validate_compilable()
         if self.tag and not ignore_tags:
@@ -1088,9 +2107,6 @@ class BaseExpansionRef(BaseRef, Expansion):
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo):
-        return self.__copy__()
-
 
 class NamedRuleRef(BaseExpansionRef):
     """
@@ -1114,11 +2130,32 @@ class NamedRuleRef(BaseExpansionRef):
 
     def _make_matcher_element(self):
         # Wrap the parser element for the referenced rule's root expansion so that
-        # the current match value for the NamedRuleRef is also set.
+        # the current match value for the NamedRuleRef is also set. Results are
+        # looked up in the current RuleMatchMemo, if there is one.
+        rule = self.referenced_rule
         return self._set_matcher_element_attributes(pyparsing.And([
-            self.referenced_rule.expansion.matcher_element
+            _MemoizedRuleElement(rule, rule.expansion.matcher_element)
         ]))
 
+    def _calculate_first_set(self):
+        first_set = self.referenced_rule.expansion._get_first_set()
+        return _FirstSet(first_set.chars, first_set.can_match_empty, None)
+
+    @property
+    def _summary_children(self):
+        return [self.referenced_rule.expansion]
+
+    def _summarize(self, child_summaries):
+        # Count this reference as a leaf along with the referenced rule's leaves.
+        summary = child_summaries[0]
+        return _ExpansionSummary(summary.leaf_count + 1, summary.literal_count,
+                                 summary.dictation_count,
+                                 summary.can_match_empty)
+
+    def _leaf_vocabulary(self):
+        # Referenced rules are looked up when rule vocabularies are used.
+        return _Vocabulary(frozenset(), (self,), False)
+
     def __hash__(self):
         return super(NamedRuleRef, self).__hash__()
 
@@ -1136,13 +2173,21 @@ class NullRef(BaseExpansionRef):
     def _make_matcher_element(self):
         return self._set_matcher_element_attributes(pyparsing.Empty())
 
-    def _set_current_match(self, value):
-        self._current_match = ""
+    def _calculate_first_set(self):
+        return _FirstSet(frozenset(), True, None)
+
+    def _current_match_value(self, value):
+        return ""
+
+    def _leaf_vocabulary(self):
+        return _EMPTY_VOCABULARY
 
     @staticmethod
     def valid(name):
         return name == "NULL"
 
+    fast_valid = valid
+
     def __copy__(self):
         e = type(self)()
         e.tag = self.tag
@@ -1165,23 +2210,38 @@ class VoidRef(BaseExpansionRef):
     def _make_matcher_element(self):
         return self._set_matcher_element_attributes(pyparsing.NoMatch())
 
-    def _set_current_match(self, value):
-        self._current_match = None
+    def _calculate_first_set(self):
+        return _FirstSet(frozenset(), False, None)
+
+    def _current_match_value(self, value):
+        return None
+
+    def _leaf_vocabulary(self):
+        return _EMPTY_VOCABULARY
 
     @staticmethod
     def valid(name):
         return name == "VOID"
 
+    fast_valid = valid
+
     def __copy__(self):
         e = type(self)()
         e.tag = self.tag
         return e
 
+    def _can_match_empty(self, child_values):
+        return False
+
     def __hash__(self):
         return super(VoidRef, self).__hash__()
 
 
 class ExpansionWithChildren(Expansion):
+    def _leaf_vocabulary(self):
+        # Expansions without children match nothing.
+        return _EMPTY_VOCABULARY
+
     def compile(self, ignore_tags=False):
         # Add a reference to the built-in NULL rule to produce a valid JSGF rule
         # expansion: "<NULL>" instead of "()";
@@ -1209,11 +2269,6 @@ class SingleChildExpansion(ExpansionWithChildren):
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo):
-        e = type(self)(deepcopy(self.child, memo))
-        e.tag = self.tag
-        return e
-
 
 class VariableChildExpansion(ExpansionWithChildren):
     def __init__(self, *expansions):
@@ -1230,15 +2285,6 @@ class VariableChildExpansion(ExpansionWithChildren):
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo):
-        if not self.children:
-            e = type(self)()
-        else:
-            children = [deepcopy(child, memo) for child in self.children]
-            e = type(self)(*children)
-        e.tag = self.tag
-        return e
-
 
 class Sequence(VariableChildExpansion):
     """
@@ -1262,6 +2308,19 @@ class Sequence(VariableChildExpansion):
             child.matcher_element for child in self.children
         ]))
 
+    def _calculate_first_set(self):
+        # Speech can start with the first characters of each child up to and
+        # including the first child that cannot match nothing.
+        chars = set()
+        for child in self.children:
+            first_set = child._get_first_set()
+            if first_set.chars is None:
+                return _UNKNOWN_FIRST_SET
+            chars.update(first_set.chars)
+            if not first_set.can_match_empty:
+                return _FirstSet(frozenset(chars), False, None)
+        return _FirstSet(frozenset(chars), True, None)
+
     def __hash__(self):
         return super(Sequence, self).__hash__()
 
@@ -1298,16 +2357,21 @@ class Literal(Expansion):
             raise TypeError("expected string, got %s instead" % value)
 
         # Use lowercase text by convention.
+        if getattr(self, "_parent", None):
+            self._detach_lazy_copies()
         self._text = value.lower()
+        self._invalidate_vocabulary()
+
+        # Parser elements using the old text are made again. This isn't needed
+        # while the expansion is being initialised.
+        if hasattr(self, "_parent"):
+            self.invalidate_matcher()
 
     def __copy__(self):
         e = type(self)(self.text)
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo):
-        return self.__copy__()
-
     def validate_compilable(self):
         if not self.text:
             raise CompilationError("%s expansion cannot be compiled with a text "
@@ -1345,6 +2409,20 @@ class Literal(Expansion):
     def _make_matcher_element(self):
         return self._set_matcher_element_attributes(pyparsing.Literal(self.text))
 
+    def _calculate_first_set(self):
+        # Whitespace before literals is skipped, so the first character of text
+        # starting with whitespace is not known.
+        text = self.text
+        if not text or text[0].isspace():
+            return _UNKNOWN_FIRST_SET
+        return _FirstSet(frozenset([text[0]]), False, text)
+
+    def _leaf_summary(self):
+        return _ExpansionSummary(1, 1, 0, False)
+
+    def _leaf_vocabulary(self):
+        return _Vocabulary(frozenset(self.text.split()), (), False)
+
     def __eq__(self, other):
         return super(Literal, self).__eq__(other) and self.text == other.text
 
@@ -1373,9 +2451,7 @@ class RuleRef(NamedRuleRef):
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo):
-        # Note that this implementation won't copy the referenced rule
-        return self.__copy__()
+    # Note that deep copies share the referenced rule; _copy_node doesn't copy it.
 
     def __hash__(self):
         return super(RuleRef, self).__hash__()
@@ -1389,8 +2465,17 @@ class Repeat(SingleChildExpansion):
 
         <repeat> = (please)+ don't crash;
     """
+    # Positions in the repetition log where the last match of this expansion and
+    # the next repetition start, and the repetitions recorded so far.
+    _log_start = 0
+    _log_position = 0
+    _pending_repetitions = ()
+
     def __init__(self, expansion):
         super(Repeat, self).__init__(expansion)
+
+        # Tuples of the (expansion, data) entries recorded for descendants that
+        # matched in each repetition. Later entries take precedence.
         self._repetitions_matched = []
 
     def compile(self, ignore_tags=False):
@@ -1420,8 +2505,8 @@ class Repeat(SingleChildExpansion):
         :returns: list
         """
         if e.is_descendant_of(self):
-            return [values[e]["current_match"] for values in
-                    self._repetitions_matched]
+            return [self._get_repetition_match_data(repetition, e)[0]
+                    for repetition in self._repetitions_matched]
         else:
             return []
 
@@ -1432,31 +2517,61 @@ class Repeat(SingleChildExpansion):
         :returns: list
         """
         if e.is_descendant_of(self):
-            return [values[e]["matching_slice"] for values in
-                    self._repetitions_matched]
+            return [self._get_repetition_match_data(repetition, e)[1]
+                    for repetition in self._repetitions_matched]
         else:
             return []
 
-    def _parse_action(self, tokens):
-        # Call the super method to set current_match.
-        super(Repeat, self)._parse_action(tokens)
+    @staticmethod
+    def _get_repetition_match_data(repetition, e):
+        """
+        Internal method to get an expansion's match data for one repetition.
+
+        :param repetition: tuple
+        :param e: Expansion
+        :returns: (current_match, matching_slice)
+        """
+        for x, data in reversed(repetition):
+            if x is e:
+                return _repetition_match_data(e, data)
+        return _repetition_match_data(e, None)
 
+    def _parse_action(self, instring, loc, tokens):
         # Note: this method is called after the child's parse actions.
-        if self._repetitions_matched:
-            # Restore the last repetition's match values.
-            last = self._repetitions_matched[len(self._repetitions_matched) - 1]
-            restore_current_matches(self.child, last, False)
+        # Reset the match data of descendants that only matched in other
+        # repetitions, then set the last repetition's match data.
+        log = _repetition_state.log
+        start = self._log_start
+        repetitions = self._repetitions_matched = self._pending_repetitions
+        last = repetitions[len(repetitions) - 1] if repetitions else ()
+        matched = set([id(x) for x, _ in last])
+        for x, _ in log[start:]:
+            if id(x) not in matched:
+                x.reset_match_data()
+        for x, data in last:
+            if len(data) == 3:
+                x._match_span = data
+            else:
+                x._match_span = None
+                x.current_match, x.matching_slice = data
+
+        # Only keep the last repetition's entries for any repetition ancestors.
+        log[start:] = last
+
+        # Call the super method to record the match.
+        super(Repeat, self)._parse_action(instring, loc, tokens)
         return tokens
 
     def _make_matcher_element(self):
-        # Define an extra parse action for the child's matcher element.
+        # Define an extra parse action for the child's matcher element that saves
+        # the entries recorded in each repetition.
         def f(tokens):
-            if tokens.asList():
-                # Add current match values to the _repetitions_matched list.
-                self._repetitions_matched.append(save_current_matches(self.child))
-
-                # Wipe current match values for the next repetition (if any).
-                self.child.reset_for_new_match()
+            if tokens:
+                log = _repetition_state.log
+                self._pending_repetitions.append(
+                    tuple(log[self._log_position:])
+                )
+                self._log_position = len(log)
             return tokens
 
         # Add the extra parse action.
@@ -1481,14 +2596,28 @@ class Repeat(SingleChildExpansion):
             # Use an And element instead if self is the only branch because
             # it makes no sense to repeat a repeat like this!
             if only_branch:
-                t = pyparsing.And
+                # Pass a list so that And doesn't use the elements of an Or
+                # element as its own.
+                return _RepetitionElement(
+                    self, self._set_matcher_element_attributes(pyparsing.And([e]))
+                )
+
+        return _RepetitionElement(self, self._set_matcher_element_attributes(t(e)))
 
-        return self._set_matcher_element_attributes(t(e))
+    def _calculate_first_set(self):
+        first_set = self.child._get_first_set()
+        return _FirstSet(first_set.chars,
+                         first_set.can_match_empty or self.is_optional, None)
 
     def reset_match_data(self):
         super(Repeat, self).reset_match_data()
         self._repetitions_matched = []
 
+    def _copy_node(self):
+        e = super(Repeat, self)._copy_node()
+        e._repetitions_matched = []
+        return e
+
 
 class KleeneStar(Repeat):
     """
@@ -1510,6 +2639,9 @@ class KleeneStar(Repeat):
     def is_optional(self):
         return True
 
+    def _can_match_empty(self, child_values):
+        return True
+
     def __hash__(self):
         return super(KleeneStar, self).__hash__()
 
@@ -1531,10 +2663,16 @@ class OptionalGrouping(SingleChildExpansion):
             pyparsing.Optional(self.child.matcher_element)
         )
 
+    def _calculate_first_set(self):
+        return _FirstSet(self.child._get_first_set().chars, True, None)
+
     @property
     def is_optional(self):
         return True
 
+    def _can_match_empty(self, child_values):
+        return True
+
     def __hash__(self):
         return super(OptionalGrouping, self).__hash__()
 
@@ -1573,6 +2711,10 @@ class AlternativeSet(VariableChildExpansion):
 
         :rtype: dict
         """
+        # Finish copying children first if this is a lazy copy so that the copied
+        # children are used as keys.
+        if self._lazy_source is not None:
+            self._copy_lazy_children()
         return self._weights
 
     @weights.setter
@@ -1607,6 +2749,7 @@ class AlternativeSet(VariableChildExpansion):
             raise TypeError("weight value '%s' is a negative number" % weight)
 
         # Use the alternative as the key for _weights.
+        self._detach_lazy_copies()
         if isinstance(child, integer_types):
             child = self.children[child]
         elif isinstance(child, string_types):
@@ -1618,8 +2761,10 @@ class AlternativeSet(VariableChildExpansion):
         self._weights[child] = weight
 
         # Invalidate this expansion. This is a quick procedure if the matcher
-        # element hasn't been initialised.
+        # element hasn't been initialised. Alternatives with a weight of 0 are
+        # not in vocabularies, so reset them too.
         self.invalidate_matcher()
+        self._invalidate_vocabulary()
 
     def __hash__(self):
         # The hash of an Alt.Set is a combination of the class name, tag and
@@ -1639,10 +2784,44 @@ class AlternativeSet(VariableChildExpansion):
         result.weights = dict(self.weights)
         return result
 
-    def __deepcopy__(self, memo):
-        result = super(AlternativeSet, self).__deepcopy__(memo)
-        result.weights = dict(self.weights)
-        return result
+    def _copy_node(self):
+        e = super(AlternativeSet, self)._copy_node()
+        e._weights = dict(self._weights)
+        return e
+
+    def _after_copy(self, original):
+        # Use the copied children as keys for the weights.
+        weights = original._weights
+        if not weights:
+            return
+        copies = dict((id(c), copy) for c, copy in
+                      zip(original.children, self._children))
+        self._weights = dict(
+            (copies.get(id(child), child), weight)
+            for child, weight in weights.items()
+        )
+
+    def _can_match_empty(self, child_values):
+        # Empty alternative sets are compiled and matched as <NULL>.
+        return any(child_values) or not child_values
+
+    def _combine_vocabularies(self, child_vocabularies):
+        # Alternatives with a weight of 0 are never matched.
+        weights = self.weights
+        if not weights or not child_vocabularies:
+            return super(AlternativeSet, self)._combine_vocabularies(
+                child_vocabularies
+            )
+        child_vocabularies = [
+            vocabulary for child, vocabulary in zip(self.children,
+                                                    child_vocabularies)
+            if weights.get(child, 1) > 0
+        ]
+        if not child_vocabularies:
+            return _EMPTY_VOCABULARY
+        return super(AlternativeSet, self)._combine_vocabularies(
+            child_vocabularies
+        )
 
     def _validate_weights(self):
         # Check that all alternatives have a weight. The rule for weights is
@@ -1675,26 +2854,66 @@ class AlternativeSet(VariableChildExpansion):
         else:
             return "(%s)" % alt_set
 
-    def _make_matcher_element(self):
-        # Return an element that can match the alternatives.
-        if self._weights:
-            self._validate_weights()
+    def _matched_children(self):
+        """
+        Internal method to get the alternatives that can be matched, in the order
+        they are tried.
 
-            # Exclude alternatives that have a weight value of 0.
-            children = []
-            for e, w in self._weights.items():
-                if w > 0:
-                    children.append((e, w))
+        :returns: list
+        """
+        if not self._weights:
+            return self.children
 
-            # Sort the list by weight (highest to lowest).
-            children = [e for e, _ in sorted(children, key=lambda x: x[1])]
-            children.reverse()
-        else:
-            children = self.children
+        self._validate_weights()
 
-        return self._set_matcher_element_attributes(pyparsing.Or([
-            e.matcher_element for e in children
-        ]))
+        # Exclude alternatives that have a weight value of 0.
+        children = []
+        for e, w in self._weights.items():
+            if w > 0:
+                children.append((e, w))
+
+        # Sort the list by weight (highest to lowest).
+        children = [e for e, _ in sorted(children, key=lambda x: x[1])]
+        children.reverse()
+        return children
+
+    def _make_matcher_element(self):
+        # Return an element that can match the alternatives.
+        children = self._matched_children()
+
+        # Match sets of plain literals using a trie instead of creating an element
+        # for each literal.
+        if len(children) > 1 and all(type(e) is Literal for e in children):
+            return self._set_matcher_element_attributes(_LiteralTrie(children))
+
+        elements = [e.matcher_element for e in children]
+
+        # pyparsing's Or element tries every alternative and uses the longest
+        # match. Use an element that only tries alternatives starting with the
+        # next character instead if no two alternatives can match at the same
+        # position.
+        table = None
+        if len(children) > 1:
+            table = _dispatch_table([e._get_first_set() for e in children])
+        if table is not None:
+            element = _FirstCharDispatch(elements, table)
+        else:
+            element = pyparsing.Or(elements)
+        return self._set_matcher_element_attributes(element)
+
+    def _calculate_first_set(self):
+        children = self._matched_children()
+        if not children:
+            return _UNKNOWN_FIRST_SET
+
+        chars, can_match_empty = set(), False
+        for child in children:
+            first_set = child._get_first_set()
+            if first_set.chars is None:
+                return _UNKNOWN_FIRST_SET
+            chars.update(first_set.chars)
+            can_match_empty = can_match_empty or first_set.can_match_empty
+        return _FirstSet(frozenset(chars), can_match_empty, None)
 
     def __eq__(self, other):
         return (
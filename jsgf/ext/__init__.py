@@ -12,5 +12,7 @@ from .expansions import dictation_and_literals_in_expansion
 from .rules import SequenceRule
 from .rules import PublicSequenceRule
 from .rules import HiddenSequenceRule
+from .rules import SequenceRuleSession
+from .rules import SequenceRuleState
 
 from .grammars import DictationGrammar
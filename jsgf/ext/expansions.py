@@ -15,13 +15,59 @@ from ..expansions import (
     OptionalGrouping,
     Repeat,
     Sequence,
-    TraversalOrder,
-    find_expansion,
+    _ExpansionSummary,
+    _OPEN_VOCABULARY,
+    _UNKNOWN_FIRST_SET,
+    _repetition_match_data,
 )
 
 # Define the regular expression used for dictation words.
 _word_regex_str = r"[\w\d?,\.\-_!;:']+"
 
+# Define the regular expression used for whitespace between dictation words. This
+# is the same as pyparsing's default whitespace characters.
+_whitespace_regex_str = r"[ \t\r\n]+"
+
+
+class _DictationWords(pyparsing.Token):
+    """
+    Internal pyparsing token class for matching one or more dictation words.
+
+    The words are matched with one regular expression that stops before any word
+    starting with one of the given stop strings. This is equivalent to using
+    ``OneOrMore(Regex(word), stopOn=Or(stop literals))``, but doesn't try each
+    stop literal for each word.
+    """
+    def __init__(self, stop_strings=()):
+        super(_DictationWords, self).__init__()
+        stop_strings = sorted(set(stop_strings))
+        if stop_strings:
+            word = r"(?!%s)%s" % ("|".join(map(re.escape, stop_strings)),
+                                  _word_regex_str)
+        else:
+            word = _word_regex_str
+        self.pattern = r"%s(?:%s%s)*" % (word, _whitespace_regex_str, word)
+        self.re = re.compile(self.pattern, re.UNICODE)
+        self.stop_strings = stop_strings
+        self.name = "dictation words"
+        self.errmsg = "Expected " + self.name
+        self.mayReturnEmpty = False
+        self.mayIndexError = False
+        self.saveAsList = True
+
+    def parseImpl(self, instring, loc, doActions=True):
+        result = self.re.match(instring, loc)
+        if not result:
+            raise pyparsing.ParseException(instring, loc, self.errmsg, self)
+
+        return result.end(), pyparsing.ParseResults(result.group().split())
+
+    def __str__(self):
+        if self.stop_strings:
+            return "{%s stopping on %s}" % (self.name,
+                                           " | ".join(self.stop_strings))
+        return "{%s}" % self.name
+
 
 def _collect_from_leaves(e, backtrack):
     result = []
@@ -148,8 +194,20 @@ class Dictation(Literal):
         e.tag = self.tag
         return e
 
-    def __deepcopy__(self, memo=None):
-        return self.__copy__()
+    def _copy_node(self):
+        e = super(Dictation, self)._copy_node()
+        e._use_current_match = False
+        return e
+
+    def _leaf_summary(self):
+        return _ExpansionSummary(1, 0, 1, False)
+
+    def _leaf_vocabulary(self):
+        # Dictation can match any words.
+        return _OPEN_VOCABULARY
+
+    def _calculate_first_set(self):
+        return _UNKNOWN_FIRST_SET
 
     def __hash__(self):
         # A Dictation hash is a hash of the class name and each ancestor's string
@@ -187,6 +245,8 @@ class Dictation(Literal):
 
     @use_current_match.setter
     def use_current_match(self, value):
+        if self._parent:
+            self._detach_lazy_copies()
         self._use_current_match = value
 
         # Invalidate the matcher.
@@ -204,7 +264,7 @@ class Dictation(Literal):
                 result = pyparsing.Literal(self.current_match)
 
             # Set the parse action and return the element.
-            return result.setParseAction(self._parse_action)
+            return self._set_matcher_element_attributes(result)
 
         # Otherwise build a list of next possible literals. Make the required stack
         # of child-parent pairs.
@@ -223,24 +283,20 @@ class Dictation(Literal):
         # De-duplicate the list.
         next_literals = set(next_literals)
 
-        word = pyparsing.Regex(_word_regex_str, re.UNICODE)
         if next_literals:
             # Check if there is a next dictation literal. If there is, only match
             # one word for this expansion.
             if _word_regex_str in next_literals:
-                result = word
+                result = pyparsing.Regex(_word_regex_str, re.UNICODE)
 
             # Otherwise build an element to match one or more words stopping on
             # any of the next literals so that they aren't matched as dictation.
             else:
-                next_literals = list(map(pyparsing.Literal, next_literals))
-                result = pyparsing.OneOrMore(
-                    word, stopOn=pyparsing.Or(next_literals)
-                )
+                result = _DictationWords(next_literals)
         else:
             # Handle the case of no literals ahead by allowing one or more Unicode
             # words without restrictions.
-            result = pyparsing.OneOrMore(word)
+            result = _DictationWords()
 
         return self._set_matcher_element_attributes(result)
 
@@ -261,200 +317,476 @@ class Dictation(Literal):
 
 
 def dictation_in_expansion(e, no_literals=False):
-    dictation_expansions = []
-    others = []
+    """
+    Whether an expansion tree has ``Dictation`` expansions.
 
-    for leaf in e.leaves:
-        if isinstance(leaf, Dictation):
-            dictation_expansions.append(leaf)
-        else:
-            others.append(leaf)
+    This uses the expansion's cached summary.
 
+    :param e: Expansion
+    :param no_literals: whether to only return True if every leaf is a
+        ``Dictation`` expansion
+    :returns: bool
+    """
     if no_literals:
-        return len(dictation_expansions) > 0 and len(others) == 0
+        return e.is_dictation_only
     else:
-        return len(dictation_expansions) > 0
+        return e.contains_dictation
 
 
 def only_dictation_in_expansion(e):
-    return dictation_in_expansion(e, no_literals=True)
+    return e.is_dictation_only
 
 
 def no_dictation_in_expansion(e):
-    return not bool(find_expansion(
-        e, lambda x: isinstance(x, Dictation), TraversalOrder.PostOrder
-    ))
+    return not e.contains_dictation
 
 
 def dictation_and_literals_in_expansion(e):
     return dictation_in_expansion(e, False)
 
 
+class _ExpandedVariant(object):
+    """
+    Internal class for one expanded variant of an expansion subtree.
+
+    Variants either stand for an unchanged subtree of the original expansion or
+    for a new expansion made from other variants. New expansion trees are only
+    made once all variants of the root expansion have been calculated.
+    """
+    __slots__ = ("original", "factory", "children", "has_dictation", "key",
+                 "structure_hash")
+
+    def __init__(self, original, factory, children, has_dictation,
+                 structure_hash):
+        """
+        :param original: Expansion in the original tree that expansions made for
+            this variant are matched in place of
+        :param factory: callable used to make the expansion (default: copy
+            ``original``)
+        :param children: list of (original child, variant) tuples or None
+        :param has_dictation: bool
+        :param structure_hash: int
+        """
+        self.original = original
+        self.factory = factory
+        self.children = children
+        self.has_dictation = has_dictation
+        self.structure_hash = structure_hash
+
+        # Variants with equal keys make identical expansion trees.
+        if children is None:
+            self.key = id(original)
+        else:
+            self.key = (factory, id(original), tuple([
+                v.key for _, v in children
+            ]))
+
+    def make_expansion(self, pairs=None):
+        """
+        Make a new expansion tree for this variant.
+
+        If a pairs list is given, a (new expansion, original expansion) tuple is
+        added to it for each new expansion that matches the same speech as an
+        expansion in the original tree.
+
+        :param pairs: list | None
+        :returns: Expansion
+        """
+        if self.children is None:
+            e = self.original.copy()
+            if pairs is not None:
+                pairs.extend(_pair_expansions(e, self.original))
+            return e
+
+        children = [v.make_expansion(pairs) for _, v in self.children]
+        if self.factory:
+            e = self.factory(*children)
+        else:
+            e = self.original._copy_node()
+            e.children = children
+            if isinstance(e, AlternativeSet) and e._weights:
+                # Use the new children as keys for the original weights.
+                weights = dict((id(k), w) for k, w in
+                               self.original._weights.items())
+                e._weights = dict(
+                    (child, weights[id(c)]) for (c, _), child in
+                    zip(self.children, children) if id(c) in weights
+                )
+
+        if pairs is not None:
+            pairs.append((e, self.original))
+        return e
+
+
+def _structure_hash(expansion_type, value, child_hashes):
+    """
+    Internal function to calculate a hash for an expansion from its type, text or
+    name value and the hashes of its children. Expansions that are equal have the
+    same hash value.
+
+    :param expansion_type: type
+    :param value: str | None
+    :param child_hashes: list
+    :returns: int
+    """
+    if issubclass(expansion_type, AlternativeSet):
+        # Alternative sets are equal regardless of child order.
+        return hash((AlternativeSet, tuple(sorted(child_hashes))))
+    else:
+        return hash((expansion_type, value, tuple(child_hashes)))
+
+
 def expand_dictation_expansion(expansion):
     """
     Take an expansion and expand any ``AlternativeSet`` with alternatives containing
     ``Dictation`` expansions. This function returns a list of all expanded
     expansions.
 
+    The expanded variants of each subtree are calculated once and combined with
+    the variants of sibling subtrees, so the expansion tree is not copied and
+    searched for each replacement.
+
     :param expansion: Expansion
     :returns: list
     """
-    def is_unprocessed(e):
-        if isinstance(e, AlternativeSet):
-            jsgf_only_alt = False
-
-            # Not necessarily dictation only, that scenario is handled by
-            # expansion sequence and SequenceRule.
-            dictation_alts = 0
-            for c in e.children:
-                if dictation_in_expansion(c):
-                    dictation_alts += 1
-                else:
-                    jsgf_only_alt = True
-
-                if jsgf_only_alt and dictation_alts:
-                    return True
-                elif dictation_alts > 1:
-                    # An AlternativeSet that has two or more dictation expansions
-                    # needs further processing
-                    return True
-        elif isinstance(e, (OptionalGrouping, KleeneStar)):
-            if dictation_in_expansion(e):
-                return True
+    return [e for e, _ in _expand_dictation_expansion(expansion)]
+
+
+def _expand_dictation_expansion(expansion):
+    """
+    Internal function used by ``expand_dictation_expansion``. This returns a list
+    of (expanded expansion, pairs) tuples, where pairs is a list of
+    (new expansion, original expansion) tuples for expansions in the expanded tree
+    that match the same speech as expansions in the original tree.
+
+    If no expansion is required, the list will only contain
+    ``(expansion, None)``.
+
+    :param expansion: Expansion
+    :returns: list
+    """
+    original_info = {}
+    memo = {}
+
+    def info(e):
+        """
+        Return whether an expansion in the original tree has Dictation
+        descendants and a hash of its structure.
+
+        :param e: Expansion
+        :returns: tuple
+        """
+        result = original_info.get(id(e))
+        if result is None:
+            if isinstance(e, NamedRuleRef):
+                # Referenced rules are checked for Dictation expansions, but are
+                # otherwise left as they are.
+                result = (dictation_in_expansion(e),
+                          _structure_hash(type(e), e.name, []))
             else:
-                # Handle the special case of dictation-free optionals in a sequence
-                # that has a dictation expansion.
-
-                # Check if there's a sequence ancestor
-                p = e
-                while p.parent:
-                    if isinstance(p, Sequence):
-                        break
-                    p = p.parent
-
-                if not p or no_dictation_in_expansion(p):
-                    # There was no sequence ancestor or there wasn't dictation
-                    # anywhere in the sequence
-                    return False
-                else:  # e requires processing
-                    return True
-        return False
-
-    def first_unprocessed_expansion(e):
+                child_info = [info(c) for c in e.children]
+                if isinstance(e, Literal):
+                    value = e.text
+                else:
+                    value = None
+                result = (
+                    isinstance(e, Dictation) or
+                    any([x for x, _ in child_info]),
+                    _structure_hash(type(e), value,
+                                    [h for _, h in child_info])
+                )
+            original_info[id(e)] = result
+        return result
+
+    def unchanged(e):
+        has_dictation, structure_hash = info(e)
+        return _ExpandedVariant(e, None, None, has_dictation, structure_hash)
+
+    def new_variant(e, factory, children):
+        return _ExpandedVariant(
+            e, factory, children,
+            any([v.has_dictation for _, v in children]),
+            _structure_hash(factory or type(e), None,
+                            [v.structure_hash for _, v in children])
+        )
+
+    def process(e, context, children, all_unchanged):
         """
-        Find the first expansion in an expansion tree for which is_unprocessed
-        returns True.
+        Process an expansion with the given child variants and return a list of
+        its variants. ``None`` is used for removed expansions.
+
         :param e: Expansion
-        :returns: Expansion | None
+        :param context: whether there are Dictation expansions outside e that are
+            under e's closest Sequence ancestor (or the root expansion)
+        :param children: list of (original child, variant) tuples
+        :param all_unchanged: whether every child is unchanged
+        :returns: list
         """
-        if isinstance(e, NamedRuleRef):
-            return first_unprocessed_expansion(e.referenced_rule.expansion)
+        # Remove e if all of its children were removed.
+        if not children:
+            return [None]
+
+        if all_unchanged:
+            variant = unchanged(e)
         else:
-            # Traverse in post order, i.e. children first, then e.
-            for child in e.children:
-                result = first_unprocessed_expansion(child)
-                if result:
-                    return result
-            if is_unprocessed(e):
-                return e
-
-    def find_goal(e, goal):
-        return find_expansion(e, lambda x: x == goal)
-
-    def process(e):
+            variant = new_variant(e, None, children)
+
+        if isinstance(e, AlternativeSet):
+            # Not necessarily dictation only alternatives, that scenario is
+            # handled by expansion sequence and SequenceRule.
+            dictation_children = [v for _, v in children if v.has_dictation]
+            jsgf_only_children = [(c, v) for c, v in children
+                                  if not v.has_dictation]
+
+            if (dictation_children and jsgf_only_children or
+                    len(dictation_children) > 1):
+                if len(jsgf_only_children) == 1:
+                    replacements = [jsgf_only_children[0][1]]
+                elif len(jsgf_only_children) > 1:
+                    replacements = [new_variant(e, AlternativeSet,
+                                                jsgf_only_children)]
+                else:  # no JSGF children
+                    replacements = []
+                replacements.extend(dictation_children)
+                return replacements
+
+        elif isinstance(e, (OptionalGrouping, KleeneStar)):
+            # Expand optionals with Dictation descendants. Also handle the special
+            # case of dictation-free optionals in a sequence that has a dictation
+            # expansion.
+            if variant.has_dictation or context:
+                if isinstance(e, OptionalGrouping):
+                    required = children[0][1]
+                else:
+                    required = new_variant(e, Repeat, children)
+                return [None, required]
+
+        return [variant]
+
+    def variants(e, context):
         """
-        Process an expansion recursively and return a list of expanded expansions.
+        Return the list of variants for an expansion in the original tree.
 
         :param e: Expansion
+        :param context: bool
         :returns: list
         """
-        result = []
-        current = first_unprocessed_expansion(e)
-
-        # Handle cases where no processing is required
-        if not current:
-            return [e]
-
-        copies = []
-        if isinstance(current, AlternativeSet):
-            # Create a replacements list with copies of the relevant children of
-            # the AlternativeSet currently being processed.
-            dictation_children = []  # again, not necessarily only dictation.
-            jsgf_only_children = []
-            for child in current.children:
-                # Add a deep copy of each child to one of the above lists.
-                if dictation_in_expansion(child):
-                    dictation_children.append(child.copy())
-                else:
-                    jsgf_only_children.append(child.copy())
-
-            if len(jsgf_only_children) == 1:
-                replacements = jsgf_only_children
-            elif len(jsgf_only_children) > 1:
-                replacements = [AlternativeSet(*jsgf_only_children)]
-            else:  # no JSGF children
-                replacements = []
-            replacements.extend(dictation_children)
-
-        elif isinstance(current, (OptionalGrouping, KleeneStar)):
-            # Handle not required - remove from a copy
-            copy = current.root_expansion.copy()
-            copy_x = find_goal(copy, current)
-            copy_parent = copy_x.parent
-            ancestor = copy_parent
-
-            # Traverse up the parent tree and remove copy_x or one of its ancestors
-            # where there is another child
-            while ancestor:
-                if len(ancestor.children) > 1:
-                    ancestor.children.remove(copy_x)
-                    break
-
-                copy_x = ancestor
-                ancestor = ancestor.parent
-
-            # copy_x or one of its ancestors was removed from the tree correctly
-            # If this isn't true, the expansion is an empty tree and shouldn't be
-            # added.
-            if ancestor:
-                copies.append(copy)
-
-            # Let replacement loop handle required
-            if isinstance(current, OptionalGrouping):
-                replacements = [current.child.copy()]
-            else:
-                replacements = [Repeat(current.child.copy())]
+        key = (id(e), context)
+        result = memo.get(key)
+        if result is not None:
+            return result
+
+        has_dictation = info(e)[0]
+        if (not has_dictation and not context) or not e.children or \
+                isinstance(e, NamedRuleRef):
+            # Nothing in this subtree requires processing.
+            result = memo[key] = [unchanged(e)]
+            return result
+
+        # Sequences separate the Dictation expansions that dictation-free
+        # optionals are checked against.
+        if isinstance(e, Sequence):
+            child_context = False
         else:
-            replacements = []
-
-        for replacement in replacements:
-            # Find the copy of the current expansion being processed
-            copy = current.root_expansion.copy()
-            copy_x = find_goal(copy, current)
-            copy_parent = copy_x.parent
-            if copy_parent:
-                index = copy_parent.children.index(copy_x)
-                copy_parent.children.remove(copy_x)
-                copy_parent.children.insert(index, replacement)
-            else:
-                # copy is the root expansion.
-                copy = replacement
-            copies.append(copy)
-
-        for copy in copies:
-            next_unprocessed = first_unprocessed_expansion(copy)
-            if not next_unprocessed and copy not in result:
-                result.append(copy)
-            else:
-                # Process the next unprocessed expansion and add the results.
-                # There are duplicates sometimes, so don't add them.
-                for r in process(next_unprocessed):
-                    if r not in result:
-                        result.append(r)
+            child_context = context
+
+        # Check which children have Dictation expansions after them.
+        children = e.children
+        dictation_after = [False] * len(children)
+        for i in range(len(children) - 2, -1, -1):
+            dictation_after[i] = (dictation_after[i + 1] or
+                                  info(children[i + 1])[0])
+
+        # Combine the variants of each child in order. Earlier children are
+        # processed first, so their variants vary the slowest. Each combination
+        # is a tuple of (child variants, Dictation found, all unchanged).
+        combinations = [([], False, True)]
+        for i, child in enumerate(children):
+            next_combinations = []
+            seen = set()
+            for chosen, dictation_before, all_unchanged in combinations:
+                for v in variants(child, child_context or dictation_before or
+                                  dictation_after[i]):
+                    if v is None:
+                        combination = (chosen, dictation_before, False)
+                        chosen_key = tuple([x.key for _, x in chosen])
+                    else:
+                        combination = (
+                            chosen + [(child, v)],
+                            dictation_before or v.has_dictation,
+                            all_unchanged and v.original is child and
+                            v.children is None
+                        )
+                        chosen_key = tuple([x.key for _, x in combination[0]])
 
+                    # Skip duplicate combinations.
+                    if chosen_key not in seen:
+                        seen.add(chosen_key)
+                        next_combinations.append(combination)
+            combinations = next_combinations
+
+        # Process e with each combination and remove duplicate variants.
+        result = []
+        seen = set()
+        for chosen, _, all_unchanged in combinations:
+            for v in process(e, context, chosen, all_unchanged):
+                v_key = v.key if v is not None else None
+                if v_key not in seen:
+                    seen.add(v_key)
+                    result.append(v)
+
+        memo[key] = result
         return result
 
-    return process(expansion)
+    expanded = variants(expansion, False)
+
+    # Handle cases where no processing is required.
+    if len(expanded) == 1 and expanded[0] is not None and \
+            expanded[0].children is None:
+        return [(expansion, None)]
+
+    # Make expansion trees for each variant, removing any that are equal.
+    result = []
+    buckets = {}
+    for v in expanded:
+        if v is None:
+            # The expansion tree is empty.
+            continue
+
+        bucket = buckets.setdefault(v.structure_hash, [])
+        pairs = []
+        e = v.make_expansion(pairs)
+        if e not in bucket:
+            bucket.append(e)
+            result.append((e, pairs))
+
+    return result
+
+
+def _pair_expansions(source, target):
+    """
+    Internal function to pair each expansion in a tree with the expansion in the
+    same position of another tree with the same structure, such as a copy.
+    Referenced rules are not followed.
+
+    :param source: Expansion
+    :param target: Expansion
+    :returns: list of (source expansion, target expansion) tuples
+    """
+    result = []
+    stack = [(source, target)]
+    while stack:
+        pair = stack.pop()
+        result.append(pair)
+        stack.extend(zip(pair[0].children, pair[1].children))
+    return result
+
+
+def _get_match_data(expansions):
+    """
+    Internal function to get the match data of each expansion in a list.
+
+    :param expansions: list
+    :returns: list of (current_match, matching_slice, repetitions) tuples
+    """
+    return [(e.current_match, e.matching_slice,
+             list(e._repetitions_matched) if isinstance(e, Repeat) else None)
+            for e in expansions]
+
+
+def _transfer_match_data(expansion, parts, text=None):
+    """
+    Internal function to set the match data of an expansion tree from the match
+    data of other expansions instead of matching the tree again.
+
+    Match data of each target expansion is copied from its source. The match data
+    of any other expansion in the tree is worked out from its children. If the
+    matched text is given, the ``current_match`` of such an expansion is the text
+    in its slice, as it would be after matching.
+
+    :param expansion: Expansion
+    :param parts: list of (pairs, match data, offset) tuples where pairs is a list
+        of (source, target) tuples, match data is the list returned by
+        ``_get_match_data`` for the sources and offset is added to slices
+    :param text: the text matched by the tree (default: None)
+    """
+    def shift(s, offset):
+        if s is None or not offset:
+            return s
+        return slice(s.start + offset, s.stop + offset)
+
+    def shift_data(e, data, offset):
+        current_match, matching_slice = _repetition_match_data(e, data)
+        return current_match, shift(matching_slice, offset)
+
+    # Collect and reset each expansion in the tree in pre-order. Referenced rules
+    # are not followed.
+    nodes = []
+    stack = [expansion]
+    while stack:
+        e = stack.pop()
+        e.reset_match_data()
+        nodes.append(e)
+        stack.extend(reversed(e.children))
+
+    # Copy match data onto target expansions. Repetition data is keyed by
+    # expansion, so those keys are replaced with their targets.
+    targets = {}
+    for pairs, _, _ in parts:
+        for source, target in pairs:
+            targets[id(source)] = target
+
+    copied = set()
+    for pairs, data, offset in parts:
+        for (_, target), (current_match, matching_slice, repetitions) in \
+                zip(pairs, data):
+            # Expansions that matched nothing have empty slices.
+            if current_match == "" and matching_slice is not None:
+                matching_slice = slice(matching_slice.start, matching_slice.start)
+            target.current_match = current_match
+            target.matching_slice = shift(matching_slice, offset)
+            if repetitions:
+                target._repetitions_matched = [tuple(
+                    (targets[id(k)], shift_data(k, data, offset))
+                    for k, data in repetition if id(k) in targets
+                ) for repetition in repetitions]
+            copied.add(id(target))
+
+    # Work out the match data of the other expansions from their children,
+    # starting with the deepest ones.
+    for e in reversed(nodes):
+        if id(e) in copied or not e.children:
+            continue
+
+        if isinstance(e, AlternativeSet):
+            # Use the first alternative that matched.
+            matched = [c for c in e.children if c.current_match][:1]
+        elif any([c.current_match is None and not c.can_match_empty
+                  for c in e.children]):
+            # At least one required child didn't match.
+            continue
+        else:
+            matched = [c for c in e.children if c.current_match]
+
+        if not matched:
+            continue
+
+        e.current_match = " ".join([c.current_match for c in matched])
+        slices = [c.matching_slice for c in matched
+                  if c.matching_slice is not None]
+        if slices:
+            e.matching_slice = slice(min([x.start for x in slices]),
+                                     max([x.stop for x in slices]))
+
+            # Use the text in the slice if the slice covers every match.
+            if text is not None and len(slices) == len(matched):
+                e.current_match = text[e.matching_slice]
+
+    # Remove partial matches like Expansion.matches does.
+    for e in nodes[1:]:
+        if not isinstance(e, NamedRuleRef) and not e.parent.current_match:
+            e.current_match = None
+            e.matching_slice = None
 
 
 def calculate_expansion_sequence(expansion, should_deepcopy=True):
@@ -1,13 +1,16 @@
 """
 This module contains extension grammar classes.
 """
-import re
+from collections import OrderedDict
+from itertools import chain
 
 from six import string_types
 
-from .expansions import dictation_in_expansion, expand_dictation_expansion
-from .rules import SequenceRule
+from .expansions import (dictation_in_expansion, _expand_dictation_expansion,
+                         _get_match_data, _pair_expansions, _transfer_match_data)
+from .rules import SequenceRule, _SessionCopies, _SessionCopy
 from jsgf import GrammarError, Grammar, Rule
+from jsgf.utterances import make_utterance
 
 
 class DictationGrammar(Grammar):
@@ -21,13 +24,43 @@ class DictationGrammar(Grammar):
         :param name: str
         """
         super(DictationGrammar, self).__init__(name)
-        self._dictation_rules = []
+
+        # Rules are stored in dictionaries using their IDs to avoid hashing them.
+        # Ordered dictionaries are used as insertion-ordered sets.
+        # Generated rules that are not in the JSGF only grammar.
+        self._dictation_rules = OrderedDict()
+
+        # Generated SequenceRules that are in the JSGF only grammar.
+        self._jsgf_only_sequence_rules = OrderedDict()
+
+        # Original rules and forward and reverse maps between generated and
+        # original rules.
+        self._original_rules = OrderedDict()
         self._original_rule_map = {}
+        self._generated_rule_map = {}
+
+        # Original and generated rules using their names.
+        self._rules_by_name = {}
+
+        self._expansion_pairs = {}
         self._init_jsgf_only_grammar()
 
+        # Private copies of rules for matching with sessions in each thread.
+        self._session_copies = _SessionCopies()
+
         if rules:
             self.add_rules(*rules)
 
+    def __getstate__(self):
+        # Session copies are made again in each thread when needed.
+        state = dict(self.__dict__)
+        state.pop("_session_copies", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._session_copies = _SessionCopies()
+
     def _init_jsgf_only_grammar(self):
         """
         Method that initialises the grammar to use for rules not containing
@@ -46,10 +79,12 @@ class DictationGrammar(Grammar):
 
         :returns: list
         """
-        return list(set(
-                self._dictation_rules + self._jsgf_only_grammar.match_rules +
-                list(self._original_rule_map.values())
-        ))
+        result = OrderedDict()
+        for rule in chain(self._dictation_rules.values(),
+                          self._jsgf_only_grammar.match_rules,
+                          self._original_rules.values()):
+            result.setdefault(id(rule), rule)
+        return list(result.values())
 
     @property
     def match_rules(self):
@@ -59,7 +94,7 @@ class DictationGrammar(Grammar):
         :returns: list
         """
         result = []
-        result.extend([x for x in self._dictation_rules if x.visible])
+        result.extend([x for x in self._dictation_rules.values() if x.visible])
         result.extend(self._jsgf_only_grammar.match_rules)
         return result
 
@@ -68,8 +103,9 @@ class DictationGrammar(Grammar):
             raise TypeError("object '%s' was not a JSGF Rule object" % rule)
 
         # Check if the same rule is already in the grammar.
-        if rule.name in self.rule_names:
-            if rule in self.rules:
+        same_name = self._rules_by_name.get(rule.name)
+        if same_name:
+            if rule in same_name:
                 # Silently return if the rule is comparable to another in the
                 # grammar.
                 return
@@ -83,26 +119,21 @@ class DictationGrammar(Grammar):
         # the original rule map.
         if not dictation_in_expansion(rule.expansion):
             self._jsgf_only_grammar.add_rule(rule)
-            self._original_rule_map[rule] = rule
+            self._add_generated_rule(rule, rule)
             return
 
         # Check if the rule is a SequenceRule already and do a few things with it.
         if isinstance(rule, SequenceRule):
-            if not rule.current_is_dictation_only:
-                # The sequence starts with a JSGF only rule and can be
-                # spoken like a normal rule
-                self._jsgf_only_grammar.add_rule(rule)
-            else:
-                self._dictation_rules.append(rule)
-            self._original_rule_map[rule] = rule
+            self._add_sequence_rule(rule)
+            self._add_generated_rule(rule, rule)
             return
 
         # Expand the rule's expansion into a list of 1 or more expansions.
-        expanded = expand_dictation_expansion(rule.expansion)
+        expanded = _expand_dictation_expansion(rule.expansion)
 
         # Otherwise create new rules from the resulting expansions and add each to
         # either dictation_rules or _jsgf_only_grammar
-        for i, x in enumerate(expanded):
+        for i, (x, pairs) in enumerate(expanded):
             if len(expanded) == 1:
                 # No need to use different names in this case
                 new_name = rule.name
@@ -113,20 +144,45 @@ class DictationGrammar(Grammar):
 
                 # Add this rule to the JSGF only grammar
                 self._jsgf_only_grammar.add_rule(r)
-
-                # Keep track of the relationship between the original rule and its
-                # expanded rules
-                self._original_rule_map[r] = rule
             else:
-                seq_rule = SequenceRule(new_name, rule.visible, x)
-                self._original_rule_map[seq_rule] = rule
+                r = SequenceRule(new_name, rule.visible, x)
+                self._add_sequence_rule(r)
+
+            # Keep track of the relationship between the original rule and its
+            # expanded rules
+            self._add_generated_rule(r, rule)
+            self._expansion_pairs[id(r)] = pairs
+
+    def _add_sequence_rule(self, rule):
+        """
+        Internal method to add a SequenceRule to either the dictation rules or the
+        JSGF only grammar.
+
+        :param rule: SequenceRule
+        """
+        if not rule.current_is_dictation_only:
+            # The sequence starts with a JSGF only rule and can be
+            # spoken like a normal rule
+            self._jsgf_only_grammar.add_rule(rule)
+            self._jsgf_only_sequence_rules[id(rule)] = rule
+        else:
+            self._dictation_rules[id(rule)] = rule
 
-                if not seq_rule.current_is_dictation_only:
-                    # The sequence starts with a JSGF only rule and can be
-                    # spoken like a normal rule
-                    self._jsgf_only_grammar.add_rule(seq_rule)
-                else:
-                    self._dictation_rules.append(seq_rule)
+    def _add_generated_rule(self, rule, original):
+        """
+        Internal method to add a generated rule to the forward, reverse and name
+        maps.
+
+        :param rule: Rule
+        :param original: Rule
+        """
+        self._original_rules[id(original)] = original
+        self._original_rule_map[id(rule)] = original
+        self._generated_rule_map.setdefault(id(original), []).append(rule)
+        for r in (rule, original):
+            names = self._rules_by_name.setdefault(r.name, [])
+            if not any([x is r for x in names]):
+                names.append(r)
 
     def get_original_rule(self, rule):
         """
@@ -135,7 +191,10 @@ class DictationGrammar(Grammar):
         :param rule: Rule
         :returns: Rule
         """
-        return self._original_rule_map[rule]
+        try:
+            return self._original_rule_map[id(rule)]
+        except KeyError:
+            raise KeyError(rule)
 
     def get_generated_rules(self, rule):
         """
@@ -144,9 +203,8 @@ class DictationGrammar(Grammar):
         :param rule: Rule
         :returns: generator
         """
-        for k, v in list(self._original_rule_map.items()):
-            if v is rule:
-                yield k
+        for k in list(self._generated_rule_map.get(id(rule), [])):
+            yield k
 
     def remove_rule(self, rule, ignore_dependent=False):
         # Find the rules generated from this rule and remove them wherever they are
@@ -156,15 +214,38 @@ class DictationGrammar(Grammar):
         else:
             rule_name = rule.name
 
-        for k, v in list(self._original_rule_map.items()):
-            if v.name == rule_name:
-                self._original_rule_map.pop(k)
+        # Find the original rule with the name.
+        original = None
+        for r in self._rules_by_name.get(rule_name, []):
+            if id(r) in self._original_rules:
+                original = r
+                break
+
+        if original is None:
+            return
+
+        del self._original_rules[id(original)]
+        for k in self._generated_rule_map.pop(id(original)):
+            self._original_rule_map.pop(id(k))
+            self._expansion_pairs.pop(id(k), None)
+            self._remove_rule_name(k)
+
+            if self._dictation_rules.pop(id(k), None) is None:
+                self._jsgf_only_sequence_rules.pop(id(k), None)
+                self._jsgf_only_grammar.remove_rule(k, ignore_dependent)
 
-                if k in self._dictation_rules:
-                    self._dictation_rules.remove(k)
+        self._remove_rule_name(original)
 
-                elif k in self._jsgf_only_grammar.match_rules:
-                    self._jsgf_only_grammar.remove_rule(k, ignore_dependent)
+    def _remove_rule_name(self, rule):
+        """
+        Internal method to remove a rule from the name map.
+
+        :param rule: Rule
+        """
+        names = self._rules_by_name.get(rule.name, [])
+        names[:] = [r for r in names if r is not rule]
+        if not names:
+            self._rules_by_name.pop(rule.name, None)
 
     def _compile(self, compile_as_root_grammar):
         """
@@ -182,11 +263,10 @@ class DictationGrammar(Grammar):
             else:
                 result = self._jsgf_only_grammar.compile()
 
-            # Check for compiled rules
-            rule_pattern = re.compile("(public )?<.+> = .+;")
-
+            # Check for compiled rules. Rule lines start with '<' or 'public <'
+            # and other lines don't.
             # If there are none, set result to "".
-            if not rule_pattern.search(result):
+            if "\n<" not in result and "\npublic <" not in result:
                 result = ""
         except GrammarError as e:
             if len(self._dictation_rules) > 0:
@@ -203,67 +283,198 @@ class DictationGrammar(Grammar):
     def compile_as_root_grammar(self):
         return self._compile(True)
 
+    def compile_iter(self, compile_as_root_grammar=False):
+        # Rules are compiled using the JSGF only grammar, which includes word list
+        # rules.
+        yield self._compile(compile_as_root_grammar)
+
     def rearrange_rules(self):
         """
         Move each ``SequenceRule`` in this grammar between the dictation rules list
         and the internal grammar used for JSGF only rules depending on whether a
         ``SequenceRule``'s current expansion is dictation-only or not.
         """
-        for rule in tuple(self._jsgf_only_grammar.match_rules):
-            if not isinstance(rule, SequenceRule):
-                continue
-            if rule.current_is_dictation_only:
-                self._jsgf_only_grammar.remove_rule(rule)
-                self._dictation_rules.append(rule)
+        self._rearrange_rules(list(self._jsgf_only_sequence_rules.values()) +
+                              list(self._dictation_rules.values()))
+
+    def _rearrange_rules(self, rules):
+        """
+        Internal method to move SequenceRules between the dictation rules and the
+        JSGF only grammar if their current expansions have changed to or from
+        dictation-only expansions.
 
-        for rule in tuple(self._dictation_rules):
-            if not rule.current_is_dictation_only:
+        :param rules: list
+        """
+        dictation_rules = self._dictation_rules
+        jsgf_only_rules = self._jsgf_only_sequence_rules
+
+        # Only visible rules in the JSGF only grammar are moved.
+        for rule in rules:
+            if (id(rule) in jsgf_only_rules and rule.visible and
+                    rule.current_is_dictation_only):
+                self._jsgf_only_grammar.remove_rule(rule, True)
+                del jsgf_only_rules[id(rule)]
+                dictation_rules[id(rule)] = rule
+
+        for rule in rules:
+            if (id(rule) in dictation_rules and
+                    not rule.current_is_dictation_only):
                 self._jsgf_only_grammar.add_rule(rule)
-                self._dictation_rules.remove(rule)
+                del dictation_rules[id(rule)]
+                jsgf_only_rules[id(rule)] = rule
 
-    def reset_sequence_rules(self):
+    def reset_sequence_rules(self, session=None):
         """
         Reset each ``SequenceRule`` in this grammar so that they can accept matches
         again.
+
+        :param session: session to reset instead (default None)
+        :type session: SequenceRuleSession
         """
-        for r in self._jsgf_only_grammar.match_rules + self._dictation_rules:
-            if isinstance(r, SequenceRule):
-                r.restart_sequence()
+        if session is not None:
+            session.reset()
+            return
+
+        for r in chain(self._jsgf_only_sequence_rules.values(),
+                       self._dictation_rules.values()):
+            r.restart_sequence()
 
         self.rearrange_rules()
 
-    def find_matching_rules(self, speech, advance_sequence_rules=True):
+    def find_matching_rules(self, speech, advance_sequence_rules=True,
+                            session=None):
         """
         Find each visible rule passed to the grammar that matches the `speech`
         string. Also set matches for the original rule.
 
-        :param speech: str
+        If a ``SequenceRuleSession`` is given, the progress of each
+        ``SequenceRule`` is read from and stored in the session instead of the
+        rules. This allows one grammar to be used for many dialogs at once.
+
+        :param speech: str | list | Utterance
         :param advance_sequence_rules: whether to call ``set_next()`` for successful
             sequence rule matches.
+        :param session: SequenceRuleSession | None
         :returns: list
         """
-        # Match against each match rule and remove any rules that didn't match
-        result = self.match_rules
-        for rule in tuple(result):
-            if not rule.matches(speech):
-                result.remove(rule)
+        speech = make_utterance(speech)
+        if session is not None:
+            with self._matching_context():
+                return self._find_matching_rules_in_session(
+                    speech, advance_sequence_rules, session
+                )
+
+        # Match against each match rule
+        with self._matching_context():
+            result = [rule for rule in self.match_rules if rule.matches(speech)]
 
         # Get the original rule for each rule in the result and ensure that their
         # current_match values reflect the generated rules' values.
         for rule in result:
-            original = self.get_original_rule(rule)
+            self._set_original_matches(rule)
             if isinstance(rule, SequenceRule):
-                SequenceRule.graft_sequence_matches(rule, original.expansion)
-
                 # Progress to the next expansion if required
                 if rule.has_next_expansion and advance_sequence_rules:
                     rule.set_next()
 
-            else:
-                original.matches(rule.expansion.current_match)
+        # Move matched SequenceRules between _dictation_rules and
+        # _jsgf_only_grammar as required
+        self._rearrange_rules([rule for rule in result
+                               if isinstance(rule, SequenceRule)])
 
-        # Move SequenceRules between _dictation_rules and _jsgf_only_grammar as
-        # required
-        self.rearrange_rules()
+        return result
+
+    def _find_matching_rules_in_session(self, speech, advance_sequence_rules,
+                                        session):
+        """
+        Internal method to find matching rules using a session's progress for each
+        ``SequenceRule``. Rules are not moved between internal lists.
+
+        Rules are matched using private copies, so the match data of the
+        grammar's rules is not changed. The session's copies of rule expansions
+        get the match data instead.
+
+        :param speech: str
+        :param advance_sequence_rules: bool
+        :param session: SequenceRuleSession
+        :returns: list
+        """
+        result = []
+        for rule in self.match_rules:
+            if isinstance(rule, SequenceRule):
+                if rule.matches(speech, session):
+                    result.append(rule)
+            elif self._match_in_session(rule, speech, session):
+                result.append(rule)
+
+        # Set matches for the original rules.
+        for rule in result:
+            self._set_original_matches(rule, session)
+
+            # Progress to the next expansion if required
+            if isinstance(rule, SequenceRule) and advance_sequence_rules:
+                rule.set_next(session)
 
         return result
+
+    def _match_in_session(self, rule, speech, session):
+        """
+        Internal method to match a rule using this thread's private copy of it and
+        set the match data of the session's copy of the rule's expansion.
+
+        :param rule: Rule
+        :param speech: Utterance
+        :param session: SequenceRuleSession
+        :returns: bool
+        """
+        if not rule.active:
+            return False
+
+        copies = self._session_copies.copies
+        copy = copies.get(id(rule))
+        if copy is None or copy.shared_rule is not rule or not copy.is_valid():
+            copy = copies[id(rule)] = _SessionCopy(rule, rule.expansion, True)
+
+        result = copy.matches(speech)
+        if result:
+            copy.transfer_match_data(session.get_expansion(rule))
+        return result
+
+    def _set_original_matches(self, rule, session=None):
+        """
+        Internal method to set the match data of a matched rule's original rule.
+
+        Match data is copied from expansions in the matched rule to the original
+        expansions they were generated from, so the original rule is not matched
+        again. If a session is given, match data is copied between the session's
+        copies of the rules' expansions instead.
+
+        :param rule: Rule
+        :param session: SequenceRuleSession | None
+        """
+        # Nothing needs to be done if the rule's expansion was not expanded.
+        # SequenceRules set match data for their own original expansions.
+        pairs = self._expansion_pairs.get(id(rule))
+        if not pairs:
+            return
+
+        original = self.get_original_rule(rule)
+        if isinstance(rule, SequenceRule):
+            source = rule.original_expansion
+        else:
+            source = rule.expansion
+        if session is None:
+            target = original.expansion
+        else:
+            # Use the same pairs of expansions in the session's copies.
+            copy = session.get_expansion(rule)
+            sources = dict((id(e), c) for e, c in _pair_expansions(source, copy))
+            target = session.get_expansion(original)
+            targets = dict((id(e), c) for e, c in _pair_expansions(
+                original.expansion, target))
+            pairs = [(sources[id(e)], targets[id(o)]) for e, o in pairs]
+            source = copy
+
+        _transfer_match_data(target, [
+            (pairs, _get_match_data([e for e, _ in pairs]), 0)
+        ], source.current_match)
@@ -2,12 +2,242 @@
 This module contains extension rule classes.
 """
 
+import threading
+
 from ..errors import GrammarError
-from ..expansions import Repeat, TraversalOrder, filter_expansion
+from ..expansions import (NamedRuleRef, Repeat, RuleRef, TraversalOrder,
+                          filter_expansion, flat_map_expansion)
+from ..grammars import Grammar
 from ..rules import Rule
 
 from .expansions import (expand_dictation_expansion, calculate_expansion_sequence,
-                         Dictation, only_dictation_in_expansion)
+                         Dictation, only_dictation_in_expansion, _get_match_data,
+                         _pair_expansions, _transfer_match_data)
+
+
+class SequenceRuleState(object):
+    """
+    Class for the progress of a ``SequenceRule`` through its expansion sequence.
+    """
+    __slots__ = ("index", "refuse_matches", "matches")
+
+    def __init__(self):
+        # Index of the current expansion in the sequence.
+        self.index = 0
+
+        # Whether matches on the rule can succeed.
+        self.refuse_matches = False
+
+        # List of (current_match, Dictation current_match list, match data) tuples
+        # for each sequence expansion up to the current one.
+        self.matches = []
+
+    def reset(self):
+        """
+        Go back to the first expansion in the sequence and clear match data.
+        """
+        self.index = 0
+        self.refuse_matches = False
+        self.matches = []
+
+
+class SequenceRuleSession(object):
+    """
+    Class for storing the progress of ``SequenceRule`` objects separately from the
+    rules themselves.
+
+    Pass a session to ``DictationGrammar.find_matching_rules`` or to
+    ``SequenceRule`` methods to use the session's progress instead of the rule's.
+    This way one grammar can be used for many dialogs at the same time.
+
+    Matching with a session doesn't change the match data of the grammar's rules.
+    Use ``get_expansion`` to get the session's match data for a rule instead.
+    """
+    def __init__(self):
+        self._states = {}
+
+        # Copies of rule expansions with this session's match data, keyed by the
+        # IDs of the copied expansions. Rules with the same expansion, such as
+        # rules generated by DictationGrammar without changes, share a copy.
+        self._expansions = {}
+
+    def get_state(self, rule):
+        """
+        Get the state of a ``SequenceRule`` in this session, creating it if
+        necessary. States are stored using rule names.
+
+        :param rule: SequenceRule
+        :returns: SequenceRuleState
+        """
+        state = self._states.get(rule.name)
+        if state is None:
+            state = self._states[rule.name] = SequenceRuleState()
+        return state
+
+    def get_expansion(self, rule):
+        """
+        Get this session's copy of a rule's expansion. The copy has the match data
+        of the last successful match of the rule in this session.
+
+        The copy is of ``original_expansion`` for ``SequenceRule`` objects. For
+        rules passed to a ``DictationGrammar``, the copy has match data from the
+        rules generated from them, like the rules themselves do after matching
+        without a session.
+
+        :param rule: Rule
+        :returns: Expansion
+        """
+        if isinstance(rule, SequenceRule):
+            expansion = rule.original_expansion
+        else:
+            expansion = rule.expansion
+
+        entry = self._expansions.get(id(expansion))
+        if entry is None or entry[0] is not expansion:
+            entry = self._expansions[id(expansion)] = (expansion,
+                                                       expansion.copy())
+        return entry[1]
+
+    def reset(self):
+        """
+        Reset the progress of every ``SequenceRule`` in this session and clear
+        the session's match data.
+        """
+        self._states.clear()
+        self._expansions.clear()
+
+
+class _SessionCopies(threading.local):
+    """
+    Internal class for the private copies of expansion trees that sessions are
+    matched against in each thread.
+    """
+    def __init__(self):
+        self.version = None
+        self.copies = {}
+
+
+class _SessionCopy(object):
+    """
+    Internal class for a private copy of a rule's expansion tree, and of the rules
+    it references, that session speech is matched against in one thread. This
+    leaves the match data of the shared rules unchanged.
+    """
+    def __init__(self, rule, expansion, watch_root):
+        """
+        :param rule: Rule
+        :param expansion: the expansion of the rule to copy
+        :param watch_root: whether to make the copy again if the rule's expansion
+            changes
+        :raises: GrammarError
+        """
+        self.shared_rule = rule
+        self.grammar = rule.grammar
+        self.version = self.grammar._rules_version if self.grammar else None
+        self.root = expansion.copy()
+        pairs = _pair_expansions(expansion, self.root)
+        self.copies = dict((id(e), c) for e, c in pairs)
+        self.originals = dict((id(c), e) for e, c in pairs)
+
+        # Rules whose expansions were copied and the matcher elements of their
+        # expansions at the time. The copy is out of date if they change.
+        self.watched = []
+        if watch_root:
+            self.watched.append((rule, expansion, expansion.matcher_element))
+
+        # Use a private grammar for copies of referenced rules.
+        grammar = Grammar(rule.grammar.name if rule.grammar else "default")
+        self.rule = Rule(rule.name, rule.visible, self.root)
+        self.rule.grammar = grammar
+        copied = {}
+        stack = [(pairs, rule.grammar)]
+        while stack:
+            pairs, shared_grammar = stack.pop()
+            for e, c in pairs:
+                if not isinstance(e, NamedRuleRef) or e.name in copied:
+                    continue
+                if isinstance(e, RuleRef):
+                    referenced = e.referenced_rule
+                elif shared_grammar:
+                    referenced = shared_grammar.get_rule_from_name(e.name)
+                else:
+                    raise GrammarError("cannot get referenced Rule object from "
+                                       "Grammar")
+
+                # Copy the referenced rule and the rules it references.
+                r = copied[e.name] = Rule(referenced.name, referenced.visible,
+                                          referenced.expansion.copy())
+                grammar.add_rule(r)
+                self.watched.append((referenced, referenced.expansion,
+                                     referenced.expansion.matcher_element))
+                stack.append((_pair_expansions(referenced.expansion,
+                                               r.expansion), referenced.grammar))
+
+        # Copied RuleRefs reference the shared rules, so use the copies instead.
+        for r in [self.rule] + list(copied.values()):
+            for e in flat_map_expansion(r.expansion, shallow=True):
+                if isinstance(e, RuleRef):
+                    e._referenced_rule = copied[e.name]
+
+    def is_valid(self):
+        """
+        Whether the copy is still the same as the shared rules.
+
+        :returns: bool
+        """
+        grammar = self.shared_rule.grammar
+        if grammar is not self.grammar or \
+                grammar and grammar._rules_version != self.version:
+            return False
+        for rule, expansion, element in self.watched:
+            if rule.expansion is not expansion or \
+                    expansion._matcher_element is not element:
+                return False
+        return True
+
+    def matches(self, speech):
+        """
+        Match speech against the copy using the shared rule's matching options.
+
+        :param speech: str | list | Utterance
+        :returns: bool
+        """
+        rule, shared = self.rule, self.shared_rule
+        rule.matching_backend = shared.matching_backend
+        rule.beam_width = shared.beam_width
+        rule.matcher_cache_dir = shared.matcher_cache_dir
+        return rule._match_expansion(self.root, speech)
+
+    def get_match_data(self, expansions):
+        """
+        Get the match data of the copies of shared expansions. Repetition data is
+        returned for the shared expansions instead of the copies.
+
+        :param expansions: list of shared expansions
+        :returns: list
+        """
+        originals = self.originals
+        result = []
+        for current_match, matching_slice, repetitions in _get_match_data(
+                [self.copies[id(e)] for e in expansions]):
+            if repetitions:
+                repetitions = [tuple((originals.get(id(k), k), data)
+                                     for k, data in repetition)
+                               for repetition in repetitions]
+            result.append((current_match, matching_slice, repetitions))
+        return result
+
+    def transfer_match_data(self, expansion):
+        """
+        Set the match data of an expansion tree with the same structure as the
+        copy, e.g. a session's copy, from the copy's match data.
+
+        :param expansion: Expansion
+        """
+        pairs = _pair_expansions(self.root, expansion)
+        _transfer_match_data(expansion, [
+            (pairs, _get_match_data([c for c, _ in pairs]), 0)
+        ], self.root.current_match)
 
 
 class SequenceRule(Rule):
@@ -27,6 +257,12 @@ class SequenceRule(Rule):
         self._original_expansion = self.expansion
         self.expansion = self.expansion.copy()
 
+        # Remember the original expansion and children of each copied expansion.
+        copied = dict(
+            (id(c), (c, o, [id(x) for x in c.children]))
+            for c, o in _pair_expansions(self.expansion, self._original_expansion)
+        )
+
         # Check if the entire rule can be repeated
         rep = self._find_root_repeat(self.expansion)
         if rep:
@@ -54,10 +290,38 @@ class SequenceRule(Rule):
 
         # Calculate the expansion sequence without deep copying again
         self._sequence = tuple(calculate_expansion_sequence(self.expansion, False))
-        self._current_index = 0
-        self._refuse_matches = False
+
+        # Keep each sequence expansion's Dictation expansions for grafting
+        # matches.
+        self._sequence_dictation = tuple([
+            filter_expansion(e, _is_dictation, TraversalOrder.PostOrder)
+            for e in self._sequence
+        ])
+
+        # Find the expansions in each sequence expansion that match the same
+        # speech as original expansions. Their match data is copied onto the original
+        # expansion after matching instead of matching it again.
+        self._sequence_pairs = tuple([
+            _find_copied_expansions(e, copied) for e in self._sequence
+        ])
+
+        # Use a state object for this rule's own progress.
+        self._state = SequenceRuleState()
         self._set_expansion_to_current()
 
+        # Private copies of sequence expansions for matching with sessions.
+        self._session_copies = _SessionCopies()
+
+    def __getstate__(self):
+        # Session copies are made again in each thread when needed.
+        state = dict(self.__dict__)
+        state.pop("_session_copies", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._session_copies = _SessionCopies()
+
     def __str__(self):
         return "%s(name='%s', visible=%s, expansion=%s)" %\
                (self.__class__.__name__,
@@ -124,6 +388,17 @@ class SequenceRule(Rule):
 
         return result
 
+    def _get_state(self, session):
+        """
+        Get the state to use for this rule's progress.
+
+        :param session: SequenceRuleSession | None
+        :returns: SequenceRuleState
+        """
+        if session is None:
+            return self._state
+        return session.get_state(self)
+
     @property
     def has_next_expansion(self):
         """
@@ -131,7 +406,17 @@ class SequenceRule(Rule):
 
         :returns: bool
         """
-        return self._current_index + 1 < len(self._sequence)
+        return self.has_next_expansion_in(None)
+
+    def has_next_expansion_in(self, session):
+        """
+        Whether there is another sequence expansion after the current one for a
+        session.
+
+        :param session: SequenceRuleSession | None
+        :returns: bool
+        """
+        return self._get_state(session).index + 1 < len(self._sequence)
 
     @property
     def current_is_dictation_only(self):
@@ -141,7 +426,26 @@ class SequenceRule(Rule):
 
         :returns: bool
         """
-        return only_dictation_in_expansion(self._sequence[self._current_index])
+        return self.current_is_dictation_only_in(None)
+
+    def current_is_dictation_only_in(self, session):
+        """
+        Whether the current expansion in the sequence for a session contains only
+        ``Dictation`` expansions.
+
+        :param session: SequenceRuleSession | None
+        :returns: bool
+        """
+        return only_dictation_in_expansion(self.get_current_expansion(session))
+
+    def get_current_expansion(self, session=None):
+        """
+        Get the current expansion in the sequence for a session.
+
+        :param session: SequenceRuleSession | None
+        :returns: Expansion
+        """
+        return self._sequence[self._get_state(session).index]
 
     @property
     def refuse_matches(self):
@@ -157,25 +461,33 @@ class SequenceRule(Rule):
 
         :returns: bool
         """
-        return self._refuse_matches
+        return self._state.refuse_matches
 
     @refuse_matches.setter
     def refuse_matches(self, value):
-        self._refuse_matches = value
+        self._state.refuse_matches = value
 
     def _set_expansion_to_current(self):
-        self.expansion = self._sequence[self._current_index]
+        self.expansion = self._sequence[self._state.index]
 
         # Stop refusing matches
         self.refuse_matches = False
 
-    def set_next(self):
+    def set_next(self, session=None):
         """
         Moves to the next expansion in the sequence if there is one.
+
+        :param session: SequenceRuleSession | None
         """
-        if self.has_next_expansion:
-            self._current_index += 1
+        if not self.has_next_expansion_in(session):
+            return
+
+        state = self._get_state(session)
+        state.index += 1
+        if session is None:
             self._set_expansion_to_current()
+        else:
+            state.refuse_matches = False
 
     @property
     def entire_match(self):
@@ -189,17 +501,40 @@ class SequenceRule(Rule):
         if all([m is not None for m in matches]):
             return " ".join(matches)
 
-    def restart_sequence(self):
+    def get_entire_match(self, session):
+        """
+        Get the entire match of the sequence for a session, i.e. all strings that
+        matched joined together by spaces. None is returned if the entire sequence
+        hasn't been matched.
+
+        :param session: SequenceRuleSession | None
+        :returns: str | None
+        """
+        if session is None:
+            return self.entire_match
+
+        matches = [m for m, _, _ in self._get_state(session).matches]
+        if len(matches) == len(self._sequence) and \
+                all([m is not None for m in matches]):
+            return " ".join(matches)
+
+    def restart_sequence(self, session=None):
         """
         Resets the current sequence expansion to the first one in the sequence and
         clears the match data of each sequence expansion.
+
+        :param session: SequenceRuleSession | None
         """
-        self._current_index = 0
+        if session is not None:
+            self._get_state(session).reset()
+            return
+
+        self._state.reset()
         self._set_expansion_to_current()
         for expansion in self._sequence:
             expansion.reset_match_data()
 
-    def matches(self, speech):
+    def matches(self, speech, session=None):
         """
         Return whether or not speech matches the current expansion in the sequence.
 
@@ -209,22 +544,66 @@ class SequenceRule(Rule):
         This method will only match once and return False on calls afterward until
         ``refuse_matches`` is False.
 
+        If a session is given, its progress is used and updated instead of this
+        rule's. Only successful matches are refused afterward in this case.
+        Speech is matched against private copies of the sequence expansions made
+        for each thread, so the match data of this rule's expansions is not
+        changed and many sessions can use the rule at the same time. The match
+        data of the original expansion is set for the session's copy of it
+        instead; see ``SequenceRuleSession.get_expansion``.
+
         :param speech: str
+        :param session: SequenceRuleSession | None
         :returns: bool
         """
-        result = False
-        if not self.refuse_matches:
+        state = self._get_state(session)
+        if state.refuse_matches:
+            return False
+
+        if session is None:
             result = super(SequenceRule, self).matches(speech)
 
             # Graft the matches in the sequence onto the original expansion used to
             # create this SequenceRule.
             SequenceRule.graft_sequence_matches(self, self._original_expansion)
+        elif not self._active:
+            return False
+        else:
+            # Match the session's current expansion using this thread's copy of it
+            # and save the match data in the session.
+            index = state.index
+            copy = self._get_session_copy(index)
+            result = copy.matches(speech)
+            del state.matches[index:]
+            state.matches.append((copy.root.current_match, [
+                copy.copies[id(e)].current_match
+                for e in self._sequence_dictation[index]
+            ], copy.get_match_data([c for c, _ in self._sequence_pairs[index]])))
+            if result:
+                self.graft_session_matches(session, session.get_expansion(self))
 
-            # By default, don't let the current expansion be matched more than once
-            self.refuse_matches = True
-
+        # By default, don't let the current expansion be matched more than once.
+        # Failed session matches are not counted so that other speech can still
+        # be matched in the same dialog.
+        if session is None or result:
+            state.refuse_matches = True
         return result
 
+    def _get_session_copy(self, index):
+        """
+        Internal method to get this thread's private copy of a sequence expansion
+        for matching with sessions.
+
+        :param index: int
+        :returns: _SessionCopy
+        """
+        copies = self._session_copies.copies
+        copy = copies.get(index)
+        if copy is None or not copy.is_valid():
+            copy = copies[index] = _SessionCopy(self, self._sequence[index],
+                                                False)
+        return copy
+
     @property
     def tags(self):
         """
@@ -253,40 +632,172 @@ class SequenceRule(Rule):
 
         Not all expansions in the sequence need to have been matched.
 
+        If the expansion is the rule's original expansion, match data is copied
+        from the sequence expansions instead of matching the expansion again.
+
         :param sequence_rule: SequenceRule
         :param expansion: Expansion
         """
-        def is_dictation(x):
-            return isinstance(x, Dictation)
-
-        # Collect Dictation in expansion and in all expansions in the
-        # sequence
-        dictation_in_seq = []
-        dictation_in_exp = filter_expansion(expansion, is_dictation,
-                                            TraversalOrder.PostOrder)
-        for e in sequence_rule._sequence:
-            dictation_in_seq.extend(filter_expansion(
-                e, is_dictation, TraversalOrder.PostOrder))
-
-        # Set current_match of Dictation expansions in the given expansion to
-        # current_match values of their respective counterparts in the sequence.
-        for e1, e2 in zip(dictation_in_seq, dictation_in_exp):
-            assert isinstance(e1, Dictation) and isinstance(e2, Dictation)
-            # Stop the matches(speech) method from changing current_match
-            e2.use_current_match = True
-            e2.current_match = e1.current_match
-
-        # Then collect expansions with current_match set.
-        matching = []
-        for e in sequence_rule._sequence:
-            if e.current_match is None:
-                # e and nothing after e match
-                break
+        if expansion is sequence_rule.original_expansion:
+            # Use the match data of the sequence expansions directly.
+            sequence_rule._graft_onto_original_expansion([
+                (e.current_match, _get_match_data([c for c, _ in pairs]))
+                for e, pairs in zip(sequence_rule._sequence,
+                                    sequence_rule._sequence_pairs)
+            ])
+            return
+
+        # Collect the current_match values of Dictation expansions in all
+        # expansions in the sequence.
+        dictation_matches = []
+        for dictation in sequence_rule._sequence_dictation:
+            dictation_matches.extend([e.current_match for e in dictation])
+
+        _graft_matches(expansion,
+                       [e.current_match for e in sequence_rule._sequence],
+                       dictation_matches)
+
+    def graft_session_matches(self, session, expansion):
+        """
+        Graft the matches of a session's sequence expansions onto the given
+        expansion in-place.
+
+        Match data is copied instead of matching the expansion again if the
+        expansion is the rule's original expansion or the session's copy of it.
+
+        :param session: SequenceRuleSession
+        :param expansion: Expansion
+        """
+        matches = self._get_state(session).matches
+        if expansion is self._original_expansion or \
+                expansion is session.get_expansion(self):
+            self._graft_onto_original_expansion([
+                (current_match, data) for current_match, _, data in matches
+            ], expansion)
+            return
+
+        dictation_matches = []
+        for i, dictation in enumerate(self._sequence_dictation):
+            if i < len(matches):
+                dictation_matches.extend(matches[i][1])
             else:
-                matching.append(e)
+                dictation_matches.extend([None] * len(dictation))
+
+        _graft_matches(expansion, [m for m, _, _ in matches], dictation_matches)
+
+    def _graft_onto_original_expansion(self, sequence_matches, target=None):
+        """
+        Internal method to set match data for the original expansion, or a copy of
+        it, from the match data of sequence expansions without matching it again.
+
+        :param sequence_matches: list of (current_match, match data) tuples for
+            each sequence expansion
+        :param target: the original expansion or a copy of it (default: the
+            original expansion)
+        """
+        original = self._original_expansion
+        if target is None or target is original:
+            targets = None
+            target = original
+        else:
+            targets = dict((id(o), c) for o, c in _pair_expansions(original,
+                                                                   target))
+
+        # Use the sequence expansions up to the first one without a match. Slices
+        # are made relative to their matches joined together by spaces.
+        parts = []
+        offset = 0
+        for pairs, (current_match, data) in zip(self._sequence_pairs,
+                                                sequence_matches):
+            if current_match is None:
+                break
+            if targets is not None:
+                pairs = [(c, targets[id(o)]) for c, o in pairs]
+            parts.append((pairs, data, offset))
+            offset += len(current_match) + 1
+
+        text = " ".join([m for m, _ in sequence_matches[:len(parts)]])
+        _transfer_match_data(target, parts, text)
+
+
+def _is_dictation(e):
+    return isinstance(e, Dictation)
+
+
+def _find_copied_expansions(expansion, copied):
+    """
+    Internal function to find the expansions in a tree that match the same speech
+    as copied expansions. These are either the copies themselves or expansions of
+    the same type with children matching the same speech as each of a copy's
+    children.
+
+    :param expansion: Expansion
+    :param copied: dictionary of copied expansion IDs to (copy, original, child
+        IDs) tuples
+    :returns: list of (expansion, original) tuples
+    """
+    # Map child IDs of each copy to their parent copies.
+    parents = dict((tuple(value[2]), value[0]) for value in copied.values()
+                   if value[2])
+
+    result = []
+    found = {}
+
+    # Check children before their parents.
+    stack = [(expansion, False)]
+    while stack:
+        e, visited = stack.pop()
+        if not visited:
+            stack.append((e, True))
+            stack.extend([(c, False) for c in e.children])
+            continue
+
+        if not e.children:
+            # Leaves are moved from the copied tree.
+            value = copied.get(id(e))
+            copy = value[0] if value and not value[2] else None
+        else:
+            children = tuple([found.get(id(c)) for c in e.children])
+            copy = parents.get(children)
+        if copy is None or copy is not e and type(copy) is not type(e):
+            continue
+
+        found[id(e)] = id(copy)
+        result.append((e, copied[id(copy)][1]))
+
+    return result
+
+
+def _graft_matches(expansion, sequence_matches, dictation_matches):
+    """
+    Internal function to graft matches of sequence expansions onto an expansion.
+
+    :param expansion: Expansion
+    :param sequence_matches: current_match values of sequence expansions
+    :param dictation_matches: current_match values of Dictation expansions in the
+        sequence in post order
+    """
+    # Set current_match of Dictation expansions in the given expansion to
+    # current_match values of their respective counterparts in the sequence.
+    dictation_in_exp = filter_expansion(expansion, _is_dictation,
+                                        TraversalOrder.PostOrder)
+    for value, e in zip(dictation_matches, dictation_in_exp):
+        # Stop the matches(speech) method from changing current_match
+        e.use_current_match = True
+        e.current_match = value
+
+    # Then collect the matches of sequence expansions up to the first one without
+    # a match.
+    matching = []
+    for m in sequence_matches:
+        if m is None:
+            # e and nothing after e match
+            break
+        else:
+            matching.append(m)
 
-        # Now match on expansion using the matches for the sequence.
-        expansion.matches(" ".join([e.current_match for e in matching]))
+    # Now match on expansion using the matches for the sequence.
+    expansion.matches(" ".join(matching))
 
 
 class PublicSequenceRule(SequenceRule):
@@ -0,0 +1,799 @@
+"""
+This module contains classes for read-only grammar snapshots.
+
+A ``FrozenGrammar`` stores every rule expansion tree of a grammar as flat parallel
+arrays with a shared string table instead of as linked ``Expansion`` objects. This
+makes frozen grammars cheap to build, share between threads and serialise (e.g.
+with ``pickle``). Frozen grammars can be compiled, matched against and queried for
+tags, but they cannot be modified. Use ``FrozenGrammar.thaw`` to get a regular,
+mutable ``Grammar`` back.
+
+Frozen grammars can be created using the ``Grammar.freeze`` method::
+
+    frozen = grammar.freeze()
+    frozen.find_matching_rules("hello world")
+"""
+
+import re
+from array import array
+from collections import deque
+
+import pyparsing
+
+from .errors import CompilationError, GrammarError
+from .expansions import (AlternativeSet, KleeneStar, Literal, NamedRuleRef, NullRef,
+                         OptionalGrouping, Repeat, RequiredGrouping, RuleRef,
+                         Sequence, VoidRef)
+from .utterances import make_utterance
+
+
+class NodeKind(object):
+    """
+    Integer codes used by ``FrozenGrammar`` for each expansion type.
+    """
+    Literal, Sequence, RequiredGrouping, AlternativeSet, OptionalGrouping, \
+        Repeat, KleeneStar, NamedRuleRef, RuleRef, NullRef, VoidRef, \
+        Dictation = list(range(12))
+
+
+# Kinds for expansions with children.
+_CONTAINER_KINDS = frozenset([
+    NodeKind.Sequence, NodeKind.RequiredGrouping, NodeKind.AlternativeSet,
+    NodeKind.OptionalGrouping, NodeKind.Repeat, NodeKind.KleeneStar
+])
+
+# Kinds for references to other rules.
+_REFERENCE_KINDS = frozenset([NodeKind.NamedRuleRef, NodeKind.RuleRef])
+
+# Value used in the weight array for alternatives without a weight.
+_NO_WEIGHT = -1.0
+
+
+def _expansion_kind(e):
+    """
+    Get the NodeKind code for an expansion.
+
+    :param e: Expansion
+    :returns: int
+    :raises: TypeError
+    """
+    # Import Dictation here to avoid a circular import with jsgf.ext.
+    from .ext.expansions import Dictation
+
+    # Order matters here because of subclassing, e.g. Dictation is a Literal.
+    for cls, kind in ((Dictation, NodeKind.Dictation),
+                      (Literal, NodeKind.Literal),
+                      (RequiredGrouping, NodeKind.RequiredGrouping),
+                      (Sequence, NodeKind.Sequence),
+                      (AlternativeSet, NodeKind.AlternativeSet),
+                      (OptionalGrouping, NodeKind.OptionalGrouping),
+                      (KleeneStar, NodeKind.KleeneStar),
+                      (Repeat, NodeKind.Repeat),
+                      (RuleRef, NodeKind.RuleRef),
+                      (NullRef, NodeKind.NullRef),
+                      (VoidRef, NodeKind.VoidRef),
+                      (NamedRuleRef, NodeKind.NamedRuleRef)):
+        if isinstance(e, cls):
+            return kind
+
+    raise TypeError("cannot freeze expansion %s of unsupported type %s"
+                    % (e, type(e).__name__))
+
+
+def _compiled_tag(tag):
+    # Same escaping as Expansion.compiled_tag.
+    if not tag:
+        return ""
+    escaped = tag.replace("{", "\\{") \
+        .replace("}", "\\}") \
+        .replace("\\", "\\\\")
+    return " { %s }" % escaped
+
+
+class FrozenRule(object):
+    """
+    Read-only rule view into a ``FrozenGrammar``.
+    """
+    __slots__ = ("grammar", "name", "visible", "active", "index", "root")
+
+    def __init__(self, grammar, index):
+        self.grammar = grammar
+        self.index = index
+        self.name = grammar._rule_names[index]
+        self.visible = grammar._rule_visible[index]
+        self.active = grammar._rule_active[index]
+        self.root = grammar._rule_roots[index]
+
+    def __str__(self):
+        return "%s(name='%s', visible=%s)" % (self.__class__.__name__,
+                                              self.name, self.visible)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self, other):
+        return (isinstance(other, FrozenRule) and self.grammar is other.grammar and
+                self.index == other.index)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.grammar), self.index))
+
+    def compile(self, ignore_tags=False):
+        """
+        Compile this rule's expansion tree and return the result.
+
+        :param ignore_tags: bool
+        :returns: str
+        """
+        return self.grammar._compile_rule(self.index, ignore_tags)
+
+    def matches(self, speech):
+        """
+        Whether speech matches this rule.
+
+        Speech is matched in the same way as ``Rule.matches`` with the default
+        matching backend, so rules with optional root expansions, such as
+        ``<rule> = (a b)*;``, match any speech. Unlike ``Rule.matches``, this does
+        not set any match data.
+
+        :param speech: str | list | Utterance
+        :returns: bool
+        """
+        return self.grammar._rule_matches(self.index, speech)
+
+    @property
+    def tags(self):
+        """
+        A list of JSGF tags used by this rule and any referenced rules. The
+        returned list will be in the order in which tags appear in the compiled
+        rule.
+
+        :returns: list
+        """
+        return self.grammar._rule_tags(self.index)
+
+    def has_tag(self, tag):
+        """
+        Check whether there are expansions in this rule or referenced rules that
+        use a given JSGF tag.
+
+        :param tag: str
+        :returns: bool
+        """
+        tag = tag.strip()
+        if not tag:
+            return False
+        return tag in self.tags
+
+
+class FrozenGrammar(object):
+    """
+    Immutable grammar snapshot storing expansion trees as flat parallel arrays.
+
+    Each expansion node is identified by an index into the following arrays:
+
+    * ``kinds`` -- the ``NodeKind`` code of the node.
+    * ``parents`` -- the index of the parent node (-1 for root nodes).
+    * ``first_child`` and ``child_count`` -- children are stored contiguously.
+    * ``text_ids`` -- the string table index of a literal's text or a
+      reference's name (-1 if not applicable).
+    * ``tag_ids`` -- the string table index of the node's tag (-1 if untagged).
+    * ``weights`` -- the node's weight in its parent ``AlternativeSet`` (-1.0 if
+      it has no weight).
+
+    Each string, such as literal text, rule names and tags, is stored only once in
+    the ``strings`` table.
+    """
+    def __init__(self, grammar):
+        """
+        :param grammar: Grammar to take a snapshot of
+        """
+        self.name = grammar.name
+        self.jsgf_version = grammar.jsgf_version
+        self.charset_name = grammar.charset_name
+        self.language_name = grammar.language_name
+        self.import_names = tuple(i.name for i in grammar.imports)
+
+        # Node arrays.
+        self.kinds = array("b")
+        self.parents = array("i")
+        self.first_child = array("i")
+        self.child_count = array("i")
+        self.text_ids = array("i")
+        self.tag_ids = array("i")
+        self.weights = array("d")
+
+        # String table.
+        self.strings = []
+        self._string_ids = {}
+
+        # Rule arrays.
+        self._rule_names = []
+        self._rule_visible = []
+        self._rule_active = []
+        self._rule_roots = array("i")
+
+        for rule in grammar.rules:
+            self._rule_names.append(rule.name)
+            self._rule_visible.append(bool(rule.visible))
+            self._rule_active.append(bool(rule.active))
+            self._rule_roots.append(self._flatten(rule.expansion))
+
+        # The string table lookup dictionary is only needed while building.
+        self._string_ids = None
+        self._init_runtime()
+
+    def _init_runtime(self):
+        # Initialise members that are not serialised.
+        self._rule_indices = dict(
+            (name, i) for i, name in enumerate(self._rule_names)
+        )
+        self._rules = tuple(FrozenRule(self, i)
+                            for i in range(len(self._rule_names)))
+        self._elements = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in ("_rule_indices", "_rules", "_elements"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def _string_id(self, s):
+        if not s:
+            return -1
+        result = self._string_ids.get(s)
+        if result is None:
+            result = len(self.strings)
+            self.strings.append(s)
+            self._string_ids[s] = result
+        return result
+
+    def _append_node(self, e, parent, weight):
+        index = len(self.kinds)
+        kind = _expansion_kind(e)
+        self.kinds.append(kind)
+        self.parents.append(parent)
+        self.first_child.append(-1)
+        self.child_count.append(0)
+        if kind in (NodeKind.Literal, NodeKind.Dictation):
+            self.text_ids.append(self._string_id(e.text))
+        elif kind in _REFERENCE_KINDS or kind in (NodeKind.NullRef,
+                                                  NodeKind.VoidRef):
+            self.text_ids.append(self._string_id(e.name))
+        else:
+            self.text_ids.append(-1)
+        self.tag_ids.append(self._string_id(e.tag))
+        self.weights.append(weight)
+        return index
+
+    def _flatten(self, root):
+        # Flatten an expansion tree in breadth-first order so that the children of
+        # each node are stored contiguously. Return the index of the root node.
+        root_index = self._append_node(root, -1, _NO_WEIGHT)
+        queue = deque([(root, root_index)])
+        while queue:
+            e, i = queue.popleft()
+            children = e.children
+            self.first_child[i] = len(self.kinds)
+            self.child_count[i] = len(children)
+            weights = e.weights if isinstance(e, AlternativeSet) else {}
+            for child in children:
+                j = self._append_node(child, i, weights.get(child, _NO_WEIGHT))
+                queue.append((child, j))
+        return root_index
+
+    def __str__(self):
+        charset = self.charset_name if self.charset_name else "<auto>"
+        language = self.language_name if self.language_name else "<auto>"
+        return "FrozenGrammar(version=%s, charset=%s, language=%s, name=%s)" % (
+            self.jsgf_version, charset, language, self.name
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def children(self, i):
+        """
+        Get the indices of a node's children.
+
+        :param i: int
+        :returns: range
+        """
+        first = self.first_child[i]
+        return range(first, first + self.child_count[i])
+
+    def text(self, i):
+        """
+        Get the text of a literal node or the name of a reference node. Returns
+        None for other nodes.
+
+        :param i: int
+        :returns: str | None
+        """
+        text_id = self.text_ids[i]
+        return self.strings[text_id] if text_id >= 0 else None
+
+    def tag(self, i):
+        """
+        Get the tag of a node or the empty string if it has none.
+
+        :param i: int
+        :returns: str
+        """
+        tag_id = self.tag_ids[i]
+        return self.strings[tag_id] if tag_id >= 0 else ""
+
+    @property
+    def rules(self):
+        """
+        The rules in this grammar.
+
+        :returns: tuple
+        """
+        return self._rules
+
+    @property
+    def rule_names(self):
+        """
+        The rule names of each rule in this grammar.
+
+        :returns: list
+        """
+        return list(self._rule_names)
+
+    @property
+    def visible_rules(self):
+        """
+        The rules in this grammar which are visible.
+
+        :returns: list
+        """
+        return [r for r in self._rules if r.visible]
+
+    @property
+    def match_rules(self):
+        """
+        The rules that the ``find_matching_rules`` method will match against.
+
+        :returns: list
+        """
+        return self.visible_rules
+
+    @property
+    def jsgf_header(self):
+        """
+        The JSGF header string for this grammar.
+
+        :returns: str
+        """
+        header = "#JSGF V%s" % self.jsgf_version
+        if self.charset_name:
+            header += " %s" % self.charset_name
+        if self.language_name:
+            header += " %s" % self.language_name
+        return header + ";\n"
+
+    def get_rule_from_name(self, name):
+        """
+        Get a rule with the specified name, if one exists in the grammar.
+
+        :param name: str
+        :returns: FrozenRule
+        :raises: GrammarError
+        """
+        index = self._rule_indices.get(name)
+        if index is None:
+            raise GrammarError("'%s' is not a rule in Grammar '%s'" % (name, self))
+        return self._rules[index]
+
+    def _referenced_root(self, i):
+        # Get the root node index of the rule referenced by node i.
+        name = self.text(i)
+        index = self._rule_indices.get(name)
+        if index is None:
+            raise GrammarError("'%s' is not a rule in Grammar '%s'" % (name, self))
+        return self._rule_roots[index]
+
+    def _compile_node(self, root, ignore_tags):
+        # Compile an expansion tree iteratively using an explicit stack of
+        # (node index, visited) pairs and a stack of compiled values.
+        values = []
+        stack = [(root, False)]
+        while stack:
+            i, visited = stack.pop()
+            kind = self.kinds[i]
+            count = self.child_count[i]
+            if not visited and kind in _CONTAINER_KINDS and count:
+                stack.append((i, True))
+                first = self.first_child[i]
+                for j in range(first + count - 1, first - 1, -1):
+                    stack.append((j, False))
+                continue
+
+            # Pop the compiled children of this node (if any).
+            if kind in _CONTAINER_KINDS:
+                if count:
+                    children = values[len(values) - count:]
+                    del values[len(values) - count:]
+                else:
+                    # Expansions without children compile as <NULL>.
+                    children = ["<NULL>"]
+
+            if kind == NodeKind.Literal:
+                value = self.text(i)
+                if not value:
+                    raise CompilationError("Literal expansion cannot be compiled "
+                                           "with a text value of ''")
+            elif kind == NodeKind.Dictation:
+                value = "<DICTATION>"
+            elif kind in _REFERENCE_KINDS or kind in (NodeKind.NullRef,
+                                                      NodeKind.VoidRef):
+                value = "<%s>" % self.text(i)
+            elif kind == NodeKind.Sequence:
+                value = " ".join(children)
+            elif kind == NodeKind.RequiredGrouping:
+                value = "(%s)" % " ".join(children)
+            elif kind == NodeKind.AlternativeSet:
+                child_weights = [self.weights[j] for j in self.children(i)]
+                if count and any(w != _NO_WEIGHT for w in child_weights):
+                    if _NO_WEIGHT in child_weights:
+                        raise GrammarError("alternative set at node %d does not "
+                                           "have a weight for each alternative"
+                                           % i)
+                    value = "(%s)" % "|".join([
+                        "/%.4f/ %s" % (w, c) for w, c in zip(child_weights,
+                                                             children)
+                    ])
+                else:
+                    value = "(%s)" % "|".join(children)
+            elif kind == NodeKind.OptionalGrouping:
+                value = "[%s]" % children[0]
+            elif kind == NodeKind.Repeat:
+                value = "(%s)+" % children[0]
+            else:  # KleeneStar
+                value = "(%s)*" % children[0]
+
+            if not ignore_tags:
+                value += _compiled_tag(self.tag(i))
+            values.append(value)
+
+        return values[0]
+
+    def _compile_rule(self, index, ignore_tags=False):
+        if not self._rule_active[index]:
+            return ""
+        expansion = self._compile_node(self._rule_roots[index], ignore_tags)
+        if not expansion:
+            return ""
+        result = "<%s> = %s;" % (self._rule_names[index], expansion)
+        if self._rule_visible[index]:
+            return "public %s" % result
+        return result
+
+    def compile(self):
+        """
+        Compile this grammar's header, imports and rules into a string that can be
+        recognised by a JSGF parser. The output is the same as ``Grammar.compile``
+        would produce for the original grammar.
+
+        :returns: str
+        """
+        result = self.jsgf_header
+        result += "grammar %s;\n" % self.name
+
+        for name in self.import_names:
+            result += "import <%s>;\n" % name
+
+        for i in range(len(self._rule_names)):
+            compiled = self._compile_rule(i)
+            if compiled:
+                result += "%s\n" % compiled
+
+        return result
+
+    def _postorder(self, root, shallow=False):
+        # Generate node indices in post-order, following rule references unless
+        # shallow is True.
+        stack = [(root, False)]
+        while stack:
+            i, visited = stack.pop()
+            if visited:
+                yield i
+                continue
+            stack.append((i, True))
+            if self.kinds[i] in _REFERENCE_KINDS and not shallow:
+                stack.append((self._referenced_root(i), False))
+            else:
+                first = self.first_child[i]
+                for j in range(first + self.child_count[i] - 1, first - 1, -1):
+                    stack.append((j, False))
+
+    def _rule_tags(self, index):
+        return [self.tag(i) for i in self._postorder(self._rule_roots[index])
+                if self.tag_ids[i] >= 0]
+
+    def find_tagged_rules(self, tag, include_hidden=False):
+        """
+        Find each rule in this grammar that has the specified JSGF tag.
+
+        :param tag: str
+        :param include_hidden: whether to include hidden rules (default False).
+        :returns: list
+        """
+        rules = self._rules if include_hidden else self.match_rules
+        return [r for r in rules if r.has_tag(tag)]
+
+    def _is_optional(self, i):
+        # Whether node i or one of its ancestors is optional.
+        while i >= 0:
+            if self.kinds[i] in (NodeKind.OptionalGrouping, NodeKind.KleeneStar):
+                return True
+            i = self.parents[i]
+        return False
+
+    def _leading_words(self, i, backtrack):
+        # Equivalent of jsgf.ext.expansions._collect_from_leaves for node i. None
+        # is used in the result for Dictation nodes.
+        result = []
+        look_further = True
+        stack = [i]
+        while stack:
+            j = stack.pop()
+            kind = self.kinds[j]
+            if kind in _REFERENCE_KINDS:
+                stack.append(self._referenced_root(j))
+                continue
+            elif self.child_count[j]:
+                first = self.first_child[j]
+                stack.extend(range(first + self.child_count[j] - 1, first - 1, -1))
+                continue
+            elif kind == NodeKind.Dictation:
+                result.append(None)
+            elif kind == NodeKind.Literal:
+                result.append(self.text(j).split()[0])
+            else:
+                continue
+
+            # Stop if the leaf is required.
+            if not self._is_optional(j):
+                if not backtrack:
+                    look_further = False
+                break
+        return result, look_further
+
+    def _collect_next_words(self, stack, i, look_further, backtrack):
+        # Equivalent of jsgf.ext.expansions._collect_next_literals using a stack
+        # of (node, parent) index pairs.
+        if not look_further or i < 0 or i >= len(stack):
+            return [], look_further
+
+        p1, p2 = stack[i]
+        kind = self.kinds[p2]
+        result = []
+        if kind in (NodeKind.Sequence, NodeKind.RequiredGrouping):
+            j = p1 - self.first_child[p2]
+            siblings = self.children(p2)
+            siblings = siblings[:j] if backtrack else siblings[j + 1:]
+            for c in siblings:
+                words, look_further = self._leading_words(c, backtrack)
+                result.extend(words)
+                if not look_further:
+                    break
+        elif kind in (NodeKind.Repeat, NodeKind.KleeneStar):
+            words, further = self._collect_next_words(stack, i - 1, look_further,
+                                                      True)
+            result.extend(words)
+            look_further = look_further or further
+        elif kind == NodeKind.AlternativeSet and backtrack:
+            for c in self.children(p2):
+                words, look_further = self._leading_words(c, backtrack)
+                result.extend(words)
+
+        words, further = self._collect_next_words(
+            stack, i - 1 if backtrack else i + 1, look_further, backtrack
+        )
+        result.extend(words)
+        return result, look_further or further
+
+    def _dictation_stop_words(self, i):
+        # Collect the next possible literal words after a Dictation node, like
+        # Dictation matcher elements do. None in the result means that the next
+        # thing could be another Dictation expansion.
+        stack = []
+        p1, p2 = i, self.parents[i]
+        while p2 >= 0:
+            stack.append((p1, p2))
+            p1, p2 = p2, self.parents[p2]
+        return set(self._collect_next_words(stack, 0, True, False)[0])
+
+    def _make_element(self, i, rule_elements):
+        # Build a side effect free pyparsing element for node i.
+        from .ext.expansions import _word_regex_str
+        kind = self.kinds[i]
+        children = self.children(i)
+        if kind == NodeKind.Literal:
+            return pyparsing.Literal(self.text(i))
+        elif kind == NodeKind.Dictation:
+            word = pyparsing.Regex(_word_regex_str, re.UNICODE)
+            stop_words = self._dictation_stop_words(i)
+            if None in stop_words:
+                return word
+            elif stop_words:
+                return pyparsing.OneOrMore(word, stopOn=pyparsing.Or(
+                    [pyparsing.Literal(w) for w in stop_words]
+                ))
+            return pyparsing.OneOrMore(word)
+        elif kind in _REFERENCE_KINDS:
+            return self._rule_element(self._referenced_root(i), rule_elements)
+        elif kind == NodeKind.NullRef:
+            return pyparsing.Empty()
+        elif kind == NodeKind.VoidRef:
+            return pyparsing.NoMatch()
+        elif not children:
+            # Expansions without children are compiled with <NULL>.
+            return pyparsing.Empty()
+        elif kind in (NodeKind.Sequence, NodeKind.RequiredGrouping):
+            return pyparsing.And([self._make_element(j, rule_elements)
+                                  for j in children])
+        elif kind == NodeKind.AlternativeSet:
+            alternatives = [(j, self.weights[j]) for j in children]
+            if any(w != _NO_WEIGHT for _, w in alternatives):
+                alternatives = sorted([(j, w) for j, w in alternatives if w > 0],
+                                      key=lambda x: x[1], reverse=True)
+            return pyparsing.Or([self._make_element(j, rule_elements)
+                                 for j, _ in alternatives])
+        elif kind == NodeKind.OptionalGrouping:
+            return pyparsing.Optional(self._make_element(children[0],
+                                                         rule_elements))
+
+        # Repeat or KleeneStar.
+        child = self._make_element(children[0], rule_elements)
+        cls = pyparsing.ZeroOrMore if self._is_optional(i) else pyparsing.OneOrMore
+        p, c = self.parents[i], i
+        while p >= 0 and self.kinds[p] not in (NodeKind.Repeat, NodeKind.KleeneStar):
+            c, p = p, self.parents[p]
+        if p >= 0:
+            # Use And if this repeat is the only branch of a repetition ancestor.
+            only_branch = True
+            j = self.first_child[p]
+            while j != i:
+                if self.child_count[j] > 1:
+                    only_branch = False
+                    break
+                j = self.first_child[j]
+            if only_branch:
+                cls = pyparsing.And
+        return cls(child)
+
+    def _rule_element(self, root, rule_elements):
+        # Get the element for a rule's root node, using a Forward element for
+        # recursive rule references.
+        element = rule_elements.get(root)
+        if element is None:
+            element = pyparsing.Forward()
+            rule_elements[root] = element
+            element <<= self._make_element(root, rule_elements)
+        return element
+
+    def _rule_matches(self, index, speech):
+        # Match speech the same way as Rule.matches.
+        if not self._rule_active[index]:
+            return False
+
+        # Rule.matches always succeeds for rules with optional root expansions
+        # because their current_match values are never None.
+        root = self._rule_roots[index]
+        if self.kinds[root] in (NodeKind.OptionalGrouping, NodeKind.KleeneStar,
+                                NodeKind.NullRef):
+            return True
+
+        element = self._elements.get(index)
+        if element is None:
+            element = self._rule_element(root, {})
+            self._elements[index] = element
+
+        # Use the remainder after the joined result to check whether the rule
+        # matched completely, like Expansion.matches.
+        text = make_utterance(speech).text
+        try:
+            result = " ".join(element.parseString(text).asList())
+        except pyparsing.ParseException:
+            return False
+        return bool(result.strip()) and not text[len(result):].strip()
+
+    def find_matching_rules(self, speech):
+        """
+        Find each visible rule in this grammar that matches the `speech` string.
+
+        :param speech: str | list | Utterance
+        :returns: list
+        """
+        speech = make_utterance(speech)
+        return [r for r in self.match_rules if r.matches(speech)]
+
+    def thaw(self):
+        """
+        Create a regular, mutable ``Grammar`` from this snapshot.
+
+        :returns: Grammar
+        """
+        # Import these here to avoid circular imports.
+        from .ext.expansions import Dictation
+        from .grammars import Grammar, Import
+        from .rules import Rule
+
+        grammar = Grammar(self.name)
+        grammar.jsgf_version = self.jsgf_version
+        grammar.charset_name = self.charset_name
+        grammar.language_name = self.language_name
+        grammar.add_imports(*[Import(name) for name in self.import_names])
+
+        # Create rules first so that RuleRefs can be thawed.
+        rules = [Rule(name, visible, NullRef()) for name, visible in
+                 zip(self._rule_names, self._rule_visible)]
+
+        simple_types = {
+            NodeKind.Sequence: Sequence,
+            NodeKind.RequiredGrouping: RequiredGrouping,
+            NodeKind.AlternativeSet: AlternativeSet,
+            NodeKind.OptionalGrouping: OptionalGrouping,
+            NodeKind.Repeat: Repeat,
+            NodeKind.KleeneStar: KleeneStar,
+        }
+
+        def thaw_tree(root):
+            # Build expansions bottom-up, i.e. in post-order.
+            built = {}
+            for i in self._postorder(root, shallow=True):
+                kind = self.kinds[i]
+                children = [built.pop(j) for j in self.children(i)]
+                if kind == NodeKind.Literal:
+                    e = Literal(self.text(i))
+                elif kind == NodeKind.Dictation:
+                    e = Dictation()
+                elif kind == NodeKind.NullRef:
+                    e = NullRef()
+                elif kind == NodeKind.VoidRef:
+                    e = VoidRef()
+                elif kind == NodeKind.RuleRef:
+                    index = self._rule_indices.get(self.text(i))
+                    if index is None:
+                        e = NamedRuleRef(self.text(i))
+                    else:
+                        e = RuleRef(rules[index])
+                elif kind == NodeKind.NamedRuleRef:
+                    e = NamedRuleRef(self.text(i))
+                elif kind in (NodeKind.OptionalGrouping, NodeKind.Repeat,
+                              NodeKind.KleeneStar):
+                    e = simple_types[kind](children[0])
+                else:
+                    e = simple_types[kind](*children)
+
+                if kind == NodeKind.AlternativeSet:
+                    weights = [(c, self.weights[j]) for c, j in
+                               zip(children, self.children(i))
+                               if self.weights[j] != _NO_WEIGHT]
+                    if weights:
+                        e.weights = weights
+
+                e.tag = self.tag(i)
+                built[i] = e
+            return built[root]
+
+        for rule, root, active in zip(rules, self._rule_roots, self._rule_active):
+            rule.expansion = thaw_tree(root)
+            if not active:
+                rule.disable()
+            grammar.add_rule(rule)
+
+        return grammar
@@ -3,11 +3,17 @@ This module contains classes for compiling, importing from and matching JSpeech
 Grammar Format grammars.
 """
 
+import pyparsing
 from six import string_types
 
-from .references import BaseRef, import_name, grammar_name
-from .rules import Rule
+from .references import (BaseRef, import_name, grammar_name, import_name_regex,
+                         grammar_name_regex)
+from .chart import ChartParser, MatchBackend
+from .expansions import RuleMatchMemo, map_expansion
+from .rules import Rule, _entries_unchanged
+from .utterances import make_utterance
 from .errors import GrammarError
+from .wordlists import compile_word_list_rules
 
 
 class Import(BaseRef):
@@ -42,6 +48,90 @@ class Import(BaseRef):
     def valid(name):
         return import_name.matches(name)
 
+    @staticmethod
+    def fast_valid(name):
+        return bool(import_name_regex.match(name))
+
+
+def enable_packrat(cache_size_limit=128):
+    """
+    Enable ``pyparsing`` packrat caching, which can speed up matching rules with
+    the default backend, especially rules with many alternatives that start the
+    same way.
+
+    Packrat caching is a process-wide ``pyparsing`` setting. Calling this function
+    affects every use of ``pyparsing`` in the process, not only JSGF matching,
+    until ``disable_packrat`` is called. Calling it again while packrat caching
+    is enabled has no effect.
+
+    :param cache_size_limit: maximum number of cached results or None for no
+        limit
+    """
+    pyparsing.ParserElement.enablePackrat(cache_size_limit)
+
+
+def disable_packrat():
+    """
+    Disable ``pyparsing`` packrat caching enabled by ``enable_packrat`` and clear
+    the cache.
+
+    Like ``enable_packrat``, this affects every use of ``pyparsing`` in the
+    process. It should not be called while other threads are matching speech.
+    """
+    element_class = pyparsing.ParserElement
+    if not element_class._packratEnabled:
+        return
+
+    element_class.resetCache()
+    element_class._packratEnabled = False
+    element_class._parse = element_class._parseNoCache
+
+
+class _MatchingContext(object):
+    """
+    Internal class for using a ``RuleMatchMemo`` while matching one utterance if
+    required.
+    """
+    def __init__(self, memoize_references):
+        self._memo = RuleMatchMemo() if memoize_references else None
+
+    def __enter__(self):
+        if self._memo:
+            self._memo.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._memo:
+            self._memo.__exit__(exc_type, exc_val, exc_tb)
+
+
+def _rules_entries(rules):
+    """
+    Internal function to get the vocabulary entries of a list of rules for
+    checking whether they have changed.
+
+    :param rules: list
+    :returns: list
+    """
+    entries = []
+    for rule in rules:
+        entries.extend(rule._vocabulary_entries())
+    return entries
+
+
+def _rules_cache_valid(cache, rules):
+    """
+    Internal function to check whether a (rules, entries, value) cache tuple
+    was made for the same rules and whether they are unchanged.
+
+    :param cache: tuple | None
+    :param rules: list
+    :returns: bool
+    """
+    return cache is not None and len(cache[0]) == len(rules) and \
+        all([r1 is r2 for r1, r2 in zip(cache[0], rules)]) and \
+        _entries_unchanged(cache[1])
+
 
 class Grammar(BaseRef):
     """
@@ -69,9 +159,34 @@ class Grammar(BaseRef):
         super(Grammar, self).__init__(name)
         self._rules = []
         self._imports = []
+
+        # Number of times rules have been added, removed or renamed.
+        self._rules_version = 0
         self.jsgf_version, self.charset_name, self.language_name =\
             self.default_header_values
 
+        # Backend used by find_matching_rules and the beam width used for pruning
+        # partial parses with the chart parser.
+        self.matching_backend = MatchBackend.Pyparsing
+        self.beam_width = None
+
+        # Whether find_matching_rules shares the results of matching referenced
+        # rules between rules.
+        self.memoize_references = False
+
+        # Whether find_matching_rules skips rules with vocabularies that don't
+        # cover the words of the speech. This is off by default because the
+        # pyparsing backend can match speech that the index rejects.
+        self.use_vocabulary_index = False
+
+        # Cached automaton for matching N-best lists and lattices, the match rules
+        # it was built from and their vocabulary entries.
+        self._automaton_cache = None
+
+        # Cached chart parser for the chart and weighted backends, the match
+        # rules it was created from and their vocabulary entries.
+        self._chart_parser_cache = None
+
     @property
     def jsgf_header(self):
         """
@@ -95,6 +210,10 @@ class Grammar(BaseRef):
     def valid(name):
         return grammar_name.matches(name)
 
+    @staticmethod
+    def fast_valid(name):
+        return bool(grammar_name_regex.match(name))
+
     def compile(self):
         """
         Compile this grammar's header, imports and rules into a string that can be
@@ -102,33 +221,178 @@ class Grammar(BaseRef):
 
         :returns: str
         """
+        return "".join(self.compile_iter())
+
+    def compile_iter(self, compile_as_root_grammar=False):
+        """
+        Compile this grammar like ``compile`` or ``compile_as_root_grammar``,
+        yielding the result in parts.
+
+        Rules generated for ``WordList`` expansions are yielded in parts so that
+        large word lists don't need to be compiled into one string.
+
+        :param compile_as_root_grammar: bool
+        :returns: generator
+        :raises: GrammarError
+        """
+        result, rules = self._compile_rules(compile_as_root_grammar)
+        yield result
+        for part in compile_word_list_rules(rules):
+            yield part
+
+    def _compile_rules(self, compile_as_root_grammar):
+        """
+        Internal method to compile this grammar's header, imports and rules,
+        except for word list rules.
+
+        :param compile_as_root_grammar: bool
+        :returns: (str, list of compiled rules)
+        """
+        if compile_as_root_grammar:
+            return self._compile_rules_as_root_grammar()
+
         result = self.jsgf_header
         result += "grammar %s;\n" % self.name
 
         for i in self._imports:
             result += "%s\n" % i.compile()
 
+        rules = []
         for r in self._rules:
             compiled = r.compile()
             if compiled and r.active:
                 result += "%s\n" % compiled
+                rules.append(r)
 
-        return result
+        return result, rules
+
+    def freeze(self):
+        """
+        Create a read-only ``FrozenGrammar`` snapshot of this grammar.
+
+        Frozen grammars store expansion trees as flat arrays. They can be compiled,
+        matched against and queried for tags, but not modified. Use
+        ``FrozenGrammar.thaw`` to get a mutable ``Grammar`` back.
+
+        :returns: FrozenGrammar
+        """
+        # Import FrozenGrammar here to avoid a circular import.
+        from .frozen import FrozenGrammar
+        return FrozenGrammar(self)
+
+    def incremental(self):
+        """
+        Create an ``IncrementalMatcher`` for matching speech against this
+        grammar's match rules one word at a time.
+
+        The matcher uses an automaton built from the rules as they are when this
+        method is called. Call this method again after adding or changing rules.
+        The automaton is shared with other matchers and methods until then.
+
+        :returns: IncrementalMatcher
+        :raises: GrammarError
+        """
+        # Import IncrementalMatcher here to avoid a circular import.
+        from .automaton import IncrementalMatcher
+        return IncrementalMatcher(self._get_automaton())
+
+    def _get_automaton(self):
+        """
+        Internal method to get a ``WordAutomaton`` for this grammar's match
+        rules. The automaton is built again after rules are added, removed or
+        changed.
+
+        :returns: WordAutomaton
+        :raises: GrammarError
+        """
+        rules = self.match_rules
+        cache = self._automaton_cache
+        if _rules_cache_valid(cache, rules):
+            return cache[2]
+
+        # Import WordAutomaton here to avoid a circular import.
+        from .automaton import WordAutomaton
+        automaton = WordAutomaton(rules)
+        self._automaton_cache = (rules, _rules_entries(rules), automaton)
+        return automaton
+
+    def _get_chart_parser(self, rules):
+        """
+        Internal method to get a ``ChartParser`` for a list of this grammar's
+        rules. The parser is cached and created again for different rules or
+        after rules are added, removed or changed.
+
+        :param rules: list
+        :returns: ChartParser
+        :raises: GrammarError
+        """
+        cache = self._chart_parser_cache
+        if _rules_cache_valid(cache, rules):
+            return cache[2]
+
+        parser = ChartParser([r.expansion for r in rules])
+        self._chart_parser_cache = (rules, _rules_entries(rules), parser)
+        return parser
+
+    def batch_matcher(self):
+        """
+        Create a ``BatchMatcher`` for matching batches of encoded utterances
+        against this grammar's match rules.
+
+        The matcher uses tables built from the rules as they are when this
+        method is called. Call this method again after adding or changing rules.
+        NumPy is required.
+
+        :returns: BatchMatcher
+        :raises: ImportError
+        """
+        # Import BatchMatcher here to avoid a circular import.
+        from .batch import BatchMatcher
+        return BatchMatcher(self.match_rules)
+
+    def match_nbest(self, hypotheses, scores=None):
+        """
+        Find the best hypothesis for each match rule in this grammar from a list
+        of N-best recognition hypotheses.
+
+        Hypotheses sharing prefixes are matched together word by word using a
+        ``WordAutomaton``. See ``WordAutomaton.match_nbest`` for details. The first
+        tuple in the returned list, if any, has the best matching hypothesis.
+
+        :param hypotheses: list of str
+        :param scores: list of numbers | None
+        :returns: list of (hypothesis, rule) tuples ordered from best to worst
+        :raises: GrammarError, ValueError
+        """
+        return self._get_automaton().match_nbest(hypotheses, scores)
+
+    def match_lattice(self, lattice, max_paths=10):
+        """
+        Find the best scoring path through a word lattice for each match rule in
+        this grammar.
+
+        See ``WordAutomaton.match_lattice`` for details. The first tuple in the
+        returned list, if any, has the best path accepted by the grammar.
+
+        :param lattice: Lattice
+        :param max_paths: int
+        :returns: list of (hypothesis, score, rule) tuples ordered from best to
+            worst
+        :raises: GrammarError, ValueError
+        """
+        return self._get_automaton().match_lattice(lattice, max_paths)
 
     def compile_to_file(self, file_path, compile_as_root_grammar=False):
         """
-        Compile this grammar by calling ``compile`` and write the result to the
-        specified file.
+        Compile this grammar by calling ``compile_iter`` and write the result to
+        the specified file.
 
         :param file_path: str
         :param compile_as_root_grammar: bool
         """
-        if compile_as_root_grammar:
-            compiled_lines = self.compile_as_root_grammar()
-        else:
-            compiled_lines = self.compile()
         with open(file_path, "w+") as f:
-            f.write(compiled_lines)
+            for part in self.compile_iter(compile_as_root_grammar):
+                f.write(part)
 
     def compile_grammar(self, charset_name="UTF-8", language_name="en",
                         jsgf_version="1.0"):
@@ -165,6 +429,15 @@ class Grammar(BaseRef):
 
         :returns: str
         """
+        return "".join(self.compile_iter(True))
+
+    def _compile_rules_as_root_grammar(self):
+        """
+        Internal method to compile this grammar with a root rule, except for word
+        list rules.
+
+        :returns: (str, list of compiled rules)
+        """
         result = self.jsgf_header
         result += "grammar %s;\n" % self.name
 
@@ -177,7 +450,7 @@ class Grammar(BaseRef):
 
         # Return the result if there are no rules that are visible and active
         if not visible_rules:
-            return result
+            return result, []
 
         # Temporarily set each visible rule to not visible
         for rule in visible_rules:
@@ -187,10 +460,12 @@ class Grammar(BaseRef):
         # something. Rules can compile to the empty string if they are disabled.
         names = []
         compiled_rules = ""
+        rules = []
         for rule in self.rules:
             compiled = rule.compile()
             if compiled:
                 compiled_rules += "%s\n" % compiled
+                rules.append(rule)
             if rule in visible_rules and compiled:
                 names.append(rule.name)
 
@@ -202,12 +477,14 @@ class Grammar(BaseRef):
             root_rule = "public <root> = %s;\n" % alt_set
             result += root_rule
             result += compiled_rules
+        else:
+            rules = []
 
         # Set rule visibility back to normal
         for rule in visible_rules:
             rule.visible = True
 
-        return result
+        return result, rules
 
     @property
     def imports(self):
@@ -254,6 +531,21 @@ class Grammar(BaseRef):
         """
         return self.visible_rules
 
+    @property
+    def vocabulary(self):
+        """
+        The set of words that this grammar's match rules can match, including the
+        words of referenced rules. This can be used to prune a speech
+        recogniser's dictionary.
+
+        Words matched by ``Dictation`` and ``WordList`` expansions are not
+        included. Use ``Rule.has_open_vocabulary`` to check which rules can
+        match other words.
+
+        :returns: frozenset
+        """
+        return frozenset().union(*[r.vocabulary for r in self.match_rules])
+
     def __str__(self):
         charset = self.charset_name if self.charset_name else "<auto>"
         language = self.language_name if self.language_name else "<auto>"
@@ -311,6 +603,7 @@ class Grammar(BaseRef):
                                    "the same name")
 
         self._rules.append(rule)
+        self._rules_version += 1
         rule.grammar = self
 
     def add_import(self, _import):
@@ -327,10 +620,108 @@ class Grammar(BaseRef):
         """
         Find each visible rule in this grammar that matches the `speech` string.
 
-        :param speech: str
+        If ``matching_backend`` is ``MatchBackend.Chart``, the speech is parsed once
+        for all rules using a ``ChartParser``. If it is ``MatchBackend.Weighted``,
+        the best parse for each rule is used, each matching rule's
+        ``match_score`` is set and rules are returned in order of highest score.
+        If it is ``MatchBackend.Compiled``, each rule is matched using its
+        ``compiled_matcher``. Otherwise each rule is matched using
+        ``Rule.matches``. The backends match rules that can match empty speech
+        differently; see ``Rule.matches``.
+
+        Set ``memoize_references`` to True to share the results of matching
+        referenced rules at each position between rules using a
+        ``RuleMatchMemo``. See ``enable_packrat`` and ``disable_packrat`` for
+        enabling and disabling ``pyparsing`` packrat caching.
+
+        The speech is normalised and split into words once as an ``Utterance``
+        that is passed to each rule.
+
+        If ``use_vocabulary_index`` is True, rules that can't match the speech
+        because one of its words can't be made from words in the rule's
+        ``vocabulary`` are not matched and have their match data reset. Words
+        made by joining vocabulary words together are allowed because literals
+        can match without whitespace between them. Rules with open vocabularies
+        are always matched. This is off by default because the ``pyparsing``
+        backend can leniently match speech that the index rejects, such as
+        partial words after repeated literals. The other backends only match
+        whole words, so the index doesn't change their results.
+
+        :param speech: str | list | Utterance
         :returns: list
         """
-        return [r for r in self.match_rules if r.visible and r.matches(speech)]
+        speech = make_utterance(speech)
+        if self.matching_backend == MatchBackend.Chart:
+            parser = self._get_chart_parser(self._active_match_rules())
+            rules = self._candidate_rules(speech)
+            chart = parser.parse(speech, self.beam_width,
+                                 [r.expansion for r in rules])
+            return [r for r in rules if chart.set_match_data(r.expansion)]
+
+        if self.matching_backend == MatchBackend.Compiled:
+            return [r for r in self._candidate_rules(speech)
+                    if r.compiled_matcher.matches(speech)]
+
+        if self.matching_backend == MatchBackend.Weighted:
+            parser = self._get_chart_parser(self._active_match_rules())
+            rules = self._candidate_rules(speech)
+            chart = parser.parse(speech, self.beam_width,
+                                 [r.expansion for r in rules])
+            result = []
+            for r in rules:
+                r.match_score = chart.set_best_match_data(r.expansion)
+                if r.match_score is not None:
+                    result.append(r)
+
+            # Sort is stable, so rules with equal scores keep their order.
+            result.sort(key=lambda r: r.match_score, reverse=True)
+            return result
+
+        rules = self._candidate_rules(speech)
+        with self._matching_context():
+            return [r for r in rules if r.matches(speech)]
+
+    def _active_match_rules(self):
+        """
+        Internal method to get the visible and active match rules.
+
+        :returns: list
+        """
+        return [r for r in self.match_rules if r.visible and r.active]
+
+    def _candidate_rules(self, speech):
+        """
+        Internal method to get the visible and active match rules that could
+        match an utterance.
+
+        :param speech: Utterance
+        :returns: list
+        """
+        rules = self._active_match_rules()
+        if not self.use_vocabulary_index:
+            return rules
+
+        words = set(speech.words)
+        result = []
+        for r in rules:
+            if r._covers_words(words):
+                result.append(r)
+            else:
+                # Reset match data as if the rule had failed to match. Only
+                # the rule's own tree is reset because rules can be recursive.
+                map_expansion(r.expansion, lambda x: x.reset_match_data(),
+                              shallow=True)
+                r.match_score = None
+        return result
+
+    def _matching_context(self):
+        """
+        Internal method to get a context for matching one utterance using this
+        grammar's caching options.
+
+        :returns: _MatchingContext
+        """
+        return _MatchingContext(self.memoize_references)
 
     def find_tagged_rules(self, tag, include_hidden=False):
         """
@@ -380,6 +771,7 @@ class Grammar(BaseRef):
                                "another rule." % rule)
 
         self._rules.remove(rule)
+        self._rules_version += 1
         rule.grammar = None
 
     def enable_rule(self, rule):
@@ -467,6 +859,9 @@ class RootGrammar(Grammar):
         """
         return self.compile_as_root_grammar()
 
+    def compile_iter(self, compile_as_root_grammar=True):
+        return super(RootGrammar, self).compile_iter(compile_as_root_grammar)
+
     def add_rule(self, rule):
         if rule.name == "root":
             raise GrammarError("cannot add rule with name 'root' to RootGrammar")
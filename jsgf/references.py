@@ -3,6 +3,7 @@ This module contains the base class for referencing rules and grammars by name.
 """
 
 import re
+import threading
 
 from pyparsing import Regex, Optional, OneOrMore, Combine
 from pyparsing import Literal as PPLiteral  # to differentiate from jsgf.Literal
@@ -44,6 +45,45 @@ grammar_name = Combine(_grammar_base_name ^ Combine(
     .setName("grammar name")
 
 
+def _name_regex(pattern):
+    # Compile a regular expression equivalent to using ParserElement.matches() on
+    # the parser elements above. Leading and trailing whitespace is ignored.
+    return re.compile(r"[ \t\r\n]*(?:%s)[ \t\r\n]*\Z" % pattern, re.UNICODE)
+
+
+# Define compiled regular expressions equivalent to the name parser elements. These
+# are used instead of the parser elements during bulk builds.
+_base = r"[\w\+\-;:\|/\\\(\)\[\]@#%!\^&~\$]+"
+_grammar_base = r"[\w\+\-:\|/\\\(\)\[\]@#%!\^&~\$]+"
+base_name_regex = _name_regex(_base)
+reserved_names_regex = _name_regex("NULL|VOID")
+optionally_qualified_name_regex = _name_regex(r"%s(?:\.%s)*" % (_base, _base))
+import_name_regex = _name_regex(r"%s(?:\.%s)+(?:\.\*)?|%s\.\*"
+                                % (_base, _base, _base))
+grammar_name_regex = _name_regex(r"%s(?:\.%s)*" % (_grammar_base, _grammar_base))
+
+
+class _BulkBuildState(threading.local):
+    """
+    Internal state used by ``jsgf.expansions.bulk_build``.
+
+    The state is thread-local, so a bulk build only affects changes made in the
+    thread it was started in.
+    """
+    def __init__(self):
+        # How many bulk_build contexts have been entered.
+        self.depth = 0
+
+        # References with names waiting to be validated on exit.
+        self.pending_refs = []
+
+        # Expansions waiting to have their matcher elements invalidated on exit.
+        self.pending_expansions = []
+
+
+_bulk_build_state = _BulkBuildState()
+
+
 class BaseRef(object):
     """
     Base class for JSGF rule and grammar references.
@@ -80,6 +120,12 @@ class BaseRef(object):
 
     @name.setter
     def name(self, value):
+        # Defer validation until the end of the bulk build if there is one.
+        if _bulk_build_state.depth:
+            _bulk_build_state.pending_refs.append(self)
+            self._name = value
+            return
+
         # Validate the format of name
         if not self.valid(value):
             raise GrammarError("'%s' is not a valid %s name"
@@ -97,3 +143,18 @@ class BaseRef(object):
         :returns: bool
         """
         return base_name.matches(name) and not reserved_names.matches(name)
+
+    @staticmethod
+    def fast_valid(name):
+        """
+        Static method equivalent to ``valid`` that uses compiled regular
+        expressions instead of parser elements. This is used to validate names
+        at the end of bulk builds.
+
+        This should be overwritten appropriately in subclasses.
+
+        :param name: str
+        :returns: bool
+        """
+        return bool(base_name_regex.match(name) and
+                    not reserved_names_regex.match(name))
@@ -5,9 +5,13 @@ This module contains classes for compiling and matching JSpeech Grammar Format
 rules.
 """
 
+from .chart import ChartParser, MatchBackend
+from .codegen import get_compiled_matcher
+from .errors import GrammarError
 from .references import BaseRef
-from .expansions import Expansion, NamedRuleRef, filter_expansion, \
-    map_expansion, TraversalOrder
+from .expansions import Expansion, NamedRuleRef, RuleRef, filter_expansion, \
+    map_expansion, TraversalOrder, _OPEN_VOCABULARY
+from .utterances import make_utterance
 
 
 class Rule(BaseRef):
@@ -42,6 +46,41 @@ class Rule(BaseRef):
         self._active = True
         self.grammar = None
 
+        # Backend used by the matches method and the beam width used for pruning
+        # partial parses with the chart parser.
+        self.matching_backend = MatchBackend.Pyparsing
+        self.beam_width = None
+
+        # Directory compiled matchers save and load compiled code in, if any.
+        self.matcher_cache_dir = None
+
+        # Score of the last match using the weighted backend.
+        self.match_score = None
+
+        # Cached vocabulary parts, words and whether the vocabulary is open.
+        self._vocabulary_cache = None
+
+        # Cached automaton for matching lattices and the vocabulary entries it
+        # was built with.
+        self._automaton_cache = None
+
+        # Cached chart parser for the chart and weighted backends and the
+        # vocabulary entries it was created with.
+        self._chart_parser_cache = None
+
+        # Cached expansions of this rule's tree and referenced rules' trees,
+        # used by RuleMatchMemo, and the vocabulary entries they were found with.
+        self._tree_expansions_cache = None
+
+    @BaseRef.name.setter
+    def name(self, value):
+        BaseRef.name.fset(self, value)
+
+        # Count the change so that references to rules are looked up again.
+        grammar = getattr(self, "grammar", None)
+        if grammar:
+            grammar._rules_version += 1
+
     @property
     def expansion(self):
         """
@@ -141,33 +180,219 @@ class Rule(BaseRef):
         """
         Whether speech matches this rule.
 
-        Matching ambiguous rule expansions is **not supported** because it not worth
-        the performance hit. Ambiguous rule expansions are defined as some optional
-        literal x followed by a required literal x. For example, successfully
-        matching ``'test'`` for the following rule is not supported::
+        Matching ambiguous rule expansions is **not supported** by default because
+        it not worth the performance hit. Ambiguous rule expansions are defined as
+        some optional literal x followed by a required literal x. For example,
+        successfully matching ``'test'`` for the following rule is not supported::
 
             <rule> = [test] test;
 
-        :param speech: str
+        Ambiguous rule expansions are supported if ``matching_backend`` is
+        ``MatchBackend.Chart`` or ``MatchBackend.Weighted``. The weighted backend
+        uses the parse with the highest product of alternative weights and sets
+        ``match_score`` to its natural logarithm.
+
+        If ``matching_backend`` is ``MatchBackend.Compiled``, speech is matched
+        using ``compiled_matcher``.
+
+        Rules that can match empty speech are matched differently by the default
+        backend. If the rule's expansion is an optional grouping, a Kleene star or
+        ``<NULL>``, the rule matches any speech. Other expansions that can match
+        empty speech, such as ``[a] [b]``, don't match empty speech. The other
+        backends only match speech that the whole expansion matches, so
+        ``<rule> = [a];`` matches "" and "a", but not "b".
+
+        Speech can be given as a string, a list of words or an ``Utterance``.
+        Passing an ``Utterance`` avoids normalising the same speech again when
+        matching many rules.
+
+        :param speech: str | list | Utterance
         :returns: bool
         """
+        return self._match_expansion(self.expansion, speech)
+
+    def _match_expansion(self, expansion, speech):
+        """
+        Internal method to match speech against an expansion belonging to this rule.
+
+        :param expansion: Expansion
+        :param speech: str | list | Utterance
+        :returns: bool
+        """
+        self.match_score = None
         if not self._active:
             return False
 
-        # Strip whitespace at the start of 'speech' and lower it to match regex
-        # properly.
-        speech = speech.lstrip().lower()
+        speech = make_utterance(speech)
+
+        if self.matching_backend == MatchBackend.Compiled:
+            return get_compiled_matcher(expansion,
+                                        self.matcher_cache_dir).matches(speech)
+
+        if self.matching_backend == MatchBackend.Chart:
+            chart = self._get_chart_parser(expansion).parse(speech,
+                                                            self.beam_width)
+            return chart.set_match_data(expansion)
+
+        if self.matching_backend == MatchBackend.Weighted:
+            chart = self._get_chart_parser(expansion).parse(speech,
+                                                            self.beam_width)
+            self.match_score = chart.set_best_match_data(expansion)
+            return self.match_score is not None
 
         # Reset match data for this rule and referenced rules.
-        self.expansion.reset_for_new_match()
+        expansion.reset_for_new_match()
 
-        # Match the expansion and use the remainder substring to check if the rule
-        # matched completely.
-        remainder = self.expansion.matches(speech)
+        # Match the expansion with the normalised speech and use the remainder
+        # substring to check if the rule matched completely.
+        remainder = expansion.matches(speech.text)
         if remainder != "":
-            self.expansion.current_match = None
+            expansion.current_match = None
 
-        return self.expansion.current_match is not None
+        return expansion.current_match is not None
+
+    def _get_chart_parser(self, expansion):
+        """
+        Internal method to get a ``ChartParser`` for an expansion belonging to
+        this rule. The parser for the rule's expansion is cached and created
+        again after this rule or a referenced rule changes.
+
+        :param expansion: Expansion
+        :returns: ChartParser
+        :raises: GrammarError
+        """
+        if expansion is not self._expansion:
+            return ChartParser([expansion])
+
+        cache = self._chart_parser_cache
+        if cache is not None and _entries_unchanged(cache[0]):
+            return cache[1]
+
+        parser = ChartParser([expansion])
+        self._chart_parser_cache = (self._vocabulary_entries(), parser)
+        return parser
+
+    @property
+    def compiled_matcher(self):
+        """
+        The ``CompiledMatcher`` for this rule's expansion. It is generated when
+        first used and again after the expansion tree changes.
+
+        :returns: CompiledMatcher
+        """
+        return get_compiled_matcher(self.expansion, self.matcher_cache_dir)
+
+    @property
+    def vocabulary(self):
+        """
+        The set of words this rule's literals can match, including the words of
+        directly and indirectly referenced rules.
+
+        The vocabulary is recalculated after this rule or a referenced rule
+        changes. It does not include words matched by ``Dictation`` or
+        ``WordList`` expansions; see ``has_open_vocabulary``.
+
+        :returns: frozenset
+        """
+        return self._get_vocabulary()[0]
+
+    @property
+    def has_open_vocabulary(self):
+        """
+        Whether this rule can match words that are not in its ``vocabulary``.
+        This is the case if this rule or a referenced rule uses ``Dictation``
+        or ``WordList`` expansions, or if a referenced rule cannot be found.
+
+        :returns: bool
+        """
+        return self._get_vocabulary()[1]
+
+    def _vocabulary_entries(self):
+        """
+        Internal method to get the vocabularies of this rule's expansion tree and
+        the trees of referenced rules.
+
+        Each entry is a (rule, expansion, vocabulary, grammar, grammar version)
+        tuple, which is used to check whether the rule or the way its references
+        are looked up have changed. References without a rule are represented
+        by open vocabulary entries with None for each other value.
+
+        :returns: list
+        """
+        entries, rules, seen = [], [self], set()
+        while rules:
+            rule = rules.pop()
+            if id(rule) in seen:
+                continue
+            seen.add(id(rule))
+            expansion = rule.expansion
+            vocabulary = expansion._get_vocabulary()
+            grammar = rule.grammar
+            entries.append((rule, expansion, vocabulary, grammar,
+                            grammar._rules_version if grammar else None))
+            for ref in vocabulary.references:
+                if isinstance(ref, RuleRef):
+                    rules.append(ref.referenced_rule)
+                    continue
+
+                # Look the rule up using the referencing rule's grammar in case
+                # the reference was added after the rule was created.
+                try:
+                    if not grammar:
+                        raise GrammarError("rule '%s' is not in a grammar"
+                                           % rule.name)
+                    rules.append(grammar.get_rule_from_name(ref.name))
+                except GrammarError:
+                    entries.append((None, None, _OPEN_VOCABULARY, None, None))
+        return entries
+
+    def _get_vocabulary(self):
+        """
+        Internal method to get this rule's vocabulary, whether it is open and the
+        length of its longest word.
+
+        :returns: tuple
+        """
+        # Expansion trees cache their vocabularies until they change and grammars
+        # count changes to their rules, so the cached result is valid if every
+        # entry is unchanged. This avoids looking up referenced rules again.
+        cache = self._vocabulary_cache
+        if cache is not None and _entries_unchanged(cache[0]):
+            return cache[1]
+
+        entries = self._vocabulary_entries()
+        words = frozenset().union(*[e[2].words for e in entries])
+        is_open = any(e[2].is_open for e in entries)
+        longest = max([len(word) for word in words] or [0])
+        result = (words, is_open, longest)
+        self._vocabulary_cache = (entries, result)
+        return result
+
+    def _covers_words(self, words):
+        """
+        Internal method to check whether this rule's vocabulary covers a set of
+        words. Rules with open vocabularies cover any words.
+
+        Literals don't need whitespace between them to match, so words made by
+        joining vocabulary words together, e.g. "helloworld", are also covered.
+
+        :param words: set
+        :returns: bool
+        """
+        vocabulary, is_open, longest = self._get_vocabulary()
+        if is_open:
+            return True
+
+        # The pyparsing backend matches any speech if the rule's expansion has a
+        # match value when it doesn't match, e.g. if it is optional.
+        if self.expansion._current_match_value(None) is not None:
+            return True
+
+        for word in words:
+            if word not in vocabulary and \
+                    not _is_joined_word(word, vocabulary, longest):
+                return False
+        return True
 
     def find_matching_part(self, speech):
         """
@@ -175,15 +400,14 @@ class Rule(BaseRef):
 
         If no part matches or the rule is disabled, return None.
 
-        :param speech: str
+        :param speech: str | list | Utterance
         :returns: str | None
         """
         if not self._active:
             return None
 
-        # Strip whitespace at the start of 'speech' and lower it to match regex
-        # properly.
-        speech = speech.lstrip().lower()
+        # Use the normalised speech.
+        speech = make_utterance(speech).text
 
         # Use the first match (if any) and break. The loop is required because
         # scanString returns a generator.
@@ -195,6 +419,72 @@ class Rule(BaseRef):
 
         return result
 
+    def match_lattice(self, lattice, max_paths=10):
+        """
+        Find the best scoring path through a word lattice that matches this rule.
+
+        Match data is set for the best path, as if it was matched using
+        ``matches``. See ``WordAutomaton.match_lattice`` for details.
+
+        If no path matches or the rule is disabled, return None.
+
+        :param lattice: Lattice
+        :param max_paths: int
+        :returns: (hypothesis, score) tuple | None
+        :raises: GrammarError, ValueError
+        """
+        result = self._get_automaton().match_lattice(lattice, max_paths)
+        if not result:
+            return None
+        hypothesis, score, _ = result[0]
+        return hypothesis, score
+
+    def _get_automaton(self):
+        """
+        Internal method to get a ``WordAutomaton`` for this rule. The automaton
+        is built again after this rule or a referenced rule changes.
+
+        :returns: WordAutomaton
+        :raises: GrammarError
+        """
+        cache = self._automaton_cache
+        if cache is not None and _entries_unchanged(cache[0]):
+            return cache[1]
+
+        # Import WordAutomaton here to avoid a circular import.
+        from .automaton import WordAutomaton
+        automaton = WordAutomaton([self])
+        self._automaton_cache = (self._vocabulary_entries(), automaton)
+        return automaton
+
+    def _get_tree_expansions(self):
+        """
+        Internal method to get the expansions in this rule's tree and the trees of
+        rules it references. The list is found again after this rule or a
+        referenced rule changes.
+
+        :returns: list
+        :raises: GrammarError
+        """
+        cache = self._tree_expansions_cache
+        if cache is not None and _entries_unchanged(cache[0]):
+            return cache[1]
+
+        result, seen = [], set()
+        stack = [self.expansion]
+        while stack:
+            x = stack.pop()
+            if id(x) in seen:
+                continue
+            seen.add(id(x))
+            result.append(x)
+            if isinstance(x, NamedRuleRef):
+                stack.append(x.referenced_rule.expansion)
+            else:
+                stack.extend(x.children)
+        self._tree_expansions_cache = (self._vocabulary_entries(), result)
+        return result
+
     @property
     def tags(self):
         """
@@ -335,3 +625,46 @@ class HiddenRule(Rule):
     def __str__(self):
         return "%s(name='%s', expansion=%s)" %\
                (self.__class__.__name__, self.name, self.expansion)
+
+
+def _entries_unchanged(entries):
+    """
+    Internal function to check whether the rules and expansions of entries
+    returned by ``Rule._vocabulary_entries`` are unchanged.
+
+    Expansion trees reset their vocabularies when they change and grammars
+    count changes to their rules, so comparing them is enough.
+
+    :param entries: list
+    :returns: bool
+    """
+    for rule, expansion, vocabulary, grammar, version in entries:
+        if rule is None:
+            continue
+        if rule._expansion is not expansion or \
+                expansion._vocabulary is not vocabulary or \
+                rule.grammar is not grammar or \
+                grammar and grammar._rules_version != version:
+            return False
+    return True
+
+
+def _is_joined_word(word, vocabulary, longest):
+    """
+    Internal function to check whether a word can be made by joining words in a
+    vocabulary together.
+
+    :param word: str
+    :param vocabulary: frozenset
+    :param longest: length of the longest word in the vocabulary
+    :returns: bool
+    """
+    # Find each position in the word that joined vocabulary words can reach.
+    reachable = [True] + [False] * len(word)
+    for start in range(len(word)):
+        if not reachable[start]:
+            continue
+        for end in range(start + 1, min(len(word), start + longest) + 1):
+            if not reachable[end] and word[start:end] in vocabulary:
+                reachable[end] = True
+    return reachable[-1]
@@ -0,0 +1,129 @@
+"""
+This module contains the ``Utterance`` class for speech that is normalised and
+split into words once and then matched against many rules.
+
+Speech is normalised for matching by lowering it and removing whitespace at the
+start and end. ``Grammar.find_matching_rules`` creates one ``Utterance`` for the
+speech and passes it to each rule, instead of each rule normalising the speech
+again. Utterances can also be created and passed to rules directly::
+
+    utterance = Utterance(" Hello  World")
+    utterance.text   # "hello  world"
+    utterance.words  # ("hello", "world")
+    utterance.spans  # ((0, 5), (7, 12))
+    rule.matches(utterance)
+"""
+
+import re
+from bisect import bisect_right
+
+from six import string_types
+
+# Regular expression used to split speech into words.
+_word_regex = re.compile(r"\S+", re.UNICODE)
+
+
+class Utterance(object):
+    """
+    Speech normalised and split into words for matching.
+
+    Utterances are immutable and can be matched against any number of rules.
+    """
+    __slots__ = ("_text", "_words", "_spans", "_starts")
+
+    def __init__(self, speech):
+        """
+        :param speech: str or list of words
+        :raises: TypeError
+        """
+        if isinstance(speech, string_types):
+            text = speech.strip().lower()
+        elif isinstance(speech, (list, tuple)):
+            for word in speech:
+                if not isinstance(word, string_types):
+                    raise TypeError("word '%s' is not a string" % word)
+            text = " ".join(speech).strip().lower()
+        else:
+            raise TypeError("speech must be a string or a list of words, not "
+                            "'%s'" % speech)
+
+        # Split the text into words and keep the character offsets of each one.
+        spans = tuple(m.span() for m in _word_regex.finditer(text))
+        self._text = text
+        self._words = tuple(text[start:end] for start, end in spans)
+        self._spans = spans
+        self._starts = [start for start, _ in spans]
+
+    @property
+    def text(self):
+        """
+        The normalised speech string: lowercase without whitespace at the start
+        or end. Matching slices of expansions are relative to this string.
+
+        :returns: str
+        """
+        return self._text
+
+    @property
+    def words(self):
+        """
+        The words in the normalised speech.
+
+        :returns: tuple
+        """
+        return self._words
+
+    @property
+    def spans(self):
+        """
+        The (start, end) character offsets of each word in ``text``.
+
+        :returns: tuple
+        """
+        return self._spans
+
+    def word_index(self, offset):
+        """
+        Get the index of the word containing or following the whitespace at a
+        character offset in ``text``.
+
+        :param offset: int
+        :returns: int
+        """
+        index = bisect_right(self._starts, offset) - 1
+        if index < 0:
+            return 0
+        if offset >= self._spans[index][1]:
+            index += 1
+        return index
+
+    def __str__(self):
+        return self._text
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._text)
+
+    def __len__(self):
+        return len(self._words)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self._text == other.text
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._text)
+
+
+def make_utterance(speech):
+    """
+    Get an ``Utterance`` for speech, returning it unchanged if it is one already.
+
+    :param speech: str, list of words or Utterance
+    :returns: Utterance
+    :raises: TypeError
+    """
+    if isinstance(speech, Utterance):
+        return speech
+    return Utterance(speech)
@@ -0,0 +1,500 @@
+"""
+This module contains the ``WordList`` expansion class for matching phrases from
+large word lists, and the lexicon classes used to store them.
+
+Word lists are stored in lexicons instead of as ``Literal`` expansions in an
+alternative set. A ``MemoryLexicon`` keeps phrases in a set. A ``MappedLexicon``
+reads phrases from a sorted lexicon file using a memory map, so large word lists
+don't need to be loaded into memory. Lexicon files can be written using
+``write_lexicon``::
+
+    write_lexicon(names, "names.txt")
+    rule = PublicRule("call", Sequence("call", WordList("names.txt", "name")))
+
+Word lists compile to references to rules generated when grammars are compiled::
+
+    public <call> = call <name>;
+    <name> = (alice|bob|...);
+
+``DynamicSlot`` expansions are word lists with phrases that can be updated while
+a grammar is in use without invalidating any matcher elements::
+
+    slot = DynamicSlot("window", ["firefox", "terminal"])
+    rule = PublicRule("focus", Sequence("focus", slot))
+    slot.set_phrases(["firefox", "editor"])
+"""
+
+import io
+import mmap
+import os
+import re
+
+import pyparsing
+from six import string_types
+
+from .errors import GrammarError
+from .expansions import Expansion, _ExpansionSummary, map_expansion
+from .references import base_name_regex, reserved_names_regex
+
+# Regular expression used to split speech into words.
+_word_regex = re.compile(r"\S+", re.UNICODE)
+
+# Number of phrases compiled into each string yielded by compile_word_list_rules.
+_PHRASES_PER_CHUNK = 1000
+
+
+def normalize_phrase(phrase):
+    """
+    Normalise a phrase the way speech is normalised for matching: lowercase with
+    one space between words.
+
+    :param phrase: str
+    :returns: str
+    """
+    return " ".join(phrase.lower().split())
+
+
+def write_lexicon(phrases, path):
+    """
+    Write phrases to a lexicon file that can be used with ``MappedLexicon``.
+
+    Phrases are normalised, duplicates are removed and the phrases are sorted and
+    written as UTF-8 lines.
+
+    :param phrases: iterable of str
+    :param path: str
+    """
+    lines = set()
+    for phrase in phrases:
+        phrase = normalize_phrase(phrase)
+        if phrase:
+            lines.add(phrase.encode("utf-8"))
+
+    with io.open(path, "wb") as f:
+        for line in sorted(lines):
+            f.write(line + b"\n")
+
+
+class MemoryLexicon(object):
+    """
+    Lexicon storing normalised phrases in memory using a set.
+
+    Phrases can be added and removed after the lexicon is created.
+    """
+    def __init__(self, phrases=None):
+        """
+        :param phrases: iterable of str (default None)
+        """
+        self._phrases = set()
+
+        # Number of phrases with each word count, for calculating 'max_words'.
+        self._word_counts = {}
+        self.max_words = 0
+        self.update(phrases or [])
+
+    def add(self, phrase):
+        """
+        Add a phrase to the lexicon.
+
+        :param phrase: str
+        """
+        phrase = normalize_phrase(phrase)
+        if not phrase or phrase in self._phrases:
+            return
+
+        self._phrases.add(phrase)
+        words = phrase.count(" ") + 1
+        self._word_counts[words] = self._word_counts.get(words, 0) + 1
+        self.max_words = max(self.max_words, words)
+
+    def discard(self, phrase):
+        """
+        Remove a phrase from the lexicon if it is present.
+
+        :param phrase: str
+        """
+        phrase = normalize_phrase(phrase)
+        if phrase not in self._phrases:
+            return
+
+        self._phrases.remove(phrase)
+        words = phrase.count(" ") + 1
+        self._word_counts[words] -= 1
+        if not self._word_counts[words]:
+            del self._word_counts[words]
+            if words == self.max_words:
+                self.max_words = max(self._word_counts) if self._word_counts else 0
+
+    def update(self, phrases):
+        """
+        Add phrases to the lexicon.
+
+        :param phrases: iterable of str
+        """
+        for phrase in phrases:
+            self.add(phrase)
+
+    def clear(self):
+        """
+        Remove all phrases from the lexicon.
+        """
+        self._phrases.clear()
+        self._word_counts.clear()
+        self.max_words = 0
+
+    def __contains__(self, phrase):
+        return phrase in self._phrases
+
+    def __iter__(self):
+        # Iterate in sorted order so that compiled word lists are the same each
+        # time.
+        return iter(sorted(self._phrases))
+
+    def __len__(self):
+        return len(self._phrases)
+
+
+class MappedLexicon(object):
+    """
+    Lexicon reading phrases from a memory-mapped lexicon file.
+
+    Lexicon files have one normalised phrase per line, encoded as UTF-8 and
+    sorted without duplicates. Phrases are found using binary search, so only
+    the parts of the file that are read are loaded into memory.
+    """
+    def __init__(self, path):
+        """
+        :param path: str
+        :raises: ValueError
+        """
+        self.path = path
+        self._file = io.open(path, "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            # Empty files cannot be mapped.
+            self._map = b""
+
+        # Check that the lines are sorted and count them and their words.
+        self._length = 0
+        self.max_words = 0
+        previous = None
+        for line in self._lines():
+            if previous is not None and line <= previous:
+                self.close()
+                raise ValueError("lexicon file '%s' is not sorted or has "
+                                 "duplicate lines at line %d"
+                                 % (path, self._length + 1))
+            previous = line
+            self._length += 1
+            self.max_words = max(self.max_words, line.count(b" ") + 1)
+
+    def _lines(self):
+        """
+        Internal method to iterate through the lines of the file as bytes.
+
+        :returns: generator
+        """
+        data, start, size = self._map, 0, len(self._map)
+        while start < size:
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = size
+            yield data[start:end]
+            start = end + 1
+
+    def __contains__(self, phrase):
+        key = phrase.encode("utf-8")
+        data = self._map
+
+        # Search between line starts. The line containing 'middle' starts at or
+        # after 'low' and before 'high'.
+        low, high = 0, len(data)
+        while low < high:
+            middle = (low + high) // 2
+            start = data.rfind(b"\n", 0, middle) + 1
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            line = data[start:end]
+            if line == key:
+                return True
+            elif line < key:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+    def __iter__(self):
+        for line in self._lines():
+            yield line.decode("utf-8")
+
+    def __len__(self):
+        return self._length
+
+    def close(self):
+        """
+        Close the lexicon file. The lexicon cannot be used afterwards.
+        """
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class _WordListElement(pyparsing.Token):
+    """
+    Internal parser element matching the longest phrase in a lexicon.
+    """
+    def __init__(self, lexicon, name):
+        super(_WordListElement, self).__init__()
+        self._lexicon = lexicon
+        self.name = "<%s>" % name
+        self.mayReturnEmpty = False
+        self.mayIndexError = False
+        self.errmsg = "Expected " + self.name
+
+    def parseImpl(self, instring, loc, doActions=True):
+        # Find the ends of the next words, up to the number of words in the
+        # longest phrase.
+        words, ends = [], []
+        pos = loc
+        while len(words) < self._lexicon.max_words:
+            match = _word_regex.match(instring, pos)
+            if not match:
+                break
+            words.append(match.group())
+            ends.append(match.end())
+            pos = match.end()
+            while pos < len(instring) and instring[pos].isspace():
+                pos += 1
+
+        # Use the longest phrase in the lexicon.
+        for i in range(len(words), 0, -1):
+            if " ".join(words[:i]) in self._lexicon:
+                return ends[i - 1], instring[loc:ends[i - 1]]
+
+        raise pyparsing.ParseException(instring, loc, self.errmsg, self)
+
+
+class WordList(Expansion):
+    """
+    Expansion class for matching any phrase from a large word list.
+
+    Phrases are stored in a lexicon instead of as ``Literal`` expansions. Matching
+    uses whole words and the longest matching phrase. Word lists compile to rule
+    references and ``Grammar.compile`` and ``Grammar.compile_iter`` generate the
+    referenced rules, so word list names must not be used by other rules.
+
+    Word lists are not supported by ``ChartParser``. ``WordAutomaton`` matches
+    rules using them with ``Rule.matches``.
+    """
+    def __init__(self, words, name="words"):
+        """
+        :param words: lexicon file path, MemoryLexicon, MappedLexicon or iterable
+            of phrases
+        :param name: name of the rule generated when compiling
+        :raises: GrammarError, ValueError
+        """
+        super(WordList, self).__init__([])
+        self.lexicon = words
+        self.name = name
+
+    @property
+    def lexicon(self):
+        """
+        The lexicon of phrases this word list matches.
+
+        :returns: MemoryLexicon | MappedLexicon
+        """
+        return self._lexicon
+
+    @lexicon.setter
+    def lexicon(self, value):
+        if isinstance(value, string_types):
+            value = MappedLexicon(value)
+        elif not isinstance(value, (MemoryLexicon, MappedLexicon)):
+            value = MemoryLexicon(value)
+
+        # Finish any lazy copies first so that they keep the current lexicon.
+        if self._parent:
+            self._detach_lazy_copies()
+        self._lexicon = value
+        self.invalidate_matcher()
+
+    @property
+    def name(self):
+        """
+        The name of the rule generated for this word list when compiling.
+
+        :returns: str
+        """
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        if (not base_name_regex.match(value) or
+                reserved_names_regex.match(value)):
+            raise GrammarError("'%s' is not a valid rule name" % value)
+        if self._parent:
+            self._detach_lazy_copies()
+        self._name = value
+        self.invalidate_matcher()
+
+    def __str__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.name)
+
+    def __hash__(self):
+        return hash("%s" % self)
+
+    def __eq__(self, other):
+        return (super(WordList, self).__eq__(other) and
+                self.name == other.name and self.lexicon is other.lexicon)
+
+    def __copy__(self):
+        e = type(self)(self.lexicon, self.name)
+        e.tag = self.tag
+        return e
+
+    def compile(self, ignore_tags=False):
+        super(WordList, self).compile()
+        if self.tag and not ignore_tags:
+            return "<%s>%s" % (self.name, self.compiled_tag)
+        else:
+            return "<%s>" % self.name
+
+    def compile_rule_iter(self):
+        """
+        Compile the rule referenced by this word list, yielding the result in
+        parts so that it doesn't need to be compiled into one string.
+
+        :returns: generator
+        """
+        if not len(self.lexicon):
+            yield "<%s> = <VOID>;\n" % self.name
+            return
+
+        yield "<%s> = (" % self.name
+        chunk = []
+        first = True
+        for phrase in self.lexicon:
+            chunk.append(phrase)
+            if len(chunk) == _PHRASES_PER_CHUNK:
+                yield ("" if first else "|") + "|".join(chunk)
+                chunk, first = [], False
+        if chunk:
+            yield ("" if first else "|") + "|".join(chunk)
+        yield ");\n"
+
+    def _make_matcher_element(self):
+        return self._set_matcher_element_attributes(
+            _WordListElement(self.lexicon, self.name)
+        )
+
+    def _leaf_summary(self):
+        # Word lists are counted as literals.
+        return _ExpansionSummary(1, 1, 0, False)
+
+    def _can_match_empty(self, child_values):
+        return False
+
+
+class DynamicSlot(WordList):
+    """
+    Word list expansion for phrases that change while a grammar is in use, such as
+    window titles or contact names.
+
+    Phrases are stored in a ``MemoryLexicon`` that is searched each time the slot
+    is matched, so adding, removing or replacing phrases does not invalidate the
+    matcher elements of this expansion, its ancestors or referencing rules.
+    Compiled grammars include the phrases in the slot at the time of compilation.
+
+    Copies of a slot share its lexicon, so updating one updates all of them.
+    """
+    def __init__(self, name, phrases=None):
+        """
+        :param name: name of the rule generated when compiling
+        :param phrases: iterable of str (default None)
+        :raises: GrammarError
+        """
+        if not isinstance(phrases, MemoryLexicon):
+            phrases = MemoryLexicon(phrases)
+        super(DynamicSlot, self).__init__(phrases, name)
+
+    def __copy__(self):
+        e = type(self)(self.name, self.lexicon)
+        e.tag = self.tag
+        return e
+
+    def add(self, *phrases):
+        """
+        Add phrases to this slot.
+
+        :param phrases: str
+        """
+        self.lexicon.update(phrases)
+
+    def remove(self, *phrases):
+        """
+        Remove phrases from this slot. Phrases not in the slot are ignored.
+
+        :param phrases: str
+        """
+        for phrase in phrases:
+            self.lexicon.discard(phrase)
+
+    def set_phrases(self, phrases):
+        """
+        Replace the phrases in this slot.
+
+        Only phrases that are not already in the slot are added and only phrases
+        that are no longer in the slot are removed.
+
+        :param phrases: iterable of str
+        """
+        lexicon = self.lexicon
+        new = set()
+        for phrase in phrases:
+            phrase = normalize_phrase(phrase)
+            if phrase:
+                new.add(phrase)
+        for phrase in lexicon._phrases - new:
+            lexicon.discard(phrase)
+        lexicon.update(new)
+
+    @property
+    def phrases(self):
+        """
+        The phrases in this slot, sorted.
+
+        :returns: list
+        """
+        return list(self.lexicon)
+
+
+def compile_word_list_rules(rules):
+    """
+    Compile the rules referenced by word lists in rule expansions, yielding the
+    result in parts.
+
+    :param rules: list of Rule
+    :returns: generator
+    :raises: GrammarError
+    """
+    word_lists = {}
+    rule_names = set([r.name for r in rules])
+
+    def collect(e):
+        if not isinstance(e, WordList):
+            return
+        other = word_lists.setdefault(e.name, e)
+        if other.lexicon is not e.lexicon or e.name in rule_names:
+            raise GrammarError("word list name '%s' is used by another word list "
+                               "or rule" % e.name)
+
+    for rule in rules:
+        map_expansion(rule.expansion, collect, shallow=True)
+
+    for name in sorted(word_lists):
+        for part in word_lists[name].compile_rule_iter():
+            yield part
@@ -28,5 +28,6 @@ setup(
     author_email='Danesprite@gmail.com',
     version='1.6.0',
     packages=['jsgf', 'jsgf.ext'],
-    install_requires=['pyparsing', 'six']
+    install_requires=['pyparsing', 'six'],
+    extras_require={'batch': ['numpy']}
 )
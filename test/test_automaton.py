@@ -0,0 +1,459 @@
+import unittest
+
+from jsgf import *
+from jsgf.ext import Dictation
+
+
+class IncrementalMatcherCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0 UTF-8 en;
+            grammar test;
+            public <greet> = (/1/ hello | /2/ hi | /0/ hey) [there] <name>+;
+            <name> = alice | bob;
+            public <count> = (one | two)* done;
+            public <void> = hello <VOID>;
+            public <null> = <NULL> hello there alice;
+        """)
+        self.matcher = self.grammar.incremental()
+
+    def assert_rule_names(self, rules, names):
+        self.assertEqual([r.name for r in rules], names)
+
+    def test_feed(self):
+        m = self.matcher
+        self.assert_rule_names(m.viable_rules, ["greet", "count", "null"])
+        self.assertTrue(m.feed("Hello"))
+        self.assert_rule_names(m.viable_rules, ["greet", "null"])
+        self.assert_rule_names(m.completed_rules, [])
+        self.assertTrue(m.feed("there"))
+        self.assertTrue(m.feed("alice"))
+        self.assert_rule_names(m.completed_rules, ["greet", "null"])
+        self.assertTrue(m.feed("bob"))
+        self.assert_rule_names(m.completed_rules, ["greet"])
+        self.assertEqual(m.words, ["hello", "there", "alice", "bob"])
+        self.assertEqual(m.current_match, "hello there alice bob")
+
+        # Rules can't match after this.
+        self.assertFalse(m.feed("there"))
+        self.assert_rule_names(m.viable_rules, [])
+        self.assertFalse(m.feed("alice"))
+        self.assert_rule_names(m.completed_rules, [])
+
+    def test_feed_multiple_words(self):
+        m = self.matcher
+        self.assertTrue(m.feed("one two one"))
+        self.assert_rule_names(m.viable_rules, ["count"])
+        self.assertTrue(m.feed("done"))
+        self.assert_rule_names(m.completed_rules, ["count"])
+
+    def test_zero_weight(self):
+        self.assertFalse(self.matcher.feed("hey"))
+
+    def test_reset(self):
+        m = self.matcher
+        self.assertFalse(m.feed("alice"))
+        m.reset()
+        self.assertEqual(m.words, [])
+        self.assertTrue(m.feed("done"))
+        self.assert_rule_names(m.completed_rules, ["count"])
+
+    def test_find_matching_rules(self):
+        m = self.matcher
+        m.feed("hi bob alice")
+        rules = m.find_matching_rules()
+        self.assert_rule_names(rules, ["greet"])
+        self.assertEqual(rules, self.grammar.find_matching_rules("hi bob alice"))
+        self.assertEqual(rules[0].expansion.current_match, "hi bob alice")
+
+    def test_ambiguous_rule(self):
+        grammar = Grammar()
+        grammar.add_rule(PublicRule("test", Sequence(
+            OptionalGrouping("a"), "a", "b"
+        )))
+        m = grammar.incremental()
+        m.feed("a b")
+
+        # The automaton accepts the words, but Rule.matches doesn't.
+        self.assert_rule_names(m.completed_rules, ["test"])
+        self.assertEqual(m.find_matching_rules(), [])
+        self.assertFalse(grammar.get_rule_from_name("test").matches("a b"))
+
+    def test_partial_matches(self):
+        m = self.matcher
+        greet = self.grammar.get_rule_from_name("greet")
+        null = self.grammar.get_rule_from_name("null")
+        count = self.grammar.get_rule_from_name("count")
+        self.assertEqual(m.partial_matches,
+                         [(greet, []), (count, []), (null, [])])
+
+        # Positions are where the last word was matched in each viable rule.
+        m.feed("hello")
+        (r1, p1), (r2, p2) = m.partial_matches
+        self.assertEqual((r1, r2), (greet, null))
+        self.assertEqual(p1, [(greet.expansion.children[0].children[0], 0)])
+        self.assertEqual(p2, [(null.expansion.children[1], 0)])
+
+        # Positions in referenced rules and multiple-word literals.
+        m.feed("there alice")
+        name = self.grammar.get_rule_from_name("name")
+        (r1, p1), (r2, p2) = m.partial_matches
+        self.assertEqual(p1, [(name.expansion.children[0], 0)])
+        self.assertEqual(p2, [(null.expansion.children[1], 2)])
+        self.assertIs(p1[0][0], name.expansion.children[0])
+
+        m.feed("nope")
+        self.assertEqual(m.partial_matches, [])
+
+    def test_partial_matches_ambiguous(self):
+        grammar = Grammar()
+        rule = PublicRule("test", Sequence(
+            OptionalGrouping("a"), "a b", Dictation()
+        ))
+        grammar.add_rule(rule)
+        m = grammar.incremental()
+        opt, literal, dictation = rule.expansion.children
+        m.feed("a")
+        self.assertEqual(m.partial_matches,
+                         [(rule, [(opt.child, 0), (literal, 0)])])
+        m.feed("a")
+        self.assertEqual(m.partial_matches, [(rule, [(literal, 0)])])
+        m.feed("b")
+        self.assertEqual(m.partial_matches, [(rule, [(literal, 1)])])
+        m.feed("c d")
+        self.assertEqual(m.partial_matches, [(rule, [(dictation, None)])])
+
+    def test_completed_rules_bound(self):
+        # Each rule that Rule.matches accepts is completed, unless its expansion
+        # can match empty speech. find_matching_rules gives exactly the rules
+        # that Rule.matches accepts.
+        grammar = Grammar()
+        grammar.add_rules(
+            PublicRule("r0", Sequence(OptionalGrouping("a"), "a", "b")),
+            PublicRule("r1", Sequence(KleeneStar("a"), Repeat("b"))),
+            PublicRule("r2", AlternativeSet("a", Sequence("a", Dictation()))),
+            PublicRule("r3", KleeneStar(Sequence("c", "d"))),
+            PublicRule("r4", Sequence(OptionalGrouping("a"),
+                                      OptionalGrouping("b"))),
+            PublicRule("r5", OptionalGrouping("c")),
+        )
+        words = ["a", "b", "c", "d"]
+        utterances = [[w] for w in words]
+        utterances.extend([[w1, w2] for w1 in words for w2 in words])
+        utterances.extend([["a", "a", "b"], ["c", "d", "c", "d"]])
+        for utterance in utterances:
+            speech = " ".join(utterance)
+            m = grammar.incremental()
+            m.feed(speech)
+            completed = m.completed_rules
+            matching = [r for r in grammar.rules if r.matches(speech)]
+            for rule in matching:
+                if not rule.expansion.can_match_empty:
+                    self.assertIn(rule, completed)
+            self.assertEqual(m.find_matching_rules(), matching)
+
+    def test_disabled_rule(self):
+        self.grammar.disable_rule("count")
+        self.assert_rule_names(self.matcher.viable_rules, ["greet", "null"])
+        self.assertFalse(self.matcher.feed("done"))
+
+    def test_multiple_word_literals(self):
+        grammar = Grammar()
+        grammar.add_rule(PublicRule("test", Sequence("hello  world", "again")))
+        m = grammar.incremental()
+        m.feed("hello")
+        self.assert_rule_names(m.viable_rules, ["test"])
+        m.feed("world again")
+        self.assert_rule_names(m.completed_rules, ["test"])
+
+    def test_dictation(self):
+        grammar = Grammar()
+        grammar.add_rule(PublicRule("note", Sequence(
+            "note", Dictation(), OptionalGrouping("end")
+        )))
+        m = grammar.incremental()
+        m.feed("note")
+        self.assert_rule_names(m.completed_rules, [])
+        m.feed("buy some milk")
+        self.assert_rule_names(m.completed_rules, ["note"])
+
+        # Dictation can also match the next literal.
+        m.feed("end")
+        self.assert_rule_names(m.completed_rules, ["note"])
+        m.feed("end")
+        self.assert_rule_names(m.completed_rules, ["note"])
+
+        # Words Dictation doesn't match.
+        m.feed("@")
+        self.assert_rule_names(m.viable_rules, [])
+
+    def test_recursive_rule(self):
+        grammar = Grammar()
+        grammar.add_rule(PublicRule("test", Sequence(
+            "a", OptionalGrouping(NamedRuleRef("test"))
+        )))
+        self.assertRaises(GrammarError, grammar.incremental)
+
+    def test_fallback_rules(self):
+        # Rules with word lists are matched using Rule.matches.
+        slot = DynamicSlot("contact", ["carol"])
+        self.grammar.add_rules(
+            PublicRule("call", Sequence("call", WordList(["alice", "dave"]))),
+            PublicRule("text", Sequence("text", slot))
+        )
+        m = self.grammar.incremental()
+        self.assert_rule_names(m.automaton.fallback_rules, ["call", "text"])
+        m.feed("hello alice")
+        self.assert_rule_names(m.viable_rules, ["greet", "call", "text"])
+        self.assertEqual(m.partial_matches[1:],
+                         [(self.grammar.get_rule_from_name("call"), []),
+                          (self.grammar.get_rule_from_name("text"), [])])
+        self.assert_rule_names(m.completed_rules, ["greet"])
+        self.assert_rule_names(m.find_matching_rules(), ["greet"])
+
+        m.reset()
+        m.feed("text dave")
+        self.assert_rule_names(m.find_matching_rules(), [])
+        slot.set_phrases(["dave"])
+        self.assert_rule_names(m.find_matching_rules(), ["text"])
+
+
+class MatchNBestCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0 UTF-8 en;
+            grammar test;
+            public <greet> = (hello | hi) <name>;
+            <name> = alice | bob;
+            public <open> = open <app>;
+            <app> = firefox | files;
+        """)
+        self.hypotheses = ["hello a list", "hello alice", "open files",
+                           "hi bob", "open firefox"]
+
+    def test_ranks(self):
+        result = self.grammar.match_nbest(self.hypotheses)
+        self.assertEqual([(h, r.name) for h, r in result], [
+            ("hello alice", "greet"), ("open files", "open")
+        ])
+
+        # Match data should be set for the best hypotheses.
+        self.assertEqual(result[1][1].expansion.current_match, "open files")
+
+    def test_scores(self):
+        result = self.grammar.match_nbest(self.hypotheses, [5, 1, 2, 3, 4])
+        self.assertEqual([(h, r.name) for h, r in result], [
+            ("open firefox", "open"), ("hi bob", "greet")
+        ])
+
+    def test_same_as_find_matching_rules(self):
+        for hypothesis in self.hypotheses:
+            result = self.grammar.match_nbest([hypothesis])
+            self.assertEqual([r for _, r in result],
+                             self.grammar.find_matching_rules(hypothesis))
+
+    def test_fallback_rules(self):
+        self.grammar.add_rule(PublicRule("call", Sequence(
+            "call", WordList(["alice", "bob"])
+        )))
+        result = self.grammar.match_nbest(["call carol", "hi bob", "call bob",
+                                           "call alice"])
+        self.assertEqual([(h, r.name) for h, r in result], [
+            ("hi bob", "greet"), ("call bob", "call")
+        ])
+        self.assertEqual(result[1][1].expansion.current_match, "call bob")
+
+    def test_no_matches(self):
+        self.assertEqual(self.grammar.match_nbest([]), [])
+        self.assertEqual(self.grammar.match_nbest(["open", "hi"]), [])
+
+    def test_invalid_scores(self):
+        self.assertRaises(ValueError, self.grammar.match_nbest,
+                          self.hypotheses, [1, 2])
+
+    def test_automaton_cache(self):
+        g = self.grammar
+        automaton = g._get_automaton()
+        g.match_nbest(self.hypotheses)
+        self.assertIs(g._get_automaton(), automaton)
+        self.assertIs(g.incremental().automaton, automaton)
+
+        def assert_rebuilt(hypothesis, names):
+            result = g.match_nbest([hypothesis])
+            self.assertEqual([r.name for _, r in result], names)
+            self.assertIsNot(g._get_automaton(), automaton)
+            return g._get_automaton()
+
+        # The automaton is built again after rules are added, removed or
+        # changed, including referenced rules.
+        g.add_rule(PublicRule("stop", "stop"))
+        automaton = assert_rebuilt("stop", ["stop"])
+        g.get_rule_from_name("app").expansion.children.append("mail")
+        automaton = assert_rebuilt("open mail", ["open"])
+        g.get_rule_from_name("name").expansion.children[0].text = "carol"
+        automaton = assert_rebuilt("hi carol", ["greet"])
+        g.get_rule_from_name("greet").expansion.children[0].weights = {
+            "hello": 1, "hi": 0
+        }
+        automaton = assert_rebuilt("hi carol", [])
+        g.get_rule_from_name("open").expansion = "open everything"
+        automaton = assert_rebuilt("open everything", ["open"])
+        g.remove_rule("stop")
+        automaton = assert_rebuilt("stop", [])
+        g.get_rule_from_name("open").visible = False
+        assert_rebuilt("open everything", [])
+
+    def test_ambiguous_rule(self):
+        grammar = Grammar()
+        rule = PublicRule("test", Sequence(OptionalGrouping("a"), "a", "b"))
+        grammar.add_rule(rule)
+
+        # "a b" is accepted by the automaton, but Rule.matches only matches
+        # "a a b".
+        result = grammar.match_nbest(["a b", "a a b"])
+        self.assertEqual(result, [("a a b", rule)])
+        self.assertEqual(rule.expansion.current_match, "a a b")
+
+
+class MatchLatticeCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0 UTF-8 en;
+            grammar test;
+            public <greet> = (hello | hi) [there] <name>;
+            <name> = alice | bob;
+            public <open> = open <app>;
+            <app> = firefox | files;
+        """)
+
+    def test_confusion_network(self):
+        lattice = Lattice.from_confusion_network([
+            [("hello", -0.5), ("open", -1.0)],
+            [("there", -0.1), ("", -0.5), ("files", -2.0)],
+            [("a list", -0.2), ("alice", -0.7), ("bob", -1.0)],
+        ])
+        result = self.grammar.match_lattice(lattice)
+        self.assertEqual([(h, r.name) for h, _, r in result], [
+            ("hello there alice", "greet"),
+        ])
+        self.assertAlmostEqual(result[0][1], -1.3)
+        self.assertEqual(result[0][2].expansion.current_match,
+                         "hello there alice")
+
+    def test_lattice(self):
+        lattice = Lattice([
+            ("a", "b", "open", 0), ("b", "c", "fire", -1),
+            ("c", "d", "fox", -1), ("b", "d", "firefox", -3),
+            ("b", "d", "files", -2.5), ("a", "d", "hi bob", -4),
+        ])
+        self.assertEqual((lattice.start, lattice.end), ("a", "d"))
+        result = self.grammar.match_lattice(lattice)
+        self.assertEqual([(h, s, r.name) for h, s, r in result], [
+            ("open files", -2.5, "open"), ("hi bob", -4, "greet"),
+        ])
+
+        rule = self.grammar.get_rule_from_name("greet")
+        self.assertEqual(rule.match_lattice(lattice), ("hi bob", -4))
+        self.assertEqual(rule.expansion.current_match, "hi bob")
+        rule.disable()
+        self.assertIsNone(rule.match_lattice(lattice))
+
+    def test_fallback_rules(self):
+        rule = PublicRule("call", Sequence("call", WordList(["alice", "bob"])))
+        self.grammar.add_rule(rule)
+        lattice = Lattice.from_confusion_network([
+            [("call", -0.1), ("hi", -1.0)],
+            [("carol", -0.1), ("bob", -0.5), ("alice", -1.0)],
+        ])
+        result = self.grammar.match_lattice(lattice)
+        self.assertEqual([(h, s, r.name) for h, s, r in result], [
+            ("call bob", -0.6, "call"), ("hi bob", -1.5, "greet")
+        ])
+        self.assertEqual(rule.expansion.current_match, "call bob")
+        self.assertEqual(rule.match_lattice(lattice), ("call bob", -0.6))
+
+        # Only the best paths through the lattice are matched.
+        self.assertEqual(rule.match_lattice(lattice, max_paths=1), None)
+
+    def test_automaton_cache(self):
+        lattice = Lattice.from_confusion_network([
+            [("hi", -0.5)], [("bob", -0.1), ("carol", -0.2)],
+        ])
+        rule = self.grammar.get_rule_from_name("greet")
+        self.assertEqual(rule.match_lattice(lattice), ("hi bob", -0.6))
+        automaton = rule._get_automaton()
+        self.assertEqual(rule.match_lattice(lattice), ("hi bob", -0.6))
+        self.assertIs(rule._get_automaton(), automaton)
+        automaton = self.grammar._get_automaton()
+        self.grammar.match_lattice(lattice)
+        self.assertIs(self.grammar._get_automaton(), automaton)
+
+        # Changes to referenced rules are used.
+        name = self.grammar.get_rule_from_name("name")
+        name.expansion.children[1].text = "carol"
+        self.assertEqual(rule.match_lattice(lattice), ("hi carol", -0.7))
+        self.assertEqual([h for h, _, _ in self.grammar.match_lattice(lattice)],
+                         ["hi carol"])
+
+    def test_ambiguous_rule(self):
+        grammar = Grammar()
+        rule = PublicRule("test", Sequence(OptionalGrouping("a"), "a", "b"))
+        grammar.add_rule(rule)
+        lattice = Lattice.from_confusion_network([
+            [("a", -0.1)], [("a", -1.0), ("", -0.5)], [("b", -0.1)],
+        ])
+
+        # The best path "a b" is accepted by the automaton, but Rule.matches
+        # only matches "a a b".
+        result = grammar.match_lattice(lattice)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], "a a b")
+        self.assertAlmostEqual(result[0][1], -1.2)
+        self.assertIs(result[0][2], rule)
+        self.assertEqual(rule.expansion.current_match, "a a b")
+
+        # Only the best path for each state is kept with max_paths=1.
+        self.assertEqual(grammar.match_lattice(lattice, 1), [])
+        self.assertRaises(ValueError, grammar.match_lattice, lattice, 0)
+
+    def test_invalid_lattices(self):
+        self.assertRaises(ValueError, Lattice, [(0, 1, "a", 0), (1, 0, "b", 0)])
+        self.assertRaises(ValueError, Lattice, [(0, 1, "a", 0), (2, 1, "b", 0)])
+        self.assertRaises(ValueError, Lattice, [(0, 1, "a", 0)], 0, 2)
+
+
+class WordAutomatonCase(unittest.TestCase):
+    def test_accepts(self):
+        rules = [
+            PublicRule("a", KleeneStar(AlternativeSet("x", Sequence("y", "z")))),
+            PublicRule("b", Repeat(OptionalGrouping("x"))),
+        ]
+        automaton = WordAutomaton(rules)
+        self.assertEqual(automaton.accepts([]), rules)
+        self.assertEqual(automaton.accepts(["X", "y", "z", "x"]), [rules[0]])
+        self.assertEqual(automaton.accepts(["x", "x"]), rules)
+        self.assertEqual(automaton.accepts(["y"]), [])
+        self.assertEqual(automaton.rules, rules)
+
+    def test_fallback_rules(self):
+        rules = [
+            PublicRule("a", Sequence("x", WordList(["y"]))),
+            PublicRule("b", Repeat("x")),
+        ]
+        automaton = WordAutomaton(rules)
+        self.assertEqual(automaton.fallback_rules, [rules[0]])
+        self.assertEqual(automaton.state_count,
+                         WordAutomaton([rules[1]]).state_count)
+        self.assertEqual(automaton.accepts(["x", "y"]), [])
+        self.assertEqual(automaton.accepts(["x"]), [rules[1]])
+        self.assertEqual(automaton.viable_rules(frozenset()), [rules[0]])
+
+    def test_step_cache(self):
+        automaton = WordAutomaton([PublicRule("a", Repeat("x"))])
+        states = automaton.step(automaton.start_states, "x")
+        self.assertIs(automaton.step(automaton.start_states, "x"), states)
+        self.assertEqual(automaton.step(states, "y"), frozenset())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+from jsgf import *
+from jsgf.batch import PADDING_ID, UNKNOWN_ID
+from jsgf.ext import Dictation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class BatchMatcherCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = Grammar()
+        self.greet = PublicRule("greet", Sequence(
+            AlternativeSet("hello", "hi"), OptionalGrouping("there")
+        ))
+        self.count = PublicRule("count", Sequence(
+            "count", Repeat(RuleRef(HiddenRule("number", AlternativeSet(
+                "one", "two", "three"))))
+        ))
+        self.ambiguous = PublicRule("ambiguous", Sequence(
+            KleeneStar("go"), OptionalGrouping("go"), "go"
+        ))
+        self.say = PublicRule("say", Sequence("say", Dictation()))
+        self.grammar.add_rules(self.greet, self.count, self.ambiguous, self.say)
+        self.matcher = self.grammar.batch_matcher()
+
+    def test_rules(self):
+        self.assertEqual(self.matcher.rules,
+                         [self.greet, self.count, self.ambiguous, self.say])
+        self.assertEqual(self.matcher.regular_rules,
+                         [self.greet, self.count, self.ambiguous])
+        self.assertEqual(self.matcher.fallback_rules, [self.say])
+
+    def test_encode(self):
+        word_ids = self.matcher.word_ids
+        self.assertEqual(sorted(word_ids.values()),
+                         list(range(2, len(word_ids) + 2)))
+        batch = self.matcher.encode(["Hello there", ["count"], ""], 3)
+        self.assertEqual(batch.shape, (3, 3))
+        self.assertEqual(batch.tolist(), [
+            [word_ids["hello"], word_ids["there"], PADDING_ID],
+            [word_ids["count"], PADDING_ID, PADDING_ID],
+            [PADDING_ID, PADDING_ID, PADDING_ID],
+        ])
+        self.assertEqual(self.matcher.encode(["hey"]).tolist(), [[UNKNOWN_ID]])
+        self.assertRaises(ValueError, self.matcher.encode, ["a b c d"], 3)
+
+    def test_match(self):
+        utterances = ["hello there", "count one two three", "go go go",
+                      "hello count", "count", "say anything at all"]
+        batch = self.matcher.encode(utterances)
+        rules, accepted = self.matcher.match(batch, utterances)
+        self.assertEqual(rules, [[self.greet], [self.count], [self.ambiguous],
+                                 [], [], [self.say]])
+        self.assertEqual(accepted.tolist(),
+                         [True, True, True, False, False, True])
+
+        # Fallback rules set match data for the last utterance.
+        self.assertEqual(self.say.expansion.children[1].current_match,
+                         "anything at all")
+
+    def test_accept_flags(self):
+        flags = self.matcher.accept_flags(self.matcher.encode(["hi"]), ["hi"])
+        self.assertEqual(flags.tolist(), [[True, False, False, False]])
+
+        # Utterances are only required if rules are not regular.
+        self.assertRaises(ValueError, self.matcher.accept_flags,
+                          self.matcher.encode(["hi"]))
+        self.assertRaises(ValueError, self.matcher.accept_flags,
+                          self.matcher.encode(["hi"]), ["hi", "hello"])
+        self.assertRaises(ValueError, self.matcher.accept_flags, [1, 2], ["hi"])
+        self.say.disable()
+        flags = self.matcher.accept_flags(self.matcher.encode(["hi"]))
+        self.assertEqual(flags.tolist(), [[True, False, False, False]])
+
+    def test_inactive_rules(self):
+        self.greet.disable()
+        rules, accepted = self.matcher.match(self.matcher.encode(["hi"]), ["hi"])
+        self.assertEqual(rules, [[]])
+        self.assertFalse(accepted[0])
+
+    def test_same_results_as_automaton(self):
+        automaton = WordAutomaton(self.matcher.regular_rules)
+        utterances = ["hi", "hello there there", "count two", "go", "go go",
+                      "count one count", "there", ""]
+        rules, _ = self.matcher.match(self.matcher.encode(utterances),
+                                      utterances)
+        for utterance, result in zip(utterances, rules):
+            self.assertEqual(result, automaton.accepts(utterance.split()))
+
+    def test_recursive_rule_fallback(self):
+        grammar = Grammar()
+        rule = PublicRule("nested", "x")
+        rule.expansion = AlternativeSet("x", Sequence("(", RuleRef(rule), ")"))
+        grammar.add_rule(rule)
+        matcher = grammar.batch_matcher()
+        self.assertEqual(matcher.fallback_rules, [rule])
+        self.assertEqual(matcher.state_count, 1)
+
+
+@unittest.skipIf(numpy is not None, "NumPy is installed")
+class BatchMatcherWithoutNumPyCase(unittest.TestCase):
+    def test_import_error(self):
+        self.assertRaises(ImportError, BatchMatcher, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,334 @@
+import math
+import unittest
+
+from jsgf import *
+from jsgf.ext import Dictation
+
+
+class ChartRuleCase(unittest.TestCase):
+    def make_rule(self, expansion):
+        rule = PublicRule("test", expansion)
+        rule.matching_backend = MatchBackend.Chart
+        return rule
+
+    def test_ambiguous(self):
+        e = Sequence(OptionalGrouping("test"), "test")
+        rule = self.make_rule(e)
+        self.assertTrue(rule.matches("test"))
+        self.assertEqual(e.current_match, "test")
+        self.assertEqual(e.children[0].current_match, "")
+        self.assertEqual(e.children[1].current_match, "test")
+        self.assertEqual(e.children[1].matching_slice, slice(0, 4))
+
+        self.assertTrue(rule.matches("TEST  test"))
+        self.assertEqual(e.children[0].current_match, "test")
+        self.assertEqual(e.children[1].matching_slice, slice(6, 10))
+        self.assertFalse(rule.matches("test test test"))
+        self.assertEqual(e.current_match, None)
+
+    def test_greedy_repeat(self):
+        # The default backend fails to match this because the Repeat matches
+        # every word.
+        e = Sequence(Repeat("a"), "a")
+        rule = self.make_rule(e)
+        self.assertTrue(rule.matches("a a a"))
+        self.assertEqual(e.children[0].current_match, "a a")
+        self.assertEqual(e.children[0].repetitions_matched, 2)
+        self.assertEqual(e.children[0].get_expansion_matches(
+            e.children[0].child), ["a", "a"])
+        self.assertEqual(e.children[0].get_expansion_slices(
+            e.children[0].child), [slice(0, 1), slice(2, 3)])
+
+    def test_same_match_data(self):
+        e1 = Sequence("open", AlternativeSet("file", "folder"),
+                      KleeneStar(AlternativeSet("up", "down")),
+                      OptionalGrouping("now"))
+        e2 = e1.copy()
+        r1, r2 = PublicRule("test", e1), self.make_rule(e2)
+        for speech in ["open file", "open folder up down up now", "open now"]:
+            self.assertEqual(r1.matches(speech), r2.matches(speech))
+            for x1, x2 in zip(e1.collect_leaves(), e2.collect_leaves()):
+                self.assertEqual(x1.current_match, x2.current_match)
+                self.assertEqual(x1.matching_slice, x2.matching_slice)
+            self.assertEqual(e1.children[2].get_expansion_matches(
+                e1.children[2].child), e2.children[2].get_expansion_matches(
+                e2.children[2].child))
+
+    def test_dictation(self):
+        e = Sequence("note", Dictation(), OptionalGrouping("end"))
+        rule = self.make_rule(e)
+        self.assertTrue(rule.matches("note buy some milk end"))
+        self.assertEqual(e.children[1].current_match, "buy some milk")
+        self.assertEqual(e.children[2].current_match, "end")
+        self.assertFalse(rule.matches("note"))
+
+    def test_void_and_null(self):
+        self.assertFalse(self.make_rule(Sequence("a", VoidRef())).matches("a"))
+        self.assertTrue(self.make_rule(Sequence(NullRef(), "a")).matches("a"))
+
+    def test_disabled(self):
+        rule = self.make_rule("test")
+        rule.disable()
+        self.assertFalse(rule.matches("test"))
+
+    def test_parser_cache(self):
+        # The parser is reused until the rule's expansion tree changes.
+        e = Sequence("open", AlternativeSet("file", "folder"))
+        rule = self.make_rule(e)
+        self.assertTrue(rule.matches("open file"))
+        parser = rule._get_chart_parser(e)
+        self.assertTrue(rule.matches("open folder"))
+        self.assertIs(rule._get_chart_parser(e), parser)
+
+        e.children[1].children[0].text = "window"
+        self.assertFalse(rule.matches("open file"))
+        self.assertTrue(rule.matches("open window"))
+        e.children[1].children.append("tab")
+        self.assertTrue(rule.matches("open tab"))
+        rule.expansion = "close"
+        self.assertTrue(rule.matches("close"))
+        self.assertIsNot(rule._get_chart_parser(rule.expansion), parser)
+
+    def test_nullable_rules(self):
+        # Rules that can match empty speech only match speech that the whole
+        # expansion matches, unlike with the default backend.
+        grammar = Grammar()
+        grammar.add_rules(
+            PublicRule("opt", OptionalGrouping("a")),
+            PublicRule("seq", Sequence(OptionalGrouping("a"),
+                                       OptionalGrouping("b"))),
+            PublicRule("null", NullRef())
+        )
+        grammar.matching_backend = MatchBackend.Chart
+        for rule in grammar.rules:
+            rule.matching_backend = MatchBackend.Chart
+
+        def names(speech):
+            return [r.name for r in grammar.find_matching_rules(speech)]
+
+        self.assertEqual(names(""), ["opt", "seq", "null"])
+        self.assertEqual(names("a"), ["opt", "seq"])
+        self.assertEqual(names("b"), ["seq"])
+        self.assertEqual(names("a b"), ["seq"])
+        self.assertEqual(names("c"), [])
+        for speech in ["", "a", "b", "a b", "c"]:
+            self.assertEqual(
+                [r.name for r in grammar.rules if r.matches(speech)],
+                names(speech)
+            )
+
+
+class ChartGrammarCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0 UTF-8 en;
+            grammar test;
+            public <list> = <list> and <item> | <item>;
+            <item> = apples | pears;
+            public <count> = <number> [<number>];
+            <number> = one | two | two one;
+            public <nested> = left <nested> right | middle;
+        """)
+        self.grammar.matching_backend = MatchBackend.Chart
+
+    def test_left_recursion(self):
+        rules = self.grammar.find_matching_rules("apples and pears and apples")
+        self.assertEqual([r.name for r in rules], ["list"])
+        self.assertEqual(rules[0].expansion.current_match,
+                         "apples and pears and apples")
+
+    def test_right_recursion(self):
+        rules = self.grammar.find_matching_rules("left left middle right right")
+        self.assertEqual([r.name for r in rules], ["nested"])
+        self.assertFalse(self.grammar.find_matching_rules("left middle"))
+
+    def test_ambiguous_references(self):
+        rules = self.grammar.find_matching_rules("two one")
+        self.assertEqual([r.name for r in rules], ["count"])
+        refs = rules[0].expansion.children
+        self.assertEqual(refs[0].current_match, "two one")
+        self.assertEqual(refs[1].current_match, "")
+
+        rules = self.grammar.find_matching_rules("two one one")
+        self.assertEqual(refs[0].current_match, "two one")
+        self.assertEqual(refs[1].current_match, "one")
+
+    def test_rule_matches(self):
+        rule = self.grammar.get_rule_from_name("list")
+        rule.matching_backend = MatchBackend.Chart
+        self.assertTrue(rule.matches("pears and pears"))
+        self.assertFalse(rule.matches("pears and"))
+
+    def test_referenced_rule_changes(self):
+        rule = self.grammar.get_rule_from_name("list")
+        rule.matching_backend = MatchBackend.Chart
+        self.assertTrue(rule.matches("pears and apples"))
+        item = self.grammar.get_rule_from_name("item")
+        item.expansion.children.append("plums")
+        self.assertTrue(rule.matches("pears and plums"))
+        item.expansion = "grapes"
+        self.assertFalse(rule.matches("pears and apples"))
+        self.assertTrue(rule.matches("grapes and grapes"))
+
+    def test_parser_cache(self):
+        grammar = Grammar()
+        grammar.add_rules(PublicRule("count", Sequence(NamedRuleRef("number"),
+                                                       "done")),
+                          HiddenRule("number", AlternativeSet("one", "two")))
+        grammar.matching_backend = MatchBackend.Chart
+        names = lambda speech: [
+            r.name for r in grammar.find_matching_rules(speech)]
+        self.assertEqual(names("one done"), ["count"])
+        parser = grammar._chart_parser_cache[2]
+        self.assertEqual(names("two done"), ["count"])
+        self.assertIs(grammar._chart_parser_cache[2], parser)
+
+        # The parser is created again after rules are added, removed, disabled
+        # or changed.
+        grammar.add_rule(PublicRule("stop", "stop"))
+        self.assertEqual(names("stop"), ["stop"])
+        grammar.disable_rule("stop")
+        self.assertEqual(names("stop"), [])
+        grammar.remove_rule("stop")
+        self.assertEqual(names("stop"), [])
+        grammar.get_rule_from_name("number").expansion.children.append("three")
+        self.assertEqual(names("three done"), ["count"])
+        grammar.remove_rule("number", ignore_dependent=True)
+        grammar.add_rule(HiddenRule("number", "four"))
+        self.assertEqual(names("one done"), [])
+        self.assertEqual(names("four done"), ["count"])
+        self.assertIsNot(grammar._chart_parser_cache[2], parser)
+
+    def test_vocabulary_index(self):
+        # Only candidate rules are parsed using the cached parser.
+        self.grammar.use_vocabulary_index = True
+        rules = self.grammar.find_matching_rules("left middle right")
+        self.assertEqual([r.name for r in rules], ["nested"])
+        self.assertEqual([r.name for r in self.grammar.find_matching_rules(
+            "apples")], ["list"])
+
+
+class ChartParserCase(unittest.TestCase):
+    def test_parse(self):
+        e1, e2 = Literal("hello world"), Sequence("hello", OptionalGrouping("x"))
+        chart = ChartParser([e1, e2]).parse(" Hello World ")
+        self.assertEqual(chart.words, ["hello", "world"])
+        self.assertTrue(chart.matched(e1))
+        self.assertFalse(chart.matched(e2))
+        self.assertFalse(chart.matched(Literal("hello world")))
+        self.assertTrue(chart.set_match_data(e1))
+        self.assertEqual(e1.matching_slice, slice(0, 11))
+
+
+class WeightedMatchingCase(unittest.TestCase):
+    def setUp(self):
+        # "play the music" can be matched using either alternative of each set.
+        self.song = AlternativeSet("music", "the music")
+        self.song.weights = {"music": 1, "the music": 4}
+        self.verb = AlternativeSet("play", "play the")
+        self.verb.weights = {"play": 1, "play the": 2}
+        self.rule = PublicRule("play", Sequence(self.verb, self.song))
+        self.rule.matching_backend = MatchBackend.Weighted
+
+    def test_best_parse(self):
+        self.assertTrue(self.rule.matches("play the music"))
+        self.assertAlmostEqual(self.rule.match_score, math.log(4))
+        self.assertEqual(self.verb.current_match, "play")
+        self.assertEqual(self.song.current_match, "the music")
+
+        # The first parse is used by the chart backend.
+        self.rule.matching_backend = MatchBackend.Chart
+        self.assertTrue(self.rule.matches("play the music"))
+        self.assertEqual(self.verb.current_match, "play the")
+        self.assertEqual(self.rule.match_score, None)
+
+    def test_no_match(self):
+        self.assertFalse(self.rule.matches("play music now"))
+        self.assertEqual(self.rule.match_score, None)
+
+    def test_grammar_order(self):
+        # Rules are ordered by score. Rules without weights score 0.
+        low = AlternativeSet("stop", "stop it")
+        low.weights = {"stop": 0.5, "stop it": 1}
+        high = AlternativeSet("stop", "halt")
+        high.weights = {"stop": 3, "halt": 1}
+        grammar = Grammar()
+        grammar.add_rules(PublicRule("low", low), PublicRule("plain", "stop"),
+                          PublicRule("high", high))
+        grammar.matching_backend = MatchBackend.Weighted
+        rules = grammar.find_matching_rules("stop")
+        self.assertEqual([r.name for r in rules], ["high", "plain", "low"])
+        self.assertAlmostEqual(rules[0].match_score, math.log(3))
+        self.assertAlmostEqual(rules[2].match_score, math.log(0.5))
+
+    def test_beam_width(self):
+        # A narrow beam prunes the partial parse using the low weight "play"
+        # alternative after the first word, so the rule no longer matches
+        # "play music".
+        self.rule.beam_width = 0.1
+        self.assertTrue(self.rule.matches("play the music"))
+        self.assertFalse(self.rule.matches("play music"))
+        self.rule.beam_width = 1.0
+        self.assertTrue(self.rule.matches("play music"))
+        self.assertAlmostEqual(self.rule.match_score, 0.0)
+
+    def test_parser_cache(self):
+        # The parser is reused until weights change.
+        self.assertTrue(self.rule.matches("play the music"))
+        parser = self.rule._get_chart_parser(self.rule.expansion)
+        self.assertTrue(self.rule.matches("play music"))
+        self.assertIs(self.rule._get_chart_parser(self.rule.expansion), parser)
+
+        self.song.set_weight("music", 8)
+        self.assertTrue(self.rule.matches("play the music"))
+        self.assertAlmostEqual(self.rule.match_score, math.log(16))
+        self.assertEqual(self.verb.current_match, "play the")
+        self.assertIsNot(self.rule._get_chart_parser(self.rule.expansion),
+                         parser)
+
+    def test_grammar_parser_cache(self):
+        grammar = Grammar()
+        grammar.add_rule(self.rule)
+        grammar.matching_backend = MatchBackend.Weighted
+        self.assertEqual(grammar.find_matching_rules("play the music"),
+                         [self.rule])
+        parser = grammar._chart_parser_cache[2]
+        self.assertEqual(grammar.find_matching_rules("play music"), [self.rule])
+        self.assertIs(grammar._chart_parser_cache[2], parser)
+
+        # Alternatives with zero weights are removed from the parser.
+        self.verb.set_weight("play", 0)
+        self.assertEqual(grammar.find_matching_rules("play music"), [])
+        self.assertIsNot(grammar._chart_parser_cache[2], parser)
+
+    def test_nullable_rules(self):
+        # Rules that can match empty speech only match speech that the whole
+        # expansion matches, unlike with the default backend.
+        grammar = Grammar()
+        grammar.add_rules(
+            PublicRule("opt", OptionalGrouping("a")),
+            PublicRule("seq", Sequence(OptionalGrouping("a"),
+                                       OptionalGrouping("b"))),
+            PublicRule("null", NullRef())
+        )
+        grammar.matching_backend = MatchBackend.Weighted
+        for rule in grammar.rules:
+            rule.matching_backend = MatchBackend.Weighted
+
+        def names(speech):
+            return [r.name for r in grammar.find_matching_rules(speech)]
+
+        self.assertEqual(names(""), ["opt", "seq", "null"])
+        self.assertEqual(names("a"), ["opt", "seq"])
+        self.assertEqual(names("b"), ["seq"])
+        self.assertEqual(names("a b"), ["seq"])
+        self.assertEqual(names("c"), [])
+        for speech in ["", "a", "b", "a b", "c"]:
+            self.assertEqual(
+                [r.name for r in grammar.rules if r.matches(speech)],
+                names(speech)
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jsgf import *
+from jsgf.ext import Dictation
+
+
+class CompiledMatcherCase(unittest.TestCase):
+    def setUp(self):
+        self.alt_set = AlternativeSet("alice", "alice smith", "bob")
+        self.repeat = KleeneStar(AlternativeSet("up", Sequence("down", "low")))
+        self.expansion = Sequence("call", self.alt_set, OptionalGrouping("now"),
+                                  self.repeat)
+        self.rule = PublicRule("call", self.expansion)
+        self.matcher = CompiledMatcher(self.expansion)
+
+    def test_source(self):
+        source = self.matcher.source
+        self.assertIn("def m0(u, w, n, p, s, r):", source)
+        self.assertIn("w[q] == 'call'", source)
+        self.assertIn("('alice', 'smith')", source)
+
+    def test_matches(self):
+        self.assertTrue(self.matcher.matches("call alice smith now"))
+        self.assertEqual(self.expansion.current_match, "call alice smith now")
+        self.assertEqual(self.alt_set.current_match, "alice smith")
+        self.assertEqual(self.alt_set.matching_slice, slice(5, 16))
+        self.assertTrue(self.matcher.matches(["Call", "bob"]))
+        self.assertEqual(self.alt_set.current_match, "bob")
+        self.assertEqual(self.expansion.children[2].current_match, "")
+
+        # Only whole words are matched.
+        self.assertFalse(self.matcher.matches("call bobby"))
+        self.assertFalse(self.matcher.matches("call"))
+        self.assertIsNone(self.expansion.current_match)
+        self.assertIsNone(self.alt_set.current_match)
+
+    def test_repetitions(self):
+        self.assertTrue(self.matcher.matches("call bob up down low up"))
+        self.assertEqual(self.repeat.current_match, "up down low up")
+        self.assertEqual(self.repeat.repetitions_matched, 3)
+        self.assertEqual(self.repeat.get_expansion_matches(self.repeat.child),
+                         ["up", "down low", "up"])
+        self.assertEqual(self.repeat.get_expansion_slices(self.repeat.child),
+                         [slice(9, 11), slice(12, 20), slice(21, 23)])
+
+        # Only the last repetition's data is set.
+        sequence = self.repeat.child.children[1]
+        self.assertEqual(sequence.current_match, "")
+        self.assertEqual(self.repeat.get_expansion_matches(sequence),
+                         ["", "down low", ""])
+
+    def test_same_results_as_pyparsing(self):
+        speech_list = ["call alice", "call alice now up", "call bob down low",
+                       "call bob down", "call now", "call alice smith up up"]
+        for speech in speech_list:
+            compiled = self.matcher.matches(speech)
+            values = save_current_matches(self.expansion)
+            self.assertEqual(compiled, self.rule.matches(speech))
+            if compiled:
+                self.assertEqual(values, save_current_matches(self.expansion))
+
+    def test_weights(self):
+        alt_set = AlternativeSet("a", "b", "c")
+        alt_set.weights = {"a": 1, "b": 0, "c": 2}
+        matcher = CompiledMatcher(alt_set)
+        self.assertTrue(matcher.matches("a"))
+        self.assertFalse(matcher.matches("b"))
+        self.assertTrue(matcher.matches("c"))
+
+    def test_special_references(self):
+        e = Sequence("a", NullRef(), OptionalGrouping(VoidRef()))
+        self.assertTrue(CompiledMatcher(e).matches("a"))
+        self.assertFalse(CompiledMatcher(Sequence("a", VoidRef())).matches("a"))
+
+    def test_rule_references(self):
+        number = HiddenRule("number", AlternativeSet("one", "two"))
+        e = Repeat(Sequence(RuleRef(number), "more"))
+        rule = PublicRule("numbers", e)
+        grammar = Grammar()
+        grammar.add_rules(number, rule)
+        matcher = CompiledMatcher(e)
+        self.assertTrue(matcher.matches("one more two more"))
+        self.assertEqual(number.expansion.current_match, "two")
+        self.assertEqual(e.get_expansion_matches(number.expansion),
+                         ["one", "two"])
+        self.assertFalse(matcher.matches("three more"))
+
+    def test_dictation(self):
+        dictation = Dictation()
+        e = Sequence("say", dictation, "now")
+        matcher = CompiledMatcher(e)
+        self.assertIn("F(E2, u, n, p)", matcher.source)
+        self.assertTrue(matcher.matches("say hello world now"))
+        self.assertEqual(dictation.current_match, "hello world")
+        self.assertEqual(dictation.matching_slice, slice(4, 15))
+        self.assertFalse(matcher.matches("say now"))
+
+    def test_word_list(self):
+        word_list = WordList(["alice", "alice smith"], "name")
+        matcher = CompiledMatcher(Sequence("call", word_list))
+        self.assertTrue(matcher.matches("call alice smith"))
+        self.assertEqual(word_list.current_match, "alice smith")
+        self.assertFalse(matcher.matches("call alice s"))
+
+    def test_cache_dir(self):
+        directory = tempfile.mkdtemp()
+        try:
+            CompiledMatcher(self.expansion, directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            matcher = CompiledMatcher(self.expansion.copy(), directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertTrue(matcher.matches("call bob up"))
+        finally:
+            shutil.rmtree(directory)
+
+
+class CompiledBackendCase(unittest.TestCase):
+    def setUp(self):
+        self.number = HiddenRule("number", Sequence(AlternativeSet("one", "two")))
+        self.rule = PublicRule("count", Sequence("count", RuleRef(self.number)))
+        self.grammar = Grammar()
+        self.grammar.add_rules(self.number, self.rule)
+        self.grammar.matching_backend = MatchBackend.Compiled
+        self.rule.matching_backend = MatchBackend.Compiled
+
+    def test_rule_matches(self):
+        self.assertTrue(self.rule.matches("count two"))
+        self.assertEqual(self.number.expansion.current_match, "two")
+        self.assertFalse(self.rule.matches("count three"))
+        self.rule.disable()
+        self.assertFalse(self.rule.matches("count two"))
+
+    def test_find_matching_rules(self):
+        self.assertEqual(self.grammar.find_matching_rules("count one"),
+                         [self.rule])
+        self.assertEqual(self.grammar.find_matching_rules("count"), [])
+
+    def test_cached_matcher(self):
+        matcher = self.rule.compiled_matcher
+        self.assertIs(self.rule.compiled_matcher, matcher)
+        self.assertIsNot(self.number.compiled_matcher, matcher)
+
+        # Changes to the rule or to referenced rules invalidate the matcher.
+        self.rule.expansion.children.append(OptionalGrouping("please"))
+        self.assertIsNot(self.rule.compiled_matcher, matcher)
+        self.assertTrue(self.rule.matches("count one please"))
+        matcher = self.rule.compiled_matcher
+        self.number.expansion.children[0].children.append(Literal("three"))
+        self.assertIsNot(self.rule.compiled_matcher, matcher)
+        self.assertTrue(self.rule.matches("count three"))
+
+    def test_copy(self):
+        matcher = self.rule.compiled_matcher
+        copied = self.rule.expansion.copy()
+        self.assertIsNone(copied._compiled_matcher)
+        self.assertIsNot(get_compiled_matcher(copied), matcher)
+
+    def test_nullable_rules(self):
+        # Rules that can match empty speech only match speech that the whole
+        # expansion matches, unlike with the default backend.
+        grammar = Grammar()
+        grammar.add_rules(
+            PublicRule("opt", OptionalGrouping("a")),
+            PublicRule("seq", Sequence(OptionalGrouping("a"),
+                                       OptionalGrouping("b"))),
+            PublicRule("null", NullRef())
+        )
+        grammar.matching_backend = MatchBackend.Compiled
+        for rule in grammar.rules:
+            rule.matching_backend = MatchBackend.Compiled
+
+        def names(speech):
+            return [r.name for r in grammar.find_matching_rules(speech)]
+
+        self.assertEqual(names(""), ["opt", "seq", "null"])
+        self.assertEqual(names("a"), ["opt", "seq"])
+        self.assertEqual(names("b"), ["seq"])
+        self.assertEqual(names("a b"), ["seq"])
+        self.assertEqual(names("c"), [])
+        for speech in ["", "a", "b", "a b", "c"]:
+            self.assertEqual(
+                [r.name for r in grammar.rules if r.matches(speech)],
+                names(speech)
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import threading
 import unittest
 from copy import deepcopy
 
@@ -286,6 +287,87 @@ class ChildListCase(unittest.TestCase):
         self.assertIsNone(a.parent)
 
 
+class BulkBuildCase(unittest.TestCase):
+    def test_build(self):
+        with bulk_build():
+            e = Sequence("hello", AlternativeSet("a", "b"), NamedRuleRef("c"))
+            rule = PublicRule("test", e)
+        self.assertEqual(rule.compile(), "public <test> = hello (a|b) <c>;")
+        self.assertIs(e.children[1].parent, e)
+        self.assertTrue(Rule("r", True, e.children[1].copy()).matches("b"))
+
+    def test_deferred_invalidation(self):
+        e = Sequence("hello", "world")
+        self.assertEqual(e.matches("hello world"), "")
+        self.assertIsNotNone(e._matcher_element)
+        with bulk_build():
+            e.children.append("again")
+
+            # The matcher element is only invalidated on exit.
+            self.assertIsNotNone(e._matcher_element)
+        self.assertIsNone(e._matcher_element)
+        self.assertEqual(e.matches("hello world again"), "")
+
+    def test_nested(self):
+        e = Sequence("a")
+        e.matches("a")
+        with bulk_build():
+            with bulk_build():
+                e.children.append("b")
+            self.assertIsNotNone(e._matcher_element)
+        self.assertIsNone(e._matcher_element)
+
+    def test_name_validation(self):
+        def build(cls, name):
+            with bulk_build():
+                cls(name)
+
+        for cls in (NamedRuleRef, Import, Grammar):
+            self.assertRaises(GrammarError, build, cls, "a b")
+        self.assertRaises(GrammarError, build, lambda n: Rule(n, True, "a"),
+                          "NULL")
+        self.assertRaises(GrammarError, build, NamedRuleRef, "")
+
+        # Names only need to be valid at the end of the build.
+        with bulk_build():
+            rule = Rule("a b", True, "test")
+            rule.name = "valid_name"
+        self.assertEqual(rule.name, "valid_name")
+
+        # Valid names should not raise errors.
+        with bulk_build():
+            NamedRuleRef("com.example.rule")
+            Import("com.example.*")
+            Grammar("com.example")
+
+    def test_exception_in_build(self):
+        def build():
+            with bulk_build():
+                NamedRuleRef("invalid name")
+                raise ValueError()
+
+        # The original exception should propagate instead of a GrammarError.
+        self.assertRaises(ValueError, build)
+
+        # Names are validated normally afterwards.
+        self.assertRaises(GrammarError, NamedRuleRef, "invalid name")
+
+    def test_other_threads(self):
+        e = Sequence("a")
+        e.matches("a")
+
+        # Changes made in other threads are not deferred.
+        def change():
+            e.children.append("b")
+
+        with bulk_build():
+            thread = threading.Thread(target=change)
+            thread.start()
+            thread.join()
+            self.assertIsNone(e._matcher_element)
+        self.assertEqual(e.matches("a b"), "")
+
+
 class Comparisons(unittest.TestCase):
     def test_literals(self):
         self.assertEqual(Literal("hello"), Literal("hello"))
@@ -467,6 +549,13 @@ class Copying(unittest.TestCase):
             # Children of e and e3 should all be the same objects
             self.assertIs(c1, c2)
 
+        # And with lazy copying
+        e4 = e.copy(lazy=True)
+        self.assertIsNot(e, e4)
+        self.assertEqual(e, e4)
+        for c1, c2 in zip(e.children, e4.children):
+            self.assertIsNot(c1, c2)
+
     def test_base(self):
         self.assert_copy_works(Expansion([]))
         self.assert_copy_works(Expansion(["a"]))
@@ -506,6 +595,125 @@ class Copying(unittest.TestCase):
         self.assert_copy_works(Repeat("testing"))
         self.assert_copy_works(KleeneStar("testing"))
 
+    def test_deep_tree(self):
+        # Copies are made without recursion, so very deep trees can be copied.
+        e = Literal("test")
+        for _ in range(5000):
+            e = RequiredGrouping(e)
+        e2 = e.copy()
+        for _ in range(5000):
+            self.assertIsNot(e, e2)
+            e, e2 = e.children[0], e2.children[0]
+            self.assertIs(e2.parent.children[0], e2)
+        self.assertEqual(e2, Literal("test"))
+
+    def test_match_data_not_copied(self):
+        e = Sequence("a", AlternativeSet("b", "c"))
+        self.assertEqual(e.matches("a b"), "")
+        for e2 in [e.copy(), e.copy(lazy=True)]:
+            self.assertIsNone(e2.current_match)
+            self.assertIsNone(e2.children[1].current_match)
+            self.assertEqual(e2.matches("a c"), "")
+            self.assertEqual(e2.children[1].current_match, "c")
+            self.assertEqual(e.children[1].current_match, "b")
+
+        # Dictation copies should not use the current_match value.
+        d = Dictation()
+        d.use_current_match = True
+        self.assertFalse(d.copy().use_current_match)
+
+    def test_match_spans_not_copied(self):
+        e = Sequence("a", Repeat(AlternativeSet("b", "c")))
+        self.assertEqual(e.matches("a b c"), "")
+        for e2 in [e.copy(), e.copy(lazy=True)]:
+            self.assertIsNone(e2.current_match)
+            self.assertEqual(e2.children[1].repetitions_matched, 0)
+            for x in flat_map_expansion(e2):
+                self.assertIsNone(x._match_span)
+                self.assertIsNone(x._match_end)
+
+    def test_alt_set_weights_remapped(self):
+        e = AlternativeSet("a", "b")
+        e.weights = {"a": 2, "b": 4}
+        for e2 in [e.copy(), e.copy(lazy=True)]:
+            self.assertEqual(e2.weights, e.weights)
+            self.assertEqual(e2.weights[e2.children[1]], 4)
+            self.assertIs(list(e2.weights)[0].parent, e2)
+            e2.set_weight("b", 3)
+            self.assertEqual(e.weights[e.children[1]], 4)
+
+    def test_lazy_copy_shares_until_accessed(self):
+        e = Sequence(AlternativeSet("a", "b"), Sequence("c", "d"))
+        e2 = e.copy(lazy=True)
+
+        # Only the root has been copied so far.
+        self.assertIsNone(e2._children)
+
+        # Accessing children copies one level at a time.
+        first = e2.children[0]
+        self.assertIsNone(first._children)
+        self.assertEqual(first.children, [Literal("a"), Literal("b")])
+        self.assertIsNone(e2.children[1]._children)
+        self.assertEqual(e2, e)
+
+    def test_lazy_copy_source_mutation(self):
+        e = Sequence(AlternativeSet("a", "b"), Sequence("c", "d"))
+        e2 = e.copy(lazy=True)
+
+        # Changing the source after copying must not change the lazy copy.
+        e.children[1].children[0].text = "x"
+        e.children[0].children.append("y")
+        e.children[1].children[1].tag = "t"
+        self.assertEqual(e2, Sequence(AlternativeSet("a", "b"),
+                                      Sequence("c", "d")))
+        self.assertEqual(e2.compile(), "(a|b) c d")
+
+        # Changing the lazy copy must not change the source either.
+        e3 = e.copy(lazy=True)
+        e3.children[0].children[0].text = "z"
+        self.assertEqual(e.children[0].children[0].text, "a")
+
+    def test_lazy_copy_source_attributes(self):
+        # Changing any attribute of a node in the source must not change copies.
+        alt = AlternativeSet("x", "y")
+        alt.weights = {0: 2, 1: 1}
+        ref = NamedRuleRef("foo")
+        dictation = Dictation()
+        word_list = WordList(["alice"], "names")
+        e = Sequence(alt, ref, Repeat("z"), KleeneStar("w"),
+                     OptionalGrouping(dictation), word_list)
+        compiled = e.compile()
+        copies = [e.copy(), e.copy(lazy=True), e.copy(lazy=True),
+                  e.copy(lazy=True)]
+        copies[2].children[0].children[1].tag  # partially copied
+        copies[3].children[2]
+
+        mutations = [
+            lambda: setattr(ref, "name", "bar"),
+            lambda: setattr(alt.children[0], "text", "v"),
+            lambda: alt.set_weight(0, 5),
+            lambda: setattr(alt, "weights", {1: 3}),
+            lambda: setattr(e.children[2].child, "tag", "t"),
+            lambda: setattr(e.children[3], "tag", "u"),
+            lambda: setattr(dictation, "use_current_match", True),
+            lambda: setattr(dictation, "tag", "d"),
+            lambda: setattr(word_list, "name", "people"),
+            lambda: setattr(word_list, "lexicon", ["bob"]),
+            lambda: e.children.append("more"),
+        ]
+        for mutate in mutations:
+            mutate()
+            for c in copies:
+                self.assertEqual(c.compile(), compiled)
+        self.assertEqual(
+            e.compile(), "(/5.0000/ v|/3.0000/ y) <bar> (z { t })+ (w)* { u } "
+                         "[<DICTATION> { d }] <people> more"
+        )
+        for c in copies:
+            words = c.children[5]
+            self.assertFalse(c.children[4].children[0].use_current_match)
+            self.assertEqual(list(words.lexicon), ["alice"])
+
 
 class LiteralProperties(unittest.TestCase):
     """
@@ -623,6 +831,102 @@ class AncestorProperties(unittest.TestCase):
         map_expansion(r.expansion, assert_descendant)
 
 
+class SummaryProperties(unittest.TestCase):
+    def test_leaf_count(self):
+        e = Sequence("a", AlternativeSet("b", "c"), OptionalGrouping("d"))
+        self.assertEqual(e.leaf_count, len(e.leaves))
+        self.assertEqual(e.children[1].leaf_count, 2)
+        self.assertEqual(Literal("a").leaf_count, 1)
+
+    def test_contains_literal(self):
+        self.assertTrue(Sequence("a", NullRef()).contains_literal)
+        self.assertFalse(Sequence(NullRef(), VoidRef()).contains_literal)
+        self.assertFalse(Sequence(Dictation()).contains_literal)
+
+    def test_dictation(self):
+        e = Sequence("a", Dictation())
+        self.assertTrue(e.contains_dictation)
+        self.assertFalse(e.is_dictation_only)
+        self.assertTrue(e.children[1].is_dictation_only)
+        self.assertFalse(e.children[0].contains_dictation)
+        self.assertTrue(Sequence(Dictation(), Dictation()).is_dictation_only)
+
+    def test_can_match_empty(self):
+        self.assertFalse(Literal("a").can_match_empty)
+        self.assertTrue(OptionalGrouping("a").can_match_empty)
+        self.assertTrue(KleeneStar("a").can_match_empty)
+        self.assertFalse(Repeat("a").can_match_empty)
+        self.assertTrue(NullRef().can_match_empty)
+        self.assertFalse(VoidRef().can_match_empty)
+        self.assertTrue(Sequence(OptionalGrouping("a"), NullRef()).can_match_empty)
+        self.assertFalse(Sequence(OptionalGrouping("a"), "b").can_match_empty)
+        self.assertTrue(AlternativeSet("a", KleeneStar("b")).can_match_empty)
+        self.assertFalse(AlternativeSet("a", "b").can_match_empty)
+
+    def test_cached(self):
+        e = Sequence("a", AlternativeSet("b", "c"))
+        self.assertEqual(e.leaf_count, 3)
+        self.assertIsNotNone(e._summary)
+        self.assertIsNotNone(e.children[1].children[0]._summary)
+
+    def test_invalidated_on_change(self):
+        alt = AlternativeSet("b", "c")
+        e = Sequence("a", OptionalGrouping(alt))
+        self.assertEqual(e.leaf_count, 3)
+        self.assertFalse(e.contains_dictation)
+        self.assertFalse(e.can_match_empty)
+
+        alt.children.append(Dictation())
+        self.assertEqual(e.leaf_count, 4)
+        self.assertTrue(e.contains_dictation)
+
+        e.children.pop(0)
+        self.assertEqual(e.leaf_count, 3)
+        self.assertTrue(e.can_match_empty)
+
+        e.children[0].children[0] = Dictation()
+        self.assertTrue(e.is_dictation_only)
+
+        e.children = ["x"]
+        self.assertEqual(e.leaf_count, 1)
+        self.assertFalse(e.contains_dictation)
+
+        # The old subtree should also have been updated.
+        self.assertEqual(alt.leaf_count, 3)
+
+    def test_rule_references(self):
+        n = HiddenRule("n", AlternativeSet("a", Dictation()))
+        r = PublicRule("r", Sequence("b", NamedRuleRef("n")))
+        g = Grammar()
+        g.add_rules(n, r)
+
+        # References are counted as leaves, like with the leaves property.
+        self.assertEqual(r.expansion.leaf_count, len(r.expansion.leaves))
+        self.assertTrue(r.expansion.contains_dictation)
+        self.assertFalse(r.expansion.can_match_empty)
+
+        # Changes to referenced rules are reflected in referencing expansions.
+        n.expansion.children.pop(1)
+        n.expansion.children.append(NullRef())
+        self.assertFalse(r.expansion.contains_dictation)
+        n.expansion = Sequence(Dictation())
+        self.assertTrue(r.expansion.contains_dictation)
+
+    def test_recursive_rule_references(self):
+        r = PublicRule("r", AlternativeSet("a", Sequence("b", NamedRuleRef("r"))))
+        g = Grammar()
+        g.add_rule(r)
+        self.assertEqual(r.expansion.leaf_count, 3)
+        self.assertTrue(r.expansion.contains_literal)
+        self.assertFalse(r.expansion.can_match_empty)
+
+    def test_deep_tree(self):
+        e = Literal("a")
+        for _ in range(5000):
+            e = RequiredGrouping(e)
+        self.assertEqual(e.leaf_count, 1)
+
+
 class LiteralRepetitionAncestor(unittest.TestCase):
     def setUp(self):
         self.seq = Sequence("hello", "world")
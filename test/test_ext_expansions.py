@@ -39,6 +39,19 @@ class DictationMatchesCase(unittest.TestCase):
         self.assertFalse(r2.matches("test testing"))
         map_expansion(e2, lambda x: self.assertIsNone(x.current_match))
 
+    def test_matches_long_dictation(self):
+        e1 = Seq("note", Dict(), Opt("please"), "done")
+        r1 = PublicRule("test", e1)
+        words = " ".join(["word%d" % i for i in range(200)])
+        self.assertTrue(r1.matches("note %s pleasant please done" % words))
+        self.assertEqual(e1.children[1].current_match, words + " pleasant")
+        self.assertEqual(e1.children[1].matching_slice,
+                         slice(5, 5 + len(words) + 9))
+        self.assertEqual(e1.children[2].current_match, "please")
+
+        # Words starting with next literals are not matched as dictation.
+        self.assertFalse(r1.matches("note word doneness"))
+
     def test_matches_as_optional(self):
         e1 = Seq("hello", Opt(Dict()))
         r1 = PublicRule("test", e1)
@@ -616,6 +629,42 @@ class ExpandedDictationExpansion(unittest.TestCase):
             Seq(Rep("c"), Seq("d", Dict()))
         ])
 
+    def test_equal_optionals(self):
+        # Only the optional in the sequence with Dictation should be expanded.
+        e1 = Seq(Seq(Opt("a"), "b"), Seq(Opt("a"), Dict()))
+        self.assertListEqual(expand_dictation_expansion(e1), [
+            Seq(Seq(Opt("a"), "b"), Seq(Dict())),
+            Seq(Seq(Opt("a"), "b"), Seq("a", Dict()))
+        ])
+
+    def test_many_dictation_positions(self):
+        children = []
+        for i in range(8):
+            children.extend(["w%d" % i, Opt(Dict())])
+        result = expand_dictation_expansion(Seq(*children))
+        self.assertEqual(len(result), 256)
+        self.assertEqual(len(set(result)), 256)
+        self.assertEqual(result[0], Seq(*["w%d" % i for i in range(8)]))
+        self.assertEqual(result[1], Seq(*(
+            ["w%d" % i for i in range(8)] + [Dict()]
+        )))
+        self.assertEqual(result[-1], Seq(*[
+            Dict() if isinstance(c, Opt) else c for c in children
+        ]))
+
+    def test_rule_references(self):
+        # Referenced rules are not expanded.
+        n = Rule("n", False, AS("one", Dict()))
+        e = Seq("hi", RuleRef(n))
+        self.assertListEqual(expand_dictation_expansion(e), [e])
+
+        # But referenced Dictation expansions are still taken into account.
+        e = AS("hi", RuleRef(n))
+        self.assertListEqual(expand_dictation_expansion(e), [
+            Literal("hi"),
+            RuleRef(n)
+        ])
+
     def test_copying(self):
         """Original expansions are not used in output expansions"""
         # Note that JSGF only expansions are not expected to pass this test;
@@ -1,3 +1,4 @@
+import threading
 import unittest
 from jsgf import *
 from jsgf.ext import *
@@ -137,6 +138,39 @@ class DictationGrammarCase(unittest.TestCase):
         grammar.remove_rule(r2)
         self.assertNotIn(r2, grammar.rules)
 
+    def test_generated_rules(self):
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", AlternativeSet("hello", Dictation()))
+        grammar.add_rule(r1)
+        generated = list(grammar.get_generated_rules(r1))
+        self.assertEqual([r.name for r in generated], ["test_0", "test_1"])
+        for r in generated:
+            self.assertIs(grammar.get_original_rule(r), r1)
+            self.assertIn(r, grammar.rules)
+
+        grammar.remove_rule(r1)
+        self.assertEqual(list(grammar.get_generated_rules(r1)), [])
+        self.assertEqual(grammar.rules, [])
+        self.assertRaises(KeyError, grammar.get_original_rule, generated[0])
+
+    def test_remove_hidden_rule(self):
+        grammar = DictationGrammar()
+        r1 = HiddenRule("test", AlternativeSet("hello", Dictation()))
+        grammar.add_rule(r1)
+        self.assertEqual(grammar.compile(),
+                         "#JSGF V1.0;\n"
+                         "grammar default;\n"
+                         "<test_0> = hello;\n")
+
+        # Generated rules should be removed even if they aren't visible.
+        grammar.remove_rule("test")
+        self.assertEqual(grammar.compile(), "")
+        grammar.add_rule(r1)
+        self.assertEqual(grammar.compile(),
+                         "#JSGF V1.0;\n"
+                         "grammar default;\n"
+                         "<test_0> = hello;\n")
+
     def test_add_sequence_rule(self):
         grammar = DictationGrammar()
         r1 = SequenceRule("test1", True, Sequence("test", Dictation()))
@@ -242,5 +276,268 @@ class DictationGrammarOriginalRule(unittest.TestCase):
                          "value")
 
 
+    def test_original_not_matched_again(self):
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", Sequence(
+            "hello", AlternativeSet(Dictation(), "world"), OptionalGrouping("now")
+        ))
+        grammar.add_rule(r1)
+        matching = grammar.find_matching_rules("hello world")
+        self.assertEqual(len(matching), 1)
+        self.assertIs(grammar.get_original_rule(matching[0]), r1)
+
+        # Match data is copied from the generated rule, so the literal alternative
+        # has the match and the original rule's matcher is not used.
+        seq = r1.expansion
+        alt_set = seq.children[1]
+        self.assertEqual(seq.current_match, "hello world")
+        self.assertEqual(seq.matching_slice, slice(0, 11))
+        self.assertEqual(alt_set.current_match, "world")
+        self.assertEqual(alt_set.matching_slice, slice(6, 11))
+        self.assertEqual(alt_set.children[0].current_match, None)
+        self.assertEqual(alt_set.children[1].current_match, "world")
+        self.assertEqual(seq.children[2].current_match, "")
+        self.assertIsNone(seq._matcher_element)
+
+    def test_sequence_slices(self):
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", Sequence(
+            "hello", Dictation(), Repeat("there")
+        ))
+        grammar.add_rule(r1)
+        grammar.find_matching_rules("hello")
+        grammar.find_matching_rules("big world")
+        grammar.find_matching_rules("there there")
+
+        # Slices are relative to the sequence matches joined together.
+        seq = r1.expansion
+        self.assertEqual(seq.current_match, "hello big world there there")
+        self.assertEqual(seq.children[1].current_match, "big world")
+        self.assertEqual(seq.children[1].matching_slice, slice(6, 15))
+        self.assertEqual(seq.children[2].matching_slice, slice(16, 27))
+        self.assertEqual(seq.children[2].repetitions_matched, 2)
+        self.assertIsNone(seq._matcher_element)
+
+    def test_matched_alternative(self):
+        # The original expansion that the generated rule matched has the match,
+        # even if the Dictation alternative could match the same words. Original
+        # rules used to be matched again, which gave the match to the Dictation
+        # expansion instead.
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", Sequence(
+            "alpha", AlternativeSet(Dictation(), "alpha", "charlie")
+        ))
+        grammar.add_rule(r1)
+        self.assertEqual(len(grammar.find_matching_rules("alpha alpha")), 1)
+        alt_set = r1.expansion.children[1]
+        self.assertEqual(alt_set.current_match, "alpha")
+        self.assertIsNone(alt_set.children[0].current_match)
+        self.assertEqual(alt_set.children[1].current_match, "alpha")
+        self.assertEqual(alt_set.children[1].matching_slice, slice(6, 11))
+
+    def test_unmatched_optional_slices(self):
+        # Optional expansions that matched nothing have no slices, or empty
+        # slices if their match data was copied.
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", Sequence(
+            "hi", OptionalGrouping(Sequence("please", Dictation())), "end"
+        ))
+        grammar.add_rule(r1)
+        self.assertEqual(len(grammar.find_matching_rules("hi end")), 1)
+        opt = r1.expansion.children[1]
+        self.assertEqual(opt.current_match, "")
+        self.assertIsNone(opt.matching_slice)
+        self.assertEqual(r1.expansion.children[2].matching_slice, slice(3, 6))
+
+        r2 = PublicRule("test2", Sequence(
+            "hello", OptionalGrouping("there"), "world", Dictation()
+        ))
+        grammar.add_rule(r2)
+        grammar.find_matching_rules("hello world")
+        grammar.find_matching_rules("lorem ipsum dolor sit amet")
+        opt = r2.expansion.children[1]
+        self.assertEqual(opt.current_match, "")
+        self.assertIn(opt.matching_slice, [None, slice(6, 6)])
+        self.assertEqual(r2.expansion.current_match,
+                         "hello world lorem ipsum dolor sit amet")
+
+    def test_worked_out_matches_use_text(self):
+        # The current_match values of expansions without a counterpart in the
+        # generated rules are the matched text in their slices.
+        grammar = DictationGrammar()
+        r1 = PublicRule("test", Sequence(
+            "alpha", Dictation(), Repeat(Sequence("charlie", Dictation()))
+        ))
+        grammar.add_rule(r1)
+        for speech in ["alpha", "bravo", "charlie charlie", "delta"]:
+            grammar.find_matching_rules(speech)
+        text = "alpha bravo charlie charlie delta"
+        for e in flat_map_expansion(r1.expansion):
+            if e.matching_slice is not None:
+                self.assertEqual(e.current_match, text[e.matching_slice])
+        self.assertEqual(r1.expansion.current_match, text)
+
+
+class DictationGrammarSessions(unittest.TestCase):
+    """
+    Test using SequenceRuleSession objects with DictationGrammar.
+    """
+    def setUp(self):
+        self.rule = PublicRule("test", Sequence("hello", Dictation(), "end"))
+        self.grammar = DictationGrammar([self.rule])
+        self.expected_compile = self.grammar.compile()
+
+    def assert_names(self, matching, names):
+        self.assertListEqual([r.name for r in matching], names)
+
+    def test_interleaved_sessions(self):
+        g = self.grammar
+        s1, s2 = SequenceRuleSession(), SequenceRuleSession()
+
+        self.assert_names(g.find_matching_rules("hello", session=s1), ["test"])
+        self.assert_names(g.find_matching_rules("world", session=s2), [])
+        self.assert_names(g.find_matching_rules("hello", session=s2), ["test"])
+
+        # Each session is now at the Dictation part of the rule.
+        self.assert_names(g.find_matching_rules("lorem ipsum", session=s1),
+                          ["test"])
+        self.assert_names(g.find_matching_rules("dolor", session=s2), ["test"])
+        self.assert_names(g.find_matching_rules("end", session=s2), ["test"])
+        self.assertEqual(s2.get_expansion(self.rule).current_match,
+                         "hello dolor end")
+
+        self.assert_names(g.find_matching_rules("end", session=s1), ["test"])
+        e1 = s1.get_expansion(self.rule)
+        self.assertEqual(e1.current_match, "hello lorem ipsum end")
+        self.assertEqual(e1.children[1].current_match, "lorem ipsum")
+        self.assertEqual(e1.children[1].matching_slice, slice(6, 17))
+        self.assertEqual(s2.get_expansion(self.rule).current_match,
+                         "hello dolor end")
+
+        seq_rule = g.match_rules[0]
+        self.assertEqual(seq_rule.get_entire_match(s1), "hello lorem ipsum end")
+        self.assertEqual(seq_rule.get_entire_match(s2), "hello dolor end")
+        self.assertEqual(s1.get_expansion(seq_rule).current_match,
+                         "hello lorem ipsum end")
+
+        # The shared rules are not changed by session matching.
+        for e in [self.rule.expansion, seq_rule.expansion,
+                  seq_rule.original_expansion] + list(
+                      seq_rule.expansion_sequence):
+            for x in flat_map_expansion(e):
+                self.assertIsNone(x.current_match)
+
+    def test_jsgf_only_rules(self):
+        rule = PublicRule("greet", Sequence("hi", AlternativeSet("a", "b")))
+        g = DictationGrammar([rule])
+        s1, s2 = SequenceRuleSession(), SequenceRuleSession()
+        self.assert_names(g.find_matching_rules("hi a", session=s1), ["greet"])
+        self.assert_names(g.find_matching_rules("hi b", session=s2), ["greet"])
+        self.assertEqual(s1.get_expansion(rule).current_match, "hi a")
+        self.assertEqual(s2.get_expansion(rule).children[1].current_match, "b")
+        self.assertIsNone(rule.expansion.current_match)
+
+        # Copies are made again after the rule changes.
+        rule.expansion.children[1].children.append("c")
+        self.assert_names(g.find_matching_rules("hi c", session=s1), ["greet"])
+        self.assertEqual(s1.get_expansion(rule).current_match, "hi c")
+
+    def test_threads(self):
+        # Sessions can be used in many threads at the same time.
+        g = self.grammar
+        seq_rule = g.match_rules[0]
+        errors = []
+
+        def run(i):
+            try:
+                for j in range(20):
+                    session = SequenceRuleSession()
+                    words = "word%d number%d" % (i, j)
+                    for speech in ["hello", words, "end"]:
+                        self.assert_names(
+                            g.find_matching_rules(speech, session=session),
+                            ["test"]
+                        )
+                    expected = "hello %s end" % words
+                    self.assertEqual(seq_rule.get_entire_match(session),
+                                     expected)
+                    expansion = session.get_expansion(self.rule)
+                    self.assertEqual(expansion.current_match, expected)
+                    self.assertEqual(expansion.children[1].current_match,
+                                     words)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertIsNone(self.rule.expansion.current_match)
+
+    def test_grammar_not_changed(self):
+        g = self.grammar
+        session = SequenceRuleSession()
+        g.find_matching_rules("hello", session=session)
+        g.find_matching_rules("world", session=session)
+
+        # The grammar and its rules are unaffected by session matching.
+        self.assertEqual(g.compile(), self.expected_compile)
+        seq_rule = g.match_rules[0]
+        self.assertFalse(seq_rule.refuse_matches)
+        self.assertEqual(seq_rule.get_current_expansion(),
+                         Sequence("hello"))
+        self.assertEqual(seq_rule.get_current_expansion(session),
+                         Sequence("end"))
+        self.assert_names(g.find_matching_rules("hello"), ["test"])
+
+    def test_matching_without_session_not_changed(self):
+        g = self.grammar
+        session = SequenceRuleSession()
+        for speech in ["hello", "my name", "end"]:
+            self.assert_names(g.find_matching_rules(speech, session=session),
+                              ["test"])
+
+        # Session match data doesn't leak into matching without a session.
+        seq_rule = g.match_rules[0]
+        self.assert_names(g.find_matching_rules("hello"), ["test"])
+        self.assertIsNone(self.rule.expansion.current_match)
+        self.assertIsNone(seq_rule.entire_match)
+        self.assertEqual(seq_rule.get_entire_match(session), "hello my name end")
+
+    def test_current_is_dictation_only(self):
+        g = self.grammar
+        session = SequenceRuleSession()
+        seq_rule = g.match_rules[0]
+        g.find_matching_rules("hello", session=session)
+        self.assertTrue(seq_rule.current_is_dictation_only_in(session))
+        self.assertFalse(seq_rule.current_is_dictation_only)
+        self.assertFalse(seq_rule.current_is_dictation_only_in(None))
+
+    def test_no_advance(self):
+        g = self.grammar
+        session = SequenceRuleSession()
+        self.assert_names(
+            g.find_matching_rules("hello", False, session=session), ["test"]
+        )
+
+        # Matches are refused until the sequence is advanced or restarted.
+        self.assert_names(g.find_matching_rules("hello", session=session), [])
+        seq_rule = g.match_rules[0]
+        seq_rule.set_next(session)
+        self.assert_names(g.find_matching_rules("world", session=session),
+                          ["test"])
+
+    def test_reset(self):
+        g = self.grammar
+        session = SequenceRuleSession()
+        g.find_matching_rules("hello", session=session)
+        g.reset_sequence_rules(session)
+        self.assert_names(g.find_matching_rules("world", session=session), [])
+        self.assert_names(g.find_matching_rules("hello", session=session),
+                          ["test"])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -179,6 +179,16 @@ class SequenceRuleGraftMatchMethods(unittest.TestCase):
         self.assertEqual(r1.expansion.children[0].current_match, "hello")
         self.assertEqual(r1.expansion.children[1].current_match, "there")
 
+    def test_same_words(self):
+        r1 = PublicRule("test", Seq(Rep(Dict()), Seq(Dict())))
+        r2 = generate_rule(r1.expansion)
+        r2.matches("hello")
+        r2.set_next()
+        r2.matches("hello")
+        self.assertEqual(r1.expansion.current_match, "hello hello")
+        self.assertEqual(r1.expansion.children[0].current_match, "hello")
+        self.assertEqual(r1.expansion.children[1].current_match, "hello")
+
     def test_complex(self):
         r1 = PublicRule("test", Seq(
             "test with", AS("lots of", "many"), Dict(), "and JSGF",
@@ -0,0 +1,128 @@
+import pickle
+import unittest
+
+from jsgf import *
+from jsgf.ext import Dictation
+
+
+class FrozenGrammarCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0 UTF-8 en;
+            grammar test;
+            import <com.example.*>;
+            public <greet> = (/1/ hello {hi} | /2/ hi | /0/ hey) [there] <name>+;
+            <name> = alice | bob {b};
+            public <count> = (one | two)* done;
+            <special> = <NULL> | <VOID>;
+        """)
+        self.grammar.add_rule(PublicRule("note", Sequence(
+            "note", Dictation(), "end"
+        )))
+        self.frozen = self.grammar.freeze()
+
+    def test_compile(self):
+        self.assertEqual(self.frozen.compile(), self.grammar.compile())
+        self.assertEqual(
+            self.frozen.get_rule_from_name("name").compile(ignore_tags=True),
+            "<name> = (alice|bob);"
+        )
+
+    def test_compile_disabled_rule(self):
+        self.grammar.disable_rule("count")
+        self.assertEqual(self.grammar.freeze().compile(), self.grammar.compile())
+
+    def test_arrays(self):
+        f = self.frozen
+        root = f.get_rule_from_name("name").root
+        self.assertEqual(f.kinds[root], NodeKind.AlternativeSet)
+        self.assertEqual(f.parents[root], -1)
+        self.assertEqual([f.text(i) for i in f.children(root)], ["alice", "bob"])
+        self.assertEqual([f.tag(i) for i in f.children(root)], ["", "b"])
+        for i in f.children(root):
+            self.assertEqual(f.parents[i], root)
+
+        # Strings are stored once.
+        self.assertEqual(len(f.strings), len(set(f.strings)))
+
+    def test_find_matching_rules(self):
+        def names(speech):
+            return [r.name for r in self.frozen.find_matching_rules(speech)]
+
+        for speech in ["hello alice", "hi there bob alice", "one two one done",
+                       "done", "note buy some milk end", "hey alice", "nope"]:
+            self.assertEqual(
+                names(speech),
+                [r.name for r in self.grammar.find_matching_rules(speech)]
+            )
+        self.assertEqual(names("Hello Bob"), ["greet"])
+        self.assertEqual(names("hey alice"), [])
+
+    def test_same_matches_as_rules(self):
+        # Frozen rules match speech the same way as Rule.matches, including for
+        # rules with optional root expansions and literals without whitespace
+        # between them.
+        grammar = parse_grammar_string("""
+            #JSGF V1.0;
+            grammar test;
+            public <r0> = (c d)*;
+            public <r1> = [a] b;
+            public <r2> = (a)+;
+            public <r3> = hello world;
+        """)
+        frozen = grammar.freeze()
+        for speech in ["", "d", "c d", "a b", "b", "a a", "aab", "helloworld",
+                       "hello"]:
+            self.assertEqual(
+                [r.name for r in frozen.find_matching_rules(speech)],
+                [r.name for r in grammar.find_matching_rules(speech)]
+            )
+        self.assertEqual([r.name for r in frozen.find_matching_rules("d")],
+                         ["r0"])
+
+    def test_tags(self):
+        greet = self.frozen.get_rule_from_name("greet")
+        self.assertEqual(greet.tags, ["hi", "b"])
+        self.assertTrue(greet.has_tag("b"))
+        self.assertFalse(greet.has_tag(" "))
+        self.assertEqual(self.frozen.find_tagged_rules("b"), [greet])
+        self.assertEqual(
+            [r.name for r in self.frozen.find_tagged_rules("b", True)],
+            ["greet", "name"]
+        )
+
+    def test_pickle(self):
+        f = pickle.loads(pickle.dumps(self.frozen))
+        self.assertEqual(f.compile(), self.grammar.compile())
+        self.assertEqual([r.name for r in f.find_matching_rules("hi bob")],
+                         ["greet"])
+
+    def test_thaw(self):
+        g = self.frozen.thaw()
+        self.assertIsInstance(g, Grammar)
+        self.assertEqual(g.compile(), self.grammar.compile())
+        self.assertEqual(g.rules, self.grammar.rules)
+        self.assertEqual(g.get_rule_from_name("greet").get_tags_matching(
+            "hello alice"), ["hi"])
+
+        # Thawed grammars are independent of the snapshot.
+        g.remove_rule("count")
+        self.assertIn("count", self.frozen.rule_names)
+
+    def test_thaw_rule_refs(self):
+        n = HiddenRule("n", AlternativeSet("one", "two"))
+        grammar = Grammar()
+        grammar.add_rules(n, PublicRule("r", Sequence("go", RuleRef(n))))
+        g = grammar.freeze().thaw()
+        ref = g.get_rule_from_name("r").expansion.children[1]
+        self.assertIsInstance(ref, RuleRef)
+        self.assertIs(ref.referenced_rule, g.get_rule_from_name("n"))
+
+    def test_unknown_reference(self):
+        grammar = Grammar()
+        grammar.add_rule(PublicRule("r", NamedRuleRef("missing")))
+        self.assertRaises(GrammarError, grammar.freeze().find_matching_rules, "a")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,11 @@
 
 import copy
 import tempfile
+import threading
 import unittest
 
+import pyparsing
+
 from jsgf import *
 from jsgf.ext import Dictation
 
@@ -370,6 +373,103 @@ class VisibleRulesCase(unittest.TestCase):
         self.assertListEqual(self.grammar2.visible_rules, [self.rule4, self.rule5])
 
 
+class MatchingOptionsCase(unittest.TestCase):
+    def setUp(self):
+        self.grammar = parse_grammar_string("""
+            #JSGF V1.0;
+            grammar test;
+            <digit> = one | two | three;
+            <number> = <digit>+;
+            public <move> = move (up | down) <number>;
+            public <scroll> = scroll (up | down) <number>;
+            public <repeat> = <number> times;
+        """)
+
+    def assert_matches(self, speech, names):
+        rules = self.grammar.find_matching_rules(speech)
+        self.assertEqual([r.name for r in rules], names)
+        return rules
+
+    def test_memoize_references(self):
+        self.grammar.memoize_references = True
+        self.assert_matches("scroll down one three", ["scroll"])
+        rules = self.assert_matches("one three times", ["repeat"])
+        number = rules[0].expansion.children[0]
+        self.assertEqual(number.current_match, "one three")
+        digits = number.referenced_rule.expansion
+        self.assertEqual(digits.repetitions_matched, 2)
+        self.assertEqual(digits.get_expansion_matches(digits.child),
+                         ["one", "three"])
+
+    def test_memoize_changed_references(self):
+        # Match data is restored for the current expansions of referenced rules.
+        self.grammar.memoize_references = True
+        self.grammar.add_rule(PublicRule("please", Sequence(
+            NamedRuleRef("number"), "please"
+        )))
+        self.assert_matches("two times", ["repeat"])
+        digit = self.grammar.get_rule_from_name("digit")
+        digit.expansion.children.append("four")
+        self.assert_matches("two four please", ["please"])
+        self.assertEqual(digit.expansion.children[3].current_match, "four")
+
+    def test_rule_match_memo(self):
+        rules = self.grammar.match_rules
+        with RuleMatchMemo() as memo:
+            self.assertEqual([r.matches("two three times") for r in rules],
+                             [False, False, True])
+            self.assertEqual(memo.hits, 0)
+            self.assertTrue(rules[2].matches("two three times"))
+            self.assertEqual(memo.hits, 1)
+            self.assertEqual(rules[2].expansion.children[0].current_match,
+                             "two three")
+
+            # Results are cleared for different speech.
+            self.assertFalse(rules[2].matches("two times three"))
+            self.assertEqual(memo.hits, 1)
+
+    def test_memo_thread_local(self):
+        results = []
+
+        def match():
+            rule = self.grammar.get_rule_from_name("move")
+            results.append(rule.matches("move up two"))
+
+        # Memos are not used by other threads.
+        with RuleMatchMemo() as memo:
+            thread = threading.Thread(target=match)
+            thread.start()
+            thread.join()
+            self.assertEqual(results, [True])
+            self.assertEqual(memo.hits + memo.misses, 0)
+
+    def test_enable_packrat(self):
+        element_class = pyparsing.ParserElement
+        if element_class._packratEnabled:
+            self.skipTest("packrat caching is already enabled")
+
+        self.addCleanup(disable_packrat)
+        enable_packrat()
+        self.assertTrue(element_class._packratEnabled)
+        self.assert_matches("move up two", ["move"])
+        rules = self.assert_matches("two three times", ["repeat"])
+        self.assertEqual(rules[0].expansion.current_match, "two three times")
+
+        # Matching the same speech again still sets match data.
+        rules = self.assert_matches("two three times", ["repeat"])
+        self.assertEqual(rules[0].expansion.current_match, "two three times")
+
+        disable_packrat()
+        self.assertFalse(element_class._packratEnabled)
+        self.assertEqual(element_class.packrat_cache_stats, [0, 0])
+        rules = self.assert_matches("two three times", ["repeat"])
+        self.assertEqual(rules[0].expansion.current_match, "two three times")
+
+        # Disabling packrat caching again has no effect.
+        disable_packrat()
+        self.assertFalse(element_class._packratEnabled)
+
+
 class RootGrammarCase(unittest.TestCase):
     def setUp(self):
         self.grammar = RootGrammar(name="root")
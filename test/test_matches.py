@@ -1,7 +1,12 @@
+import threading
 import unittest
 
+import pyparsing
+
 from jsgf import *
-from jsgf.expansions import matches_overlap
+from jsgf.expansions import matches_overlap, _FirstCharDispatch, _LiteralTrie, \
+    _repetition_state
+from jsgf.ext import Dictation
 
 
 class MatchesOverlap(unittest.TestCase):
@@ -549,6 +554,17 @@ class MatchesCase(unittest.TestCase):
         self.assertEqual(e2.child.child.current_match, "a")
         self.assertEqual(e2.current_match, "a a")
 
+    def test_alt_set_repeats_in_repeat(self):
+        # Alternatives in nested repeats should not be matched in sequence.
+        for alt_set in [AlternativeSet("a", "b"),
+                        AlternativeSet("a", Sequence("b"))]:
+            e = Repeat(Repeat(alt_set))
+            r = PublicRule("test", e)
+            self.assertTrue(r.matches("b"))
+            self.assertTrue(r.matches("a b a"))
+            self.assertEqual(e.current_match, "a b a")
+            self.assertEqual(e.repetitions_matched, 3)
+
     def test_multiple_repeats(self):
         e1 = Sequence(Repeat("a"), "b", Repeat("c"), "d")
         r1 = PublicRule("test", e1)
@@ -731,6 +747,289 @@ class MatchesCase(unittest.TestCase):
         self.assertListEqual(g.find_matching_rules("do this thrice"), [r1, r2])
         self.assertListEqual(g.find_matching_rules("do this four times"), [r1, r2])
 
+    def test_nullable_rules(self):
+        # Rules whose expansion is an optional grouping, a Kleene star or
+        # <NULL> match any speech. Other rules that can match empty speech
+        # don't match empty speech. The other matching backends only match
+        # speech that the whole expansion matches.
+        opt = PublicRule("opt", OptionalGrouping("a"))
+        seq = PublicRule("seq", Sequence(OptionalGrouping("a"),
+                                         OptionalGrouping("b")))
+        null = PublicRule("null", NullRef())
+        g = Grammar()
+        g.add_rules(opt, seq, null)
+        self.assertListEqual(g.find_matching_rules(""), [opt, null])
+        self.assertListEqual(g.find_matching_rules("a"), [opt, seq, null])
+        self.assertListEqual(g.find_matching_rules("b"), [opt, seq, null])
+        self.assertListEqual(g.find_matching_rules("c"), [opt, null])
+        for speech in ["", "a", "b", "c"]:
+            self.assertListEqual([r for r in g.rules if r.matches(speech)],
+                                 g.find_matching_rules(speech))
+
+
+class AlternativeElementCase(unittest.TestCase):
+    """
+    Test the parser elements chosen for alternative sets.
+    """
+    def assertDispatched(self, e, dispatched):
+        element = e.matcher_element
+        if dispatched:
+            self.assertIsInstance(element, _FirstCharDispatch)
+        else:
+            self.assertIsInstance(element, pyparsing.Or)
+
+    def test_disjoint_alternatives(self):
+        e = AlternativeSet("up", "down", "left", "lift", Sequence("right", "now"),
+                           Repeat("again"), VoidRef())
+        self.assertDispatched(e, True)
+        r = PublicRule("test", Sequence(e, OptionalGrouping("please")))
+        for speech in ["up", "down please", "lift", "right now", "again again"]:
+            self.assertTrue(r.matches(speech))
+        self.assertEqual(e.current_match, "again again")
+        self.assertFalse(r.matches("right"))
+        self.assertFalse(r.matches("north"))
+        self.assertFalse(r.matches(""))
+
+    def test_overlapping_alternatives(self):
+        # The longest match is required for literals that are prefixes of other
+        # literals, alternatives that can match nothing and alternatives that
+        # start with the same characters that aren't literals.
+        for e, speech in [(AlternativeSet("up", "upper", Sequence("down")),
+                           "upper"),
+                          (AlternativeSet("go", "go left", Sequence("down")),
+                           "go left"),
+                          (AlternativeSet(OptionalGrouping("a"), "b"), "b"),
+                          (AlternativeSet(Sequence("go", "left"), "gone"), "gone"),
+                          (AlternativeSet(Dictation(), "b"), "b")]:
+            self.assertDispatched(e, False)
+            self.assertTrue(PublicRule("test", e).matches(speech))
+
+    def test_nested_alternatives(self):
+        inner = AlternativeSet("one", "four")
+        e = AlternativeSet(inner, Sequence(KleeneStar("very"), "three"))
+        self.assertDispatched(e, True)
+        r = PublicRule("test", e)
+        self.assertTrue(r.matches("four"))
+        self.assertTrue(r.matches("three"))
+        self.assertTrue(r.matches("very very three"))
+
+        # Both alternatives can start with 't' now.
+        inner.children.append("two")
+        self.assertDispatched(e, False)
+        self.assertTrue(r.matches("two"))
+
+    def test_referenced_alternatives(self):
+        n = Rule("n", False, AlternativeSet("once", "twice"))
+        e = AlternativeSet(NamedRuleRef("n"), "never")
+        r = PublicRule("test", e)
+        g = Grammar()
+        g.add_rules(n, r)
+        self.assertDispatched(e, True)
+        self.assertEqual(g.find_matching_rules("twice"), [r])
+
+        # References are invalidated when referenced rules change.
+        n.expansion.children.append("ne'er")
+        self.assertDispatched(e, False)
+        self.assertEqual(g.find_matching_rules("ne'er"), [r])
+        self.assertEqual(g.find_matching_rules("never"), [r])
+
+
+class LiteralTrieCase(unittest.TestCase):
+    """
+    Test matching alternative sets of literals using tries.
+    """
+    def test_longest_match(self):
+        e = AlternativeSet("up", "upper", "upper case", "down")
+        self.assertIsInstance(e.matcher_element, _LiteralTrie)
+        r = PublicRule("test", Sequence(e, OptionalGrouping("case")))
+        self.assertTrue(r.matches("upper case"))
+        self.assertEqual(e.current_match, "upper case")
+        self.assertEqual(e.children[2].current_match, "upper case")
+        self.assertEqual(e.children[2].matching_slice, slice(0, 10))
+        self.assertEqual(e.children[1].current_match, None)
+        self.assertTrue(r.matches("up case"))
+        self.assertEqual(e.children[0].matching_slice, slice(0, 2))
+        self.assertEqual(e.children[2].current_match, None)
+        self.assertFalse(r.matches("upp"))
+        self.assertFalse(r.matches("sideways"))
+        self.assertFalse(r.matches(""))
+
+    def test_tags(self):
+        a, b = Literal("alpha"), Literal("bravo")
+        a.tag, b.tag = "a", "b"
+        r = PublicRule("test", Repeat(AlternativeSet(a, b, "charlie")))
+        self.assertTrue(r.matches("bravo alpha bravo"))
+        self.assertEqual(r.matched_tags, ["a", "b"])
+        self.assertEqual(r.expansion.get_expansion_matches(b),
+                         ["bravo", None, "bravo"])
+
+    def test_weights(self):
+        # Alternatives with weights of 0 cannot be matched.
+        one, two, three = Literal("one"), Literal("two"), Literal("three")
+        e = AlternativeSet(one, two, three)
+        e.weights = {one: 1, two: 0, three: 2}
+        self.assertIsInstance(e.matcher_element, _LiteralTrie)
+        r = PublicRule("test", e)
+        self.assertTrue(r.matches("three"))
+        self.assertEqual(three.current_match, "three")
+        self.assertFalse(r.matches("two"))
+
+    def test_invalidation(self):
+        e = AlternativeSet("red", "green", "blue")
+        r = PublicRule("test", e)
+        self.assertTrue(r.matches("green"))
+
+        # Changing literal text requires invalidating the literal's matcher.
+        e.children[1].text = "yellow"
+        e.children[1].invalidate_matcher()
+        self.assertTrue(r.matches("yellow"))
+        self.assertFalse(r.matches("green"))
+
+        e.children.append(Sequence("light", "green"))
+        self.assertNotIsInstance(e.matcher_element, _LiteralTrie)
+        self.assertTrue(r.matches("light green"))
+
+    def test_many_literals(self):
+        words = ["song number %d" % i for i in range(5000)]
+        r = PublicRule("test", Sequence("play", AlternativeSet(*words)))
+        self.assertTrue(r.matches("play song number 4999"))
+        self.assertEqual(r.expansion.children[1].current_match, "song number 4999")
+        self.assertTrue(r.matches("play song number 49"))
+        self.assertFalse(r.matches("play song number"))
+
+
+class MatchSpanCase(unittest.TestCase):
+    """
+    Test that match data is set from recorded spans of speech when it is used.
+    """
+    def test_lazy_match_data(self):
+        hello, world = Literal("hello"), Literal("world")
+        r = PublicRule("test", Sequence(hello, world))
+        self.assertTrue(r.matches("hello world"))
+
+        # Only spans are recorded until match data is used.
+        self.assertEqual(world._match_span, ("hello world", 6, 11))
+        self.assertEqual(world.current_match, "world")
+        self.assertIsNone(world._match_span)
+        self.assertEqual(world.matching_slice, slice(6, 11))
+
+        # Setting one value keeps the other value from the span.
+        self.assertTrue(r.matches("hello world"))
+        hello.current_match = "hi"
+        self.assertEqual(hello.matching_slice, slice(0, 5))
+        world.matching_slice = slice(0, 0)
+        self.assertEqual(world.current_match, "world")
+
+        # Resetting match data discards spans.
+        self.assertTrue(r.matches("hello world"))
+        r.expansion.reset_for_new_match()
+        self.assertIsNone(hello.current_match)
+        self.assertIsNone(hello.matching_slice)
+
+    def test_skipped_whitespace(self):
+        inner = Sequence("a", OptionalGrouping("b"))
+        alt_set = AlternativeSet(Sequence("c"), Sequence("d"))
+        r = PublicRule("test", Sequence(inner, alt_set))
+        self.assertTrue(r.matches("a d"))
+        self.assertEqual(inner.current_match, "a")
+        self.assertEqual(inner.matching_slice, slice(0, 1))
+        self.assertEqual(alt_set.current_match, "d")
+        self.assertEqual(alt_set.matching_slice, slice(2, 3))
+        self.assertEqual(inner.children[1].current_match, "")
+
+    def test_memoized_references(self):
+        ref = Rule("ref", False, Sequence("a", OptionalGrouping("b")))
+        r1 = PublicRule("r1", Sequence(RuleRef(ref), "c"))
+        r2 = PublicRule("r2", Sequence(RuleRef(ref), "d"))
+        g = Grammar()
+        g.add_rules(ref, r1, r2)
+        g.memoize_references = True
+        self.assertEqual(g.find_matching_rules("a b d"), [r2])
+        self.assertEqual(ref.expansion.current_match, "a b")
+        self.assertEqual(ref.expansion.children[1].matching_slice, slice(2, 3))
+
+
+class RepetitionDataCase(unittest.TestCase):
+    """
+    Test the match data recorded for each repetition of Repeat expansions.
+    """
+    def test_only_matched_expansions_recorded(self):
+        one, two, three = Literal("one"), Literal("two"), Literal("three")
+        child = AlternativeSet(Sequence(one, OptionalGrouping(two)), three)
+        e = Repeat(child)
+        r = PublicRule("test", e)
+        self.assertTrue(r.matches("one two three one"))
+        self.assertEqual(e.repetitions_matched, 3)
+        self.assertEqual(e.get_expansion_matches(one), ["one", None, "one"])
+        self.assertEqual(e.get_expansion_matches(two), ["two", "", ""])
+        self.assertEqual(e.get_expansion_slices(three),
+                         [None, slice(8, 13), None])
+        for repetition in e._repetitions_matched:
+            self.assertTrue(len(repetition) <= 5)
+
+        # Descendants have the last repetition's match data.
+        self.assertEqual(one.current_match, "one")
+        self.assertEqual(one.matching_slice, slice(14, 17))
+        self.assertEqual(two.current_match, "")
+        self.assertIsNone(three.current_match)
+
+    def test_equal_expansions(self):
+        # Equal expansions have separate match data.
+        b1, b2 = Literal("b"), Literal("b")
+        e = KleeneStar(AlternativeSet(Sequence("a", b1), Sequence("c", b2)))
+        r = PublicRule("test", e)
+        self.assertTrue(r.matches("a b c b"))
+        self.assertEqual(e.get_expansion_matches(b1), ["b", ""])
+        self.assertEqual(e.get_expansion_matches(b2), ["", "b"])
+        self.assertEqual(b1.current_match, "")
+        self.assertEqual(b2.current_match, "b")
+
+    def test_nested_repeats(self):
+        digit = AlternativeSet("one", "two", "three")
+        inner = Repeat(digit)
+        outer = Repeat(Sequence(inner, "stop"))
+        r = PublicRule("test", outer)
+        self.assertTrue(r.matches("one two stop three stop"))
+        self.assertEqual(outer.get_expansion_matches(inner),
+                         ["one two", "three"])
+        self.assertEqual(outer.get_expansion_matches(digit), ["two", "three"])
+        self.assertEqual(inner.get_expansion_matches(digit), ["three"])
+
+    def test_memoized_references(self):
+        digit = Rule("digit", False, AlternativeSet("one", "two", "three"))
+        number = PublicRule("number", Repeat(RuleRef(digit)))
+        other = PublicRule("other", Sequence(RuleRef(digit), "other"))
+        g = Grammar()
+        g.add_rules(digit, other, number)
+        g.memoize_references = True
+        self.assertEqual(g.find_matching_rules("one two one"), [number])
+        self.assertEqual(
+            number.expansion.get_expansion_matches(digit.expansion),
+            ["one", "two", "one"]
+        )
+
+    def test_other_threads(self):
+        e = Repeat(AlternativeSet("one", "two"))
+        r = PublicRule("test", e)
+        results = []
+
+        def match():
+            results.append(r.matches("one two"))
+
+        # Matches in other threads don't use this thread's repetition log, even
+        # while a repetition is being matched.
+        _repetition_state.depth += 1
+        try:
+            thread = threading.Thread(target=match)
+            thread.start()
+            thread.join()
+            self.assertEqual(_repetition_state.log, [])
+        finally:
+            _repetition_state.depth -= 1
+
+        self.assertEqual(results, [True])
+        self.assertEqual(e.get_expansion_matches(e.child), ["one", "two"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from jsgf import *
+from jsgf.ext import DictationGrammar, Dictation
+from jsgf.utterances import make_utterance
+
+
+class UtteranceCase(unittest.TestCase):
+    def test_string(self):
+        utterance = Utterance("  Hello  World ")
+        self.assertEqual(utterance.text, "hello  world")
+        self.assertEqual(str(utterance), "hello  world")
+        self.assertEqual(utterance.words, ("hello", "world"))
+        self.assertEqual(utterance.spans, ((0, 5), (7, 12)))
+        self.assertEqual(len(utterance), 2)
+
+    def test_words(self):
+        utterance = Utterance(["Hello", "big world"])
+        self.assertEqual(utterance.text, "hello big world")
+        self.assertEqual(utterance.words, ("hello", "big", "world"))
+        self.assertEqual(utterance, Utterance("hello big world"))
+        self.assertEqual(Utterance([]).words, ())
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, Utterance, 5)
+        self.assertRaises(TypeError, Utterance, ["hello", 5])
+
+    def test_word_index(self):
+        utterance = Utterance("ab  cd e")
+        self.assertEqual([utterance.word_index(i) for i in range(9)],
+                         [0, 0, 1, 1, 1, 1, 2, 2, 3])
+
+    def test_make_utterance(self):
+        utterance = Utterance("hello")
+        self.assertIs(make_utterance(utterance), utterance)
+        self.assertEqual(make_utterance("hello"), utterance)
+
+
+class UtteranceMatchingCase(unittest.TestCase):
+    def setUp(self):
+        self.greet = PublicRule("greet", Sequence(
+            "hello", AlternativeSet("world", "there")
+        ))
+        self.stop = PublicRule("stop", "stop")
+        self.grammar = Grammar()
+        self.grammar.add_rules(self.greet, self.stop)
+
+    def test_rule_matches(self):
+        for speech in ("Hello World", ["hello", "world"],
+                       Utterance("hello world")):
+            self.assertTrue(self.greet.matches(speech))
+            self.assertEqual(self.greet.expansion.current_match, "hello world")
+        self.assertFalse(self.greet.matches(["hello"]))
+        self.assertEqual(self.greet.find_matching_part(["say", "hello", "there"]),
+                         "hello there")
+
+    def test_find_matching_rules(self):
+        for backend in (MatchBackend.Pyparsing, MatchBackend.Chart,
+                        MatchBackend.Weighted):
+            self.grammar.matching_backend = backend
+            self.assertEqual(
+                self.grammar.find_matching_rules(["hello", "there"]), [self.greet]
+            )
+            self.assertEqual(
+                self.grammar.find_matching_rules(Utterance(" STOP")), [self.stop]
+            )
+
+    def test_matching_slices(self):
+        utterance = Utterance("Hello there")
+        self.assertTrue(self.greet.matches(utterance))
+        alt_set = self.greet.expansion.children[1]
+        self.assertEqual(utterance.text[alt_set.matching_slice], "there")
+        self.assertEqual(utterance.word_index(alt_set.matching_slice.start), 1)
+
+    def test_frozen_grammar(self):
+        frozen = self.grammar.freeze()
+        self.assertEqual(frozen.find_matching_rules(["STOP"]),
+                         [frozen.get_rule_from_name("stop")])
+
+    def test_dictation_grammar(self):
+        rule = PublicRule("note", Dictation())
+        grammar = DictationGrammar([rule, self.stop])
+        self.assertEqual(len(grammar.find_matching_rules(
+            Utterance("Buy milk"))), 1)
+        self.assertEqual(rule.expansion.current_match, "buy milk")
+        self.assertEqual(grammar.find_matching_rules(["STOP"]), [self.stop])
@@ -0,0 +1,176 @@
+import unittest
+
+from jsgf import *
+from jsgf.ext import Dictation
+
+
+class RuleVocabularyCase(unittest.TestCase):
+    def setUp(self):
+        self.number = HiddenRule("number", AlternativeSet("one", "two"))
+        self.rule = PublicRule("count", Sequence(
+            "Count to", NamedRuleRef("number"), OptionalGrouping("please")
+        ))
+        self.grammar = Grammar()
+        self.grammar.add_rules(self.number, self.rule)
+
+    def test_vocabulary(self):
+        self.assertEqual(self.rule.vocabulary,
+                         frozenset(["count", "to", "one", "two", "please"]))
+        self.assertEqual(self.number.vocabulary, frozenset(["one", "two"]))
+        self.assertFalse(self.rule.has_open_vocabulary)
+
+    def test_special_references(self):
+        rule = PublicRule("r", Sequence("a", NullRef(), VoidRef()))
+        self.assertEqual(rule.vocabulary, frozenset(["a"]))
+        self.assertFalse(rule.has_open_vocabulary)
+
+    def test_open_vocabulary(self):
+        say = PublicRule("say", Sequence("say", Dictation()))
+        self.assertEqual(say.vocabulary, frozenset(["say"]))
+        self.assertTrue(say.has_open_vocabulary)
+        call = PublicRule("call", Sequence("call", WordList(["alice"], "name")))
+        self.assertTrue(call.has_open_vocabulary)
+
+        # Rules referencing rules with open vocabularies have them too.
+        self.grammar.add_rule(say)
+        self.number.expansion.children.append(RuleRef(say))
+        self.assertTrue(self.rule.has_open_vocabulary)
+        self.assertIn("say", self.rule.vocabulary)
+
+    def test_missing_reference(self):
+        rule = PublicRule("r", Sequence("a", NamedRuleRef("missing")))
+        self.assertTrue(rule.has_open_vocabulary)
+
+    def test_references_looked_up_once(self):
+        self.assertIn("two", self.rule.vocabulary)
+        cache = self.rule._vocabulary_cache
+        self.assertIn("two", self.rule.vocabulary)
+        self.assertIs(self.rule._vocabulary_cache, cache)
+
+    def test_rule_changes(self):
+        rule = PublicRule("r", Sequence("a", NamedRuleRef("b")))
+        self.grammar.add_rule(rule)
+        self.assertTrue(rule.has_open_vocabulary)
+
+        # Adding, renaming and removing referenced rules updates vocabularies.
+        b = HiddenRule("b", "bee")
+        self.grammar.add_rule(b)
+        self.assertEqual(rule.vocabulary, frozenset(["a", "bee"]))
+        self.assertFalse(rule.has_open_vocabulary)
+        b.name = "c"
+        self.assertTrue(rule.has_open_vocabulary)
+        b.name = "b"
+        self.assertFalse(rule.has_open_vocabulary)
+        self.grammar.remove_rule(b, True)
+        self.assertTrue(rule.has_open_vocabulary)
+
+    def test_zero_weights(self):
+        # Alternatives with a weight of 0 are never matched.
+        self.number.expansion.weights = {"one": 1, "two": 0}
+        self.assertEqual(self.number.vocabulary, frozenset(["one"]))
+        self.assertNotIn("two", self.rule.vocabulary)
+        self.number.expansion.set_weight("two", 2)
+        self.assertIn("two", self.rule.vocabulary)
+
+    def test_reference_renamed(self):
+        self.grammar.add_rule(HiddenRule("letter", AlternativeSet("a", "b")))
+        self.assertTrue(self.rule.matches("count to one"))
+
+        # Renaming a reference updates the vocabulary and the rule's matcher.
+        self.rule.expansion.children[1].name = "letter"
+        self.assertEqual(self.rule.vocabulary,
+                         frozenset(["count", "to", "a", "b", "please"]))
+        self.assertTrue(self.rule.matches("count to a"))
+        self.assertFalse(self.rule.matches("count to one"))
+
+    def test_recursive_rule(self):
+        rule = PublicRule("nested", "x")
+        rule.expansion = AlternativeSet("x", Sequence("(", RuleRef(rule), ")"))
+        self.assertEqual(rule.vocabulary, frozenset(["x", "(", ")"]))
+
+    def test_updates(self):
+        vocabulary = self.rule.vocabulary
+        self.assertIs(self.rule.vocabulary, vocabulary)
+
+        # Changes to the rule or to referenced rules update the vocabulary.
+        self.rule.expansion.children[0].text = "count up to"
+        self.assertIn("up", self.rule.vocabulary)
+        self.number.expansion.children.append(Literal("three"))
+        self.assertIn("three", self.rule.vocabulary)
+        self.number.expansion.children.pop(0)
+        self.assertNotIn("one", self.rule.vocabulary)
+        self.rule.expansion.children[1] = Literal("ten")
+        self.assertEqual(self.rule.vocabulary,
+                         frozenset(["count", "up", "to", "ten", "please"]))
+        self.rule.expansion = "stop"
+        self.assertEqual(self.rule.vocabulary, frozenset(["stop"]))
+
+
+class GrammarVocabularyCase(unittest.TestCase):
+    def setUp(self):
+        self.number = HiddenRule("number", AlternativeSet("one", "two"))
+        self.count = PublicRule("count", Sequence("count", RuleRef(self.number)))
+        self.greet = PublicRule("greet", AlternativeSet("hello", "hi"))
+        self.say = PublicRule("say", Sequence("say", Dictation()))
+        self.grammar = Grammar()
+        self.grammar.use_vocabulary_index = True
+        self.grammar.add_rules(self.number, self.count, self.greet)
+
+    def test_vocabulary(self):
+        self.assertEqual(self.grammar.vocabulary,
+                         frozenset(["count", "one", "two", "hello", "hi"]))
+
+        # The vocabulary is updated when rules are added or removed.
+        self.grammar.add_rule(self.say)
+        self.assertIn("say", self.grammar.vocabulary)
+        self.grammar.remove_rule(self.greet)
+        self.assertEqual(self.grammar.vocabulary,
+                         frozenset(["count", "one", "two", "say"]))
+
+    def test_find_matching_rules(self):
+        self.grammar.add_rule(self.say)
+        for backend in (MatchBackend.Pyparsing, MatchBackend.Chart,
+                        MatchBackend.Weighted, MatchBackend.Compiled):
+            self.grammar.matching_backend = backend
+            self.assertEqual(self.grammar.find_matching_rules("count two"),
+                             [self.count])
+            self.assertEqual(self.grammar.find_matching_rules("say count two"),
+                             [self.say])
+            self.assertEqual(self.grammar.find_matching_rules("count three"),
+                             [])
+
+    def test_joined_words(self):
+        # Literals don't need whitespace between them to match.
+        hello = PublicRule("hello", Sequence("hello", "world"))
+        test = PublicRule("test", Sequence("test", Repeat("a")))
+        self.grammar.add_rules(hello, test)
+        for speech in ["helloworld", "test aaa", "testa a"]:
+            self.assertEqual(self.grammar.find_matching_rules(speech),
+                             [r for r in (hello, test) if r.matches(speech)])
+        self.assertEqual(self.grammar.find_matching_rules("helloworld"), [hello])
+        self.assertEqual(self.grammar.find_matching_rules("helloworlds"), [])
+
+    def test_optional_expansion(self):
+        # Rules with optional expansions match any speech with Rule.matches.
+        rule = PublicRule("optional", OptionalGrouping("please"))
+        self.grammar.add_rule(rule)
+        self.assertTrue(rule.matches("count one"))
+        self.assertEqual(self.grammar.find_matching_rules("count one"),
+                         [self.count, rule])
+
+    def test_skipped_rules_are_reset(self):
+        self.assertEqual(self.grammar.find_matching_rules("hello"), [self.greet])
+        self.assertTrue(self.greet.was_matched)
+        self.assertEqual(self.grammar.find_matching_rules("goodbye"), [])
+        self.assertFalse(self.greet.was_matched)
+
+    def test_disable_vocabulary_index(self):
+        # The index is off by default.
+        self.assertFalse(Grammar().use_vocabulary_index)
+        self.grammar.use_vocabulary_index = False
+        self.assertEqual(self.grammar.find_matching_rules("hi"), [self.greet])
+        self.assertEqual(self.grammar.find_matching_rules("hey"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
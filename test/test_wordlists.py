@@ -0,0 +1,242 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jsgf import *
+from jsgf.wordlists import _PHRASES_PER_CHUNK
+
+
+class LexiconCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "names.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_lexicon(self):
+        lexicon = MemoryLexicon(["Bob", "alice  smith", "bob", ""])
+        self.assertEqual(list(lexicon), ["alice smith", "bob"])
+        self.assertEqual(len(lexicon), 2)
+        self.assertEqual(lexicon.max_words, 2)
+        self.assertIn("alice smith", lexicon)
+        self.assertNotIn("alice", lexicon)
+
+    def test_memory_lexicon_updates(self):
+        lexicon = MemoryLexicon()
+        self.assertEqual(lexicon.max_words, 0)
+        lexicon.update(["a", "b c d", "e f"])
+        self.assertEqual(lexicon.max_words, 3)
+        lexicon.discard("B  C d")
+        self.assertEqual(lexicon.max_words, 2)
+        lexicon.discard("missing")
+        self.assertEqual(list(lexicon), ["a", "e f"])
+        lexicon.clear()
+        self.assertEqual(len(lexicon), 0)
+        self.assertEqual(lexicon.max_words, 0)
+
+    def test_write_lexicon(self):
+        write_lexicon(["Bob", "alice  smith", "bob", u"\xe9mile"], self.path)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(),
+                             u"alice smith\nbob\n\xe9mile\n".encode("utf-8"))
+
+    def test_mapped_lexicon(self):
+        phrases = ["name %d" % i for i in range(500)] + ["bob", u"\xe9mile"]
+        write_lexicon(phrases, self.path)
+        lexicon = MappedLexicon(self.path)
+        self.assertEqual(len(lexicon), 502)
+        self.assertEqual(lexicon.max_words, 2)
+        self.assertEqual(list(lexicon), sorted(phrases))
+        for phrase in phrases:
+            self.assertIn(phrase, lexicon)
+        for phrase in ["name", "name 500", "a", "zzz", "", "bo", "bobby"]:
+            self.assertNotIn(phrase, lexicon)
+        lexicon.close()
+
+    def test_mapped_lexicon_empty(self):
+        write_lexicon([], self.path)
+        lexicon = MappedLexicon(self.path)
+        self.assertEqual(len(lexicon), 0)
+        self.assertEqual(list(lexicon), [])
+        self.assertNotIn("bob", lexicon)
+        lexicon.close()
+
+    def test_mapped_lexicon_unsorted(self):
+        for data in (b"bob\nalice\n", b"alice\nalice\n"):
+            with open(self.path, "wb") as f:
+                f.write(data)
+            self.assertRaises(ValueError, MappedLexicon, self.path)
+
+
+class WordListCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "names.txt")
+        write_lexicon(["alice", "alice smith", "bob", "carol"], self.path)
+        self.word_list = WordList(self.path, "name")
+        self.rule = PublicRule("call", Sequence("call", self.word_list,
+                                                OptionalGrouping("now")))
+
+    def tearDown(self):
+        self.word_list.lexicon.close()
+        shutil.rmtree(self.directory)
+
+    def test_invalid_name(self):
+        self.assertRaises(GrammarError, WordList, ["alice"], "a name")
+        self.assertRaises(GrammarError, WordList, ["alice"], "NULL")
+
+    def test_matches(self):
+        self.assertTrue(self.rule.matches("call bob"))
+        self.assertEqual(self.word_list.current_match, "bob")
+        self.assertTrue(self.rule.matches("call alice smith now"))
+        self.assertEqual(self.word_list.current_match, "alice smith")
+        self.assertTrue(self.rule.matches("call alice now"))
+        self.assertEqual(self.word_list.current_match, "alice")
+
+        # Only whole words match.
+        self.assertFalse(self.rule.matches("call bobby"))
+        self.assertFalse(self.rule.matches("call dave"))
+        self.assertFalse(self.rule.matches("call"))
+
+    def test_memory_lexicon_matches(self):
+        rule = PublicRule("lights", Sequence(
+            WordList(["turn on", "turn off"], "action"), "lights"
+        ))
+        self.assertTrue(rule.matches("turn off lights"))
+        self.assertFalse(rule.matches("turn lights"))
+
+    def test_summary(self):
+        self.assertFalse(self.word_list.can_match_empty)
+        self.assertTrue(self.word_list.contains_literal)
+
+    def test_copy(self):
+        copied = self.word_list.copy()
+        self.assertEqual(copied, self.word_list)
+        self.assertIs(copied.lexicon, self.word_list.lexicon)
+        self.assertNotEqual(WordList(["alice"], "name"), self.word_list)
+
+    def test_compile(self):
+        self.assertEqual(self.rule.compile(), "public <call> = call <name> [now];")
+        grammar = Grammar("test")
+        grammar.add_rule(self.rule)
+        self.assertEqual(grammar.compile(),
+                         "#JSGF V1.0;\n"
+                         "grammar test;\n"
+                         "public <call> = call <name> [now];\n"
+                         "<name> = (alice|alice smith|bob|carol);\n")
+
+    def test_compile_empty(self):
+        grammar = Grammar("test")
+        grammar.add_rule(PublicRule("call", WordList([], "name")))
+        self.assertEqual(grammar.compile(),
+                         "#JSGF V1.0;\n"
+                         "grammar test;\n"
+                         "public <call> = <name>;\n"
+                         "<name> = <VOID>;\n")
+
+    def test_compile_root_grammar(self):
+        grammar = RootGrammar([self.rule, PublicRule("stop", "stop")])
+        self.assertEqual(grammar.compile(),
+                         "#JSGF V1.0;\n"
+                         "grammar root;\n"
+                         "public <root> = (<call>|<stop>);\n"
+                         "<call> = call <name> [now];\n"
+                         "<stop> = stop;\n"
+                         "<name> = (alice|alice smith|bob|carol);\n")
+
+    def test_compile_iter(self):
+        words = ["word%04d" % i for i in range(_PHRASES_PER_CHUNK * 2 + 1)]
+        grammar = Grammar("test")
+        grammar.add_rule(PublicRule("word", WordList(words, "word_list")))
+        parts = list(grammar.compile_iter())
+        self.assertEqual(len(parts), 6)
+        self.assertEqual(parts[1], "<word_list> = (")
+        self.assertEqual(parts[-1], ");\n")
+        self.assertEqual("".join(parts[2:-1]), "|".join(words))
+        self.assertEqual("".join(parts), grammar.compile())
+
+    def test_compile_to_file(self):
+        grammar = Grammar("test")
+        grammar.add_rule(self.rule)
+        path = os.path.join(self.directory, "test.jsgf")
+        grammar.compile_to_file(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), grammar.compile())
+
+    def test_name_conflicts(self):
+        grammar = Grammar("test")
+        grammar.add_rules(self.rule, Rule("name", False, "dave"))
+        self.assertRaises(GrammarError, grammar.compile)
+
+        grammar = Grammar("test")
+        grammar.add_rules(self.rule, PublicRule("other", WordList(["dave"], "name")))
+        self.assertRaises(GrammarError, grammar.compile)
+
+        # The same word list can be used more than once.
+        grammar = Grammar("test")
+        grammar.add_rules(self.rule,
+                          PublicRule("other", Sequence("x", self.word_list)))
+        self.assertEqual(grammar.compile().count("<name> ="), 1)
+
+    def test_find_matching_rules(self):
+        grammar = Grammar("test")
+        grammar.add_rules(self.rule, PublicRule("stop", "stop"))
+        self.assertEqual(grammar.find_matching_rules("call carol"), [self.rule])
+
+
+class DynamicSlotCase(unittest.TestCase):
+    def setUp(self):
+        self.slot = DynamicSlot("window", ["firefox", "terminal"])
+        self.rule = PublicRule("focus", Sequence("focus", self.slot))
+
+    def test_updates(self):
+        self.assertTrue(self.rule.matches("focus firefox"))
+        self.slot.add("Text Editor", "mail")
+        self.slot.remove("firefox", "missing")
+        self.assertEqual(self.slot.phrases, ["mail", "terminal", "text editor"])
+        self.assertTrue(self.rule.matches("focus text editor"))
+        self.assertEqual(self.slot.current_match, "text editor")
+        self.assertFalse(self.rule.matches("focus firefox"))
+
+        self.slot.set_phrases(["firefox", "mail"])
+        self.assertEqual(self.slot.phrases, ["firefox", "mail"])
+        self.assertTrue(self.rule.matches("focus firefox"))
+        self.assertFalse(self.rule.matches("focus terminal"))
+
+    def test_updates_keep_matcher_elements(self):
+        referencing = PublicRule("focus_now",
+                                 Sequence(RuleRef(self.rule), "now"))
+        grammar = Grammar("test")
+        grammar.add_rules(self.rule, referencing)
+        self.assertTrue(grammar.find_matching_rules("focus terminal now"))
+        elements = [self.rule.expansion.matcher_element,
+                    referencing.expansion.matcher_element]
+        self.slot.set_phrases(["editor"])
+        self.slot.add("browser")
+        self.slot.remove("editor")
+        self.assertIs(self.rule.expansion.matcher_element, elements[0])
+        self.assertIs(referencing.expansion.matcher_element, elements[1])
+        self.assertEqual(grammar.find_matching_rules("focus browser now"),
+                         [referencing])
+
+    def test_copy(self):
+        copied = self.slot.copy()
+        self.assertIsInstance(copied, DynamicSlot)
+        self.assertEqual(copied, self.slot)
+        self.slot.add("mail")
+        self.assertIn("mail", copied.phrases)
+
+    def test_compile(self):
+        grammar = Grammar("test")
+        grammar.add_rule(self.rule)
+        self.assertIn("<window> = (firefox|terminal);\n", grammar.compile())
+        self.slot.set_phrases(["mail"])
+        self.assertIn("<window> = (mail);\n", grammar.compile())
+        self.slot.set_phrases([])
+        self.assertIn("<window> = <VOID>;\n", grammar.compile())
+
+
+if __name__ == '__main__':
+    unittest.main()